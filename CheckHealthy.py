@@ -3,6 +3,8 @@ from ew_api.curl_infra import CurlInfra
 from ew_api.openai_infra import OpenaiInfra
 from api_key_manager.client import APIKeyManagerClient
 from ew_config.logging_config import setup_optimized_logging, create_error_summary
+from ew_router.quantile_sketch import QuantileSketch
+from ew_router.retry_policy import is_commercial_error, is_timeout_error
 from tqdm import tqdm
 from fastapi import FastAPI, BackgroundTasks, HTTPException
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -28,6 +30,8 @@ logger = setup_optimized_logging(
 app = FastAPI(title="API Health Check Service")
 
 health_data = {}
+# 每个源每个模型探测耗时的分位数草图, 与滑动窗口一起通过/check_healthy下发
+latency_sketches = {}
 
 # 最大储存多少次检查的历史, 先进先出, 后进添加在末尾. 默认储存100条.
 MAX_WINDOW_SIZE = int(os.environ.get("MAX_WINDOW_SIZE", 100))
@@ -37,6 +41,8 @@ API_KEY_MANAGER_URL = os.environ.get("API_KEY_MANAGER_URL", "http://localhost:80
 HEALTH_CHECK_TIMEOUT = int(os.environ.get("HEALTH_CHECK_TIMEOUT", 30))
 # 多模态模型专用超时时间，默认60秒
 HEALTH_CHECK_TIMEOUT_MM = int(os.environ.get("HEALTH_CHECK_TIMEOUT_MM", 60))
+# 每轮健康检查前分位数草图中已有计数的衰减系数, 让草图主要反映近期的探测结果
+SKETCH_PROBE_DECAY = float(os.environ.get("SKETCH_PROBE_DECAY", 0.98))
 
 # 加载测试图片（用于多模态模型测试）
 TEST_IMAGE_BASE64 = None
@@ -59,22 +65,7 @@ def _is_commercial_error(error_message):
     Returns:
         bool: 如果是商业性错误返回True，技术性错误返回False
     """
-    commercial_error_keywords = [
-        "negative balance",
-        "insufficient balance", 
-        "quota exceeded",
-        "insufficient_user_quota",
-        "rate limit",
-        "billing",
-        "payment",
-        "credit",
-        "funds",
-        "pre-payment",
-        "subscription"
-    ]
-    
-    error_lower = error_message.lower()
-    return any(keyword in error_lower for keyword in commercial_error_keywords)
+    return is_commercial_error(error_message)
 
 def _is_timeout_error(error_message):
     """判断是否为超时错误
@@ -85,21 +76,7 @@ def _is_timeout_error(error_message):
     Returns:
         bool: 如果是超时错误返回True
     """
-    timeout_keywords = [
-        "timeout",
-        "timed out",
-        "execution timeout",
-        "connection timeout",
-        "read timeout",
-        "request timeout",
-        "执行超时",
-        "连接超时",
-        "请求超时",
-        "响应超时"
-    ]
-    
-    error_lower = error_message.lower()
-    return any(keyword in error_lower for keyword in timeout_keywords)
+    return is_timeout_error(error_message)
 
 def _get_error_level_and_message(error_message, error_type, source_name=None, model_name=None):
     """根据错误类型确定日志级别和消息
@@ -535,12 +512,16 @@ def update_health_data():
     try:
         new_data = CheckHealthy.run()
         
+        for sketch in latency_sketches.values():
+            sketch.decay(SKETCH_PROBE_DECAY)
         # Update sliding window for each key
         for key, value in new_data.items():
             if key not in health_data:
                 health_data[key] = deque(maxlen=MAX_WINDOW_SIZE)
             
             health_data[key].append(value)
+            if value is not None:
+                latency_sketches.setdefault(key, QuantileSketch()).add(value)
         
         logger.debug(f"[{datetime.now()}] 健康检查完成，更新了 {len(new_data)} 个指标")
     except Exception as e:
@@ -621,7 +602,8 @@ async def get_health_data():
     return {
         "timestamp": datetime.now().isoformat(),
         "check_timer_span": CHECK_TIMER_SPAN,
-        "data": result
+        "data": result,
+        "sketches": {k: sketch.to_dict() for k, sketch in latency_sketches.items() if sketch.count > 0}
     }
 
 # Add a manual trigger endpoint for testing
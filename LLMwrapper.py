@@ -1,8 +1,16 @@
 try:
     # 作为包导入时使用相对导入
-    from .LoadBalancing import LoadBalancing, Harness_localAPI
+    from .LoadBalancing import LoadBalancing, Harness_localAPI, passive_stats, concurrency_limiter, key_rate_limiter, circuit_breakers, key_leases, bandit_arms, shared_state
     from .ew_api.curl_infra import CurlInfra
     from .ew_api.openai_infra import OpenaiInfra
+    from .ew_api.session_pool import get_session, get_async_client
+    from .ew_router.hedging import HedgeBudget, HedgeCancelled, hedge_delay, split_lanes
+    from .ew_router.concurrency import ConcurrencyLimitExceeded
+    from .ew_router.circuit_breaker import CircuitOpenError
+    from .ew_router.context_length import estimate_tokens
+    from .ew_router.affinity import prefix_key
+    from .ew_router.retry_policy import RetryPolicy, INVALID
+    from .ew_decorator.with_timeout import with_deadline, remaining_time, request_timeout, CancelToken, cancel_scope, cancelled
     from .ew_config.source import (
         source_config, 
         source_mapping, 
@@ -18,9 +26,17 @@ try:
     from .ew_config.api_keys import pool_mapping
 except ImportError:
     # 直接运行脚本时使用绝对导入
-    from LoadBalancing import LoadBalancing, Harness_localAPI
+    from LoadBalancing import LoadBalancing, Harness_localAPI, passive_stats, concurrency_limiter, key_rate_limiter, circuit_breakers, key_leases, bandit_arms, shared_state
     from ew_api.curl_infra import CurlInfra
     from ew_api.openai_infra import OpenaiInfra
+    from ew_api.session_pool import get_session, get_async_client
+    from ew_router.hedging import HedgeBudget, HedgeCancelled, hedge_delay, split_lanes
+    from ew_router.concurrency import ConcurrencyLimitExceeded
+    from ew_router.circuit_breaker import CircuitOpenError
+    from ew_router.context_length import estimate_tokens
+    from ew_router.affinity import prefix_key
+    from ew_router.retry_policy import RetryPolicy, INVALID
+    from ew_decorator.with_timeout import with_deadline, remaining_time, request_timeout, CancelToken, cancel_scope, cancelled
     from ew_config.source import (
         source_config, 
         source_mapping, 
@@ -36,6 +52,7 @@ except ImportError:
     from ew_config.api_keys import pool_mapping
 
 import requests
+import asyncio
 import re
 import os
 import hashlib
@@ -45,12 +62,19 @@ import uuid
 import random
 from datetime import datetime
 import base64
+import contextvars
+from collections import namedtuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 MAX_RETRY = int(os.environ.get("MAX_RETRY", 3))
+# 第一轮重试的退避上限(秒), 之后每轮翻倍并加入随机抖动
 SLEEP_TIME = int(os.environ.get("SLEEP_TIME", 5))
 API_KEY_MANAGER_URL = os.environ.get("API_KEY_MANAGER_URL", "http://localhost:8002")
 API_KEY_MANAGER_NOTICE_ENDPOINT = os.environ.get("API_KEY_MANAGER_NOTICE_ENDPOINT", "/notice_apikey")
 API_REQUEST_TIMEOUT = int(os.environ.get("API_REQUEST_TIMEOUT", 5))
+# 同步对冲请求共用的线程池大小, 所有线程都在使用时不再发出对冲请求
+HEDGE_MAX_WORKERS = int(os.environ.get("HEDGE_MAX_WORKERS", 32))
 
 
 # 定义模块导出的公共接口
@@ -58,6 +82,16 @@ __all__ = [
     'LLM_Wrapper'
 ]
 
+# 一次请求尝试: 使用infra以messages请求source_name上的model_name
+Attempt = namedtuple("Attempt", ["label", "infra", "messages", "source_name", "model_name", "api_key"])
+
+# 进程内共享的对冲预算
+hedge_budget = HedgeBudget()
+# 进程内共享的同步对冲线程池, 只执行备用源的对冲请求; 落败的请求会被取消, 线程随即归还
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="llm-hedge")
+# 线程池的空闲线程数, 取不到时不对冲, 而不是让对冲请求排队
+hedge_slots = threading.BoundedSemaphore(HEDGE_MAX_WORKERS)
+
 
 def remove_thinking(text):
     """
@@ -75,7 +109,65 @@ def remove_thinking(text):
     
     return re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
 
+
+class ThinkingStreamFilter:
+    """
+    Streaming counterpart of remove_thinking.
+
+    Tags may be split across several tokens, so a possible tag prefix at the
+    end of the buffer is held back until the next token arrives.
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self.buffer = ""
+        self.in_thinking = False
+
+    @staticmethod
+    def _partial_tag_length(text, tag):
+        """Length of the longest suffix of text that is a prefix of tag."""
+        for size in range(min(len(text), len(tag) - 1), 0, -1):
+            if text.endswith(tag[:size]):
+                return size
+        return 0
+
+    def feed(self, token):
+        """Consume a token and return the visible text that can be emitted now."""
+        self.buffer += token
+        output = []
+        while self.buffer:
+            if self.in_thinking:
+                end = self.buffer.find(self.CLOSE_TAG)
+                if end < 0:
+                    keep = self._partial_tag_length(self.buffer, self.CLOSE_TAG)
+                    self.buffer = self.buffer[len(self.buffer) - keep:]
+                    break
+                self.buffer = self.buffer[end + len(self.CLOSE_TAG):]
+                self.in_thinking = False
+            else:
+                start = self.buffer.find(self.OPEN_TAG)
+                if start < 0:
+                    keep = self._partial_tag_length(self.buffer, self.OPEN_TAG)
+                    output.append(self.buffer[:len(self.buffer) - keep])
+                    self.buffer = self.buffer[len(self.buffer) - keep:]
+                    break
+                output.append(self.buffer[:start])
+                self.buffer = self.buffer[start + len(self.OPEN_TAG):]
+                self.in_thinking = True
+        return "".join(output)
+
+    def flush(self):
+        """Return whatever visible text is still buffered at the end of the stream."""
+        output = "" if self.in_thinking else self.buffer
+        self.buffer = ""
+        return output
+
 class LLM_Wrapper:
+    # 按错误类型决定换源和重试的策略, 可以替换为RetryPolicy的子类
+    retry_policy = RetryPolicy(base=SLEEP_TIME)
+
     @staticmethod
     def _download_image_to_base64(img_url: str, timeout: int = 10) -> str:
         """
@@ -83,7 +175,7 @@ class LLM_Wrapper:
         
         Args:
             img_url (str): The URL of the image to download
-            timeout (int): Request timeout in seconds
+            timeout (int): Request timeout in seconds, capped by the remaining time of the call's deadline
             
         Returns:
             str: Base64 encoded image data
@@ -96,7 +188,7 @@ class LLM_Wrapper:
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
             
-            response = requests.get(img_url, timeout=timeout, headers=headers)
+            response = requests.get(img_url, timeout=request_timeout(timeout), headers=headers)
             response.raise_for_status()
             
             # Convert to base64
@@ -106,6 +198,73 @@ class LLM_Wrapper:
         except Exception as e:
             raise Exception(f"Failed to download and convert image from {img_url}: {str(e)}")
 
+    @staticmethod
+    async def _adownload_image_to_base64(img_url: str, timeout: int = 10) -> str:
+        """Coroutine version of _download_image_to_base64."""
+        try:
+            headers = {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+            }
+
+            response = await get_async_client(img_url).get(
+                img_url, timeout=request_timeout(timeout), headers=headers, follow_redirects=True
+            )
+            response.raise_for_status()
+            return base64.b64encode(response.content).decode('utf-8')
+
+        except Exception as e:
+            raise Exception(f"Failed to download and convert image from {img_url}: {str(e)}")
+
+    @staticmethod
+    def _build_usage_data(
+        api_key: str,
+        model_name: str,
+        source_name: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        create_time: datetime,
+        finish_time: datetime,
+        execution_time: float,
+        status: bool,
+        request_id: str,
+        remark: str = "",
+        time_to_first_token: float = None,
+    ) -> dict:
+        """Build the usage payload expected by the API key manager."""
+        usage_data = {
+            "request_id": request_id,
+            "api_key": api_key,
+            "model_name": model_name,
+            "source_name": source_name,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "create_time": create_time.isoformat(),
+            "finish_time": finish_time.isoformat(),
+            "execution_time": execution_time,
+            "status": status,
+            "remark": remark,
+        }
+        # 只有流式请求才有首token时间
+        if time_to_first_token is not None:
+            usage_data["time_to_first_token"] = time_to_first_token
+        return usage_data
+
+    @staticmethod
+    def _charge_rate_limit(usage):
+        """Charge the tokens of a finished request against the key's local TPM bucket."""
+        key_rate_limiter.charge_tokens(
+            usage.get("source_name"), usage.get("api_key"),
+            (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+        )
+
+    @staticmethod
+    def _attach_lease_picks(usage):
+        """Attach the leased-key picks not yet reported, returning them so a failed send can put them back."""
+        lease_picks = key_leases.drain_picks()
+        if lease_picks:
+            usage["lease_picks"] = lease_picks
+        return lease_picks
+
     @staticmethod
     def _send_api_key_usage(
         api_key: str,
@@ -119,40 +278,127 @@ class LLM_Wrapper:
         status: bool,
         request_id: str,
         remark: str = "",
+        time_to_first_token: float = None,
     ) -> bool:
         """Send API key usage information to the API key manager."""
+        usage_data = LLM_Wrapper._build_usage_data(
+            api_key, model_name, source_name, prompt_tokens, completion_tokens, create_time, finish_time,
+            execution_time, status, request_id, remark, time_to_first_token
+        )
+        LLM_Wrapper._charge_rate_limit(usage_data)
+        lease_picks = LLM_Wrapper._attach_lease_picks(usage_data)
         try:
-            usage_data = {
-                "request_id": request_id,
-                "api_key": api_key,
-                "model_name": model_name,
-                "source_name": source_name,
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "create_time": create_time.isoformat(),
-                "finish_time": finish_time.isoformat(),
-                "execution_time": execution_time,
-                "status": status,
-                "remark": remark,
-            }
-
-            response = requests.post(
-                f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_NOTICE_ENDPOINT}", 
+            url = f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_NOTICE_ENDPOINT}"
+            response = get_session(url).post(
+                url,
                 json=usage_data,
                 timeout=API_REQUEST_TIMEOUT
             )
-            return response.status_code == 201
+            if response.status_code != 201:
+                key_leases.restore_picks(lease_picks)
+                return False
+            # The key manager piggybacks its revocation epoch so leased keys are dropped promptly
+            Harness_localAPI.refresh_revocations(response.json().get("revocation_epoch"))
+            return True
         except Exception as e:
+            key_leases.restore_picks(lease_picks)
             # Simplify error message to reduce console noise
             print(f"Failed to send API key usage: {str(e).split('(Caused by')[0]}")
             return False
 
+    @staticmethod
+    async def _asend_api_key_usage(
+        api_key: str,
+        model_name: str,
+        source_name: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+        create_time: datetime,
+        finish_time: datetime,
+        execution_time: float,
+        status: bool,
+        request_id: str,
+        remark: str = "",
+        time_to_first_token: float = None,
+    ) -> bool:
+        """Coroutine version of _send_api_key_usage."""
+        usage_data = LLM_Wrapper._build_usage_data(
+            api_key, model_name, source_name, prompt_tokens, completion_tokens, create_time, finish_time,
+            execution_time, status, request_id, remark, time_to_first_token
+        )
+        LLM_Wrapper._charge_rate_limit(usage_data)
+        lease_picks = LLM_Wrapper._attach_lease_picks(usage_data)
+        try:
+            url = f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_NOTICE_ENDPOINT}"
+            response = await get_async_client(url).post(
+                url,
+                json=usage_data,
+                timeout=API_REQUEST_TIMEOUT
+            )
+            if response.status_code != 201:
+                key_leases.restore_picks(lease_picks)
+                return False
+            await Harness_localAPI.arefresh_revocations(response.json().get("revocation_epoch"))
+            return True
+        except Exception as e:
+            key_leases.restore_picks(lease_picks)
+            print(f"Failed to send API key usage: {str(e).split('(Caused by')[0]}")
+            return False
+
     @staticmethod
     def _generate_request_id(content: str, finish_time: datetime) -> str:
         """Generate a unique request ID based on content and finish time."""
         input_string = f"{content}{finish_time.isoformat()}"
         return hashlib.md5(input_string.encode("utf-8")).hexdigest()
 
+    @staticmethod
+    def _generate_function_call_request_id(response_content: dict, finish_time: datetime) -> str:
+        """Generate a request ID for a function calling response, serializing tool calls safely."""
+        # 创建可序列化的响应内容用于生成request_id
+        serializable_content = {}
+        if "content" in response_content:
+            serializable_content["content"] = response_content["content"]
+
+        # 对工具调用进行特殊处理, 避免序列化错误
+        if "tool_calls" in response_content:
+            serializable_tool_calls = []
+            for tool_call in response_content["tool_calls"]:
+                if hasattr(tool_call, "to_dict"):  # 如果是对象而不是dict
+                    serializable_tool_calls.append(tool_call.to_dict())
+                elif isinstance(tool_call, dict):  # 如果已经是dict
+                    serializable_tool_calls.append(tool_call)
+                else:  # 如果是其他类型的对象
+                    serializable_tool_calls.append(
+                        {
+                            "id": getattr(tool_call, "id", str(uuid.uuid4())),
+                            "type": getattr(tool_call, "type", "function"),
+                            "function": {
+                                "name": getattr(
+                                    getattr(tool_call, "function", {}),
+                                    "name",
+                                    "unknown",
+                                ),
+                                "arguments": getattr(
+                                    getattr(tool_call, "function", {}),
+                                    "arguments",
+                                    "{}",
+                                ),
+                            },
+                        }
+                    )
+            serializable_content["tool_calls"] = serializable_tool_calls
+
+        # 生成请求ID (使用可序列化的内容)
+        try:
+            return LLM_Wrapper._generate_request_id(
+                json.dumps(serializable_content), finish_time
+            )
+        except Exception as e:
+            print(f"Error generating request_id: {str(e)}")
+            return LLM_Wrapper._generate_request_id(
+                f"function_call_{finish_time.isoformat()}", finish_time
+            )
+
     @staticmethod
     def _verify_model_mapping(
         main_source_name,
@@ -310,6 +556,670 @@ class LLM_Wrapper:
             return nested_format, direct_format
 
     @staticmethod
+    def _build_mm_messages(prompt, image_url):
+        """构建包含一段文本和一张图像的多模态消息
+        
+        Args:
+            prompt (str): 文本提示
+            image_url: 图像URL, 字符串格式或{"url": ...}对象格式
+            
+        Returns:
+            list: 多模态消息列表
+        """
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": prompt},
+                    {
+                        "type": "image_url",
+                        "image_url": image_url,
+                    },
+                ],
+            }
+        ]
+
+    @staticmethod
+    def _build_infra(source_name, api_key):
+        """为单个源构建调用基础设施, 优先使用openai-api-sdk的连接方式"""
+        source_config_item = source_config[source_name]
+        if "openai" in source_config_item:
+            return OpenaiInfra(source_config_item["openai"], api_key)
+        return CurlInfra(source_config_item["curl"], api_key)
+
+    @staticmethod
+    def _build_infras(main_source_name, main_api_key, backup_source_name, backup_api_key):
+        """为主源和备用源构建调用基础设施
+        
+        主源优先使用openai-api-sdk的连接方式, 备用源优先使用网络请求curl的连接方式,
+        使两次尝试尽量走不同的链路.
+        
+        Returns:
+            tuple: (main_infra, backup_infra)
+        """
+        main_source_config = source_config[main_source_name]
+        backup_source_config = source_config[backup_source_name]
+
+        # 优先为主模型使用openai-api-sdk的连接方式
+        if "openai" in main_source_config:
+            main_infra = OpenaiInfra(main_source_config["openai"], main_api_key)
+        else:
+            main_infra = CurlInfra(main_source_config["curl"], main_api_key)
+
+        # 优先为备用模型使用网络请求curl的连接方式
+        if "curl" in backup_source_config:
+            backup_infra = CurlInfra(backup_source_config["curl"], backup_api_key)
+        else:
+            backup_infra = OpenaiInfra(
+                backup_source_config["openai"], backup_api_key
+            )
+
+        return main_infra, backup_infra
+
+    @staticmethod
+    def _build_additional_params(max_tokens):
+        """只有当max_tokens不为None时才添加到additional_params"""
+        additional_params = {}
+        if max_tokens is not None:
+            additional_params["max_tokens"] = max_tokens
+        return additional_params
+
+    @staticmethod
+    def _build_text_attempts(config, messages):
+        """根据get_config的结果构建主源->备用源的尝试序列"""
+        (
+            main_source_name,
+            main_source_model_name,
+            main_api_key,
+            backup_source_name,
+            backup_source_model_name,
+            backup_api_key,
+        ) = config
+        main_infra, backup_infra = LLM_Wrapper._build_infras(
+            main_source_name, main_api_key, backup_source_name, backup_api_key
+        )
+        return [
+            Attempt("Main", main_infra, messages, main_source_name, main_source_model_name, main_api_key),
+            Attempt("Backup", backup_infra, messages, backup_source_name, backup_source_model_name, backup_api_key),
+        ]
+
+    @staticmethod
+    def _needs_image_download(config, img_url, img_base64):
+        """Google API要求图像为base64而不是URL, 主源或备用源为Google且只有URL时需要预先下载"""
+        main_source_name, backup_source_name = config[0], config[3]
+        return bool(img_url and not img_base64 and
+                    (main_source_name == "google" or backup_source_name == "google"))
+
+    @staticmethod
+    def _build_mm_attempts(config, prompt, img_base64, img_url, downloaded_img_base64):
+        """根据get_config的结果构建多模态的尝试序列
+
+        顺序为: 主源主格式 -> 主源备用格式 -> 备用源主格式 -> 备用源备用格式.
+        图像URL的两种格式(字符串/对象)的先后顺序取决于各自的源.
+        """
+        (
+            main_source_name,
+            main_source_model_name,
+            main_api_key,
+            backup_source_name,
+            backup_source_model_name,
+            backup_api_key,
+        ) = config
+        main_infra, backup_infra = LLM_Wrapper._build_infras(
+            main_source_name, main_api_key, backup_source_name, backup_api_key
+        )
+
+        attempts = []
+        for label, infra, source_name, source_model_name, api_key in (
+            ("Main", main_infra, main_source_name, main_source_model_name, main_api_key),
+            ("Backup", backup_infra, backup_source_name, backup_source_model_name, backup_api_key),
+        ):
+            # Google源使用预先下载的base64图像
+            if source_name == "google" and img_url and not img_base64:
+                final_img_base64 = downloaded_img_base64
+                final_img_url = None if downloaded_img_base64 else img_url
+            else:
+                final_img_base64 = img_base64
+                final_img_url = img_url
+
+            # 获取两种图像URL格式
+            primary_image_url, fallback_image_url = LLM_Wrapper._build_image_url_with_fallback(
+                final_img_url, final_img_base64, source_name
+            )
+            attempts.append(Attempt(f"{label} primary", infra, LLM_Wrapper._build_mm_messages(prompt, primary_image_url),
+                                    source_name, source_model_name, api_key))
+            attempts.append(Attempt(f"{label} fallback", infra, LLM_Wrapper._build_mm_messages(prompt, fallback_image_url),
+                                    source_name, source_model_name, api_key))
+        return attempts
+
+    @staticmethod
+    def _check_content_not_empty(response):
+        """检查响应完整性，避免隐性超时"""
+        if not (response and "content" in response and response["content"]):
+            # 响应为空或不完整，视为隐性超时
+            raise Exception("Empty or incomplete response - possible timeout")
+
+    @staticmethod
+    def _format_attempt_errors(errors):
+        return ", ".join(f"{label} error: {str(e)}" for label, e in errors)
+
+    @staticmethod
+    def _request_completion(attempt, tools, timeout, additional_params):
+        return attempt.infra.get_response(
+            attempt.messages, tools, attempt.model_name, timeout=timeout, additional_params=additional_params
+        )
+
+    @staticmethod
+    async def _arequest_completion(attempt, tools, timeout, additional_params):
+        return await attempt.infra.aget_response(
+            attempt.messages, tools, attempt.model_name, timeout=timeout, additional_params=additional_params
+        )
+
+    @staticmethod
+    def _record_passive_stats(attempt, start, success):
+        """把单次尝试的耗时和成败记入进程内的被动统计和adaptive模式的后验, 供LoadBalancing调整路由"""
+        latency = time.monotonic() - start
+        passive_stats.record(attempt.source_name, attempt.model_name, latency, success)
+        bandit_arms.record(attempt.source_name, attempt.model_name, latency, success)
+
+    @staticmethod
+    def _deadline_exceeded():
+        """请求级截止时间是否已过或调用链已被取消(对冲中落败), 没有截止时间时返回False"""
+        if cancelled():
+            return True
+        remaining = remaining_time()
+        return remaining is not None and remaining <= 0
+
+    @staticmethod
+    def _retry_delay(round_errors, curr_retry, attempts=None, dropped=()):
+        """下一轮重试前的等待时间
+
+        本轮的错误都不值得重试、所有源都已放弃、重试预算用尽, 或等待后已经没有剩余时间时返回None.
+        """
+        if attempts is not None and all(attempt.source_name in dropped for attempt in attempts):
+            return None
+        return LLM_Wrapper.retry_policy.retry_delay([e for _, e in round_errors], curr_retry, remaining_time())
+
+    @staticmethod
+    def _note_failure(attempt, error, skipped, dropped):
+        """按错误类型决定是否跳过该源在本轮中剩余的尝试, 以及是否在后续重试中放弃该源"""
+        policy = LLM_Wrapper.retry_policy
+        error_class = policy.classify(error)
+        if policy.switch_source(error_class):
+            skipped.add(attempt.source_name)
+        if policy.drop_source(error_class):
+            dropped.add(attempt.source_name)
+
+    @staticmethod
+    def _deadline_error():
+        return ("Deadline", TimeoutError("Request deadline exceeded"))
+
+    @staticmethod
+    def _acquire_in_order(attempts, skipped=()):
+        """按优先级为尝试分配并发许可
+
+        达到并发上限的源先跳过, 请求转给排名靠后的源; 其余候选都尝试过后再排队等待.
+        排队超时时许可为None. 请求的优先级类别和截止时间由concurrency_limiter从当前上下文中读取,
+        因此batch请求在主源只剩保留给interactive的空位时同样会转给排名靠后的源.
+        请求级截止时间已过时不再分配, 剩余的尝试不会发出. 源在skipped中(迭代期间可以加入)的尝试不分配许可.
+        """
+        deferred = []
+        for attempt in attempts:
+            if LLM_Wrapper._deadline_exceeded():
+                return
+            if attempt.source_name in skipped:
+                continue
+            permit = concurrency_limiter.try_acquire(attempt.source_name, attempt.model_name)
+            if permit is None:
+                deferred.append(attempt)
+                continue
+            yield attempt, permit
+        for attempt in deferred:
+            if LLM_Wrapper._deadline_exceeded():
+                return
+            if attempt.source_name in skipped:
+                continue
+            yield attempt, concurrency_limiter.acquire(attempt.source_name, attempt.model_name)
+
+    @staticmethod
+    async def _aacquire_in_order(attempts, skipped=()):
+        """_acquire_in_order的协程版本, 排队时不阻塞事件循环"""
+        deferred = []
+        for attempt in attempts:
+            if LLM_Wrapper._deadline_exceeded():
+                return
+            if attempt.source_name in skipped:
+                continue
+            permit = concurrency_limiter.try_acquire(attempt.source_name, attempt.model_name)
+            if permit is None:
+                deferred.append(attempt)
+                continue
+            yield attempt, permit
+        for attempt in deferred:
+            if LLM_Wrapper._deadline_exceeded():
+                return
+            if attempt.source_name in skipped:
+                continue
+            yield attempt, await concurrency_limiter.aacquire(attempt.source_name, attempt.model_name)
+
+    @staticmethod
+    def _failure_outcome(error):
+        """失败的尝试记入熔断器、并发上限、被动统计和adaptive后验的结果
+
+        请求本身无效(400、上下文超长等)是调用方的问题, 与源的健康无关, 记为None(不计入), 其余记为失败.
+        对冲中落败而被取消的请求同样记为None.
+        """
+        if cancelled():
+            return None
+        return None if LLM_Wrapper.retry_policy.classify(error) == INVALID else False
+
+    @staticmethod
+    def _attempt_once(attempt, permit, request, tools, timeout, additional_params, validate, hold_permit=False):
+        """执行单次尝试, 熔断中的(源, 模型)直接失败; 结束后更新熔断器和被动统计并归还并发许可
+
+        失败按retry_policy的错误类型计入健康信号, 请求本身无效的失败不计入.
+        hold_permit为True时成功的尝试不归还并发许可, 而是随响应交给调用方, 由调用方在响应用完后归还.
+
+        Returns:
+            tuple: (response, error), 成功时error为None; hold_permit为True时成功的response为(response, permit)
+        """
+        if not circuit_breakers.try_acquire(attempt.source_name, attempt.model_name):
+            concurrency_limiter.release(permit)
+            return None, CircuitOpenError(f"Circuit of {attempt.source_name}/{attempt.model_name} is open")
+        start = time.monotonic()
+        success = None
+        try:
+            response = request(attempt, tools, timeout, additional_params)
+            if validate is not None:
+                validate(response)
+            success = True
+            return ((response, permit) if hold_permit else response), None
+        except Exception as e:
+            success = LLM_Wrapper._failure_outcome(e)
+            return None, e
+        finally:
+            # success为None表示请求被取消或请求本身无效, 不作为熔断、并发上限和路由统计的依据
+            if hold_permit and success:
+                concurrency_limiter.record(permit, success)
+            else:
+                concurrency_limiter.release(permit, success)
+            circuit_breakers.record(attempt.source_name, attempt.model_name, success)
+            if success is not None:
+                LLM_Wrapper._record_passive_stats(attempt, start, success)
+
+    @staticmethod
+    async def _aattempt_once(attempt, permit, request, tools, timeout, additional_params, validate, hold_permit=False):
+        """_attempt_once的协程版本"""
+        if not circuit_breakers.try_acquire(attempt.source_name, attempt.model_name):
+            concurrency_limiter.release(permit)
+            return None, CircuitOpenError(f"Circuit of {attempt.source_name}/{attempt.model_name} is open")
+        start = time.monotonic()
+        success = None
+        try:
+            response = await request(attempt, tools, timeout, additional_params)
+            if validate is not None:
+                validate(response)
+            success = True
+            return ((response, permit) if hold_permit else response), None
+        except Exception as e:
+            success = LLM_Wrapper._failure_outcome(e)
+            return None, e
+        finally:
+            if hold_permit and success:
+                concurrency_limiter.record(permit, success)
+            else:
+                concurrency_limiter.release(permit, success)
+            circuit_breakers.record(attempt.source_name, attempt.model_name, success)
+            if success is not None:
+                LLM_Wrapper._record_passive_stats(attempt, start, success)
+
+    @staticmethod
+    def get_router_metrics():
+        """返回进程内路由组件的运行指标, 便于接入监控
+
+        Returns:
+            dict: {"concurrency": {"source" 或 "source|model": {"limit": 当前并发上限, "in_flight": 在途请求数}},
+                   "rate_limits": {"source|密钥前缀": {"rpm": 剩余请求数, "tpm": 剩余token数}},
+                   "circuit_breakers": {"source|model": {"state": "open"或"half_open", "open_for": 剩余冷却秒数}},
+                   "key_leases": {"source": {"keys": 租用的密钥数, "expires_in": 租约剩余秒数}},
+                   "queued": {"interactive"或"batch": 排队等待并发许可的请求数},
+                   "shared_state": {"path": 共享文件路径, "health_bytes": 健康检查数据大小, "health_age": 健康检查数据写入距今秒数,
+                                    "stat_slots": 已使用的被动统计槽位数}, 未配置共享文件时为None}
+        """
+        return {
+            "concurrency": concurrency_limiter.metrics(),
+            "rate_limits": key_rate_limiter.metrics(),
+            "circuit_breakers": circuit_breakers.metrics(),
+            "key_leases": key_leases.metrics(),
+            "queued": concurrency_limiter.queued(),
+            "shared_state": shared_state.metrics() if shared_state is not None else None,
+        }
+
+    @staticmethod
+    def _run_with_failover(attempts, tools, timeout, additional_params, validate=None, max_retry=None, request=None,
+                           hedge=False, hold_permit=False):
+        """按顺序执行尝试序列, 全部失败时由retry_policy按错误类型决定是否退避后重试, 最多max_retry轮
+
+        Args:
+            attempts (list): Attempt列表, 按优先级排列
+            tools (list): 工具定义列表
+            timeout (int): 每次尝试的超时时间（秒）, 不超过请求级截止时间的剩余时间
+            additional_params (dict): 额外的请求参数
+            validate (callable, optional): 对响应的额外校验, 校验失败时抛出异常
+            max_retry (int, optional): 最多重试轮数, 默认MAX_RETRY
+            request (callable, optional): 执行单次尝试的函数, 默认请求完整的响应
+            hedge (bool): 主源超过对冲阈值仍未返回时, 是否并行请求备用源
+            hold_permit (bool): 成功的尝试是否保留并发许可, 为True时response为(response, permit),
+                调用方须在响应用完后通过concurrency_limiter.release归还; 不与hedge同时使用
+
+        Returns:
+            tuple: (response, attempt, errors), 全部失败时response和attempt为None
+        """
+        max_retry = MAX_RETRY if max_retry is None else max_retry
+        request = request or LLM_Wrapper._request_completion
+        if hedge and len(split_lanes(attempts)) > 1:
+            return LLM_Wrapper._run_hedged(attempts, tools, timeout, additional_params, validate, max_retry, request)
+        if max_retry > 1:
+            LLM_Wrapper.retry_policy.deposit()
+        errors = []
+        # 账户类错误的源在本次调用的后续重试中不再使用
+        dropped = set()
+        for curr_retry in range(1, max_retry + 1):
+            round_errors = []
+            # 供应商侧故障的源跳过其在本轮中剩余的尝试
+            skipped = set(dropped)
+            for attempt, permit in LLM_Wrapper._acquire_in_order(attempts, skipped):
+                if permit is None:
+                    error = ConcurrencyLimitExceeded(
+                        f"Concurrency limit of {attempt.source_name}/{attempt.model_name} reached"
+                    )
+                else:
+                    response, error = LLM_Wrapper._attempt_once(
+                        attempt, permit, request, tools, timeout, additional_params, validate, hold_permit
+                    )
+                    if error is None:
+                        return response, attempt, errors
+                round_errors.append((attempt.label, error))
+                LLM_Wrapper._note_failure(attempt, error, skipped, dropped)
+            if LLM_Wrapper._deadline_exceeded():
+                round_errors.append(LLM_Wrapper._deadline_error())
+            errors.extend(round_errors)
+            if max_retry > 1:
+                print(f"Retry {curr_retry}/{max_retry}. {LLM_Wrapper._format_attempt_errors(round_errors)}")
+            if curr_retry < max_retry:
+                delay = LLM_Wrapper._retry_delay(round_errors, curr_retry, attempts, dropped)
+                if delay is None:
+                    break
+                time.sleep(delay)
+        return None, None, errors
+
+    @staticmethod
+    async def _arun_with_failover(attempts, tools, timeout, additional_params, validate=None, max_retry=None,
+                                  request=None, hedge=False, hold_permit=False):
+        """_run_with_failover的协程版本, request须为协程函数"""
+        max_retry = MAX_RETRY if max_retry is None else max_retry
+        request = request or LLM_Wrapper._arequest_completion
+        if hedge and len(split_lanes(attempts)) > 1:
+            return await LLM_Wrapper._arun_hedged(attempts, tools, timeout, additional_params, validate, max_retry, request)
+        if max_retry > 1:
+            LLM_Wrapper.retry_policy.deposit()
+        errors = []
+        # 账户类错误的源在本次调用的后续重试中不再使用
+        dropped = set()
+        for curr_retry in range(1, max_retry + 1):
+            round_errors = []
+            # 供应商侧故障的源跳过其在本轮中剩余的尝试
+            skipped = set(dropped)
+            async for attempt, permit in LLM_Wrapper._aacquire_in_order(attempts, skipped):
+                if permit is None:
+                    error = ConcurrencyLimitExceeded(
+                        f"Concurrency limit of {attempt.source_name}/{attempt.model_name} reached"
+                    )
+                else:
+                    response, error = await LLM_Wrapper._aattempt_once(
+                        attempt, permit, request, tools, timeout, additional_params, validate, hold_permit
+                    )
+                    if error is None:
+                        return response, attempt, errors
+                round_errors.append((attempt.label, error))
+                LLM_Wrapper._note_failure(attempt, error, skipped, dropped)
+            if LLM_Wrapper._deadline_exceeded():
+                round_errors.append(LLM_Wrapper._deadline_error())
+            errors.extend(round_errors)
+            if max_retry > 1:
+                print(f"Retry {curr_retry}/{max_retry}. {LLM_Wrapper._format_attempt_errors(round_errors)}")
+            if curr_retry < max_retry:
+                delay = LLM_Wrapper._retry_delay(round_errors, curr_retry, attempts, dropped)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+        return None, None, errors
+
+    @staticmethod
+    def _hedge_delay(lane):
+        """主源该模型近期耗时的p90, 作为发出对冲请求的阈值"""
+        return hedge_delay(passive_stats.get(lane[0].source_name, lane[0].model_name))
+
+    @staticmethod
+    def _run_hedged(attempts, tools, timeout, additional_params, validate, max_retry, request):
+        """带对冲的故障转移: 主源超过阈值仍未返回且预算允许时, 并行请求备用源, 先成功者胜出
+
+        主源在阈值内失败时按普通故障转移继续尝试备用源, 不消耗对冲预算. 每次调用只为对冲预算存入一次令牌.
+        主源在调用方的线程中执行, 阈值从主源开始执行时计算; 只有对冲请求使用共享的线程池, 线程池已满时不对冲.
+        两条线路各自关联一个CancelToken; 分出胜负后取消落败的线路,
+        传输层通过call_at_deadline登记的回调立即断开其连接, 取消不计入源的健康信号.
+        落败的尝试以HedgeCancelled记录在errors中.
+        """
+        main, backup = LLM_Wrapper._split_main_and_backup(attempts)
+        delay = LLM_Wrapper._hedge_delay(main)
+
+        def run_lane(lane, token=None):
+            with cancel_scope(token):
+                return LLM_Wrapper._run_with_failover(
+                    lane, tools, timeout, additional_params, validate, max_retry=1, request=request
+                )
+
+        def hedge(main_done, started, lock, main_token, backup_token):
+            """等到对冲阈值, 主源仍未返回且预算允许时请求备用源, 成功时取消主源; 没有发出对冲请求时返回None"""
+            try:
+                if main_done.wait(delay):
+                    return None
+                with lock:
+                    if main_done.is_set() or not hedge_budget.try_acquire():
+                        return None
+                    started.set()
+                result = run_lane(backup, backup_token)
+                if result[0] is not None:
+                    main_token.cancel()
+                return result
+            finally:
+                hedge_slots.release()
+
+        if max_retry > 1:
+            LLM_Wrapper.retry_policy.deposit()
+        hedge_budget.deposit()
+        errors = []
+        for curr_retry in range(1, max_retry + 1):
+            main_done, started, lock = threading.Event(), threading.Event(), threading.Lock()
+            main_token, backup_token = CancelToken(), CancelToken()
+            future = None
+            if hedge_slots.acquire(blocking=False):
+                # 使用独立的上下文副本, 以继承with_timeout的截止时间
+                future = hedge_executor.submit(
+                    contextvars.copy_context().run, hedge, main_done, started, lock, main_token, backup_token
+                )
+            round_errors = []
+            try:
+                response, attempt, lane_errors = run_lane(main, main_token)
+                with lock:
+                    main_done.set()
+                if response is not None:
+                    errors.extend(lane_errors)
+                    if started.is_set():
+                        errors.append((backup[0].label, HedgeCancelled(backup[0])))
+                    return response, attempt, errors
+                if main_token.cancelled:
+                    # 备用源先成功, 主源的连接是被对冲取消的
+                    lane_errors = [(main[0].label, HedgeCancelled(main[0]))]
+                round_errors.extend(lane_errors)
+                if started.is_set():
+                    response, attempt, lane_errors = future.result()
+                else:
+                    # 主源在阈值内失败, 按普通故障转移尝试备用源
+                    response, attempt, lane_errors = run_lane(backup)
+                round_errors.extend(lane_errors)
+                if response is not None:
+                    errors.extend(round_errors)
+                    return response, attempt, errors
+            finally:
+                # 主源抛出异常时停止对冲, 仍在执行的备用源被取消
+                main_done.set()
+                backup_token.cancel()
+            errors.extend(round_errors)
+            if max_retry > 1:
+                print(f"Retry {curr_retry}/{max_retry}. {LLM_Wrapper._format_attempt_errors(round_errors)}")
+            if curr_retry < max_retry:
+                # delay是对冲阈值, 重试前的退避另用变量保存
+                backoff = LLM_Wrapper._retry_delay(round_errors, curr_retry)
+                if backoff is None:
+                    break
+                time.sleep(backoff)
+        return None, None, errors
+
+    @staticmethod
+    async def _arun_hedged(attempts, tools, timeout, additional_params, validate, max_retry, request):
+        """_run_hedged的协程版本, 落败的请求所在的任务会被取消"""
+        main, backup = LLM_Wrapper._split_main_and_backup(attempts)
+        delay = LLM_Wrapper._hedge_delay(main)
+        run_lane = lambda lane: LLM_Wrapper._arun_with_failover(
+            lane, tools, timeout, additional_params, validate, max_retry=1, request=request
+        )
+        if max_retry > 1:
+            LLM_Wrapper.retry_policy.deposit()
+        hedge_budget.deposit()
+        errors = []
+        for curr_retry in range(1, max_retry + 1):
+            lanes = {asyncio.ensure_future(run_lane(main)): main}
+            try:
+                done, _ = await asyncio.wait(lanes, timeout=delay)
+                if not done and hedge_budget.try_acquire():
+                    lanes[asyncio.ensure_future(run_lane(backup))] = backup
+                pending = set(lanes)
+                round_errors = []
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        response, attempt, lane_errors = task.result()
+                        round_errors.extend(lane_errors)
+                        if response is not None:
+                            errors.extend(round_errors)
+                            errors.extend((lanes[t][0].label, HedgeCancelled(lanes[t][0])) for t in pending)
+                            return response, attempt, errors
+                    if not pending and len(lanes) == 1:
+                        response, attempt, lane_errors = await run_lane(backup)
+                        round_errors.extend(lane_errors)
+                        if response is not None:
+                            errors.extend(round_errors)
+                            return response, attempt, errors
+            finally:
+                for task in lanes:
+                    task.cancel()
+            errors.extend(round_errors)
+            if max_retry > 1:
+                print(f"Retry {curr_retry}/{max_retry}. {LLM_Wrapper._format_attempt_errors(round_errors)}")
+            if curr_retry < max_retry:
+                # delay是对冲阈值, 重试前的退避另用变量保存
+                backoff = LLM_Wrapper._retry_delay(round_errors, curr_retry)
+                if backoff is None:
+                    break
+                await asyncio.sleep(backoff)
+        return None, None, errors
+
+    @staticmethod
+    def _split_main_and_backup(attempts):
+        """对冲时把尝试序列分为主源的尝试和其余尝试"""
+        lanes = split_lanes(attempts)
+        return lanes[0], [attempt for lane in lanes[1:] for attempt in lane]
+
+    @staticmethod
+    def _hedge_usage_records(errors, create_time, remark):
+        """对冲中落败的尝试的使用记录, 状态为失败, 不计token"""
+        return [
+            LLM_Wrapper._build_usage_record(
+                e.attempt, create_time, f"hedge|{e.attempt.source_name}", 0, 0, False, (remark + " [hedge cancelled]").strip()
+            )
+            for _, e in errors if isinstance(e, HedgeCancelled)
+        ]
+
+    @staticmethod
+    def _build_usage_record(attempt, create_time, request_id_content, prompt_tokens, completion_tokens, status, remark,
+                            is_function_call=False, time_to_first_token=None):
+        """组装发送给API密钥管理服务的使用记录"""
+        # 记录结束时间和执行时间
+        finish_time = datetime.now()
+        execution_time = (finish_time - create_time).total_seconds()
+
+        # 生成请求ID
+        if is_function_call:
+            request_id = LLM_Wrapper._generate_function_call_request_id(request_id_content, finish_time)
+        else:
+            request_id = LLM_Wrapper._generate_request_id(request_id_content, finish_time)
+
+        return dict(
+            api_key=attempt.api_key,
+            model_name=attempt.model_name,
+            source_name=attempt.source_name,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            create_time=create_time,
+            finish_time=finish_time,
+            execution_time=execution_time,
+            status=status,
+            request_id=request_id,
+            remark=remark,
+            time_to_first_token=time_to_first_token
+        )
+
+    @staticmethod
+    def _response_tokens(response, prompt_tokens, content):
+        """服务商返回的(prompt_tokens, completion_tokens), 缺失时用估计的提示token数和按生成内容估计的值"""
+        return (response.get("prompt_tokens") or prompt_tokens,
+                response.get("completion_tokens") or estimate_tokens(content))
+
+    @staticmethod
+    def _finish_text(prompt_tokens, response, attempt, attempts, create_time, remark):
+        """整理文本生成的结果和使用记录, 失败时按主源记录
+
+        prompt_tokens是估计的提示token数, 服务商返回了实际用量时以实际用量为准.
+        """
+        success = response is not None
+        content = response["content"] if success else ""
+        prompt_tokens, completion_tokens = (
+            LLM_Wrapper._response_tokens(response, prompt_tokens, content) if success else (0, 0)
+        )
+        usage = LLM_Wrapper._build_usage_record(
+            attempt if success else attempts[0], create_time, content,
+            prompt_tokens, completion_tokens, success, remark
+        )
+        return content, usage
+
+    @staticmethod
+    def _finish_function_call(prompt_tokens, response, attempt, attempts, create_time, remark):
+        """整理函数调用的结果和使用记录, 失败时按主源记录"""
+        success = response is not None
+        # 对于function calling，保留完整响应以获取工具调用
+        response_content = response if success else {}
+        prompt_tokens, completion_tokens = (
+            LLM_Wrapper._response_tokens(response, prompt_tokens, response.get("content")) if success else (0, 0)
+        )
+        usage = LLM_Wrapper._build_usage_record(
+            attempt if success else attempts[0], create_time, response_content,
+            prompt_tokens, completion_tokens, success, remark, is_function_call=True
+        )
+        return response_content, usage
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
     def generate(
         model_name,
         prompt,
@@ -319,11 +1229,12 @@ class LLM_Wrapper:
         output_proportion=40,
         max_tokens=None,
         test_response = None,
-        remark = ""
+        remark = "",
+        hedge=False
     ):
         # Validate model is allowed for text generation
         LLM_Wrapper._validate_model_for_generate(model_name)
-        
+
         if test_response is not None:
             return test_response
         """
@@ -333,10 +1244,11 @@ class LLM_Wrapper:
             model_name (str): 模型名称
             prompt (str): 输入提示
             mode (str): 选择策略，"cheap_first"或"fast_first"
-            timeout (int): 请求超时时间（秒）
+            timeout (int): 整次调用的超时时间（秒）, 选路、获取密钥、每次尝试和重试等待共用
             input_proportion (int): 输入比例
             output_proportion (int): 输出比例
             max_tokens (int, optional): 最大生成token数，默认None（不限制）
+            hedge (bool): 主源超过近期p90耗时仍未返回时, 是否在对冲预算内并行请求备用源
 
         Returns:
             str: 模型生成的文本
@@ -347,118 +1259,32 @@ class LLM_Wrapper:
         """
         try:
             load_balancing = LoadBalancing()
-            (
-                main_source_name,
-                main_source_model_name,
-                main_api_key,
-                backup_source_name,
-                backup_source_model_name,
-                backup_api_key,
-            ) = load_balancing.get_config(
-                model_name, mode, input_proportion, output_proportion
+            config = load_balancing.get_config(
+                model_name, mode, input_proportion, output_proportion,
+                prompt_tokens=estimate_tokens(prompt), max_tokens=max_tokens,
+                affinity_key=prefix_key(prompt)
             )
-            
+
             # Verify model mappings are valid
-            LLM_Wrapper._verify_model_mapping(
-                main_source_name,
-                backup_source_name,
-                main_source_model_name,
-                backup_source_model_name,
-                model_name,
-            )
+            LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
 
-            main_source_config = source_config[main_source_name]
-            backup_source_config = source_config[backup_source_name]
+            messages = [{"role": "user", "content": prompt}]
+            attempts = LLM_Wrapper._build_text_attempts(config, messages)
+            additional_params = LLM_Wrapper._build_additional_params(max_tokens)
 
-            # 优先为主模型使用openai-api-sdk的连接方式
-            if "openai" in main_source_config:
-                main_infra = OpenaiInfra(main_source_config["openai"], main_api_key)
-            else:
-                main_infra = CurlInfra(main_source_config["curl"], main_api_key)
-
-            # 优先为备用模型使用网络请求curl的连接方式
-            if "curl" in backup_source_config:
-                backup_infra = CurlInfra(backup_source_config["curl"], backup_api_key)
-            else:
-                backup_infra = OpenaiInfra(
-                    backup_source_config["openai"], backup_api_key
-                )
-
-            messages = [{"role": "user", "content": prompt}]
-            
-            # 只有当max_tokens不为None时才添加到additional_params
-            additional_params = {}
-            if max_tokens is not None:
-                additional_params["max_tokens"] = max_tokens
-
-            curr_retry = 0
-            success = False
             create_time = datetime.now()
-            content = ""
-            used_api_key = main_api_key
-            used_model_name = main_source_model_name
-            used_source_name = main_source_name
-            prompt_tokens = 0
-            completion_tokens = 0
-
-            while curr_retry < MAX_RETRY:
-                try:
-                    # 先尝试主模型
-                    response = main_infra.get_response(
-                        messages, [], main_source_model_name, timeout=timeout, additional_params=additional_params
-                    )
-                    used_api_key = main_api_key
-                    used_model_name = main_source_model_name
-                    used_source_name = main_source_name
-                    success = True
-                    content = response["content"]
-                    prompt_tokens = len(prompt)
-                    completion_tokens = len(content)
-                    break
-                except Exception as e:
-                    # 如果主模型失败，尝试备用模型
-                    try:
-                        response = backup_infra.get_response(
-                            messages, [], backup_source_model_name, timeout=timeout, additional_params=additional_params
-                        )
-                        used_api_key = backup_api_key
-                        used_model_name = backup_source_model_name
-                        used_source_name = backup_source_name
-                        success = True
-                        content = response["content"]
-                        prompt_tokens = len(prompt)
-                        completion_tokens = len(content)
-                        break
-                    except Exception as backup_e:
-                        curr_retry += 1
-                        print(
-                            f"Retry {curr_retry}/{MAX_RETRY}. Main error: {str(e)}, Backup error: {str(backup_e)}"
-                        )
-                time.sleep(SLEEP_TIME)
-                
-            # 记录结束时间和执行时间
-            finish_time = datetime.now()
-            execution_time = (finish_time - create_time).total_seconds()
-
-            # 生成请求ID
-            request_id = LLM_Wrapper._generate_request_id(content, finish_time)
+            # 先尝试主模型, 失败后尝试备用模型
+            response, attempt, errors = LLM_Wrapper._run_with_failover(
+                attempts, [], timeout, additional_params, hedge=hedge
+            )
+            content, usage = LLM_Wrapper._finish_text(estimate_tokens(prompt), response, attempt, attempts, create_time, remark)
 
             # 发送API使用记录
-            LLM_Wrapper._send_api_key_usage(
-                api_key=used_api_key,
-                model_name=used_model_name,
-                source_name=used_source_name,
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                create_time=create_time,
-                finish_time=finish_time,
-                execution_time=execution_time,
-                status=success,
-                request_id=request_id,
-                remark=remark
-            )
+            LLM_Wrapper._send_api_key_usage(**usage)
+            for hedge_usage in LLM_Wrapper._hedge_usage_records(errors, create_time, remark):
+                LLM_Wrapper._send_api_key_usage(**hedge_usage)
 
-            if not success:
+            if response is None:
                 raise Exception(f"Failed to get response after {MAX_RETRY} retries")
 
             return remove_thinking(content)
@@ -467,6 +1293,7 @@ class LLM_Wrapper:
             raise ve
 
     @staticmethod
+    @with_deadline(timeout_param='timeout')
     def generate_mm(
         model_name: str,
         prompt: str,
@@ -478,11 +1305,12 @@ class LLM_Wrapper:
         output_proportion=40,
         max_tokens=None,
         test_response = None,
-        remark = ""
+        remark = "",
+        hedge=False
     ):
         # Validate model is allowed for multimodal generation
         LLM_Wrapper._validate_model_for_generate_mm(model_name)
-        
+
         if test_response is not None:
             return test_response
         """
@@ -492,11 +1320,12 @@ class LLM_Wrapper:
             model_name (str): 模型名称
             prompt (str): 文本提示
             img_base64 (str): Base64编码的图像
-            timeout (int): 请求超时时间（秒）
+            timeout (int): 整次调用的超时时间（秒）, 选路、获取密钥、每次尝试和重试等待共用
             mode (str): 选择策略，"cheap_first"或"fast_first"
             input_proportion (int): 输入比例
             output_proportion (int): 输出比例
             max_tokens (int, optional): 最大生成token数，默认None（不限制）
+            hedge (bool): 主源超过近期p90耗时仍未返回时, 是否在对冲预算内并行请求备用源
 
         Returns:
             str: 模型生成的文本
@@ -506,268 +1335,46 @@ class LLM_Wrapper:
             Exception: 请求失败或其他错误
         """
         try:
-            
+
             load_balancing = LoadBalancing()
-            (
-                main_source_name,
-                main_source_model_name,
-                main_api_key,
-                backup_source_name,
-                backup_source_model_name,
-                backup_api_key,
-            ) = load_balancing.get_config(
-                model_name, mode, input_proportion, output_proportion
+            config = load_balancing.get_config(
+                model_name, mode, input_proportion, output_proportion,
+                prompt_tokens=estimate_tokens(prompt, images=1), max_tokens=max_tokens,
+                affinity_key=prefix_key(prompt)
             )
 
             # Verify model mappings are valid
-            LLM_Wrapper._verify_model_mapping(
-                main_source_name,
-                backup_source_name,
-                main_source_model_name,
-                backup_source_model_name,
-                model_name,
-            )
-
-            main_source_config = source_config[main_source_name]
-            backup_source_config = source_config[backup_source_name]
-
-            # 优先为主模型使用openai-api-sdk的连接方式
-            if "openai" in main_source_config:
-                main_infra = OpenaiInfra(main_source_config["openai"], main_api_key)
-            else:
-                main_infra = CurlInfra(main_source_config["curl"], main_api_key)
-
-            # 优先为备用模型使用网络请求curl的连接方式
-            if "curl" in backup_source_config:
-                backup_infra = CurlInfra(backup_source_config["curl"], backup_api_key)
-            else:
-                backup_infra = OpenaiInfra(
-                    backup_source_config["openai"], backup_api_key
-                )
+            LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
 
             # Handle Google API's requirement for base64 images instead of URLs
             # Pre-download image if either main or backup source is Google and we only have URL
             downloaded_img_base64 = img_base64
-            
-            # Check if we need to download for either Google source
-            needs_download = (img_url and not img_base64 and 
-                             (main_source_name == "google" or backup_source_name == "google"))
-            
-            if needs_download:
+            if LLM_Wrapper._needs_image_download(config, img_url, img_base64):
                 try:
-                    downloaded_img_base64 = LLM_Wrapper._download_image_to_base64(img_url)
+                    downloaded_img_base64 = LLM_Wrapper._download_image_to_base64(img_url, timeout)
                     print(f"Pre-downloaded image for Google API compatibility")
                 except Exception as e:
                     print(f"Warning: Failed to download image for Google API: {str(e)}")
                     # Continue with original img_url, backup source might work
-            
-            # Set final images for main source
-            if main_source_name == "google" and img_url and not img_base64:
-                final_img_base64 = downloaded_img_base64
-                final_img_url = None if downloaded_img_base64 else img_url
-            else:
-                final_img_base64 = img_base64
-                final_img_url = img_url
-            
-            # 获取两种图像URL格式
-            primary_image_url, fallback_image_url = LLM_Wrapper._build_image_url_with_fallback(final_img_url, final_img_base64, main_source_name)
-            
-            # 构建多模态消息（使用主格式）
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": primary_image_url,
-                        },
-                    ],
-                }
-            ]
-            
-            # 构建备用格式的消息
-            messages_fallback = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": fallback_image_url,
-                        },
-                    ],
-                }
-            ]
-            
-            # 只有当max_tokens不为None时才添加到additional_params
-            additional_params = {}
-            if max_tokens is not None:
-                additional_params["max_tokens"] = max_tokens
 
-            curr_retry = 0
-            success = False
+            attempts = LLM_Wrapper._build_mm_attempts(config, prompt, img_base64, img_url, downloaded_img_base64)
+            additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
             create_time = datetime.now()
-            content = ""
-            used_api_key = main_api_key
-            used_model_name = main_source_model_name
-            used_source_name = main_source_name
-            prompt_tokens = 0
-            completion_tokens = 0
-
-            while curr_retry < MAX_RETRY:
-                try:
-                    # 先尝试主格式
-                    response = main_infra.get_response(
-                        messages, [], main_source_model_name, timeout=timeout, additional_params=additional_params
-                    )
-                    used_api_key = main_api_key
-                    used_model_name = main_source_model_name
-                    used_source_name = main_source_name
-                    success = True
-                    
-                    # 检查响应完整性，避免隐性超时
-                    if response and "content" in response and response["content"]:
-                        content = response["content"]
-                        prompt_tokens = len(prompt) + len(img_base64)
-                        completion_tokens = len(content)
-                    else:
-                        # 响应为空或不完整，视为隐性超时
-                        raise Exception("Empty or incomplete response - possible timeout")
-                    break
-                except Exception as e:
-                    # 如果主格式失败，尝试备用格式
-                    try:
-                        response = main_infra.get_response(
-                            messages_fallback, [], main_source_model_name, timeout=timeout, additional_params=additional_params
-                        )
-                        used_api_key = main_api_key
-                        used_model_name = main_source_model_name
-                        used_source_name = main_source_name
-                        success = True
-                        
-                        # 检查响应完整性，避免隐性超时
-                        if response and "content" in response and response["content"]:
-                            content = response["content"]
-                            prompt_tokens = len(prompt) + len(img_base64)
-                            completion_tokens = len(content)
-                        else:
-                            # 响应为空或不完整，视为隐性超时
-                            raise Exception("Empty or incomplete response - possible timeout")
-                        break
-                    except Exception as e2:
-                        # 如果主模型的两种格式都失败，尝试备用模型
-                        # Handle backup source image format (reuse downloaded image if available)
-                        if backup_source_name == "google" and img_url and not img_base64:
-                            # Use pre-downloaded image if available
-                            backup_final_img_base64 = downloaded_img_base64
-                            backup_final_img_url = None if downloaded_img_base64 else img_url
-                        else:
-                            backup_final_img_base64 = img_base64
-                            backup_final_img_url = img_url
-                        
-                        # 为备用模型重新生成格式
-                        backup_primary_image_url, backup_fallback_image_url = LLM_Wrapper._build_image_url_with_fallback(
-                            backup_final_img_url, backup_final_img_base64, backup_source_name
-                        )
-                        
-                        # 构建备用模型的消息
-                        backup_messages = [
-                            {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": prompt},
-                                    {
-                                        "type": "image_url",
-                                        "image_url": backup_primary_image_url,
-                                    },
-                                ],
-                            }
-                        ]
-                        
-                        backup_messages_fallback = [
-                            {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": prompt},
-                                    {
-                                        "type": "image_url",
-                                        "image_url": backup_fallback_image_url,
-                                    },
-                                ],
-                            }
-                        ]
-                        
-                        try:
-                            response = backup_infra.get_response(
-                                    backup_messages, [], backup_source_model_name, timeout=timeout, additional_params=additional_params
-                            )
-                            used_api_key = backup_api_key
-                            used_model_name = backup_source_model_name
-                            used_source_name = backup_source_name
-                            success = True
-                            
-                            # 检查响应完整性，避免隐性超时
-                            if response and "content" in response and response["content"]:
-                                content = response["content"]
-                                prompt_tokens = len(prompt) + len(img_base64)
-                                completion_tokens = len(content)
-                            else:
-                                # 响应为空或不完整，视为隐性超时
-                                raise Exception("Empty or incomplete response - possible timeout")
-                            break
-                        except Exception as e3:
-                            # 最后尝试备用模型的备用格式
-                            try:
-                                response = backup_infra.get_response(
-                                    backup_messages_fallback, [], backup_source_model_name, timeout=timeout, additional_params=additional_params
-                                )
-                                used_api_key = backup_api_key
-                                used_model_name = backup_source_model_name
-                                used_source_name = backup_source_name
-                                success = True
-                                
-                                # 检查响应完整性，避免隐性超时
-                                if response and "content" in response and response["content"]:
-                                    content = response["content"]
-                                    prompt_tokens = len(prompt) + len(img_base64)
-                                    completion_tokens = len(content)
-                                else:
-                                    # 响应为空或不完整，视为隐性超时
-                                    raise Exception("Empty or incomplete response - possible timeout")
-                                break
-                            except Exception as e4:
-                                curr_retry += 1
-                                print(
-                                    f"Retry {curr_retry}/{MAX_RETRY}. All attempts failed: "
-                                    f"Main primary: {str(e)}, Main fallback: {str(e2)}, "
-                                    f"Backup primary: {str(e3)}, Backup fallback: {str(e4)}"
-                                )
-                time.sleep(SLEEP_TIME)
-                
-            # 记录结束时间和执行时间
-            finish_time = datetime.now()
-            execution_time = (finish_time - create_time).total_seconds()
-
-            # 生成请求ID
-            request_id = LLM_Wrapper._generate_request_id(content, finish_time)
+            # 主模型的两种格式都失败后，尝试备用模型的两种格式
+            response, attempt, errors = LLM_Wrapper._run_with_failover(
+                attempts, [], timeout, additional_params, validate=LLM_Wrapper._check_content_not_empty, hedge=hedge
+            )
+            content, usage = LLM_Wrapper._finish_text(
+                estimate_tokens(prompt, images=1), response, attempt, attempts, create_time, remark
+            )
 
             # 发送API使用记录
-            LLM_Wrapper._send_api_key_usage(
-                api_key=used_api_key,
-                model_name=used_model_name,
-                source_name=used_source_name,
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                create_time=create_time,
-                finish_time=finish_time,
-                execution_time=execution_time,
-                status=success,
-                request_id=request_id,
-                remark=remark
-            )
+            LLM_Wrapper._send_api_key_usage(**usage)
+            for hedge_usage in LLM_Wrapper._hedge_usage_records(errors, create_time, remark):
+                LLM_Wrapper._send_api_key_usage(**hedge_usage)
 
-            if not success:
+            if response is None:
                 raise Exception(f"Failed to get response after {MAX_RETRY} retries")
 
             return remove_thinking(content)
@@ -776,6 +1383,7 @@ class LLM_Wrapper:
             raise ve
 
     @staticmethod
+    @with_deadline(timeout_param='timeout')
     def function_calling(
         model_name,
         prompt,
@@ -786,11 +1394,12 @@ class LLM_Wrapper:
         output_proportion=40,
         max_tokens=None,
         test_response = None,
-        remark = ""
+        remark = "",
+        hedge=False
     ):
         # Validate model is allowed for function calling
         LLM_Wrapper._validate_model_for_function_calling(model_name)
-        
+
         if test_response is not None:
             return test_response
         """
@@ -800,11 +1409,12 @@ class LLM_Wrapper:
             model_name (str): 模型名称
             prompt (str): 输入提示
             tools (list): 工具定义列表
-            timeout (int): 请求超时时间（秒）
+            timeout (int): 整次调用的超时时间（秒）, 选路、获取密钥、每次尝试和重试等待共用
             mode (str): 选择策略，"cheap_first"或"fast_first"
             input_proportion (int): 输入比例
             output_proportion (int): 输出比例
             max_tokens (int, optional): 最大生成token数，默认None（不限制）
+            hedge (bool): 主源超过近期p90耗时仍未返回时, 是否在对冲预算内并行请求备用源
 
         Returns:
             dict: 包含响应内容和工具调用的完整响应
@@ -814,165 +1424,37 @@ class LLM_Wrapper:
             Exception: 请求失败或其他错误
         """
         try:
-            
+
             load_balancing = LoadBalancing()
-            (
-                main_source_name,
-                main_source_model_name,
-                main_api_key,
-                backup_source_name,
-                backup_source_model_name,
-                backup_api_key,
-            ) = load_balancing.get_config(
-                model_name, mode, input_proportion, output_proportion
+            config = load_balancing.get_config(
+                model_name, mode, input_proportion, output_proportion,
+                prompt_tokens=estimate_tokens(prompt, json.dumps(tools, ensure_ascii=False)), max_tokens=max_tokens,
+                affinity_key=prefix_key(json.dumps(tools, ensure_ascii=False), prompt)
             )
 
             # Verify model mappings are valid
-            LLM_Wrapper._verify_model_mapping(
-                main_source_name,
-                backup_source_name,
-                main_source_model_name,
-                backup_source_model_name,
-                model_name,
-            )
-
-            main_source_config = source_config[main_source_name]
-            backup_source_config = source_config[backup_source_name]
-
-            # 优先为主模型使用openai-api-sdk的连接方式
-            if "openai" in main_source_config:
-                main_infra = OpenaiInfra(main_source_config["openai"], main_api_key)
-            else:
-                main_infra = CurlInfra(main_source_config["curl"], main_api_key)
-
-            # 优先为备用模型使用网络请求curl的连接方式
-            if "curl" in backup_source_config:
-                backup_infra = CurlInfra(backup_source_config["curl"], backup_api_key)
-            else:
-                backup_infra = OpenaiInfra(
-                    backup_source_config["openai"], backup_api_key
-                )
+            LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
 
             messages = [{"role": "user", "content": prompt}]
-            
-            # 只有当max_tokens不为None时才添加到additional_params
-            additional_params = {}
-            if max_tokens is not None:
-                additional_params["max_tokens"] = max_tokens
+            attempts = LLM_Wrapper._build_text_attempts(config, messages)
+            additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+            tools_str = json.dumps(tools, ensure_ascii=False)
 
-            curr_retry = 0
-            success = False
             create_time = datetime.now()
-            response_content = {}
-            used_api_key = main_api_key
-            used_model_name = main_source_model_name
-            used_source_name = main_source_name
-            prompt_tokens = 0
-            completion_tokens = 0
-            tools_str = json.dumps(tools, ensure_ascii=False)
-            
-            while curr_retry < MAX_RETRY:
-                try:
-                    # 先尝试主模型
-                    response = main_infra.get_response(
-                        messages, tools, main_source_model_name, timeout=timeout, additional_params=additional_params
-                    )
-                    used_api_key = main_api_key
-                    used_model_name = main_source_model_name
-                    used_source_name = main_source_name
-                    success = True
-                    # 对于function calling，保留完整响应以获取工具调用
-                    response_content = response
-                    prompt_tokens = len(prompt) + len(tools_str)
-                    completion_tokens = len(response.get("content", "")) if "content" in response else 0
-                    break
-                except Exception as e:
-                    # 如果主模型失败，尝试备用模型
-                    try:
-                        response = backup_infra.get_response(
-                            messages, tools, backup_source_model_name, timeout=timeout, additional_params=additional_params
-                        )
-                        used_api_key = backup_api_key
-                        used_model_name = backup_source_model_name
-                        used_source_name = backup_source_name
-                        success = True
-                        # 对于function calling，保留完整响应以获取工具调用
-                        response_content = response
-                        prompt_tokens = len(prompt) + len(tools_str)
-                        completion_tokens = len(response.get("content", "")) if "content" in response else 0
-                        break
-                    except Exception as backup_e:
-                        curr_retry += 1
-                        print(
-                            f"Retry {curr_retry}/{MAX_RETRY}. Main error: {str(e)}, Backup error: {str(backup_e)}"
-                        )
-                time.sleep(SLEEP_TIME)
-                
-            # 记录结束时间和执行时间
-            finish_time = datetime.now()
-            execution_time = (finish_time - create_time).total_seconds()
-
-            # 创建可序列化的响应内容用于生成request_id
-            serializable_content = {}
-            if "content" in response_content:
-                serializable_content["content"] = response_content["content"]
-
-            # 对工具调用进行特殊处理, 避免序列化错误
-            if "tool_calls" in response_content:
-                serializable_tool_calls = []
-                for tool_call in response_content["tool_calls"]:
-                    if hasattr(tool_call, "to_dict"):  # 如果是对象而不是dict
-                        serializable_tool_calls.append(tool_call.to_dict())
-                    elif isinstance(tool_call, dict):  # 如果已经是dict
-                        serializable_tool_calls.append(tool_call)
-                    else:  # 如果是其他类型的对象
-                        serializable_tool_calls.append(
-                            {
-                                "id": getattr(tool_call, "id", str(uuid.uuid4())),
-                                "type": getattr(tool_call, "type", "function"),
-                                "function": {
-                                    "name": getattr(
-                                        getattr(tool_call, "function", {}),
-                                        "name",
-                                        "unknown",
-                                    ),
-                                    "arguments": getattr(
-                                        getattr(tool_call, "function", {}),
-                                        "arguments",
-                                        "{}",
-                                    ),
-                                },
-                            }
-                        )
-                serializable_content["tool_calls"] = serializable_tool_calls
-
-            # 生成请求ID (使用可序列化的内容)
-            try:
-                request_id = LLM_Wrapper._generate_request_id(
-                    json.dumps(serializable_content), finish_time
-                )
-            except Exception as e:
-                print(f"Error generating request_id: {str(e)}")
-                request_id = LLM_Wrapper._generate_request_id(
-                    f"function_call_{finish_time.isoformat()}", finish_time
-                )
+            # 先尝试主模型, 失败后尝试备用模型
+            response, attempt, errors = LLM_Wrapper._run_with_failover(
+                attempts, tools, timeout, additional_params, hedge=hedge
+            )
+            response_content, usage = LLM_Wrapper._finish_function_call(
+                estimate_tokens(prompt, tools_str), response, attempt, attempts, create_time, remark
+            )
 
             # 发送API使用记录
-            LLM_Wrapper._send_api_key_usage(
-                api_key=used_api_key,
-                model_name=used_model_name,
-                source_name=used_source_name,
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                create_time=create_time,
-                finish_time=finish_time,
-                execution_time=execution_time,
-                status=success,
-                request_id=request_id,
-                remark=remark
-            )
+            LLM_Wrapper._send_api_key_usage(**usage)
+            for hedge_usage in LLM_Wrapper._hedge_usage_records(errors, create_time, remark):
+                LLM_Wrapper._send_api_key_usage(**hedge_usage)
 
-            if not success:
+            if response is None:
                 raise Exception(f"Failed to get response after {MAX_RETRY} retries")
 
             return response_content
@@ -981,6 +1463,39 @@ class LLM_Wrapper:
             raise ve
 
     @staticmethod
+    def _build_best_attempts(front, prompt, img_base64=None, img_url=None, multimodal=False):
+        """根据select_the_front_fromAbatch的结果构建尝试序列, 按前沿中的顺序依次尝试各候选"""
+        attempts = []
+        for best_model_name, source_name, source_model_name, api_key in front:
+            # 选择合适的基础设施
+            infra = LLM_Wrapper._build_infra(source_name, api_key)
+            if not multimodal:
+                label = best_model_name if len(front) == 1 else f"{best_model_name} ({source_name})"
+                messages = [{"role": "user", "content": prompt}]
+                attempts.append(Attempt(label, infra, messages, source_name, source_model_name, api_key))
+                continue
+
+            # 获取两种图像URL格式
+            primary_image_url, fallback_image_url = LLM_Wrapper._build_image_url_with_fallback(
+                img_url, img_base64, source_name
+            )
+            suffix = "" if len(front) == 1 else f" ({best_model_name}, {source_name})"
+            attempts.extend([
+                Attempt("Primary format" + suffix, infra, LLM_Wrapper._build_mm_messages(prompt, primary_image_url),
+                        source_name, source_model_name, api_key),
+                Attempt("Fallback format" + suffix, infra, LLM_Wrapper._build_mm_messages(prompt, fallback_image_url),
+                        source_name, source_model_name, api_key),
+            ])
+        return attempts
+
+    @staticmethod
+    def _best_failure_message(best_model_name, errors):
+        if len(errors) == 1:
+            return f"Failed to get response from {best_model_name}: {str(errors[0][1])}"
+        return f"Failed to get response from {best_model_name}: {LLM_Wrapper._format_attempt_errors(errors)}"
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
     def generate_fromTHEbest(
         model_list,
         prompt,
@@ -993,20 +1508,20 @@ class LLM_Wrapper:
         remark=""
     ):
         """从多个模型中选择最优的一个进行文本生成
-        
+
         Args:
             model_list (list): 候选模型名称列表
             prompt (str): 输入提示
             mode (str): 选择策略，"cheap_first"或"fast_first"
-            timeout (int): 请求超时时间（秒）
+            timeout (int): 整次调用的超时时间（秒）, 选路、获取密钥、每次尝试和重试等待共用
             input_proportion (int): 输入比例
             output_proportion (int): 输出比例
             max_tokens (int, optional): 最大生成token数，默认None（不限制）
             test_response: 测试响应（用于单元测试）
-            
+
         Returns:
             str: 模型生成的文本
-            
+
         Raises:
             ValueError: 当没有可用模型时
             Exception: 请求失败或其他错误
@@ -1014,77 +1529,40 @@ class LLM_Wrapper:
         # 验证所有模型都支持文本生成
         for model_name in model_list:
             LLM_Wrapper._validate_model_for_generate(model_name)
-        
+
         if test_response is not None:
             return test_response
-            
+
         try:
             load_balancing = LoadBalancing()
-            
-            # 从批量模型中选择最优的
-            best_model_name, source_name, source_model_name, api_key = load_balancing.select_the_best_fromAbatch(
+
+            # 从批量模型中选出排好序的帕累托前沿, 依次尝试
+            front = load_balancing.select_the_front_fromAbatch(
                 model_list, mode, input_proportion, output_proportion
             )
-            
-            # 获取源配置
-            source_config_item = source_config[source_name]
-            
-            # 选择合适的基础设施
-            if "openai" in source_config_item:
-                infra = OpenaiInfra(source_config_item["openai"], api_key)
-            else:
-                infra = CurlInfra(source_config_item["curl"], api_key)
-            
-            messages = [{"role": "user", "content": prompt}]
-            
-            # 只有当max_tokens不为None时才添加到additional_params
-            additional_params = {}
-            if max_tokens is not None:
-                additional_params["max_tokens"] = max_tokens
-            
+            attempts = LLM_Wrapper._build_best_attempts(front, prompt)
+            additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
             # 记录开始时间
             create_time = datetime.now()
-            
-            try:
-                response = infra.get_response(messages, [], source_model_name, timeout=timeout, additional_params=additional_params)
-                success = True
-                content = response["content"]
-                prompt_tokens = len(prompt)
-                completion_tokens = len(content)
-            except Exception as e:
-                success = False
-                content = ""
-                prompt_tokens = len(prompt)
-                completion_tokens = 0
-                raise Exception(f"Failed to get response from {best_model_name}: {str(e)}")
-            finally:
-                # 记录结束时间
-                finish_time = datetime.now()
-                execution_time = (finish_time - create_time).total_seconds()
-                
-                # 生成请求ID
-                request_id = LLM_Wrapper._generate_request_id(content, finish_time)
-                
-                # 发送API使用记录
-                LLM_Wrapper._send_api_key_usage(
-                    api_key=api_key,
-                    model_name=source_model_name,
-                    source_name=source_name,
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    create_time=create_time,
-                    finish_time=finish_time,
-                    execution_time=execution_time,
-                    status=success,
-                    request_id=request_id,
-                remark=remark
+            response, attempt, errors = LLM_Wrapper._run_with_failover(
+                attempts, [], timeout, additional_params, max_retry=1
             )
-            
+            content, usage = LLM_Wrapper._finish_text(estimate_tokens(prompt), response, attempt, attempts, create_time, remark)
+            usage["prompt_tokens"] = usage["prompt_tokens"] or estimate_tokens(prompt)
+
+            # 发送API使用记录
+            LLM_Wrapper._send_api_key_usage(**usage)
+
+            if response is None:
+                raise Exception(LLM_Wrapper._best_failure_message(front[0][0], errors))
+
             return remove_thinking(content)
         except ValueError as ve:
             raise ve
 
     @staticmethod
+    @with_deadline(timeout_param='timeout')
     def generate_mm_fromTHEbest(
         model_list,
         prompt,
@@ -1099,22 +1577,22 @@ class LLM_Wrapper:
         remark=""
     ):
         """从多个多模态模型中选择最优的一个进行生成
-        
+
         Args:
             model_list (list): 候选多模态模型名称列表
             prompt (str): 文本提示
             img_base64 (str): Base64编码的图像
             img_url (str): 图像URL（可选）
-            timeout (int): 请求超时时间（秒）
+            timeout (int): 整次调用的超时时间（秒）, 选路、获取密钥、每次尝试和重试等待共用
             mode (str): 选择策略，"cheap_first"或"fast_first"
             input_proportion (int): 输入比例
             output_proportion (int): 输出比例
             max_tokens (int, optional): 最大生成token数，默认None（不限制）
             test_response: 测试响应（用于单元测试）
-            
+
         Returns:
             str: 模型生成的文本
-            
+
         Raises:
             ValueError: 当没有可用模型时
             Exception: 请求失败或其他错误
@@ -1122,120 +1600,42 @@ class LLM_Wrapper:
         # 验证所有模型都支持多模态生成
         for model_name in model_list:
             LLM_Wrapper._validate_model_for_generate_mm(model_name)
-        
+
         if test_response is not None:
             return test_response
-            
+
         try:
             load_balancing = LoadBalancing()
-            
-            # 从批量模型中选择最优的
-            best_model_name, source_name, source_model_name, api_key = load_balancing.select_the_best_fromAbatch(
+
+            # 从批量模型中选出排好序的帕累托前沿, 依次尝试
+            front = load_balancing.select_the_front_fromAbatch(
                 model_list, mode, input_proportion, output_proportion
             )
-            
-            # 获取源配置
-            source_config_item = source_config[source_name]
-            
-            # 选择合适的基础设施
-            if "openai" in source_config_item:
-                infra = OpenaiInfra(source_config_item["openai"], api_key)
-            else:
-                infra = CurlInfra(source_config_item["curl"], api_key)
-            
-            # 获取两种图像URL格式
-            primary_image_url, fallback_image_url = LLM_Wrapper._build_image_url_with_fallback(
-                img_url, img_base64, source_name
-            )
-            
-            # 构建多模态消息（使用主格式）
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": primary_image_url,
-                        },
-                    ],
-                }
-            ]
-            
-            # 构建备用格式的消息
-            messages_fallback = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": fallback_image_url,
-                        },
-                    ],
-                }
-            ]
-
-            # 只有当max_tokens不为None时才添加到additional_params
-            additional_params = {}
-            if max_tokens is not None:
-                additional_params["max_tokens"] = max_tokens
-            
+            # 先尝试主格式, 失败后尝试备用格式
+            attempts = LLM_Wrapper._build_best_attempts(front, prompt, img_base64, img_url, multimodal=True)
+            additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
             # 记录开始时间
             create_time = datetime.now()
-            success = False
-            content = ""
-            prompt_tokens = len(prompt) + len(img_base64)
-            completion_tokens = 0
-            
-            try:
-                # 先尝试主格式
-                response = infra.get_response(messages, [], source_model_name, timeout=timeout, additional_params=additional_params)
-                success = True
-                content = response["content"]
-                completion_tokens = len(content)
-            except Exception as e:
-                # 如果主格式失败，尝试备用格式
-                try:
-                    response = infra.get_response(messages_fallback, [], source_model_name, timeout=timeout, additional_params=additional_params)
-                    success = True
-                    content = response["content"]
-                    completion_tokens = len(content)
-                except Exception as e2:
-                    success = False
-                    raise Exception(
-                        f"Failed to get response from {best_model_name}: "
-                        f"Primary format error: {str(e)}, "
-                        f"Fallback format error: {str(e2)}"
-                    )
-            finally:
-                # 记录结束时间
-                finish_time = datetime.now()
-                execution_time = (finish_time - create_time).total_seconds()
-                
-                # 生成请求ID
-                request_id = LLM_Wrapper._generate_request_id(content, finish_time)
-                
-                # 发送API使用记录
-                LLM_Wrapper._send_api_key_usage(
-                    api_key=api_key,
-                    model_name=source_model_name,
-                    source_name=source_name,
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    create_time=create_time,
-                    finish_time=finish_time,
-                    execution_time=execution_time,
-                    status=success,
-                    request_id=request_id,
-                remark=remark
+            prompt_tokens = estimate_tokens(prompt, images=1)
+            response, attempt, errors = LLM_Wrapper._run_with_failover(
+                attempts, [], timeout, additional_params, max_retry=1
             )
-            
+            content, usage = LLM_Wrapper._finish_text(prompt_tokens, response, attempt, attempts, create_time, remark)
+            usage["prompt_tokens"] = usage["prompt_tokens"] or prompt_tokens
+
+            # 发送API使用记录
+            LLM_Wrapper._send_api_key_usage(**usage)
+
+            if response is None:
+                raise Exception(LLM_Wrapper._best_failure_message(front[0][0], errors))
+
             return remove_thinking(content)
         except ValueError as ve:
             raise ve
 
     @staticmethod
+    @with_deadline(timeout_param='timeout')
     def function_calling_fromTHEbest(
         model_list,
         prompt,
@@ -1249,21 +1649,21 @@ class LLM_Wrapper:
         remark=""
     ):
         """从多个支持函数调用的模型中选择最优的一个
-        
+
         Args:
             model_list (list): 候选模型名称列表（必须支持函数调用）
             prompt (str): 输入提示
             tools (list): 工具定义列表
-            timeout (int): 请求超时时间（秒）
+            timeout (int): 整次调用的超时时间（秒）, 选路、获取密钥、每次尝试和重试等待共用
             mode (str): 选择策略，"cheap_first"或"fast_first"
             input_proportion (int): 输入比例
             output_proportion (int): 输出比例
             max_tokens (int, optional): 最大生成token数，默认None（不限制）
             test_response: 测试响应（用于单元测试）
-            
+
         Returns:
             dict: 包含响应内容和工具调用的完整响应
-            
+
         Raises:
             ValueError: 当没有可用模型时
             Exception: 请求失败或其他错误
@@ -1271,227 +1671,408 @@ class LLM_Wrapper:
         # 验证所有模型都支持函数调用
         for model_name in model_list:
             LLM_Wrapper._validate_model_for_function_calling(model_name)
-        
+
         if test_response is not None:
             return test_response
-            
+
         try:
             load_balancing = LoadBalancing()
-            
-            # 从批量模型中选择最优的
-            best_model_name, source_name, source_model_name, api_key = load_balancing.select_the_best_fromAbatch(
+
+            # 从批量模型中选出排好序的帕累托前沿, 依次尝试
+            front = load_balancing.select_the_front_fromAbatch(
                 model_list, mode, input_proportion, output_proportion
             )
-            
-            # 获取源配置
-            source_config_item = source_config[source_name]
-            
-            # 选择合适的基础设施
-            if "openai" in source_config_item:
-                infra = OpenaiInfra(source_config_item["openai"], api_key)
-            else:
-                infra = CurlInfra(source_config_item["curl"], api_key)
-            
-            messages = [{"role": "user", "content": prompt}]
-            
-            # 只有当max_tokens不为None时才添加到additional_params
-            additional_params = {}
-            if max_tokens is not None:
-                additional_params["max_tokens"] = max_tokens
-            
+            attempts = LLM_Wrapper._build_best_attempts(front, prompt)
+            additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
             # 记录开始时间
             create_time = datetime.now()
-            tools_str = json.dumps(tools, ensure_ascii=False)
-            
-            try:
-                response = infra.get_response(messages, tools, source_model_name, timeout=timeout, additional_params=additional_params)
-                success = True
-                response_content = response
-                prompt_tokens = len(prompt) + len(tools_str)
-                completion_tokens = len(response.get("content", "")) if "content" in response else 0
-            except Exception as e:
-                success = False
-                response_content = {}
-                prompt_tokens = len(prompt) + len(tools_str)
-                completion_tokens = 0
-                raise Exception(f"Failed to get response from {best_model_name}: {str(e)}")
-            finally:
-                # 记录结束时间
-                finish_time = datetime.now()
-                execution_time = (finish_time - create_time).total_seconds()
-                
-                # 创建可序列化的响应内容用于生成request_id
-                serializable_content = {}
-                if "content" in response_content:
-                    serializable_content["content"] = response_content["content"]
-
-                # 对工具调用进行特殊处理
-                if "tool_calls" in response_content:
-                    serializable_tool_calls = []
-                    for tool_call in response_content["tool_calls"]:
-                        if hasattr(tool_call, "to_dict"):
-                            serializable_tool_calls.append(tool_call.to_dict())
-                        elif isinstance(tool_call, dict):
-                            serializable_tool_calls.append(tool_call)
-                        else:
-                            serializable_tool_calls.append(
-                                {
-                                    "id": getattr(tool_call, "id", str(uuid.uuid4())),
-                                    "type": getattr(tool_call, "type", "function"),
-                                    "function": {
-                                        "name": getattr(
-                                            getattr(tool_call, "function", {}),
-                                            "name",
-                                            "unknown",
-                                        ),
-                                        "arguments": getattr(
-                                            getattr(tool_call, "function", {}),
-                                            "arguments",
-                                            "{}",
-                                        ),
-                                    },
-                                }
-                            )
-                    serializable_content["tool_calls"] = serializable_tool_calls
-
-                # 生成请求ID
-                try:
-                    request_id = LLM_Wrapper._generate_request_id(
-                        json.dumps(serializable_content), finish_time
-                    )
-                except Exception as e:
-                    print(f"Error generating request_id: {str(e)}")
-                    request_id = LLM_Wrapper._generate_request_id(
-                        f"function_call_{finish_time.isoformat()}", finish_time
-                    )
-                
-                # 发送API使用记录
-                LLM_Wrapper._send_api_key_usage(
-                    api_key=api_key,
-                    model_name=source_model_name,
-                    source_name=source_name,
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    create_time=create_time,
-                    finish_time=finish_time,
-                    execution_time=execution_time,
-                    status=success,
-                    request_id=request_id,
-                remark=remark
+            prompt_tokens = estimate_tokens(prompt, json.dumps(tools, ensure_ascii=False))
+            response, attempt, errors = LLM_Wrapper._run_with_failover(
+                attempts, tools, timeout, additional_params, max_retry=1
             )
-            
+            response_content, usage = LLM_Wrapper._finish_function_call(
+                prompt_tokens, response, attempt, attempts, create_time, remark
+            )
+            usage["prompt_tokens"] = usage["prompt_tokens"] or prompt_tokens
+
+            # 发送API使用记录
+            LLM_Wrapper._send_api_key_usage(**usage)
+
+            if response is None:
+                raise Exception(LLM_Wrapper._best_failure_message(front[0][0], errors))
+
             return response_content
         except ValueError as ve:
             raise ve
 
     @staticmethod
-    def generate_doc(
-        model_name: str,
-        prompt: str,
-        pdf_base64: str,
-        timeout=240,
+    def _open_stream(attempt, tools, timeout, additional_params):
+        """打开流式响应并等待第一个token, 返回(stream, first_token)
+
+        在收到第一个token之前发生的错误(建连失败, HTTP错误, 首token超时)都会抛出,
+        从而由_run_with_failover切换到下一个源.
+        """
+        stream = attempt.infra.stream_response(
+            attempt.messages, tools, attempt.model_name, timeout=timeout, additional_params=additional_params
+        )
+        try:
+            first_token = next(stream)
+        except StopIteration:
+            raise Exception("Empty stream response - possible timeout")
+        except Exception:
+            stream.close()
+            raise
+        return stream, first_token
+
+    @staticmethod
+    async def _aopen_stream(attempt, tools, timeout, additional_params):
+        """_open_stream的协程版本"""
+        stream = attempt.infra.astream_response(
+            attempt.messages, tools, attempt.model_name, timeout=timeout, additional_params=additional_params
+        )
+        try:
+            first_token = await stream.__anext__()
+        except StopAsyncIteration:
+            raise Exception("Empty stream response - possible timeout")
+        except Exception:
+            await stream.aclose()
+            raise
+        return stream, first_token
+
+    @staticmethod
+    def _stream_with_failover(attempts, timeout, additional_params, prompt_tokens, remark):
+        """流式生成的公共流程: 首token前可以切换源, 首token后不再切换
+
+        结束(或调用方提前关闭迭代器)时发送使用记录, 其中包含首token时间.
+        并发许可一直持有到流关闭, 首token时已按成功调整并发上限.
+        """
+        create_time = datetime.now()
+        opened, attempt, _ = LLM_Wrapper._run_with_failover(
+            attempts, [], timeout, additional_params, request=LLM_Wrapper._open_stream, hold_permit=True
+        )
+        if opened is None:
+            LLM_Wrapper._send_api_key_usage(**LLM_Wrapper._build_usage_record(
+                attempts[0], create_time, "", 0, 0, False, remark
+            ))
+            raise Exception(f"Failed to get response after {MAX_RETRY} retries")
+
+        (stream, first_token), permit = opened
+        time_to_first_token = (datetime.now() - create_time).total_seconds()
+        thinking_filter = ThinkingStreamFilter()
+        tokens = [first_token]
+        success = False
+        try:
+            text = thinking_filter.feed(first_token)
+            if text:
+                yield text
+            for token in stream:
+                tokens.append(token)
+                text = thinking_filter.feed(token)
+                if text:
+                    yield text
+            text = thinking_filter.flush()
+            if text:
+                yield text
+            success = True
+        except GeneratorExit:
+            # 调用方主动停止读取不算请求失败
+            success = True
+            raise
+        finally:
+            stream.close()
+            concurrency_limiter.release(permit)
+            content = "".join(tokens)
+            LLM_Wrapper._send_api_key_usage(**LLM_Wrapper._build_usage_record(
+                attempt, create_time, content, prompt_tokens, estimate_tokens(content), success, remark,
+                time_to_first_token=time_to_first_token
+            ))
+
+    @staticmethod
+    async def _astream_with_failover(attempts, timeout, additional_params, prompt_tokens, remark):
+        """_stream_with_failover的协程版本"""
+        create_time = datetime.now()
+        opened, attempt, _ = await LLM_Wrapper._arun_with_failover(
+            attempts, [], timeout, additional_params, request=LLM_Wrapper._aopen_stream, hold_permit=True
+        )
+        if opened is None:
+            await LLM_Wrapper._asend_api_key_usage(**LLM_Wrapper._build_usage_record(
+                attempts[0], create_time, "", 0, 0, False, remark
+            ))
+            raise Exception(f"Failed to get response after {MAX_RETRY} retries")
+
+        (stream, first_token), permit = opened
+        time_to_first_token = (datetime.now() - create_time).total_seconds()
+        thinking_filter = ThinkingStreamFilter()
+        tokens = [first_token]
+        success = False
+        try:
+            text = thinking_filter.feed(first_token)
+            if text:
+                yield text
+            async for token in stream:
+                tokens.append(token)
+                text = thinking_filter.feed(token)
+                if text:
+                    yield text
+            text = thinking_filter.flush()
+            if text:
+                yield text
+            success = True
+        except GeneratorExit:
+            success = True
+            raise
+        finally:
+            await stream.aclose()
+            concurrency_limiter.release(permit)
+            content = "".join(tokens)
+            await LLM_Wrapper._asend_api_key_usage(**LLM_Wrapper._build_usage_record(
+                attempt, create_time, content, prompt_tokens, estimate_tokens(content), success, remark,
+                time_to_first_token=time_to_first_token
+            ))
+
+    @staticmethod
+    def generate_stream(
+        model_name,
+        prompt,
+        mode="fast_first",
+        timeout=30,
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
         test_response=None,
         remark=""
     ):
         """
-        使用PDF文档处理模型生成响应（仅支持Google源的模型）
-        使用requests直接调用Google的generateContent API
+        流式生成文本响应, 返回逐个产出文本片段的迭代器
+
+        在收到第一个token之前, 主源失败会切换到备用源并按MAX_RETRY重试;
+        收到第一个token之后不再切换, 流中途出错时直接抛出异常.
 
         Args:
-            model_name (str): 模型名称（必须是Google源支持的模型）
-            prompt (str): 文本提示
-            pdf_base64 (str): Base64编码的PDF文档
-            timeout (int): 请求超时时间（秒，默认240秒用于大文件处理）
-            test_response: 测试响应（用于单元测试）
+            model_name (str): 模型名称
+            prompt (str): 输入提示
+            mode (str): 选择策略，"cheap_first"或"fast_first"
+            timeout (int): 建连和相邻两个数据块之间的超时时间（秒）
+            input_proportion (int): 输入比例
+            output_proportion (int): 输出比例
+            max_tokens (int, optional): 最大生成token数，默认None（不限制）
 
         Returns:
-            str: 模型生成的文本
+            Iterator[str]: 已移除思维链的文本片段
 
         Raises:
-            ValueError: 当模型不支持PDF处理或不在Google源上时
-            Exception: 请求失败或其他错误
+            ValueError: 当模型在源上不可用时
+            Exception: 请求失败或其他错误(在迭代时抛出)
         """
-        # 验证模型支持PDF文档处理
-        LLM_Wrapper._validate_model_for_generate_doc(model_name)
-        
-        # 验证模型在Google源上可用
-        LLM_Wrapper._validate_model_is_google_source(model_name)
-        
+        LLM_Wrapper._validate_model_for_generate(model_name)
+
         if test_response is not None:
-            return test_response
+            return iter([test_response])
 
-        try:
-            # 获取Google源配置
-            source_name = "google"
-            source_model_name = source_mapping[source_name][model_name]
-            
-            # 获取API密钥
-            harness = Harness_localAPI()
-            api_key = harness.get_api_key(source_name)
-            
-            # 记录开始时间
-            create_time = datetime.now()
-            
-            # 构造请求
-            url = f"https://generativelanguage.googleapis.com/v1beta/models/{source_model_name}:generateContent"
-            headers = {
-                "Content-Type": "application/json",
-                "x-goog-api-key": api_key
-            }
-            payload = {
-                "contents": [{
-                    "parts": [
-                        {
-                            "inline_data": {
-                                "mime_type": "application/pdf",
-                                "data": pdf_base64
-                            }
-                        },
-                        {
-                            "text": prompt
+        load_balancing = LoadBalancing()
+        config = load_balancing.get_config(
+            model_name, mode, input_proportion, output_proportion,
+            prompt_tokens=estimate_tokens(prompt), max_tokens=max_tokens,
+            affinity_key=prefix_key(prompt)
+        )
+        LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
+
+        messages = [{"role": "user", "content": prompt}]
+        attempts = LLM_Wrapper._build_text_attempts(config, messages)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+        return LLM_Wrapper._stream_with_failover(attempts, timeout, additional_params, estimate_tokens(prompt), remark)
+
+    @staticmethod
+    def generate_mm_stream(
+        model_name: str,
+        prompt: str,
+        img_base64: str,
+        img_url=None,
+        timeout=30,
+        mode="fast_first",
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark=""
+    ):
+        """
+        流式多模态生成, 返回逐个产出文本片段的迭代器
+
+        失败切换规则与generate_stream相同, 尝试顺序与generate_mm相同.
+
+        Args:
+            model_name (str): 模型名称
+            prompt (str): 文本提示
+            img_base64 (str): Base64编码的图像
+            img_url (str): 图像URL（可选）
+            timeout (int): 建连和相邻两个数据块之间的超时时间（秒）
+            mode (str): 选择策略，"cheap_first"或"fast_first"
+            input_proportion (int): 输入比例
+            output_proportion (int): 输出比例
+            max_tokens (int, optional): 最大生成token数，默认None（不限制）
+
+        Returns:
+            Iterator[str]: 已移除思维链的文本片段
+
+        Raises:
+            ValueError: 当模型在源上不可用时
+            Exception: 请求失败或其他错误(在迭代时抛出)
+        """
+        LLM_Wrapper._validate_model_for_generate_mm(model_name)
+
+        if test_response is not None:
+            return iter([test_response])
+
+        load_balancing = LoadBalancing()
+        config = load_balancing.get_config(
+            model_name, mode, input_proportion, output_proportion,
+            prompt_tokens=estimate_tokens(prompt, images=1), max_tokens=max_tokens,
+            affinity_key=prefix_key(prompt)
+        )
+        LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
+
+        downloaded_img_base64 = img_base64
+        if LLM_Wrapper._needs_image_download(config, img_url, img_base64):
+            try:
+                downloaded_img_base64 = LLM_Wrapper._download_image_to_base64(img_url, timeout)
+                print(f"Pre-downloaded image for Google API compatibility")
+            except Exception as e:
+                print(f"Warning: Failed to download image for Google API: {str(e)}")
+
+        attempts = LLM_Wrapper._build_mm_attempts(config, prompt, img_base64, img_url, downloaded_img_base64)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+        return LLM_Wrapper._stream_with_failover(
+            attempts, timeout, additional_params, estimate_tokens(prompt, images=1), remark
+        )
+
+    @staticmethod
+    def _build_doc_request(source_model_name, api_key, prompt, pdf_base64):
+        """构造Google generateContent请求, 返回(url, headers, payload)"""
+        url = f"https://generativelanguage.googleapis.com/v1beta/models/{source_model_name}:generateContent"
+        headers = {
+            "Content-Type": "application/json",
+            "x-goog-api-key": api_key
+        }
+        payload = {
+            "contents": [{
+                "parts": [
+                    {
+                        "inline_data": {
+                            "mime_type": "application/pdf",
+                            "data": pdf_base64
                         }
-                    ]
-                }]
-            }
+                    },
+                    {
+                        "text": prompt
+                    }
+                ]
+            }]
+        }
+        return url, headers, payload
+
+    @staticmethod
+    def _parse_doc_response(result):
+        """从generateContent的响应中提取文本"""
+        if "candidates" not in result or len(result["candidates"]) == 0:
+            raise Exception(f"No candidates in response")
+
+        candidate = result["candidates"][0]
+        if "content" not in candidate or "parts" not in candidate["content"]:
+            raise Exception(f"Invalid response structure")
+
+        parts = candidate["content"]["parts"]
+        if len(parts) == 0 or "text" not in parts[0]:
+            raise Exception(f"No text content in response")
+
+        return parts[0]["text"]
+
+    @staticmethod
+    def _build_doc_usage(api_key, source_model_name, source_name, prompt, usage_metadata, content, create_time, status,
+                         remark):
+        """组装PDF文档处理的使用记录, token数取自Google响应的usageMetadata, 缺失时按提示和生成内容估计"""
+        finish_time = datetime.now()
+        execution_time = (finish_time - create_time).total_seconds()
+        usage_metadata = usage_metadata or {}
+        return dict(
+            api_key=api_key,
+            model_name=source_model_name,
+            source_name=source_name,
+            prompt_tokens=usage_metadata.get("promptTokenCount") or estimate_tokens(prompt),
+            completion_tokens=usage_metadata.get("candidatesTokenCount") or estimate_tokens(content),
+            create_time=create_time,
+            finish_time=finish_time,
+            execution_time=execution_time,
+            status=status,
+            request_id=LLM_Wrapper._generate_request_id(content, finish_time),
+            remark=remark
+        )
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    def generate_doc(
+        model_name: str,
+        prompt: str,
+        pdf_base64: str,
+        timeout=240,
+        test_response=None,
+        remark=""
+    ):
+        """
+        使用PDF文档处理模型生成响应（仅支持Google源的模型）
+        使用requests直接调用Google的generateContent API
+
+        Args:
+            model_name (str): 模型名称（必须是Google源支持的模型）
+            prompt (str): 文本提示
+            pdf_base64 (str): Base64编码的PDF文档
+            timeout (int): 整次调用的超时时间（秒，默认240秒用于大文件处理）, 包括获取密钥
+            test_response: 测试响应（用于单元测试）
+
+        Returns:
+            str: 模型生成的文本
+
+        Raises:
+            ValueError: 当模型不支持PDF处理或不在Google源上时
+            Exception: 请求失败或其他错误
+        """
+        # 验证模型支持PDF文档处理
+        LLM_Wrapper._validate_model_for_generate_doc(model_name)
+        
+        # 验证模型在Google源上可用
+        LLM_Wrapper._validate_model_is_google_source(model_name)
+        
+        if test_response is not None:
+            return test_response
+
+        # 获取Google源配置
+        source_name = "google"
+        source_model_name = source_mapping[source_name][model_name]
+        api_key = ""
+        create_time = datetime.now()
+        try:
+            # 获取API密钥
+            harness = Harness_localAPI()
+            api_key = harness.get_api_key(source_name)
+            
+            # 记录开始时间
+            create_time = datetime.now()
             
-            # 发送请求
-            response = requests.post(url, headers=headers, json=payload, timeout=timeout)
+            # 构造并发送请求
+            url, headers, payload = LLM_Wrapper._build_doc_request(source_model_name, api_key, prompt, pdf_base64)
+            response = requests.post(url, headers=headers, json=payload, timeout=request_timeout(timeout))
             response.raise_for_status()
             
             # 解析响应
-            result = response.json()
-            if "candidates" not in result or len(result["candidates"]) == 0:
-                raise Exception(f"No candidates in response")
-            
-            candidate = result["candidates"][0]
-            if "content" not in candidate or "parts" not in candidate["content"]:
-                raise Exception(f"Invalid response structure")
-            
-            parts = candidate["content"]["parts"]
-            if len(parts) == 0 or "text" not in parts[0]:
-                raise Exception(f"No text content in response")
-            
-            content = parts[0]["text"]
-            
-            # 记录结束时间和使用统计
-            finish_time = datetime.now()
-            execution_time = (finish_time - create_time).total_seconds()
-            request_id = LLM_Wrapper._generate_request_id(content, finish_time)
+            response_data = response.json()
+            content = LLM_Wrapper._parse_doc_response(response_data)
             
             # 发送API使用记录
-            LLM_Wrapper._send_api_key_usage(
-                api_key=api_key,
-                model_name=source_model_name,
-                source_name=source_name,
-                prompt_tokens=len(prompt) + len(pdf_base64),
-                completion_tokens=len(content),
-                create_time=create_time,
-                finish_time=finish_time,
-                execution_time=execution_time,
-                status=True,
-                request_id=request_id,
-                remark=remark
-            )
+            LLM_Wrapper._send_api_key_usage(**LLM_Wrapper._build_doc_usage(
+                api_key, source_model_name, source_name, prompt, response_data.get("usageMetadata"), content,
+                create_time, True, remark
+            ))
             
             return remove_thinking(content)
             
@@ -1501,29 +2082,137 @@ class LLM_Wrapper:
         except Exception as e:
             # 记录失败的API使用
             try:
-                finish_time = datetime.now()
-                execution_time = (finish_time - create_time).total_seconds()
-                request_id = LLM_Wrapper._generate_request_id("", finish_time)
-                
-                LLM_Wrapper._send_api_key_usage(
-                    api_key=api_key if 'api_key' in locals() else "",
-                    model_name=source_model_name if 'source_model_name' in locals() else model_name,
-                    source_name=source_name,
-                    prompt_tokens=len(prompt) + len(pdf_base64),
-                    completion_tokens=0,
-                    create_time=create_time if 'create_time' in locals() else datetime.now(),
-                    finish_time=finish_time,
-                    execution_time=execution_time,
-                    status=False,
-                    request_id=request_id,
-                    remark=remark
-                )
+                LLM_Wrapper._send_api_key_usage(**LLM_Wrapper._build_doc_usage(
+                    api_key, source_model_name, source_name, prompt, None, "", create_time, False, remark
+                ))
             except:
                 pass  # 忽略记录失败的错误
             
             raise Exception(f"PDF processing failed: {str(e)}")
-    
+
+    @staticmethod
+    def _build_embedding_request(model_name, api_key, prompt):
+        """构造deepinfra embedding请求, 返回(url, headers, payload)"""
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        payload = {
+            "input": prompt,
+            "model": model_name,
+            "encoding_format": "float"
+        }
+        return "https://api.deepinfra.com/v1/openai/embeddings", headers, payload
+
+    @staticmethod
+    def _parse_embedding_response(response_data, prompt):
+        """解析embedding响应, 返回(embedding_result, prompt_tokens)"""
+        # 检查响应格式
+        if "data" not in response_data or not response_data["data"]:
+            raise Exception(f"API响应格式异常: 缺少data字段. 响应内容: {response_data}")
+
+        # 提取嵌入向量
+        embedding_result = {
+            "embedding": response_data["data"][0]["embedding"],
+            "model": response_data["model"],
+            "usage": response_data.get("usage", {})
+        }
+        prompt_tokens = response_data.get("usage", {}).get("prompt_tokens", len(prompt.split()))
+        return embedding_result, prompt_tokens
+
+    @staticmethod
+    def _build_reranker_request(model_name, api_key, prompt, documents_list):
+        """构造deepinfra reranker请求, 返回(url, headers, payload)"""
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"bearer {api_key}"
+        }
+        payload = {
+            "queries": [prompt] * len(documents_list),
+            "documents": documents_list
+        }
+        return f"https://api.deepinfra.com/v1/inference/{model_name}", headers, payload
+
+    @staticmethod
+    def _parse_reranker_response(response_data, prompt, documents_list):
+        """解析reranker响应, 返回(reranker_result, prompt_tokens)"""
+        # 检查响应格式
+        if "scores" not in response_data:
+            raise Exception(f"API响应格式异常: 缺少scores字段. 响应内容: {response_data}")
+
+        # 提取重新排序结果
+        reranker_result = {
+            "scores": response_data["scores"],
+            "input_tokens": response_data.get("input_tokens", 0),
+            "request_id": response_data.get("request_id"),
+            "inference_status": response_data.get("inference_status", {})
+        }
+        prompt_tokens = response_data.get("input_tokens", len(prompt.split()) + sum(len(doc.split()) for doc in documents_list))
+        return reranker_result, prompt_tokens
+
+    @staticmethod
+    def _build_deepinfra_usage(api_key, model_name, result, prompt_tokens, create_time, success, remark):
+        finish_time = datetime.now()
+        execution_time = (finish_time - create_time).total_seconds()
+        return dict(
+            api_key=api_key,
+            model_name=model_name,
+            source_name="deepinfra",
+            prompt_tokens=prompt_tokens,
+            completion_tokens=0,  # embedding/reranker不产生completion tokens
+            create_time=create_time,
+            finish_time=finish_time,
+            execution_time=execution_time,
+            status=success,
+            request_id=LLM_Wrapper._generate_request_id(str(result), finish_time),
+            remark=remark
+        )
+
+    @staticmethod
+    def _run_deepinfra_request(label, build_request, parse_response, timeout):
+        """带重试地发送deepinfra请求, 返回(result, prompt_tokens, success)"""
+        url, headers, payload = build_request()
+        LLM_Wrapper.retry_policy.deposit()
+        for curr_retry in range(1, MAX_RETRY + 1):
+            try:
+                # 发送请求
+                response = get_session(url).post(url, headers=headers, json=payload, timeout=request_timeout(timeout))
+                response.raise_for_status()
+                result, prompt_tokens = parse_response(response.json())
+                return result, prompt_tokens, True
+            except Exception as e:
+                delay = LLM_Wrapper._retry_delay([(label, e)], curr_retry) if curr_retry < MAX_RETRY else None
+                if delay is not None:
+                    print(f"{label} retry {curr_retry}/{MAX_RETRY}. Error: {str(e)}")
+                    time.sleep(delay)
+                else:
+                    print(f"{label} failed after {curr_retry} retries. Final error: {str(e)}")
+                    break
+        return None, 0, False
+
+    @staticmethod
+    async def _arun_deepinfra_request(label, build_request, parse_response, timeout):
+        """_run_deepinfra_request的协程版本"""
+        url, headers, payload = build_request()
+        LLM_Wrapper.retry_policy.deposit()
+        for curr_retry in range(1, MAX_RETRY + 1):
+            try:
+                response = await get_async_client(url).post(url, headers=headers, json=payload, timeout=request_timeout(timeout))
+                response.raise_for_status()
+                result, prompt_tokens = parse_response(response.json())
+                return result, prompt_tokens, True
+            except Exception as e:
+                delay = LLM_Wrapper._retry_delay([(label, e)], curr_retry) if curr_retry < MAX_RETRY else None
+                if delay is not None:
+                    print(f"{label} retry {curr_retry}/{MAX_RETRY}. Error: {str(e)}")
+                    await asyncio.sleep(delay)
+                else:
+                    print(f"{label} failed after {curr_retry} retries. Final error: {str(e)}")
+                    break
+        return None, 0, False
+
     @staticmethod
+    @with_deadline(timeout_param='timeout')
     def generate_embedding(model_name: str,
         prompt: str,
         test_response=None,
@@ -1536,7 +2225,7 @@ class LLM_Wrapper:
             model_name (str): 模型名称，仅支持embedding模型
             prompt (str): 输入文本
             test_response (dict, optional): 测试响应，用于测试
-            timeout (int): 请求超时时间（秒）
+            timeout (int): 整次调用的超时时间（秒）, 选路、获取密钥、每次尝试和重试等待共用
             remark (str): 备注信息
 
         Returns:
@@ -1552,98 +2241,21 @@ class LLM_Wrapper:
         if test_response is not None:
             return test_response
             
-        # 只支持deepinfra源
-        source_name = "deepinfra"
-        deepinfra_config = source_config[source_name]
-        
-        # 获取实际模型名称
-        actual_model_name = model_name  # embedding模型使用原始名称
-        
-        # 获取API密钥
-        harness = Harness_localAPI()
-        api_key = harness.get_api_key(source_name)
+        # 只支持deepinfra源, embedding模型使用原始名称
+        api_key = Harness_localAPI().get_api_key("deepinfra")
         
-        # 创建CurlInfra实例
-        curl_infra = CurlInfra("https://api.deepinfra.com/v1/openai/embeddings", api_key)
-        
-        curr_retry = 0
-        success = False
         create_time = datetime.now()
-        embedding_result = None
-        prompt_tokens = 0
-        completion_tokens = 0
-        
-        while curr_retry < MAX_RETRY:
-            try:
-                # 构建请求数据
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {api_key}"
-                }
-                
-                payload = {
-                    "input": prompt,
-                    "model": actual_model_name,
-                    "encoding_format": "float"
-                }
-                
-                # 发送请求
-                response = requests.post(
-                    "https://api.deepinfra.com/v1/openai/embeddings",
-                    headers=headers,
-                    json=payload,
-                    timeout=timeout
-                )
-                response.raise_for_status()
-                
-                # 解析响应
-                response_data = response.json()
-                
-                # 检查响应格式
-                if "data" not in response_data or not response_data["data"]:
-                    raise Exception(f"API响应格式异常: 缺少data字段. 响应内容: {response_data}")
-                
-                # 提取嵌入向量
-                embedding_result = {
-                    "embedding": response_data["data"][0]["embedding"],
-                    "model": response_data["model"],
-                    "usage": response_data.get("usage", {})
-                }
-                
-                prompt_tokens = response_data.get("usage", {}).get("prompt_tokens", len(prompt.split()))
-                completion_tokens = 0  # embedding不产生completion tokens
-                success = True
-                break
-                
-            except Exception as e:
-                curr_retry += 1
-                if curr_retry < MAX_RETRY:
-                    print(f"Embedding retry {curr_retry}/{MAX_RETRY}. Error: {str(e)}")
-                    time.sleep(SLEEP_TIME)
-                else:
-                    print(f"Embedding failed after {MAX_RETRY} retries. Final error: {str(e)}")
-                    
-        # 记录结束时间和执行时间
-        finish_time = datetime.now()
-        execution_time = (finish_time - create_time).total_seconds()
-        
-        # 生成请求ID
-        request_id = LLM_Wrapper._generate_request_id(str(embedding_result), finish_time)
+        embedding_result, prompt_tokens, success = LLM_Wrapper._run_deepinfra_request(
+            "Embedding",
+            lambda: LLM_Wrapper._build_embedding_request(model_name, api_key, prompt),
+            lambda data: LLM_Wrapper._parse_embedding_response(data, prompt),
+            timeout,
+        )
         
         # 发送API使用记录
-        LLM_Wrapper._send_api_key_usage(
-            api_key=api_key,
-            model_name=actual_model_name,
-            source_name=source_name,
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            create_time=create_time,
-            finish_time=finish_time,
-            execution_time=execution_time,
-            status=success,
-            request_id=request_id,
-            remark=remark
-        )
+        LLM_Wrapper._send_api_key_usage(**LLM_Wrapper._build_deepinfra_usage(
+            api_key, model_name, embedding_result, prompt_tokens, create_time, success, remark
+        ))
         
         if not success:
             raise Exception(f"Failed to generate embedding after {MAX_RETRY} retries")
@@ -1651,6 +2263,7 @@ class LLM_Wrapper:
         return embedding_result
     
     @staticmethod
+    @with_deadline(timeout_param='timeout')
     def generate_reranker(model_name: str,
         prompt: str,
         documents_list: list,
@@ -1664,7 +2277,7 @@ class LLM_Wrapper:
             model_name (str): 模型名称，仅支持reranker模型
             prompt (str): 查询文本
             documents_list (list): 文档列表
-            timeout (int): 请求超时时间（秒）
+            timeout (int): 整次调用的超时时间（秒）, 选路、获取密钥、每次尝试和重试等待共用
             test_response (dict, optional): 测试响应，用于测试
             remark (str): 备注信息
 
@@ -1685,99 +2298,509 @@ class LLM_Wrapper:
         if not isinstance(documents_list, list) or len(documents_list) == 0:
             raise ValueError("documents_list must be a non-empty list")
             
-        # 只支持deepinfra源
-        source_name = "deepinfra"
-        deepinfra_config = source_config[source_name]
+        # 只支持deepinfra源, reranker模型使用原始名称
+        api_key = Harness_localAPI().get_api_key("deepinfra")
         
-        # 获取实际模型名称
-        actual_model_name = model_name  # reranker模型使用原始名称
+        create_time = datetime.now()
+        reranker_result, prompt_tokens, success = LLM_Wrapper._run_deepinfra_request(
+            "Reranker",
+            lambda: LLM_Wrapper._build_reranker_request(model_name, api_key, prompt, documents_list),
+            lambda data: LLM_Wrapper._parse_reranker_response(data, prompt, documents_list),
+            timeout,
+        )
         
-        # 获取API密钥
-        harness = Harness_localAPI()
-        api_key = harness.get_api_key(source_name)
+        # 发送API使用记录
+        LLM_Wrapper._send_api_key_usage(**LLM_Wrapper._build_deepinfra_usage(
+            api_key, model_name, reranker_result, prompt_tokens, create_time, success, remark
+        ))
         
-        curr_retry = 0
-        success = False
+        if not success:
+            raise Exception(f"Failed to rerank documents after {MAX_RETRY} retries")
+            
+        return reranker_result
+
+    # ------------------------------------------------------------------
+    # 协程版本: 与同步版本参数和返回值一致, 在事件循环中并发调用时不占用线程
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def agenerate(
+        model_name,
+        prompt,
+        mode="fast_first",
+        timeout=30,
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark="",
+        hedge=False
+    ):
+        """generate的协程版本"""
+        LLM_Wrapper._validate_model_for_generate(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        load_balancing = await LoadBalancing.acreate()
+        config = await load_balancing.aget_config(
+            model_name, mode, input_proportion, output_proportion,
+            prompt_tokens=estimate_tokens(prompt), max_tokens=max_tokens,
+            affinity_key=prefix_key(prompt)
+        )
+        LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
+
+        messages = [{"role": "user", "content": prompt}]
+        attempts = LLM_Wrapper._build_text_attempts(config, messages)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
         create_time = datetime.now()
-        reranker_result = None
-        prompt_tokens = 0
-        completion_tokens = 0
-        
-        while curr_retry < MAX_RETRY:
+        response, attempt, errors = await LLM_Wrapper._arun_with_failover(
+            attempts, [], timeout, additional_params, hedge=hedge
+        )
+        content, usage = LLM_Wrapper._finish_text(estimate_tokens(prompt), response, attempt, attempts, create_time, remark)
+        await LLM_Wrapper._asend_api_key_usage(**usage)
+        for hedge_usage in LLM_Wrapper._hedge_usage_records(errors, create_time, remark):
+            await LLM_Wrapper._asend_api_key_usage(**hedge_usage)
+
+        if response is None:
+            raise Exception(f"Failed to get response after {MAX_RETRY} retries")
+
+        return remove_thinking(content)
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def agenerate_mm(
+        model_name: str,
+        prompt: str,
+        img_base64: str,
+        img_url=None,
+        timeout=30,
+        mode="fast_first",
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark="",
+        hedge=False
+    ):
+        """generate_mm的协程版本"""
+        LLM_Wrapper._validate_model_for_generate_mm(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        load_balancing = await LoadBalancing.acreate()
+        config = await load_balancing.aget_config(
+            model_name, mode, input_proportion, output_proportion,
+            prompt_tokens=estimate_tokens(prompt, images=1), max_tokens=max_tokens,
+            affinity_key=prefix_key(prompt)
+        )
+        LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
+
+        downloaded_img_base64 = img_base64
+        if LLM_Wrapper._needs_image_download(config, img_url, img_base64):
             try:
-                # 构建请求数据
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"bearer {api_key}"
-                }
-                
-                payload = {
-                    "queries": [prompt] * len(documents_list),
-                    "documents": documents_list
-                }
-                
-                # 发送请求
-                response = requests.post(
-                    f"https://api.deepinfra.com/v1/inference/{actual_model_name}",
-                    headers=headers,
-                    json=payload,
-                    timeout=timeout
-                )
-                response.raise_for_status()
-                
-                # 解析响应
-                response_data = response.json()
-                
-                # 检查响应格式
-                if "scores" not in response_data:
-                    raise Exception(f"API响应格式异常: 缺少scores字段. 响应内容: {response_data}")
-                
-                # 提取重新排序结果
-                reranker_result = {
-                    "scores": response_data["scores"],
-                    "input_tokens": response_data.get("input_tokens", 0),
-                    "request_id": response_data.get("request_id"),
-                    "inference_status": response_data.get("inference_status", {})
-                }
-                
-                prompt_tokens = response_data.get("input_tokens", len(prompt.split()) + sum(len(doc.split()) for doc in documents_list))
-                completion_tokens = 0  # reranker不产生completion tokens
-                success = True
-                break
-                
+                downloaded_img_base64 = await LLM_Wrapper._adownload_image_to_base64(img_url, timeout)
+                print(f"Pre-downloaded image for Google API compatibility")
             except Exception as e:
-                curr_retry += 1
-                if curr_retry < MAX_RETRY:
-                    print(f"Reranker retry {curr_retry}/{MAX_RETRY}. Error: {str(e)}")
-                    time.sleep(SLEEP_TIME)
-                else:
-                    print(f"Reranker failed after {MAX_RETRY} retries. Final error: {str(e)}")
-                    
-        # 记录结束时间和执行时间
-        finish_time = datetime.now()
-        execution_time = (finish_time - create_time).total_seconds()
-        
-        # 生成请求ID
-        request_id = LLM_Wrapper._generate_request_id(str(reranker_result), finish_time)
-        
-        # 发送API使用记录
-        LLM_Wrapper._send_api_key_usage(
-            api_key=api_key,
-            model_name=actual_model_name,
-            source_name=source_name,
-            prompt_tokens=prompt_tokens,
-            completion_tokens=completion_tokens,
-            create_time=create_time,
-            finish_time=finish_time,
-            execution_time=execution_time,
-            status=success,
-            request_id=request_id,
-            remark=remark
+                print(f"Warning: Failed to download image for Google API: {str(e)}")
+
+        attempts = LLM_Wrapper._build_mm_attempts(config, prompt, img_base64, img_url, downloaded_img_base64)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
+        create_time = datetime.now()
+        response, attempt, errors = await LLM_Wrapper._arun_with_failover(
+            attempts, [], timeout, additional_params, validate=LLM_Wrapper._check_content_not_empty, hedge=hedge
         )
-        
+        content, usage = LLM_Wrapper._finish_text(
+            estimate_tokens(prompt, images=1), response, attempt, attempts, create_time, remark
+        )
+        await LLM_Wrapper._asend_api_key_usage(**usage)
+        for hedge_usage in LLM_Wrapper._hedge_usage_records(errors, create_time, remark):
+            await LLM_Wrapper._asend_api_key_usage(**hedge_usage)
+
+        if response is None:
+            raise Exception(f"Failed to get response after {MAX_RETRY} retries")
+
+        return remove_thinking(content)
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def afunction_calling(
+        model_name,
+        prompt,
+        tools,
+        timeout=30,
+        mode="fast_first",
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark="",
+        hedge=False
+    ):
+        """function_calling的协程版本"""
+        LLM_Wrapper._validate_model_for_function_calling(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        load_balancing = await LoadBalancing.acreate()
+        config = await load_balancing.aget_config(
+            model_name, mode, input_proportion, output_proportion,
+            prompt_tokens=estimate_tokens(prompt, json.dumps(tools, ensure_ascii=False)), max_tokens=max_tokens,
+            affinity_key=prefix_key(json.dumps(tools, ensure_ascii=False), prompt)
+        )
+        LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
+
+        messages = [{"role": "user", "content": prompt}]
+        attempts = LLM_Wrapper._build_text_attempts(config, messages)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+        tools_str = json.dumps(tools, ensure_ascii=False)
+
+        create_time = datetime.now()
+        response, attempt, errors = await LLM_Wrapper._arun_with_failover(
+            attempts, tools, timeout, additional_params, hedge=hedge
+        )
+        response_content, usage = LLM_Wrapper._finish_function_call(
+            estimate_tokens(prompt, tools_str), response, attempt, attempts, create_time, remark
+        )
+        await LLM_Wrapper._asend_api_key_usage(**usage)
+        for hedge_usage in LLM_Wrapper._hedge_usage_records(errors, create_time, remark):
+            await LLM_Wrapper._asend_api_key_usage(**hedge_usage)
+
+        if response is None:
+            raise Exception(f"Failed to get response after {MAX_RETRY} retries")
+
+        return response_content
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def agenerate_fromTHEbest(
+        model_list,
+        prompt,
+        mode="fast_first",
+        timeout=30,
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark=""
+    ):
+        """generate_fromTHEbest的协程版本"""
+        for model_name in model_list:
+            LLM_Wrapper._validate_model_for_generate(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        load_balancing = await LoadBalancing.acreate()
+        front = await load_balancing.aselect_the_front_fromAbatch(
+            model_list, mode, input_proportion, output_proportion
+        )
+        attempts = LLM_Wrapper._build_best_attempts(front, prompt)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
+        create_time = datetime.now()
+        response, attempt, errors = await LLM_Wrapper._arun_with_failover(
+            attempts, [], timeout, additional_params, max_retry=1
+        )
+        content, usage = LLM_Wrapper._finish_text(estimate_tokens(prompt), response, attempt, attempts, create_time, remark)
+        usage["prompt_tokens"] = usage["prompt_tokens"] or estimate_tokens(prompt)
+        await LLM_Wrapper._asend_api_key_usage(**usage)
+
+        if response is None:
+            raise Exception(LLM_Wrapper._best_failure_message(front[0][0], errors))
+
+        return remove_thinking(content)
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def agenerate_mm_fromTHEbest(
+        model_list,
+        prompt,
+        img_base64,
+        img_url=None,
+        timeout=30,
+        mode="fast_first",
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark=""
+    ):
+        """generate_mm_fromTHEbest的协程版本"""
+        for model_name in model_list:
+            LLM_Wrapper._validate_model_for_generate_mm(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        load_balancing = await LoadBalancing.acreate()
+        front = await load_balancing.aselect_the_front_fromAbatch(
+            model_list, mode, input_proportion, output_proportion
+        )
+        attempts = LLM_Wrapper._build_best_attempts(front, prompt, img_base64, img_url, multimodal=True)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
+        create_time = datetime.now()
+        prompt_tokens = estimate_tokens(prompt, images=1)
+        response, attempt, errors = await LLM_Wrapper._arun_with_failover(
+            attempts, [], timeout, additional_params, max_retry=1
+        )
+        content, usage = LLM_Wrapper._finish_text(prompt_tokens, response, attempt, attempts, create_time, remark)
+        usage["prompt_tokens"] = usage["prompt_tokens"] or prompt_tokens
+        await LLM_Wrapper._asend_api_key_usage(**usage)
+
+        if response is None:
+            raise Exception(LLM_Wrapper._best_failure_message(front[0][0], errors))
+
+        return remove_thinking(content)
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def afunction_calling_fromTHEbest(
+        model_list,
+        prompt,
+        tools,
+        timeout=30,
+        mode="fast_first",
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark=""
+    ):
+        """function_calling_fromTHEbest的协程版本"""
+        for model_name in model_list:
+            LLM_Wrapper._validate_model_for_function_calling(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        load_balancing = await LoadBalancing.acreate()
+        front = await load_balancing.aselect_the_front_fromAbatch(
+            model_list, mode, input_proportion, output_proportion
+        )
+        attempts = LLM_Wrapper._build_best_attempts(front, prompt)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+
+        create_time = datetime.now()
+        prompt_tokens = estimate_tokens(prompt, json.dumps(tools, ensure_ascii=False))
+        response, attempt, errors = await LLM_Wrapper._arun_with_failover(
+            attempts, tools, timeout, additional_params, max_retry=1
+        )
+        response_content, usage = LLM_Wrapper._finish_function_call(
+            prompt_tokens, response, attempt, attempts, create_time, remark
+        )
+        usage["prompt_tokens"] = usage["prompt_tokens"] or prompt_tokens
+        await LLM_Wrapper._asend_api_key_usage(**usage)
+
+        if response is None:
+            raise Exception(LLM_Wrapper._best_failure_message(front[0][0], errors))
+
+        return response_content
+
+    @staticmethod
+    async def agenerate_stream(
+        model_name,
+        prompt,
+        mode="fast_first",
+        timeout=30,
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark=""
+    ):
+        """generate_stream的异步生成器版本, 使用async for读取"""
+        LLM_Wrapper._validate_model_for_generate(model_name)
+
+        if test_response is not None:
+            yield test_response
+            return
+
+        load_balancing = await LoadBalancing.acreate()
+        config = await load_balancing.aget_config(
+            model_name, mode, input_proportion, output_proportion,
+            prompt_tokens=estimate_tokens(prompt), max_tokens=max_tokens,
+            affinity_key=prefix_key(prompt)
+        )
+        LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
+
+        messages = [{"role": "user", "content": prompt}]
+        attempts = LLM_Wrapper._build_text_attempts(config, messages)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+        stream = LLM_Wrapper._astream_with_failover(attempts, timeout, additional_params, estimate_tokens(prompt), remark)
+        try:
+            async for text in stream:
+                yield text
+        finally:
+            await stream.aclose()
+
+    @staticmethod
+    async def agenerate_mm_stream(
+        model_name: str,
+        prompt: str,
+        img_base64: str,
+        img_url=None,
+        timeout=30,
+        mode="fast_first",
+        input_proportion=60,
+        output_proportion=40,
+        max_tokens=None,
+        test_response=None,
+        remark=""
+    ):
+        """generate_mm_stream的异步生成器版本, 使用async for读取"""
+        LLM_Wrapper._validate_model_for_generate_mm(model_name)
+
+        if test_response is not None:
+            yield test_response
+            return
+
+        load_balancing = await LoadBalancing.acreate()
+        config = await load_balancing.aget_config(
+            model_name, mode, input_proportion, output_proportion,
+            prompt_tokens=estimate_tokens(prompt, images=1), max_tokens=max_tokens,
+            affinity_key=prefix_key(prompt)
+        )
+        LLM_Wrapper._verify_model_mapping(config[0], config[3], config[1], config[4], model_name)
+
+        downloaded_img_base64 = img_base64
+        if LLM_Wrapper._needs_image_download(config, img_url, img_base64):
+            try:
+                downloaded_img_base64 = await LLM_Wrapper._adownload_image_to_base64(img_url, timeout)
+                print(f"Pre-downloaded image for Google API compatibility")
+            except Exception as e:
+                print(f"Warning: Failed to download image for Google API: {str(e)}")
+
+        attempts = LLM_Wrapper._build_mm_attempts(config, prompt, img_base64, img_url, downloaded_img_base64)
+        additional_params = LLM_Wrapper._build_additional_params(max_tokens)
+        stream = LLM_Wrapper._astream_with_failover(
+            attempts, timeout, additional_params, estimate_tokens(prompt, images=1), remark
+        )
+        try:
+            async for text in stream:
+                yield text
+        finally:
+            await stream.aclose()
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def agenerate_doc(
+        model_name: str,
+        prompt: str,
+        pdf_base64: str,
+        timeout=240,
+        test_response=None,
+        remark=""
+    ):
+        """generate_doc的协程版本"""
+        LLM_Wrapper._validate_model_for_generate_doc(model_name)
+        LLM_Wrapper._validate_model_is_google_source(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        source_name = "google"
+        source_model_name = source_mapping[source_name][model_name]
+        api_key = ""
+        create_time = datetime.now()
+        try:
+            api_key = await Harness_localAPI().aget_api_key(source_name)
+            create_time = datetime.now()
+
+            url, headers, payload = LLM_Wrapper._build_doc_request(source_model_name, api_key, prompt, pdf_base64)
+            response = await get_async_client(url).post(url, headers=headers, json=payload, timeout=request_timeout(timeout))
+            response.raise_for_status()
+            response_data = response.json()
+            content = LLM_Wrapper._parse_doc_response(response_data)
+
+            await LLM_Wrapper._asend_api_key_usage(**LLM_Wrapper._build_doc_usage(
+                api_key, source_model_name, source_name, prompt, response_data.get("usageMetadata"), content,
+                create_time, True, remark
+            ))
+
+            return remove_thinking(content)
+        except ValueError as ve:
+            raise ve
+        except Exception as e:
+            try:
+                await LLM_Wrapper._asend_api_key_usage(**LLM_Wrapper._build_doc_usage(
+                    api_key, source_model_name, source_name, prompt, None, "", create_time, False, remark
+                ))
+            except:
+                pass  # 忽略记录失败的错误
+
+            raise Exception(f"PDF processing failed: {str(e)}")
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def agenerate_embedding(model_name: str,
+        prompt: str,
+        test_response=None,
+        timeout=10,
+        remark="embedding"):
+        """generate_embedding的协程版本"""
+        LLM_Wrapper._validate_model_for_embedding(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        api_key = await Harness_localAPI().aget_api_key("deepinfra")
+
+        create_time = datetime.now()
+        embedding_result, prompt_tokens, success = await LLM_Wrapper._arun_deepinfra_request(
+            "Embedding",
+            lambda: LLM_Wrapper._build_embedding_request(model_name, api_key, prompt),
+            lambda data: LLM_Wrapper._parse_embedding_response(data, prompt),
+            timeout,
+        )
+        await LLM_Wrapper._asend_api_key_usage(**LLM_Wrapper._build_deepinfra_usage(
+            api_key, model_name, embedding_result, prompt_tokens, create_time, success, remark
+        ))
+
+        if not success:
+            raise Exception(f"Failed to generate embedding after {MAX_RETRY} retries")
+
+        return embedding_result
+
+    @staticmethod
+    @with_deadline(timeout_param='timeout')
+    async def agenerate_reranker(model_name: str,
+        prompt: str,
+        documents_list: list,
+        timeout=10,
+        test_response=None,
+        remark="reranker"):
+        """generate_reranker的协程版本"""
+        LLM_Wrapper._validate_model_for_reranker(model_name)
+
+        if test_response is not None:
+            return test_response
+
+        if not isinstance(documents_list, list) or len(documents_list) == 0:
+            raise ValueError("documents_list must be a non-empty list")
+
+        api_key = await Harness_localAPI().aget_api_key("deepinfra")
+
+        create_time = datetime.now()
+        reranker_result, prompt_tokens, success = await LLM_Wrapper._arun_deepinfra_request(
+            "Reranker",
+            lambda: LLM_Wrapper._build_reranker_request(model_name, api_key, prompt, documents_list),
+            lambda data: LLM_Wrapper._parse_reranker_response(data, prompt, documents_list),
+            timeout,
+        )
+        await LLM_Wrapper._asend_api_key_usage(**LLM_Wrapper._build_deepinfra_usage(
+            api_key, model_name, reranker_result, prompt_tokens, create_time, success, remark
+        ))
+
         if not success:
             raise Exception(f"Failed to rerank documents after {MAX_RETRY} retries")
-            
+
         return reranker_result
     
 if __name__ == "__main__":
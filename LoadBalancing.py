@@ -1,15 +1,54 @@
 try:
-    from .ew_config.source import source_price, source_ranking, source_mapping, model_list_normal, model_list_thinking, model_list_mm_normal, model_list_mm_thinking, health_check_blacklist, is_model_health_check_blacklisted
+    from .ew_config.source import source_price, source_max_ioLength, source_ranking, source_mapping, model_list_normal, model_list_thinking, model_list_mm_normal, model_list_mm_thinking, health_check_blacklist, is_model_health_check_blacklisted
     from .ew_config.api_keys import pool_mapping
+    from .ew_config import api_keys as api_keys_config
+    from .ew_api.session_pool import get_async_client
+    from .ew_decorator.with_timeout import request_timeout
+    from .ew_router.snapshot import HealthSnapshotStore
+    from .ew_router.routing_table import RoutingTable
+    from .ew_router.health_index import HealthIndexCache
+    from .ew_router.scoring import ScoringEngine
+    from .ew_router.pareto import pareto_front
+    from .ew_router.passive_stats import PassiveStats, blend_route
+    from .ew_router.concurrency import ConcurrencyLimiter
+    from .ew_router.rate_limit import KeyRateLimiter
+    from .ew_router.circuit_breaker import CircuitBreakerRegistry
+    from .ew_router.load_spread import spread_route
+    from .ew_router.context_length import required_length, fits
+    from .ew_router.quantile_sketch import QuantileSketch, QUANTILE_MODES, merged_quantile
+    from .ew_router.key_lease import KeyLeaseCache, KEY_LEASE_SIZE
+    from .ew_router.bandit import BanditArms, ArmPrior, thompson_order, ADAPTIVE_MODE
+    from .ew_router.affinity import ring_order, AFFINITY_MODE
+    from .ew_router.shared_state import open_shared_state, SharedHealthSource, SharedPassiveStats
 except ImportError:
-    from ew_config.source import source_price, source_ranking, source_mapping, model_list_normal, model_list_thinking, model_list_mm_normal, model_list_mm_thinking, health_check_blacklist, is_model_health_check_blacklisted
+    from ew_config.source import source_price, source_max_ioLength, source_ranking, source_mapping, model_list_normal, model_list_thinking, model_list_mm_normal, model_list_mm_thinking, health_check_blacklist, is_model_health_check_blacklisted
     from ew_config.api_keys import pool_mapping
+    from ew_config import api_keys as api_keys_config
+    from ew_api.session_pool import get_async_client
+    from ew_decorator.with_timeout import request_timeout
+    from ew_router.snapshot import HealthSnapshotStore
+    from ew_router.routing_table import RoutingTable
+    from ew_router.health_index import HealthIndexCache
+    from ew_router.scoring import ScoringEngine
+    from ew_router.pareto import pareto_front
+    from ew_router.passive_stats import PassiveStats, blend_route
+    from ew_router.concurrency import ConcurrencyLimiter
+    from ew_router.rate_limit import KeyRateLimiter
+    from ew_router.circuit_breaker import CircuitBreakerRegistry
+    from ew_router.load_spread import spread_route
+    from ew_router.context_length import required_length, fits
+    from ew_router.quantile_sketch import QuantileSketch, QUANTILE_MODES, merged_quantile
+    from ew_router.key_lease import KeyLeaseCache, KEY_LEASE_SIZE
+    from ew_router.bandit import BanditArms, ArmPrior, thompson_order, ADAPTIVE_MODE
+    from ew_router.affinity import ring_order, AFFINITY_MODE
+    from ew_router.shared_state import open_shared_state, SharedHealthSource, SharedPassiveStats
 import numpy as np
 from datetime import datetime
 import requests
 import os
 import logging
 import random
+import asyncio
 
 """目标: 在需要一个模型时, 输入自定义模型名, 推出最满足当前需求的源下模型,
 以及主模型和备用模型, 各自源下模型负载均衡后的api_key.
@@ -21,46 +60,262 @@ TOLERANCE_TIMES = int(os.environ.get("TOLERANCE_TIMES", 4))
 API_HEALTH_CHECK_URL = os.environ.get("API_HEALTH_CHECK_URL", "http://localhost:8001/check_healthy")
 API_KEY_MANAGER_URL = os.environ.get("API_KEY_MANAGER_URL", "http://localhost:8002")
 API_KEY_MANAGER_GET_ENDPOINT = os.environ.get("API_KEY_MANAGER_GET_ENDPOINT", "/get_apikey")
+API_KEY_MANAGER_LEASE_ENDPOINT = os.environ.get("API_KEY_MANAGER_LEASE_ENDPOINT", "/lease_apikeys")
+API_KEY_MANAGER_REVOCATIONS_ENDPOINT = os.environ.get("API_KEY_MANAGER_REVOCATIONS_ENDPOINT", "/revocations")
+# 访问健康检查服务和API密钥管理服务的超时时间(秒), 调用方设置了请求级截止时间时不超过剩余时间
 INNER_TIMEOUT = int(os.environ.get("INNER_TIMEOUT", 5))
+# *_fromTHEbest在帕累托前沿中最多依次尝试的候选数
+BEST_FRONT_SIZE = int(os.environ.get("BEST_FRONT_SIZE", 3))
+
+# fast_p50/fast_p95/fast_p99按耗时分位数路由, 其余行为与fast_first相同
+# adaptive按真实请求结果的后验做Thompson采样, 不经过路由表
+# affinity按提示前缀的一致性哈希把相同前缀固定到同一(源, 密钥), 以命中供应商的提示缓存
+ROUTING_MODES = ["cheap_first", "fast_first"] + list(QUANTILE_MODES) + [ADAPTIVE_MODE, AFFINITY_MODE]
 
 
 class Harness_localAPI:
     @staticmethod
-    def check_healthy():
-        """从本地健康检查服务获取API健康状态数据
-        
-        Returns:
-            dict: 包含时间戳、检查间隔和健康数据的字典
-        """
+    def _empty_health_data():
+        """健康检查服务不可用时返回的空数据结构"""
+        return {"timestamp": datetime.now().isoformat(), "check_timer_span": 15, "data": {}}
+
+    @staticmethod
+    def _parse_health_data(result):
+        """将健康检查服务返回的字符串键转换为元组键, None转换为np.nan, 分位数草图还原为QuantileSketch"""
+        if "data" in result:
+            result["data"] = {tuple(key.split("|")): [np.nan if v is None else v for v in value] for key, value in result["data"].items()}
+        sketches = {}
+        for key, value in (result.get("sketches") or {}).items():
+            try:
+                sketches[tuple(key.split("|"))] = QuantileSketch.from_dict(value)
+            except ValueError as e:
+                logging.getLogger(__name__).warning(f"忽略无效的分位数草图 {key}: {e}")
+        result["sketches"] = sketches
+        return result
+
+    @staticmethod
+    def _to_health_data(raw):
+        """健康检查服务返回的原始数据 -> 健康检查数据, 请求失败(raw为None)时返回空数据结构"""
+        return Harness_localAPI._empty_health_data() if raw is None else Harness_localAPI._parse_health_data(raw)
+
+    @staticmethod
+    def _request_health_data():
+        """请求本地健康检查服务, 返回未解析的原始数据, 失败时返回None"""
         logger = logging.getLogger(__name__)
         # 防止日志向上传播，避免重复打印
         logger.propagate = False
         try:
             # 调用本地健康检查服务API
             logger.info("正在调用健康检查服务API获取健康状态数据")
-            response = requests.get(API_HEALTH_CHECK_URL, timeout=INNER_TIMEOUT)
+            response = requests.get(API_HEALTH_CHECK_URL, timeout=request_timeout(INNER_TIMEOUT))
             if response.status_code == 200:
-                result = response.json()
-                # 将字符串键转换为元组键
-                if "data" in result:
-                    result["data"] = {tuple(key.split("|")): [np.nan if v is None else v for v in value] for key, value in result["data"].items()}
                 logger.info("成功获取健康状态数据")
-                return result
+                return response.json()
             else:
-                # 如果API调用失败，返回空数据结构和当前时间
                 logger.error(f"健康检查API返回错误状态码: {response.status_code}")
-                return {"timestamp": datetime.now().isoformat(), "check_timer_span": 15, "data": {}}
+                return None
         except Exception as e:
-            # 出现异常时记录错误并返回空数据结构
             logger.error(f"获取健康状态数据时出错: {str(e)}")
-            return {"timestamp": datetime.now().isoformat(), "check_timer_span": 15, "data": {}}
+            return None
+
+    @staticmethod
+    async def _arequest_health_data():
+        """_request_health_data的协程版本"""
+        logger = logging.getLogger(__name__)
+        logger.propagate = False
+        try:
+            logger.info("正在调用健康检查服务API获取健康状态数据")
+            response = await get_async_client(API_HEALTH_CHECK_URL).get(API_HEALTH_CHECK_URL, timeout=request_timeout(INNER_TIMEOUT))
+            if response.status_code == 200:
+                logger.info("成功获取健康状态数据")
+                return response.json()
+            else:
+                logger.error(f"健康检查API返回错误状态码: {response.status_code}")
+                return None
+        except Exception as e:
+            logger.error(f"获取健康状态数据时出错: {str(e)}")
+            return None
+
+    @staticmethod
+    def check_healthy():
+        """从本地健康检查服务获取API健康状态数据
+        
+        Returns:
+            dict: 包含时间戳、检查间隔和健康数据的字典, 服务不可用时为空数据结构
+        """
+        return Harness_localAPI._to_health_data(Harness_localAPI._request_health_data())
+
+    @staticmethod
+    async def acheck_healthy():
+        """check_healthy的协程版本"""
+        return Harness_localAPI._to_health_data(await Harness_localAPI._arequest_health_data())
+
+    @staticmethod
+    def _get_api_key_from_pool(source_name, error, affinity_key=None):
+        """API密钥管理服务不可用时, 从兜底离线配置pool_mapping中随机选择API密钥
+        
+        Args:
+            source_name (str): 源名称
+            error (Exception): 调用API密钥管理服务时的错误
+            affinity_key (str, optional): 亲和键, 给出时按一致性哈希选择密钥
+            
+        Returns:
+            str: API密钥
+            
+        Raises:
+            Exception: 如果兜底离线配置也无法提供API密钥
+        """
+        logger = logging.getLogger(__name__)
+        logger.propagate = False
+        # 连接失败时，尝试使用备用方案：从pool_mapping中获取API密钥
+        logger.warning(f"无法连接到API密钥管理服务 (已离线): {str(error)}，使用兜底离线配获取API密钥")
+        
+        try:
+            if source_name not in pool_mapping:
+                raise ValueError(f"兜底离线配中未找到源 '{source_name}' 的配置")
+            
+            source_pool = pool_mapping[source_name]
+            if not source_pool:
+                raise ValueError(f"源 '{source_name}' 的API密钥池为空")
+            
+            # 从所有账户的所有API密钥中, 随机选择一个未超出RPM/TPM限额的
+            all_api_keys = []
+            for account, keys in source_pool.items():
+                for key_info in keys:
+                    if "api_key" in key_info:
+                        all_api_keys.append(key_info["api_key"])
+            
+            if not all_api_keys:
+                raise ValueError(f"源 '{source_name}' 的兜底离线配中没有有效的API密钥")
+            
+            selected_api_key = key_rate_limiter.pick(
+                source_name, ring_order(all_api_keys, affinity_key), ordered=affinity_key is not None
+            )
+            logger.warning(f"使用兜底离线配置为源 '{source_name}' 随机选择了一个API密钥")
+            return selected_api_key
+            
+        except Exception as backup_e:
+            # 备用方案也失败时，抛出异常
+            error_msg = f"主方案和备用方案都无法获取源 '{source_name}' 的API密钥。主方案错误: {str(error)}，备用方案错误: {str(backup_e)}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
 
     @staticmethod
-    def get_api_key(source_name):
+    def _pick_leased_key(source_name):
+        """从该源仍有效的租约中选择一个未超出RPM/TPM限额的密钥, 没有租约时返回None
+
+        选取次数随之后的使用记录上报给密钥管理服务, 以便其按所有进程的请求数计算RPM.
+        """
+        api_keys = key_leases.keys(source_name)
+        if not api_keys:
+            return None
+        api_key = key_rate_limiter.pick(source_name, api_keys)
+        key_leases.record_pick(source_name, api_key)
+        return api_key
+
+    @staticmethod
+    def _store_lease(source_name, response):
+        """保存租约并从中选择密钥, 密钥管理服务不支持租约(旧版本)等非200响应时返回None"""
+        if response.status_code == 404:
+            # 记住不支持租约, 之后一段时间内直接获取单个密钥, 不再每次多一次往返
+            logging.getLogger(__name__).warning(f"API密钥管理服务不支持租约, {key_leases.ttl}秒内不再尝试")
+            key_leases.mark_unsupported()
+            return None
+        if response.status_code != 200:
+            logging.getLogger(__name__).warning(f"租用 {source_name} 的API密钥时返回错误状态码: {response.status_code}")
+            return None
+        result = response.json()
+        key_leases.store(source_name, result.get("api_keys"), result.get("revocation_epoch"))
+        return Harness_localAPI._pick_leased_key(source_name)
+
+    @staticmethod
+    def _lease_api_key(source_name):
+        """优先使用租约中的密钥, 没有租约时向密钥管理服务租用一组, 连接失败时抛出异常"""
+        api_key = Harness_localAPI._pick_leased_key(source_name)
+        if api_key is not None:
+            return api_key
+        response = requests.post(
+            f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_LEASE_ENDPOINT}",
+            json={"source_name": source_name, "count": KEY_LEASE_SIZE},
+            timeout=request_timeout(INNER_TIMEOUT)
+        )
+        return Harness_localAPI._store_lease(source_name, response)
+
+    @staticmethod
+    async def _alease_api_key(source_name):
+        """_lease_api_key的协程版本"""
+        api_key = Harness_localAPI._pick_leased_key(source_name)
+        if api_key is not None:
+            return api_key
+        url = f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_LEASE_ENDPOINT}"
+        response = await get_async_client(url).post(
+            url,
+            json={"source_name": source_name, "count": KEY_LEASE_SIZE},
+            timeout=request_timeout(INNER_TIMEOUT)
+        )
+        return Harness_localAPI._store_lease(source_name, response)
+
+    @staticmethod
+    def _apply_revocations(result):
+        """按/revocations的响应从租约中移除被吊销的密钥, 吊销记录已被截断时放弃所有租约"""
+        if result.get("reset"):
+            key_leases.clear(result.get("revocation_epoch"))
+        else:
+            key_leases.revoke(result.get("revoked"), result.get("revocation_epoch"))
+
+    @staticmethod
+    def refresh_revocations(epoch):
+        """密钥管理服务的吊销序号比本地新时, 拉取吊销的密钥; 无法同步时放弃所有租约
+        
+        Args:
+            epoch (int): 密钥管理服务响应中的revocation_epoch
+        """
+        if not key_leases.is_stale(epoch):
+            return
+        try:
+            response = requests.get(
+                f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_REVOCATIONS_ENDPOINT}",
+                params={"since": key_leases.epoch},
+                timeout=INNER_TIMEOUT
+            )
+            response.raise_for_status()
+            Harness_localAPI._apply_revocations(response.json())
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"同步API密钥吊销记录失败，放弃所有租约: {str(e)}")
+            key_leases.clear()
+
+    @staticmethod
+    async def arefresh_revocations(epoch):
+        """refresh_revocations的协程版本"""
+        if not key_leases.is_stale(epoch):
+            return
+        try:
+            url = f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_REVOCATIONS_ENDPOINT}"
+            response = await get_async_client(url).get(url, params={"since": key_leases.epoch}, timeout=INNER_TIMEOUT)
+            response.raise_for_status()
+            Harness_localAPI._apply_revocations(response.json())
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"同步API密钥吊销记录失败，放弃所有租约: {str(e)}")
+            key_leases.clear()
+
+    @staticmethod
+    def _key_request(source_name, affinity_key):
+        """获取API密钥的请求体, 旧版本的密钥管理服务会忽略affinity_key"""
+        if affinity_key is None:
+            return {"source_name": source_name}
+        return {"source_name": source_name, "affinity_key": affinity_key}
+
+    @staticmethod
+    def get_api_key(source_name, affinity_key=None):
         """从API密钥管理服务获取API密钥，失败时使用备用方案
         
+        启用租约时优先在本地轮换租用的密钥, 只在租约过期后才访问密钥管理服务.
+        给出亲和键时不使用租约: 租约只是各进程各自轮询租到的一部分密钥, 在其上按一致性哈希选择无法把前缀固定到
+        同一个密钥, 因此直接由密钥管理服务在所有健康的密钥构成的环上选择.
+        
         Args:
             source_name (str): 源名称
+            affinity_key (str, optional): 亲和键, 给出时按一致性哈希把它固定到同一个健康的密钥上
             
         Returns:
             str: API密钥
@@ -72,17 +327,27 @@ class Harness_localAPI:
         # 防止日志向上传播，避免重复打印
         logger.propagate = False
         
+        if key_leases.enabled and affinity_key is None:
+            try:
+                api_key = Harness_localAPI._lease_api_key(source_name)
+            except Exception as e:
+                return Harness_localAPI._get_api_key_from_pool(source_name, e, affinity_key)
+            if api_key is not None:
+                return api_key
+        
         try:
             # 优先尝试调用API密钥管理服务API
             response = requests.post(
                 f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_GET_ENDPOINT}", 
-                json={"source_name": source_name}, 
-                timeout=INNER_TIMEOUT
+                json=Harness_localAPI._key_request(source_name, affinity_key), 
+                timeout=request_timeout(INNER_TIMEOUT)
             )
             
             if response.status_code == 200:
                 result = response.json()
                 logger.info(f"成功从API密钥管理服务获取 {source_name} 的API密钥")
+                # 同步记录到本地限流器, 以便密钥管理服务离线时兜底选择仍然知道近期用量
+                key_rate_limiter.acquire(source_name, result["api_key"])
                 return result["api_key"]
             else:
                 # 如果API调用失败，记录警告并尝试备用方案
@@ -90,46 +355,87 @@ class Harness_localAPI:
                 raise Exception(f"API service returned status code: {response.status_code}")
                 
         except Exception as e:
-            # 连接失败时，尝试使用备用方案：从pool_mapping中获取API密钥
-            logger.warning(f"无法连接到API密钥管理服务 (已离线): {str(e)}，使用兜底离线配获取API密钥")
-            
+            return Harness_localAPI._get_api_key_from_pool(source_name, e, affinity_key)
+
+    @staticmethod
+    async def aget_api_key(source_name, affinity_key=None):
+        """get_api_key的协程版本"""
+        logger = logging.getLogger(__name__)
+        logger.propagate = False
+        
+        if key_leases.enabled and affinity_key is None:
             try:
-                if source_name not in pool_mapping:
-                    raise ValueError(f"兜底离线配中未找到源 '{source_name}' 的配置")
-                
-                source_pool = pool_mapping[source_name]
-                if not source_pool:
-                    raise ValueError(f"源 '{source_name}' 的API密钥池为空")
-                
-                # 从所有账户的所有API密钥中随机选择一个
-                all_api_keys = []
-                for account, keys in source_pool.items():
-                    for key_info in keys:
-                        if "api_key" in key_info:
-                            all_api_keys.append(key_info["api_key"])
-                
-                if not all_api_keys:
-                    raise ValueError(f"源 '{source_name}' 的兜底离线配中没有有效的API密钥")
-                
-                selected_api_key = random.choice(all_api_keys)
-                logger.warning(f"使用兜底离线配置为源 '{source_name}' 随机选择了一个API密钥")
-                return selected_api_key
+                api_key = await Harness_localAPI._alease_api_key(source_name)
+            except Exception as e:
+                return Harness_localAPI._get_api_key_from_pool(source_name, e, affinity_key)
+            if api_key is not None:
+                return api_key
+        
+        try:
+            url = f"{API_KEY_MANAGER_URL}{API_KEY_MANAGER_GET_ENDPOINT}"
+            response = await get_async_client(url).post(
+                url,
+                json=Harness_localAPI._key_request(source_name, affinity_key),
+                timeout=request_timeout(INNER_TIMEOUT)
+            )
+            
+            if response.status_code == 200:
+                result = response.json()
+                logger.info(f"成功从API密钥管理服务获取 {source_name} 的API密钥")
+                # 同步记录到本地限流器, 以便密钥管理服务离线时兜底选择仍然知道近期用量
+                key_rate_limiter.acquire(source_name, result["api_key"])
+                return result["api_key"]
+            else:
+                logger.warning(f"API密钥服务返回错误状态码: {response.status_code}，尝试使用备用方案")
+                raise Exception(f"API service returned status code: {response.status_code}")
                 
-            except Exception as backup_e:
-                # 备用方案也失败时，抛出异常
-                error_msg = f"主方案和备用方案都无法获取源 '{source_name}' 的API密钥。主方案错误: {str(e)}，备用方案错误: {str(backup_e)}"
-                logger.error(error_msg)
-                raise Exception(error_msg)
+        except Exception as e:
+            return Harness_localAPI._get_api_key_from_pool(source_name, e, affinity_key)
+
+
+# 同一主机上各路由进程通过mmap文件共享的健康检查数据和被动统计, 未设置ROUTER_SHARED_STATE_PATH时为None
+shared_state = open_shared_state()
+# 进程级共享的健康检查快照, 由后台线程定时刷新, 各LoadBalancing实例只读共享
+if shared_state is not None:
+    # 快照刷新时优先读取共享文件, 主机上同一时刻只有一个进程请求健康检查服务
+    _shared_health = SharedHealthSource(shared_state, Harness_localAPI._request_health_data,
+                                        Harness_localAPI._arequest_health_data, Harness_localAPI._to_health_data)
+    health_snapshot = HealthSnapshotStore(_shared_health.fetch, _shared_health.afetch)
+else:
+    health_snapshot = HealthSnapshotStore(Harness_localAPI.check_healthy, Harness_localAPI.acheck_healthy)
+# 进程级共享的路由表, 随健康检查快照的版本失效
+routing_table = RoutingTable()
+# 共享快照按模型建立的索引, 随快照版本重建
+health_indexes = HealthIndexCache(TOLERANCE_TIMES)
+# 进程内共享的被动统计, 由LLM_Wrapper在每次请求后记录; 配置了共享文件时计数由主机上所有路由进程共同记录
+passive_stats = SharedPassiveStats(shared_state) if shared_state is not None else PassiveStats()
+# 进程内共享的按源和(源, 模型)的自适应并发限制
+concurrency_limiter = ConcurrencyLimiter()
+# 进程内共享的按密钥和账户的RPM/TPM限流, 旧版配置文件中可能没有account_limit_mapping
+key_rate_limiter = KeyRateLimiter(pool_mapping, getattr(api_keys_config, "account_limit_mapping", None))
+# 进程内共享的按(源, 模型)的熔断器, 由LLM_Wrapper根据真实请求的结果更新
+circuit_breakers = CircuitBreakerRegistry()
+# 进程内共享的API密钥租约, 吊销序号随使用记录的响应同步
+key_leases = KeyLeaseCache()
+# 进程内共享的adaptive模式各臂的后验统计, 由LLM_Wrapper在每次请求后记录
+bandit_arms = BanditArms()
 
 
 class LoadBalancing:
-    def __init__(self) -> None:
-        """初始化LoadBalancing实例，获取健康检查数据和配置"""
+    def __init__(self, healthy=None) -> None:
+        """初始化LoadBalancing实例，获取健康检查数据和配置
+        
+        Args:
+            healthy (dict, optional): 已获取的健康检查数据, 为None时使用进程级共享的健康检查快照
+        """
         # 这里要维护一个包含滑动窗口逻辑的, 每个供应商的每个模型的表现情况队列.
         # 然后先按照损坏概率去降序排序.
         # 再按照执行时间去降序排序.
-        self.healthy = Harness_localAPI.check_healthy()
+        # 快照中的数据被所有实例共享, 只能读取不能修改.
+        # snapshot_version为None表示健康检查数据由调用方传入, 不属于共享快照.
+        self._use_snapshot(health_snapshot.get() if healthy is None else None, healthy)
         self.source_price = source_price
+        self.source_max_ioLength = source_max_ioLength
         self.source_ranking = source_ranking
         self.source_mapping = source_mapping
         # 添加日志记录器
@@ -137,6 +443,53 @@ class LoadBalancing:
         # 防止日志向上传播，避免重复打印
         self.logger.propagate = False
 
+    @classmethod
+    async def acreate(cls):
+        """异步构造LoadBalancing实例, 需要加载健康检查快照时通过协程获取, 不阻塞事件循环"""
+        instance = cls(healthy={})
+        instance._use_snapshot(await health_snapshot.aget())
+        return instance
+
+    def _use_snapshot(self, snapshot, healthy=None):
+        """使用共享快照(snapshot不为None时)或调用方传入的健康检查数据"""
+        if snapshot is not None:
+            self.healthy = snapshot.healthy
+            self.snapshot_version = snapshot.version
+        else:
+            self.healthy = healthy
+            self.snapshot_version = None
+        self._health_index = None
+
+    @property
+    def health_index(self):
+        """按模型索引的健康检查数据, 首次访问时获取"""
+        if self._health_index is None:
+            self._health_index = health_indexes.get(self.snapshot_version, self.healthy)
+        return self._health_index
+
+    @property
+    def scoring(self):
+        """当前健康检查索引上所有模型的评分结果, 随索引一起缓存"""
+        return self.health_index.derived("scoring", lambda index: ScoringEngine(index, self._check_valid_model, self._get_source_price))
+
+    def _is_health_data_expired(self):
+        """健康检查数据距今是否已超过一个检查周期"""
+        # 修复bug: 使用total_seconds()而不是seconds
+        # 同时检查timestamp字段是否存在
+        return bool(self.healthy and "timestamp" in self.healthy and 
+            (datetime.now() - datetime.fromisoformat(self.healthy["timestamp"])).total_seconds() > self.healthy.get("check_timer_span", 15)*60)
+
+    def _refresh_if_expired(self):
+        """健康检查数据过期时换用共享快照中的最新数据, 快照自身的刷新由HealthSnapshotStore负责"""
+        if self._is_health_data_expired():
+            self.logger.info("健康检查数据已过期，正在刷新")
+            self._use_snapshot(health_snapshot.get())
+
+    async def _arefresh_if_expired(self):
+        """健康检查数据过期时异步换用共享快照中的最新数据"""
+        if self._is_health_data_expired():
+            self.logger.info("健康检查数据已过期，正在刷新")
+            self._use_snapshot(await health_snapshot.aget())
 
     def _check_valid_model(self, source_name, model_name):
         """检查模型是否在源上有效
@@ -223,15 +576,9 @@ class LoadBalancing:
                 return True
             
             # 不再处理多模态模型名称，直接使用完整的model_name
-                
             # 寻找该模型在任意源上的非空数据
-            for key, value in self.healthy["data"].items():
-                try:
-                    if len(key) >= 2 and key[1] == model_name and value and len(value) > 0:
-                        return False
-                except Exception as e:
-                    self.logger.warning(f"处理健康数据键 {key} 时出错: {str(e)}")
-                    continue
+            if self.health_index.has_data(model_name):
+                return False
                     
             self.logger.info(f"模型 {model_name} 在所有源上的健康数据均为空")
             return True  # 所有源的该模型数据均为空
@@ -239,6 +586,89 @@ class LoadBalancing:
             self.logger.error(f"检查模型 {model_name} 的健康数据时出错: {str(e)}")
             return True  # 出错时假设数据为空，使用预设排名
     
+    def _rank_sources_from_ranking(self, model_name):
+        """基于预设排名返回所有可用源, 按优先级排序
+        
+        Args:
+            model_name (str): 模型名称
+            
+        Returns:
+            list: 可用源名称列表
+            
+        Raises:
+            ValueError: 如果找不到可用的源
+        """
+        # 检查是否为屏蔽模型
+        if is_model_health_check_blacklisted(model_name):
+            self.logger.info(f"🚫 模型 {model_name} 在健康检测屏蔽清单中，基于预设排名选择源")
+        else:
+            self.logger.info(f"基于预设排名为模型 {model_name} 选择源")
+        
+        # 根据source_ranking选择排名靠前的源
+        sorted_sources = sorted(self.source_ranking.keys(), key=lambda s: self.source_ranking[s])
+        
+        # 找出可用的源（即映射中有此模型的源）
+        available_sources = []
+        for source in sorted_sources:
+            if self._check_valid_model(source, model_name):
+                available_sources.append(source)
+
+        if not available_sources:
+            error_msg = f"在预设排名中找不到模型 {model_name} 的可用源"
+            self.logger.error(error_msg)
+            raise ValueError(error_msg)
+        return available_sources
+
+    @staticmethod
+    def _main_and_backup(sources):
+        """从排好序的候选源中取主源和备用源, 只有一个源时备用源与主源相同"""
+        return sources[0], sources[1] if len(sources) > 1 else sources[0]
+
+    def _select_sources_from_ranking(self, model_name):
+        """基于预设排名选择主源和备用源
+        
+        Args:
+            model_name (str): 模型名称
+            
+        Returns:
+            tuple: (主源名称, 备用源名称)
+            
+        Raises:
+            ValueError: 如果找不到可用的源
+        """
+        main_source, backup_source = self._main_and_backup(self._rank_sources_from_ranking(model_name))
+        self.logger.info(f"选择主源 {main_source} 和备用源 {backup_source} 为模型 {model_name}")
+        return main_source, backup_source
+
+    def _build_config(self, model_name, main_source_name, backup_source_name, main_api_key, backup_api_key):
+        """组装get_config的返回值"""
+        main_source_model_name = self._get_actual_model_name(main_source_name, model_name)
+        backup_source_model_name = self._get_actual_model_name(backup_source_name, model_name)
+        return main_source_name, main_source_model_name, main_api_key, backup_source_name, backup_source_model_name, backup_api_key
+
+    def _fetch_api_keys(self, model_name, main_source_name, backup_source_name, affinity_key=None):
+        """为选定的主源和备用源获取API密钥"""
+        try:
+            main_api_key = Harness_localAPI.get_api_key(main_source_name, affinity_key)
+            backup_api_key = Harness_localAPI.get_api_key(backup_source_name, affinity_key)
+        except Exception as e:
+            # 统一错误消息格式，包含"无法获取API密钥"
+            self.logger.error(f"获取API密钥时出错: {str(e)}")
+            raise ValueError(f"无法获取API密钥: {str(e)}")
+        return self._build_config(model_name, main_source_name, backup_source_name, main_api_key, backup_api_key)
+
+    async def _afetch_api_keys(self, model_name, main_source_name, backup_source_name, affinity_key=None):
+        """_fetch_api_keys的协程版本, 主源和备用源的API密钥并发获取"""
+        try:
+            main_api_key, backup_api_key = await asyncio.gather(
+                Harness_localAPI.aget_api_key(main_source_name, affinity_key),
+                Harness_localAPI.aget_api_key(backup_source_name, affinity_key),
+            )
+        except Exception as e:
+            self.logger.error(f"获取API密钥时出错: {str(e)}")
+            raise ValueError(f"无法获取API密钥: {str(e)}")
+        return self._build_config(model_name, main_source_name, backup_source_name, main_api_key, backup_api_key)
+
     def get_sources_from_ranking(self, model_name):
         """基于预设排名获取源和模型配置
         
@@ -254,44 +684,8 @@ class LoadBalancing:
             ValueError: 如果找不到可用的源
         """
         try:
-            # 检查是否为屏蔽模型
-            if is_model_health_check_blacklisted(model_name):
-                self.logger.info(f"🚫 模型 {model_name} 在健康检测屏蔽清单中，基于预设排名选择源")
-            else:
-                self.logger.info(f"基于预设排名为模型 {model_name} 选择源")
-            
-            # 根据source_ranking选择排名靠前的源
-            sorted_sources = sorted(self.source_ranking.keys(), key=lambda s: self.source_ranking[s])
-            
-            # 找出可用的源（即映射中有此模型的源）
-            available_sources = []
-            for source in sorted_sources:
-                if self._check_valid_model(source, model_name):
-                    available_sources.append(source)
-
-            if not available_sources:
-                error_msg = f"在预设排名中找不到模型 {model_name} 的可用源"
-                self.logger.error(error_msg)
-                raise ValueError(error_msg)
-            
-            # 选择主源和备用源
-            main_source = available_sources[0]
-            backup_source = available_sources[1] if len(available_sources) > 1 else main_source
-            
-            # 获取模型名称和API密钥
-            main_source_model_name = self._get_actual_model_name(main_source, model_name)
-            backup_source_model_name = self._get_actual_model_name(backup_source, model_name)
-            
-            self.logger.info(f"选择主源 {main_source} 和备用源 {backup_source} 为模型 {model_name}")
-            
-            try:
-                main_api_key = Harness_localAPI.get_api_key(main_source)
-                backup_api_key = Harness_localAPI.get_api_key(backup_source)
-            except Exception as e:
-                self.logger.error(f"获取API密钥时出错: {str(e)}")
-                raise ValueError(f"无法获取API密钥: {str(e)}")
-            
-            return main_source, main_source_model_name, main_api_key, backup_source, backup_source_model_name, backup_api_key
+            main_source, backup_source = self._select_sources_from_ranking(model_name)
+            return self._fetch_api_keys(model_name, main_source, backup_source)
         except Exception as e:
             self.logger.error(f"基于预设排名选择源时出错: {str(e)}")
             raise
@@ -319,9 +713,21 @@ class LoadBalancing:
         
         return self.source_mapping[source_name][base_model_name]
 
-    def get_config(self, model_name, mode, input_proportion: int, output_proportion: int):
+    def _get_source_price(self, source_name, model_name):
+        """获取模型在源上的价格配置, 找不到时返回None"""
+        source_model_name = self._get_actual_model_name(source_name, model_name)
+        return self.source_price.get(source_name, {}).get(source_model_name)
+
+    def _get_max_io_length(self, source_name, model_name):
+        """获取模型在源上的最大输入输出长度, 未声明时返回None"""
+        source_model_name = self._get_actual_model_name(source_name, model_name)
+        return self.source_max_ioLength.get(source_name, {}).get(source_model_name)
+
+    def _rank_sources(self, model_name, mode, input_proportion: int, output_proportion: int):
         """维护两套策略, 一套是以便宜为导向,
         一套是以时间最少为导向的.
+        只负责对候选源排序, 不获取API密钥. 结果只取决于健康检查数据和入参,
+        因此由路由表按快照版本缓存.
         
         Args:
             model_name (str): 模型名称
@@ -330,11 +736,10 @@ class LoadBalancing:
             output_proportion (int): 输出比例
             
         Returns:
-            tuple: 包含主源和备用源的配置信息
+            list: 按优先级排序的候选源名称, 第一个为主源, 第二个为备用源
             
         Raises:
-            ValueError: 如果找不到可用的源或配置
-            Exception: 其他错误
+            ValueError: 如果找不到可用的源
         """
         self.logger.info(f"获取模型 {model_name} 的配置，模式: {mode}, 输入比例: {input_proportion}, 输出比例: {output_proportion}")
 
@@ -342,26 +747,18 @@ class LoadBalancing:
         # 因为跑不通大概不是发不过去, 而是response收不回来.
         # pre-filling也是照常收费的, 与其二遍返工, 还不如一次做好.
         # 因此无论如何, 都先用成功率作为筛选.
-        #
-        # 如果当前实例初始化的时候距离当前尝试获取配置的时间已过去超过15min了.
-        # 那么就自动刷新当前健康检查状态.
 
         # ================ 状态维护与入参校验 ================
         
-        # 修复bug: 使用total_seconds()而不是seconds
-        # 同时检查timestamp字段是否存在
-        if (self.healthy and "timestamp" in self.healthy and 
-            (datetime.now() - datetime.fromisoformat(self.healthy["timestamp"])).total_seconds() > self.healthy.get("check_timer_span", 15)*60):
-            self.logger.info("健康检查数据已过期，正在刷新")
-            self.healthy = Harness_localAPI.check_healthy()
+        # 健康检查数据的过期刷新由调用方(get_config/aget_config)负责
         
         # 如果健康数据为空，直接使用预设排名
         if self.is_health_data_empty(model_name):
             self.logger.info(f"健康数据为空，使用预设排名选择模型 {model_name} 的源")
-            return self.get_sources_from_ranking(model_name)
+            return self._rank_sources_from_ranking(model_name)
 
         # 验证模式参数
-        if mode not in ["cheap_first", "fast_first"]:
+        if mode not in ROUTING_MODES:
             self.logger.warning(f"未知的模式 '{mode}'，使用默认模式 'cheap_first'")
             mode = "cheap_first"
         
@@ -373,159 +770,230 @@ class LoadBalancing:
 
         # 处理多模态的情况, 多模态完全默认为等同于常规模型.
         # 只是常规模型的另外一种传参模式.
-        real_model_name = model_name
-        # 不再转换为base_model_name，直接使用完整的model_name
-        
-        span_mean_list = []
-        global_successProb_list = []
-        source_list = []
-        
-        # 收集匹配的模型数据
-        for key in self.healthy["data"]:
-            # 直接使用完整的model_name进行匹配
-            if model_name == key[1]:
-                # 检查是否这个源的这个模型近{TOLERANCE_TIMES}次记录中存在任何一次异常情况.
-                source_list.append(key[0])
-                # 对于没有这个模型的源, 健康检查的数据为空.
-                if not self.healthy["data"][key]:
-                    # 保证即使为空的事后, span_mean_list, global_successProb_list, source_list三个数组的长度和内容也是对齐的.
-                    span_mean_list.append(np.nan)
-                    global_successProb_list.append(np.nan)
-                    continue
-                # 对于健康检查数据不为空的源下的模型, 计算近期平均响应时间
-                recent_data = self.healthy["data"][key][-TOLERANCE_TIMES:]
-                # 过滤掉None值（失败的请求）
-                valid_times = [t for t in recent_data if t is not None and not np.isnan(t)]
-                if valid_times:
-                    span_mean_list.append(np.mean(valid_times))
-                else:
-                    span_mean_list.append(np.nan)
-                
-                # 修复bug: 改进成功率计算，区分"未测试"和"失败"
-                # None表示失败，数值表示成功
-                success_count = sum(1 for t in self.healthy["data"][key] if t is not None and not np.isnan(t))
-                total_count = len(self.healthy["data"][key])
-                if total_count > 0:
-                    global_successProb_list.append(success_count / total_count)
-                else:
-                    global_successProb_list.append(np.nan)
+        # 所有模型的预排名和价格排名在评分对象中向量化地一次算好:
+        # 近期平均响应时间只统计近{TOLERANCE_TIMES}次记录中的成功请求, 所有源近期都存在异常情况时改用全局成功率,
+        # 连成功率都没有(例如服务刚启动, 亦或是干脆就是网从头炸到尾)时使用默认排序.
+        ranked_sources = self.scoring.rank(model_name, mode, input_proportion, output_proportion)
+        if ranked_sources is None:
+            self.logger.warning(f"[{mode}] 健康数据中没有可用于排序的模型 {model_name} 的有效源，使用预设排名")
+            return self._rank_sources_from_ranking(model_name)
+        return list(ranked_sources)
 
+    def get_route(self, model_name, mode, input_proportion: int, output_proportion: int):
+        """查询路由表, 返回按优先级排序的候选源
+
+        路由表按(模型, 模式, 输入输出比例分桶)缓存_rank_sources的结果,
+        共享快照的版本变化时整体失效, 因此同一份健康检查数据下每个键只计算一次.
         
-        # 处理没有找到匹配模型的情况
-        if not source_list:
-            self.logger.warning(f"未找到匹配模型 {real_model_name} 的任何源")
-            # 使用预设排名
-            return self.get_sources_from_ranking(real_model_name)
-        
-        # 成功率排序
-        ranking_successProb = {source_list[int(n)]: r+1 for n, r, g in zip(np.argsort(global_successProb_list)[::-1], range(len(global_successProb_list)), global_successProb_list) if not np.isnan(g)}
+        Returns:
+            tuple: 按优先级排序的候选源名称
+        """
+        if mode not in ROUTING_MODES:
+            self.logger.warning(f"未知的模式 '{mode}'，使用默认模式 'cheap_first'")
+            mode = "cheap_first"
+        bucket, input_proportion, output_proportion = routing_table.bucket(input_proportion, output_proportion)
+        build = lambda: tuple(self._rank_sources(model_name, mode, input_proportion, output_proportion))
+        if self.snapshot_version is None:
+            # 显式传入的健康检查数据不属于共享快照, 不使用共享路由表
+            return build()
+        return routing_table.get(self.snapshot_version, (model_name, mode, bucket), build)
+
+    def _select_sources(self, model_name, mode, input_proportion: int, output_proportion: int,
+                        prompt_tokens=None, max_tokens=None, affinity_key=None):
+        """选出主源和备用源, 不获取API密钥, 同步和异步调用共用
         
-        # 决定使用哪种排序方式
-        if np.all(np.isnan(span_mean_list)):
-            # 极端情况1，所有源近期都存在异常情况
-            # 如果至少对于该模型, 存在任意源是有成功率的, 则使用全局成功率作为参考.
-            if np.any(~np.isnan(np.array(global_successProb_list))):
-                pre_ranking = ranking_successProb
-            else:
-                # 极端情况2, 如果所有源近期都存在异常情况, 且所有源都是不存在有效的成功率统计的. (例如服务刚启动, 亦或是干脆就是网从头炸到尾)
-                # 则使用默认排序.
-                return self.get_sources_from_ranking(real_model_name)
-        else:
-            # 如果一切正常, 则使用近期平均执行时间
-            pre_ranking = {source_list[int(n)]: r+1 for n, r, s in zip(np.argsort(span_mean_list), range(len(span_mean_list)), span_mean_list) if not np.isnan(s)}
-        # 模式处理
-        if mode == "cheap_first":
-            # 计算价格排名
-            price_list = []
-            inner_source_list = []
-            for source_name in pre_ranking:
-                try:
-                    # 检查模型是否在源上有效
-                    if not self._check_valid_model(source_name, real_model_name):
-                        self.logger.warning(f"[cheap_first] 模型 {real_model_name} 在源 {source_name} 上不可用，跳过 (因为不知道价格)")
-                        continue
-                        
-                    source_model_name = self._get_actual_model_name(source_name, real_model_name)
-                    
-                    # 获取价格
-                    if source_name in self.source_price and source_model_name in self.source_price[source_name]:
-                        price = self.source_price[source_name][source_model_name]
-                        if price is None:
-                            # 如果价格为None，给低优先级
-                            final_price = 1e8
-                        elif isinstance(price, tuple):
-                            # 确保价格元组中没有None值
-                            if None in price:
-                                final_price = 1e8
-                            else:
-                                final_price = (price[0]*input_proportion + price[1]*output_proportion)/(input_proportion+output_proportion)
-
-                        elif isinstance(price, float):
-                            final_price = price
-                        else:
-                            final_price = 1e8  # 未知价格，给最低优先级
-                    else:
-                        final_price = 1e8  # 找不到价格信息
-                        
-                    inner_source_list.append(source_name)
-                    price_list.append(final_price)
-                except Exception as e:
-                    self.logger.warning(f"计算源 {source_name} 的价格时出错: {str(e)}")
-            
-            # 最少可能只有一个源
-            if not inner_source_list:
-                self.logger.warning(f"未找到具有有效价格信息的源，使用预设排名")
-                return self.get_sources_from_ranking(real_model_name)
-            
-            # 价格排序
-            post_ranking = {inner_source_list[int(n)]: r+1 for n, r, p in zip(np.argsort(price_list), range(len(price_list)), price_list) if not np.isnan(p)}
-            
-            # 融合排名
-            final_ranking = self.get_combinedRanking(pre_ranking, post_ranking, 2/3)
-            final_ranking = {key: final_ranking[key] for key in final_ranking if self._check_valid_model(key, real_model_name)}
-            # 选择主源和备用源
-            inner_list = list(final_ranking.keys())
-            if len(inner_list) >= 2:
-                # 按融合后的排名排序
-                sorted_sources = sorted(inner_list, key=lambda x: final_ranking[x])
-                main_source_name = sorted_sources[0]
-                backup_source_name = sorted_sources[1]
-            else:
-                main_source_name = inner_list[0]
-                backup_source_name = inner_list[0]
-            
-        elif mode == "fast_first":
-            # 直接使用预处理的排名
-            inner_list = list(pre_ranking.keys())
-            # 过滤掉不支持该模型的源
-            valid_sources = [source for source in inner_list if self._check_valid_model(source, real_model_name)]
-            
-            if not valid_sources:
-                self.logger.warning(f"[fast_first] 预处理排名中没有支持模型 {real_model_name} 的有效源，使用预设排名")
-                return self.get_sources_from_ranking(real_model_name)
-                
-            if len(valid_sources) >= 2:
-                main_source_name = valid_sources[0]
-                backup_source_name = valid_sources[1]
-            else:
-                main_source_name = valid_sources[0]
-                backup_source_name = valid_sources[0]
+        Returns:
+            tuple: (主源名称, 备用源名称)
+        """
+        if mode == AFFINITY_MODE and affinity_key is None:
+            # 提示太短, 达不到供应商提示缓存的最小长度, 按fast_first分散负载
+            mode = "fast_first"
+        if mode == AFFINITY_MODE:
+            # 候选为fast_first路由表中通过成功率筛选的健康源, 与排名无关, 只在环上按亲和键排列
+            route = self.get_route(model_name, "fast_first", input_proportion, output_proportion)
+            route = self._filter_by_context_length(model_name, route, required_length(prompt_tokens, max_tokens))
+            route = self._skip_open_circuits(model_name, route)
+            return self._main_and_backup(ring_order(route, affinity_key))
+        if mode == ADAPTIVE_MODE:
+            route = self._filter_by_context_length(
+                model_name, self._valid_sources(model_name), required_length(prompt_tokens, max_tokens)
+            )
+            route = self._skip_open_circuits(model_name, route)
+            return self._main_and_backup(self._sample_route(model_name, route, input_proportion, output_proportion))
+        route = self.get_route(model_name, mode, input_proportion, output_proportion)
+        route = self._filter_by_context_length(model_name, route, required_length(prompt_tokens, max_tokens))
+        route = self._skip_open_circuits(model_name, route)
+        route = self._rerank_by_live_quantile(model_name, mode, route)
+        route = self._blend_passive_stats(model_name, mode, route)
+        return self._main_and_backup(self._spread_load(model_name, mode, route))
+
+    def _valid_sources(self, model_name):
+        """支持该模型的所有源, 按预设排名排序, 不考虑健康检查数据
+
+        Raises:
+            ValueError: 如果没有支持该模型的源
+        """
+        sources = [source_name for source_name in sorted(self.source_ranking, key=lambda s: self.source_ranking[s])
+                   if self._check_valid_model(source_name, model_name)]
+        if not sources:
+            error_msg = f"在预设排名中找不到模型 {model_name} 的可用源"
+            self.logger.error(error_msg)
+            raise ValueError(error_msg)
+        return sources
+
+    def _get_weighted_price(self, source_name, model_name, input_proportion, output_proportion):
+        """按输入输出比例加权的价格, 价格未知或不完整时返回None"""
+        price = self._get_source_price(source_name, model_name)
+        if isinstance(price, tuple) and len(price) >= 2 and None not in price:
+            total = input_proportion + output_proportion
+            if total <= 0:
+                return (price[0] + price[1]) / 2
+            return (price[0] * input_proportion + price[1] * output_proportion) / total
+        if isinstance(price, float):
+            return price
+        return None
+
+    def _sample_route(self, model_name, route, input_proportion, output_proportion):
+        """adaptive模式: 以健康检查数据为先验, 从各臂的后验中采样一次后按奖励排序"""
+        if len(route) < 2:
+            return route
+        stats = self.health_index.sources(model_name)
+
+        def prior(source_name):
+            health = stats.get(source_name)
+            if health is None:
+                return ArmPrior(None, None)
+            latency = health.recent_mean if not np.isnan(health.recent_mean) else health.mean
+            return ArmPrior(
+                None if np.isnan(health.success_rate) else health.success_rate,
+                None if np.isnan(latency) else latency,
+            )
+
+        sample_of = lambda source_name: bandit_arms.sample(
+            source_name, self._get_actual_model_name(source_name, model_name), prior(source_name)
+        )
+        price_of = lambda source_name: self._get_weighted_price(source_name, model_name, input_proportion, output_proportion)
+        return thompson_order(route, sample_of, price_of)
+
+    def _filter_by_context_length(self, model_name, route, required):
+        """排除最大输入输出长度放不下请求的源, 路由表与请求长度无关, 因此过滤不进入路由表缓存
+
+        Raises:
+            ValueError: 如果没有任何源放得下请求
+        """
+        if required is None:
+            return route
+        available = [source_name for source_name in route
+                     if fits(self._get_max_io_length(source_name, model_name), required)]
+        if not available:
+            error_msg = f"模型 {model_name} 的所有源的最大输入输出长度都放不下约 {required} 个token的请求"
+            self.logger.error(error_msg)
+            raise ValueError(error_msg)
+        if len(available) < len(route):
+            skipped = [source_name for source_name in route if source_name not in available]
+            self.logger.info(f"模型 {model_name} 的源 {skipped} 放不下约 {required} 个token的请求，已跳过")
+        return available
+
+    def _spread_load(self, model_name, mode, route):
+        """fast_first(及分位数模式)下在排名靠前且耗时相近的候选之间按在途请求数选择主源, 避免所有请求涌向同一个源"""
+        if (mode != "fast_first" and mode not in QUANTILE_MODES) or len(route) < 2:
+            return route
+        stats = self.health_index.sources(model_name)
+        latency_of = lambda source_name: stats[source_name].recent_mean if source_name in stats else None
+        return spread_route(route, latency_of, concurrency_limiter.in_flight)
+
+    def _rerank_by_live_quantile(self, model_name, mode, route):
+        """分位数模式下, 把进程内真实请求的草图与健康检查的草图合并后重新按分位数排序
+
+        路由表只包含健康检查的草图; 没有任何候选有真实请求统计时直接沿用路由表的顺序.
+        """
+        if mode not in QUANTILE_MODES or len(route) < 2:
+            return route
+        live = {source_name: passive_stats.sketch(source_name, self._get_actual_model_name(source_name, model_name))
+                for source_name in route}
+        if not any(live.values()):
+            return route
+        q = QUANTILE_MODES[mode]
+        stats = self.health_index.sources(model_name)
+
+        def latency(source_name):
+            value = merged_quantile([self.health_index.sketch(source_name, model_name), live[source_name]], q)
+            if value is None and source_name in stats and not np.isnan(stats[source_name].recent_mean):
+                value = stats[source_name].recent_mean
+            return np.inf if value is None else value
+
+        return sorted(route, key=latency)
+
+    def _skip_open_circuits(self, model_name, route):
+        """跳过熔断中的(源, 模型); 所有候选都在熔断中时保留原顺序, 由请求时的熔断检查快速失败"""
+        available = [source_name for source_name in route
+                     if not circuit_breakers.is_open(source_name, self._get_actual_model_name(source_name, model_name))]
+        if len(available) < len(route):
+            skipped = [source_name for source_name in route if source_name not in available]
+            self.logger.warning(f"模型 {model_name} 在源 {skipped} 上处于熔断状态，已跳过")
+        return available or route
+
+    def _blend_passive_stats(self, model_name, mode, route):
+        """用进程内真实请求的被动统计调整路由表给出的候选顺序
+
+        路由表只随健康检查快照更新, 被动统计则在每次请求后更新, 因此不进入路由表缓存.
+        """
+        if len(route) < 2:
+            return route
+        stats_of = lambda source_name: passive_stats.get(source_name, self._get_actual_model_name(source_name, model_name))
+        blended = blend_route(route, stats_of, mode)
+        if blended[0] != route[0]:
+            self.logger.info(f"根据近期真实请求的统计, 模型 {model_name} 的主源由 {route[0]} 调整为 {blended[0]}")
+        return blended
+
+    def get_config(self, model_name, mode, input_proportion: int, output_proportion: int,
+                   prompt_tokens=None, max_tokens=None, affinity_key=None):
+        """选出主源和备用源, 并获取各自负载均衡后的API密钥
         
-        # 获取模型名称和API密钥
-        try:
-            main_source_model_name = self._get_actual_model_name(main_source_name, real_model_name)
-            backup_source_model_name = self._get_actual_model_name(backup_source_name, real_model_name)
+        Args:
+            model_name (str): 模型名称
+            mode (str): 模式，可以是"cheap_first", "fast_first", 按耗时分位数路由的"fast_p50", "fast_p95", "fast_p99",
+                按真实请求结果做Thompson采样的"adaptive", 或按提示前缀固定(源, 密钥)的"affinity"
+            input_proportion (int): 输入比例
+            output_proportion (int): 输出比例
+            prompt_tokens (int, optional): 估计的提示token数, 给出时排除最大输入输出长度放不下请求的源
+            max_tokens (int, optional): 最大生成token数
+            affinity_key (str, optional): affinity模式下提示前缀的亲和键, 为None时按fast_first处理
             
-            main_api_key = Harness_localAPI.get_api_key(main_source_name)
-            backup_api_key = Harness_localAPI.get_api_key(backup_source_name)
-        except Exception as e:
-            # 统一错误消息格式，包含"无法获取API密钥"
-            raise ValueError(f"无法获取API密钥: {str(e)}")
-        
-        return main_source_name, main_source_model_name, main_api_key, backup_source_name, backup_source_model_name, backup_api_key
+        Returns:
+            tuple: 包含主源和备用源的配置信息
+            
+        Raises:
+            ValueError: 如果找不到可用的源或配置
+            Exception: 其他错误
+        """
+        # 如果当前实例初始化的时候距离当前尝试获取配置的时间已过去超过一个检查周期了.
+        # 那么就自动刷新当前健康检查状态.
+        self._refresh_if_expired()
+        main_source_name, backup_source_name = self._select_sources(
+            model_name, mode, input_proportion, output_proportion, prompt_tokens, max_tokens, affinity_key
+        )
+        return self._fetch_api_keys(model_name, main_source_name, backup_source_name, self._key_affinity(mode, affinity_key))
 
-    def select_the_best_fromAbatch(self, model_list, mode="fast_first", input_proportion=60, output_proportion=40):
-        """从一批模型中选择帕累托最优的模型
+    async def aget_config(self, model_name, mode, input_proportion: int, output_proportion: int,
+                          prompt_tokens=None, max_tokens=None, affinity_key=None):
+        """get_config的协程版本, 健康检查数据刷新和API密钥获取均不阻塞事件循环"""
+        await self._arefresh_if_expired()
+        main_source_name, backup_source_name = self._select_sources(
+            model_name, mode, input_proportion, output_proportion, prompt_tokens, max_tokens, affinity_key
+        )
+        return await self._afetch_api_keys(
+            model_name, main_source_name, backup_source_name, self._key_affinity(mode, affinity_key)
+        )
+
+    @staticmethod
+    def _key_affinity(mode, affinity_key):
+        """只有affinity模式才把亲和键用于选择密钥, 其余模式保持密钥轮询"""
+        return affinity_key if mode == AFFINITY_MODE else None
+
+
+    def _rank_best_from_batch(self, model_list, mode="fast_first", input_proportion=60, output_proportion=40):
+        """计算一批模型在(平均耗时, 价格, 成功率)上的帕累托前沿, 并按模式排序, 不获取API密钥
         
         Args:
             model_list (list): 模型名称列表
@@ -534,37 +1002,28 @@ class LoadBalancing:
             output_proportion (int): 输出比例
             
         Returns:
-            tuple: (最优模型名, 源名称, 源模型名, API密钥)
+            list: [(模型名, 源名称, 源模型名), ...], 第一个为最优
             
         Raises:
             ValueError: 如果没有可用的模型
         """
         self.logger.info(f"从模型列表中选择最优模型: {model_list}")
         
-        # 刷新健康数据
-        if (self.healthy and "timestamp" in self.healthy and 
-            (datetime.now() - datetime.fromisoformat(self.healthy["timestamp"])).total_seconds() > self.healthy.get("check_timer_span", 15)*60):
-            self.logger.info("健康检查数据已过期，正在刷新")
-            self.healthy = Harness_localAPI.check_healthy()
-        
         # 收集每个模型的性能数据
         model_stats = {}
         
         for model_name in model_list:
             # 收集该模型在所有源上的数据
-            for key, value in self.healthy["data"].items():
-                if len(key) >= 2 and key[1] == model_name and value:
-                    source_name = key[0]
-                    
+            for source_name, stats in self.health_index.sources(model_name).items():
+                if stats.window.size:
                     # 检查模型在该源上是否有效
                     if not self._check_valid_model(source_name, model_name):
                         continue
                     
-                    # 计算平均响应时间和成功率
-                    valid_times = [t for t in value if t is not None and not np.isnan(t)]
-                    if valid_times:
-                        avg_time = np.mean(valid_times)
-                        success_rate = len(valid_times) / len(value)
+                    # 平均响应时间和成功率已在索引中预先计算
+                    if not np.isnan(stats.mean):
+                        avg_time = stats.mean
+                        success_rate = stats.success_rate
                         
                         # 获取价格信息
                         source_model_name = self._get_actual_model_name(source_name, model_name)
@@ -590,67 +1049,160 @@ class LoadBalancing:
                         }
         
         if not model_stats:
-            # 如果没有健康数据，使用预设排名选择第一个可用的模型
+            # 如果没有健康数据，使用预设排名, 按model_list的顺序取各模型的主源
             self.logger.warning("没有找到有效的健康数据，使用预设排名")
+            ranked = []
             for model_name in model_list:
                 try:
-                    result = self.get_sources_from_ranking(model_name)
-                    return model_name, result[0], result[1], result[2]
+                    main_source, _ = self._select_sources_from_ranking(model_name)
+                    ranked.append((model_name, main_source, self._get_actual_model_name(main_source, model_name)))
                 except:
                     continue
-            raise ValueError("没有找到任何可用的模型")
-        
-        # 找出帕累托前沿
-        pareto_models = []
-        
-        for key1, stats1 in model_stats.items():
-            is_dominated = False
-            
-            # 根据模式选择比较维度
-            if mode == "fast_first":
-                # 比较速度和成功率
-                for key2, stats2 in model_stats.items():
-                    if key1 != key2:
-                        if (stats2['avg_time'] < stats1['avg_time'] and 
-                            stats2['success_rate'] >= stats1['success_rate']):
-                            is_dominated = True
-                            break
-            else:  # cheap_first
-                # 比较价格和成功率
-                for key2, stats2 in model_stats.items():
-                    if key1 != key2:
-                        if (stats2['price'] < stats1['price'] and 
-                            stats2['success_rate'] >= stats1['success_rate']):
-                            is_dominated = True
-                            break
-            
-            if not is_dominated:
-                pareto_models.append((key1, stats1))
-        
-        # 从帕累托前沿中选择最优
-        if not pareto_models:
-            # 如果没有帕累托模型（理论上不应该发生），选择第一个
-            key, stats = list(model_stats.items())[0]
-        else:
-            # 根据模式选择最优
-            if mode == "fast_first":
-                # 选择最快的
-                pareto_models.sort(key=lambda x: x[1]['avg_time'])
-            else:  # cheap_first
-                # 选择最便宜的
-                pareto_models.sort(key=lambda x: x[1]['price'])
+            if not ranked:
+                raise ValueError("没有找到任何可用的模型")
+            return ranked
+        
+        # 在三个维度上同时求帕累托前沿, 被支配的候选在任何模式下都不如前沿中的某个候选
+        candidates = list(model_stats.values())
+        front = [candidates[i] for i in pareto_front(
+            [(stats['avg_time'], stats['price'], -stats['success_rate']) for stats in candidates]
+        )]
+        
+        # 根据模式对前沿排序
+        if mode == "fast_first" or mode in QUANTILE_MODES:
+            # 最快的优先
+            front.sort(key=lambda x: (x['avg_time'], x['price'], -x['success_rate']))
+        else:  # cheap_first
+            # 最便宜的优先
+            front.sort(key=lambda x: (x['price'], x['avg_time'], -x['success_rate']))
+        
+        self.logger.info(f"选择了最优模型: {front[0]['model_name']} from {front[0]['source_name']}, 前沿中共{len(front)}个候选")
+        
+        return [(stats['model_name'], stats['source_name'], stats['source_model_name']) for stats in front]
+
+    def _select_best_from_batch(self, model_list, mode="fast_first", input_proportion=60, output_proportion=40):
+        """从一批模型中选择帕累托最优的模型, 不获取API密钥, 同步和异步调用共用
+        
+        Returns:
+            tuple: (最优模型名, 源名称, 源模型名)
             
-            key, stats = pareto_models[0]
+        Raises:
+            ValueError: 如果没有可用的模型
+        """
+        return self._rank_best_from_batch(model_list, mode, input_proportion, output_proportion)[0]
+
+    def select_the_best_fromAbatch(self, model_list, mode="fast_first", input_proportion=60, output_proportion=40):
+        """从一批模型中选择帕累托最优的模型
+        
+        Args:
+            model_list (list): 模型名称列表
+            mode (str): 选择模式，"fast_first"或"cheap_first"
+            input_proportion (int): 输入比例
+            output_proportion (int): 输出比例
+            
+        Returns:
+            tuple: (最优模型名, 源名称, 源模型名, API密钥)
+            
+        Raises:
+            ValueError: 如果没有可用的模型
+        """
+        # 刷新健康数据
+        self._refresh_if_expired()
+        model_name, source_name, source_model_name = self._select_best_from_batch(
+            model_list, mode, input_proportion, output_proportion
+        )
         
         # 获取API密钥
         try:
-            api_key = Harness_localAPI.get_api_key(stats['source_name'])
+            api_key = Harness_localAPI.get_api_key(source_name)
+        except Exception as e:
+            raise ValueError(f"无法获取API密钥: {str(e)}")
+        
+        return model_name, source_name, source_model_name, api_key
+
+    async def aselect_the_best_fromAbatch(self, model_list, mode="fast_first", input_proportion=60, output_proportion=40):
+        """select_the_best_fromAbatch的协程版本"""
+        await self._arefresh_if_expired()
+        model_name, source_name, source_model_name = self._select_best_from_batch(
+            model_list, mode, input_proportion, output_proportion
+        )
+        
+        try:
+            api_key = await Harness_localAPI.aget_api_key(source_name)
         except Exception as e:
             raise ValueError(f"无法获取API密钥: {str(e)}")
         
-        self.logger.info(f"选择了最优模型: {stats['model_name']} from {stats['source_name']}")
+        return model_name, source_name, source_model_name, api_key
+
+    def select_the_front_fromAbatch(self, model_list, mode="fast_first", input_proportion=60, output_proportion=40,
+                                    size=BEST_FRONT_SIZE):
+        """从一批模型中选出排好序的帕累托前沿, 供调用方在前沿内依次故障转移
         
-        return stats['model_name'], stats['source_name'], stats['source_model_name'], api_key
+        Args:
+            model_list (list): 模型名称列表
+            mode (str): 选择模式，"fast_first"或"cheap_first"
+            input_proportion (int): 输入比例
+            output_proportion (int): 输出比例
+            size (int): 最多返回的候选数
+            
+        Returns:
+            list: [(模型名, 源名称, 源模型名, API密钥), ...], 第一个为最优; 获取不到API密钥的候选被跳过,
+                同一源上的候选使用同一个API密钥
+            
+        Raises:
+            ValueError: 如果没有可用的模型或所有候选都获取不到API密钥
+        """
+        self._refresh_if_expired()
+        front = []
+        errors = []
+        # 密钥按源获取, 同一源上的多个候选共用一次获取的结果, 获取失败的源记为None
+        api_keys = {}
+        for model_name, source_name, source_model_name in self._rank_best_from_batch(
+            model_list, mode, input_proportion, output_proportion
+        ):
+            if len(front) >= size:
+                break
+            if source_name not in api_keys:
+                try:
+                    api_keys[source_name] = Harness_localAPI.get_api_key(source_name)
+                except Exception as e:
+                    api_keys[source_name] = None
+                    errors.append(str(e))
+            if api_keys[source_name] is not None:
+                front.append((model_name, source_name, source_model_name, api_keys[source_name]))
+        if not front:
+            raise ValueError(f"无法获取API密钥: {'; '.join(errors)}")
+        return front
+
+    async def aselect_the_front_fromAbatch(self, model_list, mode="fast_first", input_proportion=60, output_proportion=40,
+                                           size=BEST_FRONT_SIZE):
+        """select_the_front_fromAbatch的协程版本, 同时获取还缺的候选所在各源的密钥"""
+        await self._arefresh_if_expired()
+        ranked = self._rank_best_from_batch(model_list, mode, input_proportion, output_proportion)
+        front = []
+        errors = []
+        api_keys = {}
+        start = 0
+        while len(front) < size and start < len(ranked):
+            batch = ranked[start:start + size - len(front)]
+            start += len(batch)
+            sources = list(dict.fromkeys(source_name for _, source_name, _ in batch if source_name not in api_keys))
+            results = await asyncio.gather(
+                *(Harness_localAPI.aget_api_key(source_name) for source_name in sources), return_exceptions=True
+            )
+            for source_name, result in zip(sources, results):
+                if isinstance(result, Exception):
+                    api_keys[source_name] = None
+                    errors.append(str(result))
+                else:
+                    api_keys[source_name] = result
+            front.extend(
+                (model_name, source_name, source_model_name, api_keys[source_name])
+                for model_name, source_name, source_model_name in batch if api_keys[source_name] is not None
+            )
+        if not front:
+            raise ValueError(f"无法获取API密钥: {'; '.join(errors)}")
+        return front
 
 if __name__ == "__main__":
     # 测试用例
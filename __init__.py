@@ -8,6 +8,8 @@
   - generate: 生成文本响应
   - generate_mm: 多模态生成（支持图像输入）
   - function_calling: 函数调用功能
+  - generate_stream / generate_mm_stream: 流式生成，逐个返回文本片段
+  - 以上方法均提供a前缀的协程版本(如agenerate), 供asyncio应用直接await
 """
 
 # 只导入需要对外暴露的类
@@ -2,17 +2,17 @@ from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, func
-from typing import Dict, List, Tuple, Set
+from typing import Dict, List, Optional, Tuple, Set
 import logging
 from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, deque
 import asyncio
 
 # 导入本地模块
 from .models import get_db, ApiKeyUsage, create_tables
-from .schemas import ApiKeyRequest, ApiKeyUsageCreate, ApiKeyResponse
+from .schemas import ApiKeyRequest, ApiKeyUsageCreate, ApiKeyResponse, ApiKeyLeaseRequest, ApiKeyLeaseResponse
 
 # 导入配置
 import sys
@@ -22,13 +22,18 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # 从正确的配置文件导入所有配置
 from ew_config.api_keys import pool_mapping
+from ew_config import api_keys as api_keys_config
 from ew_config.source import *
+from ew_router.rate_limit import KeyRateLimiter
+from ew_router.affinity import ring_order
 
 # 配置参数
 # 不可以忍受最近{TOLERANCE_TIMER_SPAN}分钟内存在任意一次错误记录的api_key.
 TOLERANCE_TIMER_SPAN = int(os.environ.get("TOLERANCE_TIMER_SPAN", 15))
 # 定时任务间隔：每多少分钟查询一次失败的API密钥，默认1分钟
 FAILED_KEY_CHECK_INTERVAL = int(os.environ.get("FAILED_KEY_CHECK_INTERVAL", 1))
+# 保留的吊销记录条数, 客户端落后更多时需要放弃所有租约
+REVOCATION_LOG_SIZE = int(os.environ.get("REVOCATION_LOG_SIZE", 1000))
 
 # 设置日志记录
 logging.basicConfig(
@@ -73,6 +78,14 @@ global_index_cache: Dict[str, int] = {}
 # 统计信息缓存
 stats_cache: Dict[str, Dict] = {}
 
+# 按密钥和账户的RPM/TPM限流, 选取密钥时跳过已用完限额的密钥
+key_rate_limiter = KeyRateLimiter(pool_mapping, getattr(api_keys_config, "account_limit_mapping", None))
+
+# 密钥吊销记录: 密钥新进入失败缓存时吊销序号加一, 客户端据此从租约中移除该密钥
+# [(epoch, source_name, api_key), ...]
+revocation_log = deque(maxlen=REVOCATION_LOG_SIZE)
+revocation_epoch: int = 0
+
 # 最后更新时间
 last_update_time: datetime = datetime.now()
 
@@ -91,7 +104,8 @@ def update_failed_keys_cache():
         # 计算时间窗口
         cutoff_time = datetime.now() - timedelta(minutes=TOLERANCE_TIMER_SPAN)
         
-        # 重置缓存
+        # 重置缓存, 保留上一轮的失败密钥以找出新失败的密钥
+        previously_failed = {source: set(keys) for source, keys in failed_keys_cache.items()}
         failed_keys_cache.clear()
         key_failure_count_cache.clear()
         stats_cache.clear()
@@ -161,6 +175,11 @@ def update_failed_keys_cache():
         # 保存统计信息
         stats_cache.update(source_stats)
         
+        # 新进入失败缓存的密钥需要从客户端的租约中吊销
+        for source_name, keys in failed_keys_cache.items():
+            for api_key in keys - previously_failed.get(source_name, set()):
+                _record_revocation(source_name, api_key)
+        
         # 关闭数据库会话
         db.close()
         
@@ -174,6 +193,13 @@ def update_failed_keys_cache():
     except Exception as e:
         logger.error(f"❌ 更新失败API密钥缓存时出错: {str(e)}")
         
+def _record_revocation(source_name: str, api_key: str):
+    """记录一次密钥吊销, 吊销序号加一"""
+    global revocation_epoch
+    revocation_epoch += 1
+    revocation_log.append((revocation_epoch, source_name, api_key))
+    logger.info(f"🔒 吊销API密钥租约: {source_name} {api_key[:8]}... (吊销序号: {revocation_epoch})")
+
 def _generate_failed_keys_summary_report(total_failed_keys: int, source_stats: dict, execution_time: float):
     """生成失败密钥的汇总报告"""
     logger.info("📊 ==================== API密钥失败情况汇总报告 ====================")
@@ -290,15 +316,12 @@ async def check_healthy():
 
 # ==================== 核心API端点 ====================
 
-@app.post("/get_apikey", response_model=ApiKeyResponse)
-async def get_api_key(request: ApiKeyRequest):
+def _select_api_keys(source_name: str, count: int, affinity_key: Optional[str] = None) -> List[Tuple[str, int, str]]:
     """
-    获取给定源的最佳API密钥。
-    使用缓存的失败密钥列表，实现高性能的密钥选择。
+    为给定源选出最多count个API密钥, 返回[(user_name, key_index, api_key), ...]。
+    不记录RPM用量, 由调用方负责。
+    给出亲和键时不轮询, 而是在正常工作的密钥上按一致性哈希选择, 该密钥失败或超出限额时顺延到环上的下一个。
     """
-    logger.debug(f"请求源 '{request.source_name}' 的API密钥")
-    source_name = request.source_name
-    
     # 检查源是否存在
     if source_name not in pool_mapping:
         available_sources = list(pool_mapping.keys())
@@ -334,16 +357,22 @@ async def get_api_key(request: ApiKeyRequest):
     working_keys = [(idx, user, key_idx, api_key) for idx, (user, key_idx, api_key) in enumerate(all_keys) if api_key not in failing_keys]
     
     if working_keys:
-        # 使用轮询方式选择正常工作的密钥
-        current_global_index = global_index_cache[source_name]
-        next_key_idx = (current_global_index + 1) % len(working_keys)
-        global_index_cache[source_name] = next_key_idx
-        
-        _, user_name, key_index, api_key = working_keys[next_key_idx]
-        key_usage_cache[source_name][user_name] = key_index
+        # 只在未超出RPM/TPM限额的密钥中轮询, 都已超出时选择最快恢复的
+        ready_keys = [key for key in working_keys if key_rate_limiter.has_capacity(source_name, key[3])]
+        if ready_keys and affinity_key is not None:
+            by_api_key = {key[3]: key for key in ready_keys}
+            ring = ring_order([key[3] for key in working_keys], affinity_key)
+            selected = [by_api_key[api_key] for api_key in ring if api_key in by_api_key][:count]
+        elif ready_keys:
+            current_global_index = global_index_cache[source_name]
+            selected = [ready_keys[(current_global_index + 1 + i) % len(ready_keys)] for i in range(min(count, len(ready_keys)))]
+            global_index_cache[source_name] = (current_global_index + len(selected)) % len(ready_keys)
+        else:
+            selected = [min(working_keys, key=lambda key: key_rate_limiter.wait_time(source_name, key[3]))]
+            logger.warning(f"源 '{source_name}' 所有正常的API密钥都已达到RPM/TPM限额，选择最快恢复的密钥")
         
-        logger.debug(f"返回API密钥（健康轮询）: {api_key[:8]}...")
-        return ApiKeyResponse(api_key=api_key)
+        logger.debug(f"选出API密钥（健康轮询）: {', '.join(key[3][:8] + '...' for key in selected)}")
+        return [(user_name, key_index, api_key) for _, user_name, key_index, api_key in selected]
     
     # 如果所有密钥都有失败记录，选择失败次数最少的密钥
     cutoff_time = datetime.now() - timedelta(minutes=TOLERANCE_TIMER_SPAN)
@@ -361,11 +390,52 @@ async def get_api_key(request: ApiKeyRequest):
     key_with_failures.sort(key=lambda x: x[0])
     failure_count, user_name, key_index, api_key = key_with_failures[0]
     
-    key_usage_cache[source_name][user_name] = key_index
-    
     logger.info(f"🎯 选择失败次数最少的API密钥: {api_key[:8]}... (失败次数: {failure_count})")
+    return [(user_name, key_index, api_key)]
+
+@app.post("/get_apikey", response_model=ApiKeyResponse)
+async def get_api_key(request: ApiKeyRequest):
+    """
+    获取给定源的最佳API密钥。
+    使用缓存的失败密钥列表，实现高性能的密钥选择。
+    """
+    logger.debug(f"请求源 '{request.source_name}' 的API密钥")
+    source_name = request.source_name
+    
+    user_name, key_index, api_key = _select_api_keys(source_name, 1, request.affinity_key)[0]
+    key_rate_limiter.acquire(source_name, api_key)
+    key_usage_cache[source_name][user_name] = key_index
     return ApiKeyResponse(api_key=api_key)
 
+@app.post("/lease_apikeys", response_model=ApiKeyLeaseResponse)
+async def lease_api_keys(request: ApiKeyLeaseRequest):
+    """
+    为给定源租出一组健康的API密钥, 由客户端在租约有效期内本地轮换使用。
+    响应中的吊销序号用于客户端之后判断是否需要同步吊销记录。
+    """
+    logger.debug(f"请求租用源 '{request.source_name}' 的 {request.count} 个API密钥")
+    selected = _select_api_keys(request.source_name, max(request.count, 1))
+    for user_name, key_index, _ in selected:
+        key_usage_cache[request.source_name][user_name] = key_index
+    return ApiKeyLeaseResponse(api_keys=[api_key for _, _, api_key in selected], revocation_epoch=revocation_epoch)
+
+@app.get("/revocations", response_model=Dict)
+async def get_revocations(since: int = 0):
+    """
+    返回吊销序号大于since的吊销记录。
+    since早于保留的最早记录时返回reset, 客户端应放弃所有租约。
+    """
+    oldest = revocation_log[0][0] if revocation_log else revocation_epoch + 1
+    revoked = defaultdict(list)
+    for epoch, source_name, api_key in revocation_log:
+        if epoch > since:
+            revoked[source_name].append(api_key)
+    return {
+        "revocation_epoch": revocation_epoch,
+        "reset": since < oldest - 1,
+        "revoked": dict(revoked),
+    }
+
 @app.post("/notice_apikey", status_code=201)
 async def notice_api_key(usage: ApiKeyUsageCreate, db: Session = Depends(get_db)):
     """
@@ -377,6 +447,16 @@ async def notice_api_key(usage: ApiKeyUsageCreate, db: Session = Depends(get_db)
     else:
         logger.debug(f"记录API密钥使用情况: {usage.api_key[:8]}... 状态: {usage.status}")
     
+    # 租用的密钥在客户端本地选取, 按上报的选取次数计入各密钥的RPM
+    for source_name, picks in (usage.lease_picks or {}).items():
+        for api_key, count in picks.items():
+            key_rate_limiter.acquire(source_name, api_key, count)
+    
+    # 按使用记录中的token数扣除该密钥的TPM限额: 服务商返回了用量时为实际用量, 否则为客户端的估计值
+    key_rate_limiter.charge_tokens(
+        usage.source_name, usage.api_key, (usage.prompt_tokens or 0) + (usage.completion_tokens or 0)
+    )
+    
     # 创建数据库记录
     db_usage = ApiKeyUsage(
         request_id=usage.request_id,
@@ -388,6 +468,7 @@ async def notice_api_key(usage: ApiKeyUsageCreate, db: Session = Depends(get_db)
         create_time=usage.create_time,
         finish_time=usage.finish_time,
         execution_time=usage.execution_time,
+        time_to_first_token=usage.time_to_first_token,
         status=usage.status,
         remark=usage.remark or ""
     )
@@ -402,7 +483,7 @@ async def notice_api_key(usage: ApiKeyUsageCreate, db: Session = Depends(get_db)
         logger.error(f"记录API密钥使用情况到数据库时失败: {str(e)}")
         raise HTTPException(status_code=500, detail="记录到数据库失败")
     
-    return {"message": "API密钥使用情况已成功记录"}
+    return {"message": "API密钥使用情况已成功记录", "revocation_epoch": revocation_epoch}
 
 # ==================== 管理端点 ====================
 
@@ -413,7 +494,9 @@ async def get_stats():
         "last_update": last_update_time.isoformat(),
         "failed_keys_by_source": {source: len(keys) for source, keys in failed_keys_cache.items()},
         "total_failed_keys": sum(len(keys) for keys in failed_keys_cache.values()),
-        "detailed_stats": dict(stats_cache)
+        "detailed_stats": dict(stats_cache),
+        "rate_limits": key_rate_limiter.metrics(),
+        "revocation_epoch": revocation_epoch
     }
 
 @app.post("/refresh_cache")
@@ -50,7 +50,8 @@ class APIKeyManagerClient:
         prompt_tokens: Optional[int] = None,
         completion_tokens: Optional[int] = None,
         request_id: Optional[str] = None,
-        remark: Optional[str] = ""
+        remark: Optional[str] = "",
+        time_to_first_token: Optional[float] = None
     ) -> bool:
         """通知服务关于API密钥的使用情况。
         
@@ -66,6 +67,7 @@ class APIKeyManagerClient:
             completion_tokens: 输出令牌数量（可选）
             request_id: 自定义请求ID（可选，如果未提供将生成UUID）
             remark: 备注信息，用于记录API调用的用途或来源（可选）
+            time_to_first_token: 流式请求的首token时间（秒，可选）
             
         返回:
             通知是否成功
@@ -97,6 +99,8 @@ class APIKeyManagerClient:
             payload["prompt_tokens"] = prompt_tokens
         if completion_tokens is not None:
             payload["completion_tokens"] = completion_tokens
+        if time_to_first_token is not None:
+            payload["time_to_first_token"] = time_to_first_token
             
         try:
             response = requests.post(
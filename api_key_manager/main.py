@@ -23,6 +23,7 @@ API密钥管理器服务 (APIKeyManager)
      - create_time: 请求开始时间 (必填)
      - finish_time: 请求结束时间 (必填)
      - execution_time: 执行耗时 (必填)
+     - time_to_first_token: 流式请求的首token时间 (可选)
      - status: 请求状态 (True=成功，False=失败) (必填)
 
 数据库表结构已在models.py中通过SQLAlchemy ORM实现，支持MySQL数据库存储。
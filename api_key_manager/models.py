@@ -41,6 +41,7 @@ class ApiKeyUsage(Base):
     create_time = Column(DateTime, nullable=False)
     finish_time = Column(DateTime, nullable=False, index=True)  # 添加索引
     execution_time = Column(Float, nullable=False)
+    time_to_first_token = Column(Float, nullable=True)  # 流式请求的首token时间（秒）
     status = Column(Boolean, nullable=False, default=True, index=True)  # 添加索引
     remark = Column(String(255), nullable=True, default="")
 
@@ -126,6 +127,17 @@ def create_tables():
                 logger.info("remark 字段添加成功")
             else:
                 logger.info("remark 字段已存在，跳过添加")
+
+            # 检查 time_to_first_token 字段是否存在
+            if 'time_to_first_token' not in column_names:
+                logger.info("添加 time_to_first_token 字段到现有表...")
+                with engine.begin() as connection:
+                    connection.execute(
+                        text(f"ALTER TABLE {ApiKeyUsage.__tablename__} ADD COLUMN time_to_first_token FLOAT NULL COMMENT '流式请求的首token时间（秒）'")
+                    )
+                logger.info("time_to_first_token 字段添加成功")
+            else:
+                logger.info("time_to_first_token 字段已存在，跳过添加")
             
             # 检查并添加索引
             existing_indexes = inspector.get_indexes(ApiKeyUsage.__tablename__)
@@ -1,11 +1,12 @@
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional, List
 
 
 class ApiKeyRequest(BaseModel):
     """请求特定源的API密钥的模式。"""
     source_name: str = Field(..., description="API源的名称")
+    affinity_key: Optional[str] = Field(None, description="提示前缀的亲和键, 给出时按一致性哈希固定到同一个健康的密钥")
 
 
 class ApiKeyUsageCreate(BaseModel):
@@ -19,10 +20,25 @@ class ApiKeyUsageCreate(BaseModel):
     create_time: datetime = Field(..., description="请求开始时间")
     finish_time: datetime = Field(..., description="请求完成时间")
     execution_time: float = Field(..., description="总执行时间（秒）")
+    time_to_first_token: Optional[float] = Field(None, description="流式请求的首token时间（秒）")
     status: bool = Field(..., description="请求是否成功")
     remark: Optional[str] = Field("", description="备注信息，用于记录API调用的用途或来源")
+    lease_picks: Optional[Dict[str, Dict[str, int]]] = Field(
+        None, description="客户端上次上报以来在租约中选取各密钥的次数, {source_name: {api_key: 次数}}"
+    )
 
 
 class ApiKeyResponse(BaseModel):
     """API密钥响应的模式。"""
-    api_key: str = Field(..., description="要使用的API密钥") 
\ No newline at end of file
+    api_key: str = Field(..., description="要使用的API密钥") 
+
+class ApiKeyLeaseRequest(BaseModel):
+    """租用特定源的一组API密钥的模式。"""
+    source_name: str = Field(..., description="API源的名称")
+    count: int = Field(4, description="希望租用的密钥数量")
+
+
+class ApiKeyLeaseResponse(BaseModel):
+    """API密钥租约响应的模式。"""
+    api_keys: List[str] = Field(..., description="租出的API密钥")
+    revocation_epoch: int = Field(..., description="租出时的吊销序号")
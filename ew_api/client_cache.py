@@ -0,0 +1,182 @@
+import os
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+"""进程级的OpenAI SDK客户端缓存.
+
+按(base_url, api_key)缓存OpenAI客户端, 同一源(origin)下的所有客户端
+共享同一个httpx连接池, 因此主源/备用源切换api_key时也能复用已建立的连接.
+异步客户端(AsyncOpenAI)的连接池与事件循环绑定, 因此每个事件循环各有一份缓存.
+"""
+
+# 每个源(origin)最多同时持有的连接数
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 64))
+# 每个源最多保留的空闲keep-alive连接数
+OPENAI_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", 32))
+# 空闲keep-alive连接的过期时间(秒)
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 60))
+# 客户端空闲多久(秒)后被逐出缓存
+OPENAI_CLIENT_IDLE_TTL = int(os.environ.get("OPENAI_CLIENT_IDLE_TTL", 1800))
+# 缓存的客户端数量上限, 超出时逐出最久未使用的
+OPENAI_CLIENT_MAX_SIZE = int(os.environ.get("OPENAI_CLIENT_MAX_SIZE", 256))
+# 连接池不再被缓存中的客户端引用后延迟关闭的时间(秒), 被逐出的客户端可能还在其他线程的请求中使用
+OPENAI_CLIENT_CLOSE_DELAY = float(os.environ.get("OPENAI_CLIENT_CLOSE_DELAY", 600))
+# SDK内部的重试次数. 重试由LLM_Wrapper的主备切换负责, SDK内部重试会突破调用的截止时间
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 0))
+
+
+class OpenAIClientRegistry:
+    """线程安全的OpenAI客户端注册表.
+
+    - 键为(base_url, api_key), 值为OpenAI客户端及其最近使用时间
+    - 同一origin的客户端共享一个带连接数限制的httpx.Client
+    - 超过idle_ttl未使用或超出max_size的客户端会被逐出,
+      某origin下的客户端全部被逐出close_delay秒后才关闭其httpx连接池,
+      以免中断仍在使用被逐出的客户端的请求; 期间该origin再次被使用时继续沿用原连接池
+    - is_async=True时缓存AsyncOpenAI和httpx.AsyncClient, 只能在同一个事件循环内使用
+    """
+
+    def __init__(self,
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        idle_ttl=OPENAI_CLIENT_IDLE_TTL,
+        max_size=OPENAI_CLIENT_MAX_SIZE,
+        close_delay=OPENAI_CLIENT_CLOSE_DELAY,
+        is_async=False
+    ) -> None:
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.idle_ttl = idle_ttl
+        self.max_size = max_size
+        self.close_delay = close_delay
+        self.is_async = is_async
+        # {(base_url, api_key): [OpenAI, last_used]}
+        self._clients = OrderedDict()
+        # {origin: httpx.Client}
+        self._http_clients = {}
+        # 等待关闭的连接池, {origin: (httpx.Client, 不再被引用的时间)}
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _origin(base_url):
+        parts = urlsplit(base_url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def _get_http_client(self, origin):
+        http_client = self._http_clients.get(origin)
+        if http_client is None and origin in self._retired:
+            http_client = self._http_clients[origin] = self._retired.pop(origin)[0]
+        if http_client is None:
+            # 超时由with_timeout设置的截止时间按请求传入, 这里不设置读超时
+            client_class = httpx.AsyncClient if self.is_async else httpx.Client
+            http_client = client_class(
+                limits=self.limits,
+                timeout=httpx.Timeout(None, connect=10.0),
+            )
+            self._http_clients[origin] = http_client
+        return http_client
+
+    def _evict(self, now):
+        """逐出过期和超量的客户端, 需在持有锁时调用"""
+        expired = [key for key, (_, last_used) in self._clients.items() if now - last_used > self.idle_ttl]
+        for key in expired:
+            del self._clients[key]
+        while len(self._clients) > self.max_size:
+            self._clients.popitem(last=False)
+
+        # 不再被任何客户端引用的连接池先等待close_delay秒, 被逐出的客户端上进行中的请求结束后再关闭
+        alive_origins = {self._origin(base_url) for base_url, _ in self._clients}
+        for origin in [o for o in self._http_clients if o not in alive_origins]:
+            self._retired[origin] = (self._http_clients.pop(origin), now)
+        for origin in [o for o, (_, retired_at) in self._retired.items() if now - retired_at > self.close_delay]:
+            self._close_http_client(self._retired.pop(origin)[0])
+
+    def _close_http_client(self, http_client):
+        if not self.is_async:
+            http_client.close()
+            return
+        # 异步连接池只能在其所属的事件循环中关闭
+        try:
+            asyncio.get_running_loop().create_task(http_client.aclose())
+        except RuntimeError:
+            pass
+
+    def get_client(self, base_url, api_key):
+        """获取(base_url, api_key)对应的OpenAI客户端, 不存在时创建
+
+        Args:
+            base_url (str): 源的OpenAI兼容接口基础URL
+            api_key (str): API密钥
+
+        Returns:
+            OpenAI: 可复用的客户端
+        """
+        key = (base_url, api_key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry[1] = now
+                self._clients.move_to_end(key)
+                return entry[0]
+
+            client_class = AsyncOpenAI if self.is_async else OpenAI
+            client = client_class(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=OPENAI_MAX_RETRIES,
+                http_client=self._get_http_client(self._origin(base_url)),
+            )
+            self._clients[key] = [client, now]
+            self._evict(now)
+            return client
+
+    def clear(self):
+        """清空缓存并关闭所有连接池"""
+        with self._lock:
+            self._clients.clear()
+            http_clients = list(self._http_clients.values()) + [c for c, _ in self._retired.values()]
+            self._http_clients.clear()
+            self._retired.clear()
+        for http_client in http_clients:
+            self._close_http_client(http_client)
+
+    def __len__(self):
+        return len(self._clients)
+
+
+# 进程级共享的客户端缓存
+openai_client_registry = OpenAIClientRegistry()
+# 每个事件循环各自的异步客户端缓存, 事件循环被回收后随之释放
+_async_registries = weakref.WeakKeyDictionary()
+_async_registries_lock = threading.Lock()
+
+
+def get_openai_client(base_url, api_key):
+    """获取进程级缓存中的OpenAI客户端"""
+    return openai_client_registry.get_client(base_url, api_key)
+
+
+def get_async_openai_client(base_url, api_key):
+    """获取当前事件循环缓存中的AsyncOpenAI客户端, 必须在协程中调用"""
+    loop = asyncio.get_running_loop()
+    registry = _async_registries.get(loop)
+    if registry is None:
+        with _async_registries_lock:
+            registry = _async_registries.get(loop)
+            if registry is None:
+                registry = OpenAIClientRegistry(is_async=True)
+                _async_registries[loop] = registry
+    return registry.get_client(base_url, api_key)
@@ -1,5 +1,7 @@
+import json
+import socket
 import requests
-from typing import Dict
+from typing import Dict, Iterator, AsyncIterator
 
 import sys
 from pathlib import Path
@@ -7,24 +9,19 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from ew_decorator.counting_time import counting_time
-from ew_decorator.with_timeout import with_timeout
+from ew_decorator.with_timeout import with_timeout, request_timeout, call_at_deadline
+from ew_api.session_pool import get_session, get_async_client
 
 
 class CurlInfra:
     def __init__(self, base_url, api_key) -> None:
         self.base_url = base_url
         self.api_key = api_key
-        
-    @with_timeout(timeout_param='timeout')
-    @counting_time
-    def get_response(self,
-        messages: list,
-        tools: list,
-        model: str,
-        timeout,
-        stream = False,
-        additional_params={}
-    ) -> Dict:
+        # 同一源的所有实例和线程共享keep-alive连接池
+        self.session = get_session(base_url)
+
+    def _build_request(self, messages, tools, model, stream, additional_params):
+        """构造请求头和请求体, 同步和异步调用共用"""
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
@@ -39,16 +36,11 @@ class CurlInfra:
 
         if additional_params:
             payload.update(additional_params)
-        
-        response = requests.post(
-            self.base_url,
-            headers=headers,
-            json=payload,
-            timeout=timeout
-        )
-        response.raise_for_status()
-        completion = response.json()
-        
+        return headers, payload
+
+    @staticmethod
+    def _parse_completion(completion, model) -> Dict:
+        """解析非流式响应体, 同步和异步调用共用"""
         # 检查是否包含预期的choices字段
         if "choices" not in completion or not completion["choices"]:
             raise Exception(f"API响应格式异常: 缺少choices字段. 响应内容: {completion}")
@@ -63,10 +55,154 @@ class CurlInfra:
             "finish_reason": completion["choices"][0]["finish_reason"],
             "model": model
         }
+        
+    @with_timeout(timeout_param='timeout')
+    @counting_time
+    def get_response(self,
+        messages: list,
+        tools: list,
+        model: str,
+        timeout,
+        stream = False,
+        additional_params={}
+    ) -> Dict:
+        headers, payload = self._build_request(messages, tools, model, stream, additional_params)
+        
+        # 剩余时间同时作为建连超时和等待响应头的读超时
+        response = self.session.post(
+            self.base_url,
+            headers=headers,
+            json=payload,
+            timeout=request_timeout(timeout),
+            stream=True
+        )
+        try:
+            response.raise_for_status()
+            # 读超时只限制单次读操作, 响应体缓慢到达时由看门狗在截止时间断开连接
+            with call_at_deadline(lambda: self._abort(response)):
+                body = response.content
+        finally:
+            # 未读完的响应会直接断开连接, 上游请求随之取消
+            response.close()
+        return self._parse_completion(json.loads(body), model)
+
+    @staticmethod
+    def _abort(response):
+        """在看门狗线程中断开响应所在的连接, 使阻塞中的读操作立即返回"""
+        connection = getattr(response.raw, "_connection", None)
+        sock = getattr(connection, "sock", None)
+        if sock is None:
+            # 服务端要求关闭连接时, socket已从连接对象转交给底层的http.client响应
+            fp = getattr(getattr(response.raw, "_fp", None), "fp", None)
+            sock = getattr(getattr(fp, "raw", None), "_sock", None)
+        try:
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    @with_timeout(timeout_param='timeout')
+    @counting_time
+    async def aget_response(self,
+        messages: list,
+        tools: list,
+        model: str,
+        timeout,
+        stream = False,
+        additional_params={}
+    ) -> Dict:
+        """get_response的协程版本, 使用当前事件循环中该源共享的httpx.AsyncClient"""
+        headers, payload = self._build_request(messages, tools, model, stream, additional_params)
+
+        response = await get_async_client(self.base_url).post(
+            self.base_url,
+            headers=headers,
+            json=payload,
+            timeout=request_timeout(timeout)
+        )
+        response.raise_for_status()
+        return self._parse_completion(response.json(), model)
+
+    @staticmethod
+    def _parse_stream_line(line):
+        """解析一行SSE数据, 返回(done, content), done为True表示流已结束"""
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line or not line.startswith("data:"):
+            return False, None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return True, None
+
+        chunk = json.loads(data)
+        if "error" in chunk:
+            raise Exception(f"API流式响应错误: {chunk['error']}")
+        choices = chunk.get("choices") or []
+        if not choices:
+            return False, None
+        delta = choices[0].get("delta") or {}
+        return False, delta.get("content")
+
+    def stream_response(self,
+        messages: list,
+        tools: list,
+        model: str,
+        timeout,
+        additional_params={}
+    ) -> Iterator[str]:
+        """以SSE流式请求, 逐个产出文本增量
+
+        timeout同时作为建连超时和相邻两个数据块之间的读超时.
+        """
+        headers, payload = self._build_request(messages, tools, model, True, additional_params)
+
+        response = self.session.post(
+            self.base_url,
+            headers=headers,
+            json=payload,
+            timeout=timeout,
+            stream=True
+        )
+        try:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                done, content = self._parse_stream_line(line)
+                if done:
+                    break
+                if content:
+                    yield content
+        finally:
+            # 提前结束时关闭连接, 不再继续接收上游的输出
+            response.close()
+
+    async def astream_response(self,
+        messages: list,
+        tools: list,
+        model: str,
+        timeout,
+        additional_params={}
+    ) -> AsyncIterator[str]:
+        """stream_response的协程版本"""
+        headers, payload = self._build_request(messages, tools, model, True, additional_params)
+
+        async with get_async_client(self.base_url).stream(
+            "POST",
+            self.base_url,
+            headers=headers,
+            json=payload,
+            timeout=timeout
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                done, content = self._parse_stream_line(line)
+                if done:
+                    break
+                if content:
+                    yield content
 
 if __name__ == "__main__":
     # 示例测试代码 - 请替换为您的真实API密钥
     curl_infra_deerapi = CurlInfra("https://api.deerapi.com/v1/chat/completions", "your-api-key-here")
     
     # 测试代码示例
-    # print(curl_infra_deerapi.get_response([{"role": "user", "content": "Hello"}], [], "gpt-3.5-turbo"))
\ No newline at end of file
+    # print(curl_infra_deerapi.get_response([{"role": "user", "content": "Hello"}], [], "gpt-3.5-turbo"))
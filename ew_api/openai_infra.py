@@ -1,4 +1,4 @@
-from openai import OpenAI
+import socket
 from openai._types import NOT_GIVEN
 
 import sys
@@ -7,23 +7,20 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from ew_decorator.counting_time import counting_time
-from ew_decorator.with_timeout import with_timeout
+from ew_decorator.with_timeout import with_timeout, request_timeout, call_at_deadline
+from ew_api.client_cache import get_openai_client, get_async_openai_client
 
 class OpenaiInfra:
     def __init__(self, base_url, api_key) -> None:
-       self.openai = OpenAI(
-            api_key=api_key,
-            base_url=base_url,
-        )
-       
-    # 不使用openai.chat.completions.create自有的timeout方法, 而是进行统一的错误管理.
-    # 从入参中捕获timeout参数.
-    # 对每个底层接口记录执行时间, 添加到返回值的execution_time字段中.
-    #
-    @with_timeout(timeout_param='timeout')
-    @counting_time
-    def get_response(self, messages: list, tools: list, model: str, timeout, stream = False, additional_params={}):
-        completion = self.openai.chat.completions.create(
+       self.base_url = base_url
+       self.api_key = api_key
+       # 复用进程级缓存中的客户端, 保持连接池的热连接
+       self.openai = get_openai_client(base_url, api_key)
+
+    @staticmethod
+    def _build_kwargs(messages, tools, model, stream, additional_params):
+        """构造chat.completions.create的参数, 同步和异步调用共用"""
+        return dict(
             model=model,
             messages=messages,
             tools=tools if tools else NOT_GIVEN,
@@ -32,7 +29,10 @@ class OpenaiInfra:
             top_p=additional_params["top_p"] if "top_p" in additional_params else NOT_GIVEN,
             max_tokens=additional_params["max_tokens"] if "max_tokens" in additional_params else NOT_GIVEN
         )
-        
+
+    @staticmethod
+    def _parse_completion(completion, model):
+        """解析非流式响应, 同步和异步调用共用"""
         if not completion.choices:
             raise Exception(f"API响应格式异常: 缺少choices字段. 响应内容: {completion}")
 
@@ -42,6 +42,77 @@ class OpenaiInfra:
                 "completion_tokens": completion.usage.completion_tokens,
                 "finish_reason": completion.choices[0].finish_reason,
                 "model": model}
+       
+    # 超时由with_timeout统一管理: 它设置截止时间, 这里把剩余时间作为SDK的请求超时(建连和等待响应头),
+    # httpx的读超时只限制单次读操作, 响应体缓慢到达时由看门狗在截止时间断开连接.
+    # 对每个底层接口记录执行时间, 添加到返回值的execution_time字段中.
+    #
+    @with_timeout(timeout_param='timeout')
+    @counting_time
+    def get_response(self, messages: list, tools: list, model: str, timeout, stream = False, additional_params={}):
+        # 使用流式响应接口在收到响应头后返回, 读取响应体期间可以被看门狗中断; 退出时关闭响应
+        with self.openai.chat.completions.with_streaming_response.create(
+            timeout=request_timeout(timeout), **self._build_kwargs(messages, tools, model, stream, additional_params)
+        ) as response:
+            with call_at_deadline(lambda: self._abort(response.http_response)):
+                completion = response.parse()
+        return self._parse_completion(completion, model)
+
+    @staticmethod
+    def _abort(http_response):
+        """在看门狗线程中断开响应所在的连接, 使阻塞中的读操作立即返回"""
+        network_stream = http_response.extensions.get("network_stream")
+        sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+        try:
+            if sock is not None:
+                sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    @with_timeout(timeout_param='timeout')
+    @counting_time
+    async def aget_response(self, messages: list, tools: list, model: str, timeout, stream = False, additional_params={}):
+        """get_response的协程版本, 使用当前事件循环中缓存的AsyncOpenAI客户端"""
+        async_openai = get_async_openai_client(self.base_url, self.api_key)
+        completion = await async_openai.chat.completions.create(
+            timeout=request_timeout(timeout), **self._build_kwargs(messages, tools, model, stream, additional_params)
+        )
+        return self._parse_completion(completion, model)
+
+    @staticmethod
+    def _chunk_content(chunk):
+        """提取流式数据块中的文本增量"""
+        if not chunk.choices:
+            return None
+        return chunk.choices[0].delta.content
+
+    def stream_response(self, messages: list, tools: list, model: str, timeout, additional_params={}):
+        """流式请求, 逐个产出文本增量. timeout作为SDK的请求超时(含相邻数据块之间的读超时)"""
+        stream = self.openai.chat.completions.create(
+            timeout=timeout, **self._build_kwargs(messages, tools, model, True, additional_params)
+        )
+        try:
+            for chunk in stream:
+                content = self._chunk_content(chunk)
+                if content:
+                    yield content
+        finally:
+            # 提前结束时关闭连接, 不再继续接收上游的输出
+            stream.close()
+
+    async def astream_response(self, messages: list, tools: list, model: str, timeout, additional_params={}):
+        """stream_response的协程版本"""
+        async_openai = get_async_openai_client(self.base_url, self.api_key)
+        stream = await async_openai.chat.completions.create(
+            timeout=timeout, **self._build_kwargs(messages, tools, model, True, additional_params)
+        )
+        try:
+            async for chunk in stream:
+                content = self._chunk_content(chunk)
+                if content:
+                    yield content
+        finally:
+            await stream.close()
 
 if __name__ == "__main__":
     # 示例测试代码 - 请替换为您的真实API密钥
@@ -0,0 +1,222 @@
+import os
+import asyncio
+import socket
+import threading
+import weakref
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+"""进程级的HTTP会话池.
+
+每个源(按base_url的scheme+host区分)共享一个requests.Session,
+所有CurlInfra实例和所有线程复用同一组keep-alive连接,
+避免每次请求都重新进行TCP和TLS握手.
+异步调用使用httpx.AsyncClient, 其连接池与事件循环绑定, 因此按(事件循环, 源)缓存.
+"""
+
+# 每个会话缓存多少个不同host的连接池.
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 10))
+# 每个host最多保持多少个keep-alive连接, 应不小于单源的并发请求数.
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 64))
+# 连接层面的重试次数. 只在请求尚未发出(建连失败)时重试, 避免重复计费.
+HTTP_POOL_RETRIES = int(os.environ.get("HTTP_POOL_RETRIES", 1))
+HTTP_POOL_BACKOFF = float(os.environ.get("HTTP_POOL_BACKOFF", 0.2))
+# TCP keep-alive探测参数(秒), 防止空闲连接被中间设备静默断开.
+HTTP_KEEPALIVE_IDLE = int(os.environ.get("HTTP_KEEPALIVE_IDLE", 60))
+HTTP_KEEPALIVE_INTERVAL = int(os.environ.get("HTTP_KEEPALIVE_INTERVAL", 15))
+HTTP_KEEPALIVE_COUNT = int(os.environ.get("HTTP_KEEPALIVE_COUNT", 4))
+# 空闲keep-alive连接的过期时间(秒), 仅用于异步连接池
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 60))
+
+
+def _keepalive_socket_options():
+    """构造开启TCP keep-alive的socket选项, 不支持的平台上自动跳过对应选项"""
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, HTTP_KEEPALIVE_IDLE))
+    elif hasattr(socket, "TCP_KEEPALIVE"):
+        # macOS下的等价选项
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, HTTP_KEEPALIVE_IDLE))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, HTTP_KEEPALIVE_INTERVAL))
+    if hasattr(socket, "TCP_KEEPCNT"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, HTTP_KEEPALIVE_COUNT))
+    return options
+
+
+def _default_socket_options():
+    """urllib3默认的socket选项(关闭Nagle算法)"""
+    try:
+        from urllib3.connection import HTTPConnection
+        return list(HTTPConnection.default_socket_options)
+    except Exception:
+        return [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """在urllib3连接池上开启TCP keep-alive的适配器"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = _default_socket_options() + _keepalive_socket_options()
+        super().init_poolmanager(*args, **kwargs)
+
+
+class HTTPSessionPool:
+    """按源的origin(scheme://host:port)缓存requests.Session的线程安全池.
+
+    requests.Session发送请求本身是线程安全的, 因此同一个源下的所有线程
+    可以共享同一个会话及其底层的urllib3连接池.
+    """
+
+    def __init__(self,
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=HTTP_POOL_RETRIES,
+        backoff_factor=HTTP_POOL_BACKOFF
+    ) -> None:
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _origin(base_url):
+        """从完整URL中提取origin作为会话的键"""
+        parts = urlsplit(base_url)
+        if not parts.scheme or not parts.netloc:
+            raise ValueError(f"无效的base_url: {base_url}")
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def _build_session(self):
+        session = requests.Session()
+        # 不同api_key共享会话, 不保存任何服务端下发的cookie, 避免串号.
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=self.backoff_factor,
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = KeepAliveAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=retry,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def get_session(self, base_url):
+        """获取base_url对应源的共享会话, 不存在时创建
+
+        Args:
+            base_url (str): 请求的完整URL或源的基础URL
+
+        Returns:
+            requests.Session: 该源的共享会话
+        """
+        origin = self._origin(base_url)
+        session = self._sessions.get(origin)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(origin)
+            if session is None:
+                session = self._build_session()
+                self._sessions[origin] = session
+            return session
+
+    def close(self, base_url=None):
+        """关闭指定源(或全部源)的会话, 释放其持有的连接"""
+        with self._lock:
+            if base_url is None:
+                sessions = list(self._sessions.values())
+                self._sessions.clear()
+            else:
+                session = self._sessions.pop(self._origin(base_url), None)
+                sessions = [session] if session is not None else []
+        for session in sessions:
+            session.close()
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+# 进程级共享的会话池
+session_pool = HTTPSessionPool()
+
+
+def get_session(base_url):
+    """获取进程级会话池中base_url对应源的共享会话"""
+    return session_pool.get_session(base_url)
+
+
+class AsyncHTTPClientPool:
+    """按源的origin缓存httpx.AsyncClient的池, 每个事件循环各有一份.
+
+    与HTTPSessionPool的配置保持一致: 连接数上限, TCP keep-alive以及仅建连阶段的重试.
+    """
+
+    def __init__(self,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=HTTP_POOL_RETRIES,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    ) -> None:
+        self.limits = httpx.Limits(
+            max_connections=pool_maxsize,
+            max_keepalive_connections=pool_maxsize,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.max_retries = max_retries
+        # {event_loop: {origin: httpx.AsyncClient}}
+        self._clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _build_client(self):
+        transport = httpx.AsyncHTTPTransport(
+            limits=self.limits,
+            retries=self.max_retries,
+            socket_options=_default_socket_options() + _keepalive_socket_options(),
+        )
+        # 超时由每次请求的timeout参数控制
+        return httpx.AsyncClient(transport=transport, timeout=None)
+
+    def get_client(self, base_url):
+        """获取当前事件循环中base_url对应源的共享异步客户端, 必须在协程中调用"""
+        origin = HTTPSessionPool._origin(base_url)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            loop_clients = self._clients.setdefault(loop, {})
+            client = loop_clients.get(origin)
+            if client is None or client.is_closed:
+                client = self._build_client()
+                loop_clients[origin] = client
+            return client
+
+    async def aclose(self):
+        """关闭当前事件循环中的所有异步客户端"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = list(self._clients.pop(loop, {}).values())
+        for client in clients:
+            await client.aclose()
+
+
+# 进程级共享的异步客户端池
+async_client_pool = AsyncHTTPClientPool()
+
+
+def get_async_client(base_url):
+    """获取当前事件循环中base_url对应源的共享异步客户端"""
+    return async_client_pool.get_client(base_url)
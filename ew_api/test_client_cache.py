@@ -0,0 +1,90 @@
+import unittest
+import sys
+import threading
+import time
+from pathlib import Path
+
+# 导入客户端缓存
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_api.client_cache import OpenAIClientRegistry
+
+
+class TestOpenAIClientRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = OpenAIClientRegistry(idle_ttl=60, max_size=3)
+
+    def tearDown(self):
+        self.registry.clear()
+
+    def test_same_key_reuses_client(self):
+        """相同(base_url, api_key)返回同一个客户端"""
+        c1 = self.registry.get_client("https://api.example.com/v1", "key-1")
+        c2 = self.registry.get_client("https://api.example.com/v1", "key-1")
+        self.assertIs(c1, c2)
+
+    def test_different_keys_share_connection_pool(self):
+        """同一源下不同api_key的客户端共享httpx连接池"""
+        c1 = self.registry.get_client("https://api.example.com/v1", "key-1")
+        c2 = self.registry.get_client("https://api.example.com/v1", "key-2")
+        self.assertIsNot(c1, c2)
+        self.assertIs(c1._client, c2._client)
+
+    def test_lru_eviction(self):
+        """超出上限时逐出最久未使用的客户端"""
+        c1 = self.registry.get_client("https://a.example.com/v1", "key-1")
+        self.registry.get_client("https://b.example.com/v1", "key-2")
+        self.registry.get_client("https://c.example.com/v1", "key-3")
+        # 访问key-1使其成为最近使用
+        self.registry.get_client("https://a.example.com/v1", "key-1")
+        self.registry.get_client("https://d.example.com/v1", "key-4")
+        self.assertEqual(len(self.registry), 3)
+        self.assertIs(self.registry.get_client("https://a.example.com/v1", "key-1"), c1)
+        self.assertNotIn("https://b.example.com", self.registry._http_clients)
+
+    def test_idle_eviction(self):
+        """空闲超过TTL的客户端被逐出, 其连接池在延迟后关闭"""
+        registry = OpenAIClientRegistry(idle_ttl=0.05, max_size=10, close_delay=0.05)
+        try:
+            c1 = registry.get_client("https://a.example.com/v1", "key-1")
+            http_client = c1._client
+            time.sleep(0.1)
+            registry.get_client("https://b.example.com/v1", "key-2")
+            self.assertEqual(len(registry), 1)
+            self.assertFalse(http_client.is_closed)
+            time.sleep(0.1)
+            registry.get_client("https://c.example.com/v1", "key-3")
+            self.assertTrue(http_client.is_closed)
+        finally:
+            registry.clear()
+
+    def test_evicted_client_keeps_pool(self):
+        """被逐出的客户端在延迟期间仍可使用, 该源再次被使用时沿用原连接池"""
+        registry = OpenAIClientRegistry(idle_ttl=60, max_size=1, close_delay=60)
+        try:
+            c1 = registry.get_client("https://a.example.com/v1", "key-1")
+            registry.get_client("https://b.example.com/v1", "key-2")
+            self.assertFalse(c1._client.is_closed)
+            c3 = registry.get_client("https://a.example.com/v1", "key-3")
+            self.assertIs(c3._client, c1._client)
+        finally:
+            registry.clear()
+        self.assertTrue(c1._client.is_closed)
+
+    def test_concurrent_get_client(self):
+        """多线程并发获取时只会创建一个客户端"""
+        results = []
+
+        def worker():
+            results.append(self.registry.get_client("https://api.example.com/v1", "key-1"))
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len({id(c) for c in results}), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import sys
+from pathlib import Path
+
+# 导入CurlInfra
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_api.curl_infra import CurlInfra
+
+
+class FakeStreamResponse:
+    """模拟requests的流式响应"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.closed = False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_lines(self):
+        for line in self.lines:
+            yield line.encode("utf-8")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.kwargs = None
+
+    def post(self, url, **kwargs):
+        self.kwargs = kwargs
+        return self.response
+
+
+class TestCurlInfraStream(unittest.TestCase):
+
+    def setUp(self):
+        self.infra = CurlInfra("https://api.example.com/v1/chat/completions", "key-1")
+
+    def test_parse_stream_line(self):
+        """解析SSE数据行"""
+        self.assertEqual(CurlInfra._parse_stream_line(""), (False, None))
+        self.assertEqual(CurlInfra._parse_stream_line(": keep-alive"), (False, None))
+        self.assertEqual(CurlInfra._parse_stream_line("data: [DONE]"), (True, None))
+        self.assertEqual(
+            CurlInfra._parse_stream_line('data: {"choices":[{"delta":{"content":"你好"}}]}'),
+            (False, "你好")
+        )
+        with self.assertRaises(Exception):
+            CurlInfra._parse_stream_line('data: {"error":{"message":"rate limited"}}')
+
+    def test_stream_response(self):
+        """逐个产出文本增量, 遇到[DONE]结束并关闭连接"""
+        response = FakeStreamResponse([
+            'data: {"choices":[{"delta":{"role":"assistant"}}]}',
+            'data: {"choices":[{"delta":{"content":"Hel"}}]}',
+            "",
+            'data: {"choices":[{"delta":{"content":"lo"}}]}',
+            "data: [DONE]",
+            'data: {"choices":[{"delta":{"content":"ignored"}}]}',
+        ])
+        self.infra.session = FakeSession(response)
+        tokens = list(self.infra.stream_response([{"role": "user", "content": "hi"}], [], "m", timeout=5))
+        self.assertEqual(tokens, ["Hel", "lo"])
+        self.assertTrue(response.closed)
+        self.assertTrue(self.infra.session.kwargs["stream"])
+        self.assertTrue(self.infra.session.kwargs["json"]["stream"])
+
+    def test_stream_closed_early(self):
+        """调用方提前停止读取时关闭连接"""
+        response = FakeStreamResponse([
+            'data: {"choices":[{"delta":{"content":"a"}}]}',
+            'data: {"choices":[{"delta":{"content":"b"}}]}',
+        ])
+        self.infra.session = FakeSession(response)
+        stream = self.infra.stream_response([], [], "m", timeout=5)
+        self.assertEqual(next(stream), "a")
+        stream.close()
+        self.assertTrue(response.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
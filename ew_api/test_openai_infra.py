@@ -0,0 +1,67 @@
+import json
+import socket
+import threading
+import time
+import unittest
+import sys
+from pathlib import Path
+
+# 导入OpenaiInfra
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_api.openai_infra import OpenaiInfra
+
+BODY = json.dumps({
+    "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "m",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "hi"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}).encode("utf-8")
+
+
+class TricklingServer:
+    """本地HTTP服务, 响应头立即返回, 响应体每隔interval秒发送一个字节"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.sock.getsockname()[1]}/v1"
+
+    def _serve(self):
+        conn, _ = self.sock.accept()
+        try:
+            conn.recv(65536)
+            conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % len(BODY))
+            for byte in BODY:
+                conn.sendall(bytes([byte]))
+                time.sleep(self.interval)
+            time.sleep(0.2)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            self.sock.close()
+
+
+class TestOpenaiInfraDeadline(unittest.TestCase):
+
+    def test_response(self):
+        infra = OpenaiInfra(TricklingServer(0).base_url, "key-1")
+        response = infra.get_response([{"role": "user", "content": "hi"}], [], "m", timeout=5)
+        self.assertEqual(response["content"], "hi")
+
+    def test_trickling_body_aborted_at_deadline(self):
+        """响应体缓慢到达时, 每次读都不超过读超时, 仍在截止时间断开连接"""
+        infra = OpenaiInfra(TricklingServer(0.05).base_url, "key-1")
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            infra.get_response([{"role": "user", "content": "hi"}], [], "m", timeout=0.5)
+        self.assertLess(time.monotonic() - start, 1.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import sys
+import threading
+from pathlib import Path
+
+# 导入会话池
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_api.session_pool import HTTPSessionPool
+from ew_api.curl_infra import CurlInfra
+
+
+class TestHTTPSessionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = HTTPSessionPool(pool_maxsize=8, max_retries=2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_same_origin_shares_session(self):
+        """同一源下不同路径的URL应共享同一个会话"""
+        s1 = self.pool.get_session("https://api.example.com/v1/chat/completions")
+        s2 = self.pool.get_session("https://API.example.com/v1/embeddings")
+        self.assertIs(s1, s2)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_different_origin_separate_session(self):
+        """不同源应使用各自独立的会话"""
+        s1 = self.pool.get_session("https://api.example.com/v1")
+        s2 = self.pool.get_session("https://openrouter.ai/api/v1")
+        self.assertIsNot(s1, s2)
+        self.assertEqual(len(self.pool), 2)
+
+    def test_adapter_configuration(self):
+        """适配器应带有连接池大小和仅建连阶段的重试配置"""
+        session = self.pool.get_session("https://api.example.com/v1")
+        adapter = session.get_adapter("https://api.example.com/v1")
+        self.assertEqual(adapter._pool_maxsize, 8)
+        self.assertEqual(adapter.max_retries.connect, 2)
+        self.assertEqual(adapter.max_retries.read, 0)
+
+    def test_concurrent_get_session(self):
+        """多线程并发获取时只会创建一个会话"""
+        results = []
+
+        def worker():
+            results.append(self.pool.get_session("https://api.example.com/v1"))
+
+        threads = [threading.Thread(target=worker) for _ in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len({id(s) for s in results}), 1)
+
+    def test_invalid_url(self):
+        """无效的URL应抛出ValueError"""
+        with self.assertRaises(ValueError):
+            self.pool.get_session("not-a-url")
+
+    def test_curl_infra_instances_share_session(self):
+        """同一源的不同CurlInfra实例(不同api_key)复用同一会话"""
+        infra_1 = CurlInfra("https://api.example.com/v1/chat/completions", "key-1")
+        infra_2 = CurlInfra("https://api.example.com/v1/chat/completions", "key-2")
+        self.assertIs(infra_1.session, infra_2.session)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,10 @@ API密钥配置示例文件
 2. 编辑 api_keys_local.py，填入您的真实API密钥
 3. 确保 api_keys_local.py 在 .gitignore 中，不会被提交
 
+限流配置（可选）：
+- 每个密钥可以配置 "rpm"/"tpm"：该密钥每分钟的请求数/token数上限，未配置则不限制
+- 账户级的 "rpm"/"tpm" 上限在文件末尾的 account_limit_mapping 中配置，由该账户下所有密钥共享
+
 注意：
 - 请勿在公共仓库中提交真实的API密钥
 - 建议使用环境变量或密钥管理服务管理生产环境的API密钥
@@ -20,6 +24,8 @@ deerapi_pool = {
         {
             "name": "key_1",
             "api_key": "sk-your-deerapi-key-1-here",
+            # "rpm": 60,       # 可选：该密钥每分钟请求数上限
+            # "tpm": 100000,   # 可选：该密钥每分钟token数上限
         },
         {
             "name": "key_2", 
@@ -136,6 +142,11 @@ pool_mapping = {
     "anthropic": anthropic_pool
 }
 
+# 账户级限流配置：{源名称: {账户: {"rpm": 每分钟请求数, "tpm": 每分钟token数}}}
+# 例如 "deerapi": {"your-email@example.com": {"rpm": 500, "tpm": 2000000}}
+account_limit_mapping = {
+}
+
 # 配置验证提示
 print("API密钥配置示例文件已加载")
 print("请复制此文件为 api_keys_local.py 并填入您的真实API密钥")
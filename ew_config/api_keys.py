@@ -5,6 +5,8 @@ API密钥配置文件
 配置格式：
 - 第一层：用户标识符（可以是邮箱或用户名）
 - 第二层：API密钥列表，每个密钥包含名称和密钥值
+- 密钥可选字段 "rpm"/"tpm"：该密钥每分钟的请求数/token数上限，未配置则不限制
+- 账户级的 "rpm"/"tpm" 上限在 account_limit_mapping 中配置，由该账户下所有密钥共享
 
 请将此文件复制为您的配置文件，并填入真实的API密钥。
 建议使用环境变量或密钥管理服务来管理生产环境的API密钥。
@@ -208,3 +210,8 @@ pool_mapping = {
     "openai": openai_pool,
     "anthropic": anthropic_pool
 }
+
+# 账户级限流配置：{源名称: {账户: {"rpm": 每分钟请求数, "tpm": 每分钟token数}}}
+# 例如 "deerapi": {"your-email@example.com": {"rpm": 500, "tpm": 2000000}}
+account_limit_mapping = {
+}
@@ -1,4 +1,4 @@
 from .counting_time import counting_time
-from .with_timeout import with_timeout
+from .with_timeout import with_timeout, with_deadline
 
-__all__ = ['counting_time', 'with_timeout']
+__all__ = ['counting_time', 'with_timeout', 'with_deadline']
@@ -1,8 +1,25 @@
 import time
 import functools
+import inspect
 
 # 定义 counting_time 装饰器
 def counting_time(func):
+    # 协程函数需要在await之后再计时
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start_time = time.time()
+            result = await func(*args, **kwargs)
+            end_time = time.time()
+            execution_time = end_time - start_time
+            
+            # 如果结果是字典，添加执行时间作为key-value
+            if isinstance(result, dict):
+                result["execution_time"] = execution_time
+            
+            return result
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         start_time = time.time()
@@ -15,4 +32,4 @@ def counting_time(func):
             result["execution_time"] = execution_time
         
         return result
-    return wrapper
\ No newline at end of file
+    return wrapper
@@ -1,11 +1,13 @@
 import time
+import asyncio
 import unittest
 import sys
 from pathlib import Path
 
 # 导入with_timeout装饰器
 sys.path.insert(0, str(Path(__file__).parent))
-from with_timeout import with_timeout
+import threading
+from with_timeout import with_timeout, with_deadline, remaining_time, request_timeout, call_at_deadline, CancelToken, cancel_scope
 
 # 定义一些测试函数
 @with_timeout(timeout_param='timeout')
@@ -32,6 +34,49 @@ def function_with_custom_param_name(sleep_time=1, custom_timeout_name=None):
     time.sleep(sleep_time)
     return "正常完成"
 
+@with_timeout(timeout_param='timeout')
+async def async_function_with_param_timeout(timeout=None, sleep_time=1):
+    """使用带有timeout参数的协程函数"""
+    await asyncio.sleep(sleep_time)
+    return "正常完成"
+
+@with_deadline(timeout_param='timeout')
+def function_with_request_deadline(timeout, sleep_time):
+    """在截止时间之后才返回, 并报告内层尝试可用的时间"""
+    time.sleep(sleep_time)
+    remaining = remaining_time()
+    if remaining == 0:
+        return remaining, None
+    return remaining, function_with_nested_timeout(timeout=100, inner_timeout=100)
+
+class TransportReadTimeout(Exception):
+    """模拟传输库(如requests.ReadTimeout)的超时异常"""
+
+@with_timeout(timeout_param='timeout')
+def function_with_transport(timeout=None):
+    """模拟把剩余时间交给传输层的函数"""
+    seconds = request_timeout(timeout)
+    time.sleep(seconds)
+    raise TransportReadTimeout(f"read timed out after {seconds}")
+
+@with_timeout(timeout_param='timeout')
+def function_with_blocking_read(timeout=None):
+    """模拟阻塞读取, 截止时间到期时由看门狗中断"""
+    aborted = threading.Event()
+    with call_at_deadline(aborted.set):
+        if not aborted.wait(5):
+            return "正常完成"
+    raise ConnectionError("connection aborted")
+
+@with_timeout(timeout_param='timeout')
+def function_with_nested_timeout(timeout=None, inner_timeout=None):
+    """在外层截止时间内调用带更长超时的内层函数"""
+    return function_returning_remaining(timeout=inner_timeout)
+
+@with_timeout(timeout_param='timeout')
+def function_returning_remaining(timeout=None):
+    return remaining_time()
+
 class TestWithTimeout(unittest.TestCase):
     
     def test_normal_execution(self):
@@ -72,6 +117,64 @@ class TestWithTimeout(unittest.TestCase):
         with self.assertRaises(TimeoutError):
             function_with_custom_param_name(sleep_time=3, custom_timeout_name=2)
 
+    def test_no_timeout(self):
+        """超时为None时不设置截止时间, 与原来的future.result(timeout=None)一样不限时"""
+        self.assertEqual(function_with_param_timeout(timeout=None, sleep_time=0.1), "正常完成")
+        self.assertIsNone(function_returning_remaining())
+        self.assertEqual(asyncio.run(async_function_with_param_timeout(sleep_time=0.1)), "正常完成")
+        # 外层的截止时间仍然有效
+        self.assertLessEqual(function_with_nested_timeout(timeout=1, inner_timeout=None), 1)
+
+    def test_transport_timeout(self):
+        """传输层超时应转换为TimeoutError, 并在截止时间附近返回"""
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            function_with_transport(timeout=0.3)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_call_at_deadline(self):
+        """读操作阻塞时, 看门狗在截止时间到期时中断并转换为TimeoutError"""
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            function_with_blocking_read(timeout=0.3)
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_cancel_scope(self):
+        """其他线程取消时立即中断阻塞的读操作, 之后的请求直接失败"""
+        token = CancelToken()
+        threading.Timer(0.1, token.cancel).start()
+        start = time.monotonic()
+        with cancel_scope(token):
+            with self.assertRaises(ConnectionError):
+                function_with_blocking_read(timeout=None)
+            with self.assertRaises(TimeoutError):
+                request_timeout(None)
+        self.assertLess(time.monotonic() - start, 1)
+        request_timeout(None)
+
+    def test_nested_deadline(self):
+        """内层的超时不能超过外层剩余的时间"""
+        remaining = function_with_nested_timeout(timeout=1, inner_timeout=100)
+        self.assertLessEqual(remaining, 1)
+        self.assertIsNone(remaining_time())
+
+    def test_request_deadline(self):
+        """请求级截止时间约束内层的超时, 但截止时间之后返回的结果不作废"""
+        remaining, inner = function_with_request_deadline(timeout=1, sleep_time=0.1)
+        self.assertLessEqual(remaining, 0.9)
+        self.assertLessEqual(inner, remaining)
+        remaining, _ = function_with_request_deadline(timeout=0.05, sleep_time=0.1)
+        self.assertEqual(remaining, 0.0)
+        self.assertIsNone(remaining_time())
+
+    def test_async_function(self):
+        """测试协程函数, 超时时应取消协程并引发TimeoutError"""
+        result = asyncio.run(async_function_with_param_timeout(timeout=1, sleep_time=0.1))
+        self.assertEqual(result, "正常完成")
+
+        with self.assertRaises(TimeoutError):
+            asyncio.run(async_function_with_param_timeout(timeout=0.2, sleep_time=2))
+
 if __name__ == "__main__":
     # 运行测试
     unittest.main() 
\ No newline at end of file
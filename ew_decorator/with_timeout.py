@@ -1,53 +1,316 @@
 import os
 import signal
-import functools
-from concurrent.futures import ThreadPoolExecutor, TimeoutError
-import concurrent.futures
+import time
+import heapq
+import itertools
 import threading
+import functools
+import contextlib
+import contextvars
 import inspect
+import asyncio
+
+"""函数超时装饰器.
+
+超时通过截止时间(deadline)实现: 被装饰的函数在调用方线程中直接执行,
+截止时间保存在contextvar中, 传输层通过request_timeout()取得剩余时间作为
+建连/读超时. 读超时只限制单次读操作, 因此读取响应体期间还可以用call_at_deadline()
+登记一个到期回调, 由进程内唯一的看门狗线程在到期时断开连接.
+到期后请求被真正中断并关闭连接, 不会有被遗弃的工作线程继续占用socket.
+同样的回调也在所在的cancel_scope被其他线程取消时立即调用, 用于中断对冲中落败的同步请求.
+"""
+
+# 当前调用链上最近的截止时间(time.monotonic()时间戳), 嵌套时取较早的一个
+_current_deadline = contextvars.ContextVar("ew_deadline", default=None)
+# 当前调用链所属的CancelToken, 没有时为None
+_current_cancel = contextvars.ContextVar("ew_cancel", default=None)
 
 # 定义 with_timeout 装饰器
 def timeout_handler(signum, frame):
     """超时信号处理函数"""
     raise TimeoutError("操作超时")
 
+def get_deadline():
+    """返回当前的截止时间(time.monotonic()时间戳), 没有时返回None"""
+    return _current_deadline.get()
+
+def remaining_time(default=None):
+    """返回距离当前截止时间的剩余秒数(不小于0), 没有截止时间时返回default"""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return default
+    return max(deadline - time.monotonic(), 0.0)
+
+def request_timeout(default):
+    """返回传输层本次请求应使用的超时时间(秒)
+
+    有截止时间时取剩余时间和default中较小的一个, 截止时间已过或请求已被取消则直接抛出TimeoutError,
+    避免发出注定超时的请求.
+    """
+    if cancelled():
+        raise TimeoutError("请求已取消")
+    remaining = remaining_time()
+    if remaining is None:
+        return default
+    if remaining <= 0:
+        raise TimeoutError("请求截止时间已过")
+    return remaining if default is None else min(default, remaining)
+
+@contextlib.contextmanager
+def deadline_scope(seconds):
+    """在with块内设置截止时间, 已有更早的外层截止时间时沿用外层的"""
+    deadline = time.monotonic() + seconds
+    outer = _current_deadline.get()
+    if outer is not None:
+        deadline = min(deadline, outer)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+@contextlib.contextmanager
+def detached_scope():
+    """在with块内清除截止时间和CancelToken
+
+    用于多个调用方共享的工作(如刷新进程级缓存): 其结果会被缓存或发布给其他调用方,
+    不能因为恰好触发它的调用方截止时间将到或被取消而失败.
+    """
+    deadline = _current_deadline.set(None)
+    cancel = _current_cancel.set(None)
+    try:
+        yield
+    finally:
+        _current_cancel.reset(cancel)
+        _current_deadline.reset(deadline)
+
+class _DeadlineWatchdog:
+    """按截止时间触发回调的看门狗, 整个进程只使用一个守护线程"""
+
+    def __init__(self):
+        # 小顶堆, 元素为[deadline, seq, callback], callback为None表示已取消
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, deadline, callback):
+        entry = [deadline, next(self._seq), callback]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="deadline-watchdog", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self._cond:
+            entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # 丢弃已取消的条目
+                    while self._heap and self._heap[0][2] is None:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        callback = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(delay)
+            try:
+                callback()
+            except Exception:
+                pass
+
+
+_watchdog = _DeadlineWatchdog()
+
+class CancelToken:
+    """可以从其他线程取消的调用链
+
+    取消时立即调用链上通过call_at_deadline登记的回调, 之后的request_timeout()抛出TimeoutError.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callbacks, self._callbacks = list(self._callbacks.values()), {}
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def _register(self, callback):
+        """登记回调并返回其编号, 已经取消时直接调用并返回None"""
+        with self._lock:
+            if not self.cancelled:
+                key = next(self._seq)
+                self._callbacks[key] = callback
+                return key
+        try:
+            callback()
+        except Exception:
+            pass
+        return None
+
+    def _unregister(self, key):
+        with self._lock:
+            self._callbacks.pop(key, None)
+
+
+@contextlib.contextmanager
+def cancel_scope(token):
+    """在with块内把调用链关联到token, 线程池中执行时需在复制的上下文中进入"""
+    reset = _current_cancel.set(token)
+    try:
+        yield token
+    finally:
+        _current_cancel.reset(reset)
+
+def cancelled():
+    """当前调用链是否已被取消"""
+    token = _current_cancel.get()
+    return token is not None and token.cancelled
+
+@contextlib.contextmanager
+def call_at_deadline(callback):
+    """with块执行期间当前截止时间到期或调用链被取消时调用callback
+
+    用于断开阻塞在读操作上的连接. 截止时间到期时在看门狗线程中调用, 被取消时在调用cancel()的线程中调用.
+    既没有截止时间也不在cancel_scope内时不做任何事.
+    """
+    deadline = _current_deadline.get()
+    token = _current_cancel.get()
+    entry = _watchdog.schedule(deadline, callback) if deadline is not None else None
+    key = token._register(callback) if token is not None else None
+    try:
+        yield
+    finally:
+        if entry is not None:
+            _watchdog.cancel(entry)
+        if key is not None:
+            token._unregister(key)
+
+def _is_timeout_error(e):
+    """识别各传输库的超时异常(requests/httpx/openai/socket), 不直接依赖这些库"""
+    if isinstance(e, (TimeoutError, asyncio.TimeoutError)):
+        return True
+    return any("Timeout" in cls.__name__ for cls in type(e).__mro__)
+
+def _seconds_resolver(func, timeout_param, default_seconds):
+    """返回从调用参数中取出超时秒数的函数"""
+    # 获取函数的参数信息
+    sig = inspect.signature(func)
+    
+    def resolve_seconds(args, kwargs):
+        seconds = default_seconds
+        
+        if timeout_param:
+            # 先检查kwargs中是否有该参数
+            if timeout_param in kwargs:
+                seconds = kwargs[timeout_param]
+            else:
+                # 如果kwargs中没有，尝试从位置参数中获取
+                param_names = list(sig.parameters.keys())
+                if timeout_param in param_names:
+                    param_index = param_names.index(timeout_param)
+                    if param_index < len(args):
+                        seconds = args[param_index]
+                    else:
+                        # 如果位置参数中也没有，尝试从函数默认参数中获取
+                        param = sig.parameters[timeout_param]
+                        if param.default != inspect.Parameter.empty:
+                            seconds = param.default
+        return seconds
+    return resolve_seconds
+
+def with_deadline(timeout_param=None, default_seconds=300):
+    """请求级截止时间装饰器
+
+    只在调用期间设置截止时间, 由内部的选路、获取密钥、每次尝试和重试等待通过remaining_time()/request_timeout()
+    共享剩余时间. 与with_timeout不同, 它不取消协程, 也不作废截止时间之后才返回的结果,
+    因此截止时间前已经拿到的响应在之后发送使用记录等收尾工作变慢时不会丢失.
+    超时秒数为None时不设置截止时间.
+    """
+    def decorator(func):
+        resolve_seconds = _seconds_resolver(func, timeout_param, default_seconds)
+
+        def scope(args, kwargs):
+            seconds = resolve_seconds(args, kwargs)
+            return deadline_scope(seconds) if seconds is not None else contextlib.nullcontext()
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with scope(args, kwargs):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with scope(args, kwargs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
 def with_timeout(timeout_param=None, default_seconds=300):
     """函数超时装饰器
     
-    修改为始终使用ThreadPoolExecutor实现超时功能，
-    因为signal模块只能在主线程中使用。
+    同步函数在调用方线程中执行, 不再为每次调用创建线程池.
+    被装饰的函数应通过request_timeout()把剩余时间交给传输层,
+    传输层超时或执行超过截止时间时统一抛出TimeoutError.
+    协程函数使用asyncio.wait_for, 超时后协程会被真正取消.
+    超时秒数为None时不设置截止时间, 沿用外层的截止时间(如果有).
     """
     def decorator(func):
-        # 获取函数的参数信息
-        sig = inspect.signature(func)
-        
+        resolve_seconds = _seconds_resolver(func, timeout_param, default_seconds)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                seconds = resolve_seconds(args, kwargs)
+                if seconds is None:
+                    return await func(*args, **kwargs)
+                with deadline_scope(seconds) as deadline:
+                    try:
+                        return await asyncio.wait_for(
+                            func(*args, **kwargs), timeout=max(deadline - time.monotonic(), 0)
+                        )
+                    except Exception as e:
+                        if _is_timeout_error(e):
+                            raise TimeoutError(f"函数 {func.__name__} 执行超时（{seconds}秒）") from e
+                        raise
+            return async_wrapper
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            seconds = default_seconds
-            
-            if timeout_param:
-                # 先检查kwargs中是否有该参数
-                if timeout_param in kwargs:
-                    seconds = kwargs[timeout_param]
-                else:
-                    # 如果kwargs中没有，尝试从位置参数中获取
-                    param_names = list(sig.parameters.keys())
-                    if timeout_param in param_names:
-                        param_index = param_names.index(timeout_param)
-                        if param_index < len(args):
-                            seconds = args[param_index]
-                        else:
-                            # 如果位置参数中也没有，尝试从函数默认参数中获取
-                            param = sig.parameters[timeout_param]
-                            if param.default != inspect.Parameter.empty:
-                                seconds = param.default
-            
-            with ThreadPoolExecutor(max_workers=1) as executor:
-                future = executor.submit(func, *args, **kwargs)
+            seconds = resolve_seconds(args, kwargs)
+            if seconds is None:
+                return func(*args, **kwargs)
+            with deadline_scope(seconds) as deadline:
                 try:
-                    return future.result(timeout=seconds)
-                except concurrent.futures.TimeoutError:
-                    raise TimeoutError(f"函数 {func.__name__} 执行超时（{seconds}秒）")
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    if _is_timeout_error(e) or time.monotonic() >= deadline:
+                        raise TimeoutError(f"函数 {func.__name__} 执行超时（{seconds}秒）") from e
+                    raise
+            # 不感知截止时间的函数执行超时后, 其结果同样作废
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"函数 {func.__name__} 执行超时（{seconds}秒）")
+            return result
                 
         return wrapper
     return decorator
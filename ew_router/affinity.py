@@ -0,0 +1,70 @@
+import os
+import bisect
+import hashlib
+import functools
+
+"""按提示前缀的亲和路由(mode="affinity").
+
+供应商的提示缓存只在相同前缀反复命中同一后端和账户时生效, 而按耗时或价格排序、密钥轮询会把相同前缀分散开.
+这里对提示的前AFFINITY_PREFIX_CHARS个字符取哈希作为亲和键, 用带虚拟节点的一致性哈希环把亲和键固定到
+某个源以及该源的某个密钥上. 环只由当前健康的候选构成: 某个候选不健康时只有原本落在它上面的亲和键
+顺延到环上的下一个候选, 其余亲和键不受影响, 恢复后也会回到原处.
+哈希使用md5而不是内置hash, 保证不同进程对同一前缀得到同样的结果.
+"""
+
+# 计算亲和键使用的提示前缀长度(字符), 更短的提示达不到供应商提示缓存的最小长度, 不计算亲和键
+AFFINITY_PREFIX_CHARS = int(os.environ.get("AFFINITY_PREFIX_CHARS", 2048))
+# 一致性哈希环上每个节点的虚拟节点数
+AFFINITY_VNODES = int(os.environ.get("AFFINITY_VNODES", 64))
+
+AFFINITY_MODE = "affinity"
+
+
+def _hash(text):
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "big")
+
+
+def prefix_key(*texts, length=AFFINITY_PREFIX_CHARS):
+    """按顺序拼接的文本(工具定义、提示等)的前length个字符的哈希, 不足length个字符时返回None
+
+    Args:
+        texts (str): 按发送顺序排列的文本, None会被忽略
+    """
+    prefix = "".join(text for text in texts if text)[:length]
+    if not prefix or len(prefix) < length:
+        return None
+    return hashlib.sha1(prefix.encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=256)
+def _ring(nodes, vnodes):
+    """nodes(已排序去重)构成的哈希环: (各虚拟节点的哈希值, 对应的节点)"""
+    points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+    return [point for point, _ in points], [node for _, node in points]
+
+
+def ring_order(nodes, key, vnodes=AFFINITY_VNODES):
+    """从亲和键在环上的位置开始顺时针排列节点, 第一个即亲和键固定到的节点
+
+    Args:
+        nodes (list): 候选节点(源名称或API密钥)
+        key (str): 亲和键, 为None时保持原顺序
+
+    Returns:
+        list: 去重后的节点
+    """
+    unique = tuple(sorted(set(nodes)))
+    if key is None or len(unique) < 2:
+        return list(dict.fromkeys(nodes))
+    points, owners = _ring(unique, vnodes)
+    start = bisect.bisect(points, _hash(key))
+    order = []
+    seen = set()
+    for i in range(len(owners)):
+        owner = owners[(start + i) % len(owners)]
+        if owner not in seen:
+            seen.add(owner)
+            order.append(owner)
+            if len(order) == len(unique):
+                break
+    return order
@@ -0,0 +1,171 @@
+import os
+import math
+import time
+import random
+import threading
+from collections import namedtuple
+
+"""Thompson采样的自适应路由(mode="adaptive").
+
+每个(source, source_model_name)视为一个臂, 维护两个后验分布:
+- 成功率: Beta(1 + 成功数, 1 + 失败数)
+- 耗时: 对数耗时均值的正态后验, 样本越少越宽
+真实请求的结果按BANDIT_HALF_LIFE秒的半衰期衰减, 长时间没有请求的臂后验重新变宽, 从而被再次探索.
+健康检查数据作为先验, 权重相当于BANDIT_PRIOR_WEIGHT次请求; 没有健康检查数据的新源先验很宽.
+每次路由从各臂的后验中各采样一次, 按奖励
+成功率权重 * log(成功率) - 耗时权重 * log(耗时) - 价格权重 * log(价格) 排序.
+取对数后奖励与耗时和价格的单位无关.
+"""
+
+# 真实请求统计的半衰期(秒)
+BANDIT_HALF_LIFE = float(os.environ.get("BANDIT_HALF_LIFE", 300))
+# 奖励中成功率, 耗时和价格的权重
+BANDIT_SUCCESS_WEIGHT = float(os.environ.get("BANDIT_SUCCESS_WEIGHT", 2.0))
+BANDIT_LATENCY_WEIGHT = float(os.environ.get("BANDIT_LATENCY_WEIGHT", 1.0))
+BANDIT_PRICE_WEIGHT = float(os.environ.get("BANDIT_PRICE_WEIGHT", 0.5))
+# 健康检查先验相当于多少次真实请求
+BANDIT_PRIOR_WEIGHT = float(os.environ.get("BANDIT_PRIOR_WEIGHT", 2))
+
+ADAPTIVE_MODE = "adaptive"
+
+# 先验中对数耗时的标准差
+_PRIOR_LOG_SD = 1.0
+# 没有健康检查数据时的先验耗时(秒)及其权重
+_DEFAULT_LATENCY = 10.0
+_DEFAULT_PRIOR_WEIGHT = 0.5
+# 采样成功率的下限, 避免log(0)
+_MIN_SUCCESS = 1e-6
+
+# success_rate: 健康检查的成功率, 未知时为None
+# latency: 健康检查的平均耗时(秒), 未知时为None
+ArmPrior = namedtuple("ArmPrior", ["success_rate", "latency"])
+NO_PRIOR = ArmPrior(None, None)
+
+
+class _Arm:
+    """单个臂随时间衰减的充分统计量, 调用方负责加锁"""
+
+    __slots__ = ("updated_at", "successes", "failures", "log_sum", "log_sq_sum")
+
+    def __init__(self, now):
+        self.updated_at = now
+        self.successes = 0.0
+        self.failures = 0.0
+        self.log_sum = 0.0
+        self.log_sq_sum = 0.0
+
+    def decay(self, now, half_life):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            factor = 0.5 ** (elapsed / half_life)
+            self.successes *= factor
+            self.failures *= factor
+            self.log_sum *= factor
+            self.log_sq_sum *= factor
+            self.updated_at = now
+
+
+def posterior(arm, prior=NO_PRIOR, prior_weight=BANDIT_PRIOR_WEIGHT):
+    """计算后验参数
+
+    Args:
+        arm (_Arm): 真实请求的统计, 可以为None
+        prior (ArmPrior): 健康检查先验
+
+    Returns:
+        tuple: (alpha, beta, 对数耗时均值, 对数耗时均值的标准差)
+    """
+    successes = arm.successes if arm is not None else 0.0
+    failures = arm.failures if arm is not None else 0.0
+    log_sum = arm.log_sum if arm is not None else 0.0
+    log_sq_sum = arm.log_sq_sum if arm is not None else 0.0
+
+    alpha, beta = 1.0 + successes, 1.0 + failures
+    if prior.success_rate is not None:
+        alpha += prior_weight * prior.success_rate
+        beta += prior_weight * (1 - prior.success_rate)
+
+    if prior.latency is not None and prior.latency > 0:
+        k0, m0 = prior_weight, math.log(prior.latency)
+    else:
+        k0, m0 = _DEFAULT_PRIOR_WEIGHT, math.log(_DEFAULT_LATENCY)
+    weight = k0 + successes
+    mu = (k0 * m0 + log_sum) / weight
+    # 先验方差与观测到的离差合并
+    spread = max(log_sq_sum - (log_sum * log_sum / successes if successes > 0 else 0.0), 0.0)
+    variance = (k0 * _PRIOR_LOG_SD ** 2 + spread) / weight
+    return alpha, beta, mu, math.sqrt(variance / weight)
+
+
+class BanditArms:
+    """线程安全的臂统计, 按(source_name, source_model_name)记录"""
+
+    def __init__(self, half_life=BANDIT_HALF_LIFE, prior_weight=BANDIT_PRIOR_WEIGHT, clock=time.monotonic, rng=None):
+        self.half_life = half_life
+        self.prior_weight = prior_weight
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._arms = {}
+        self._lock = threading.Lock()
+
+    def record(self, source_name, model_name, latency, success):
+        """记录一次请求的结果, 失败请求的耗时不参与耗时统计"""
+        now = self.clock()
+        with self._lock:
+            arm = self._arms.get((source_name, model_name))
+            if arm is None:
+                arm = self._arms[(source_name, model_name)] = _Arm(now)
+            arm.decay(now, self.half_life)
+            if success:
+                arm.successes += 1.0
+                log_latency = math.log(max(latency, 1e-3))
+                arm.log_sum += log_latency
+                arm.log_sq_sum += log_latency * log_latency
+            else:
+                arm.failures += 1.0
+
+    def posterior(self, source_name, model_name, prior=NO_PRIOR):
+        now = self.clock()
+        with self._lock:
+            arm = self._arms.get((source_name, model_name))
+            if arm is not None:
+                arm.decay(now, self.half_life)
+            return posterior(arm, prior, self.prior_weight)
+
+    def sample(self, source_name, model_name, prior=NO_PRIOR):
+        """从后验中采样一次, 返回(成功率, 耗时)"""
+        alpha, beta, mu, sd = self.posterior(source_name, model_name, prior)
+        return self.rng.betavariate(alpha, beta), math.exp(self.rng.gauss(mu, sd))
+
+    def clear(self):
+        with self._lock:
+            self._arms.clear()
+
+
+def thompson_order(candidates, sample_of, price_of, success_weight=BANDIT_SUCCESS_WEIGHT,
+                   latency_weight=BANDIT_LATENCY_WEIGHT, price_weight=BANDIT_PRICE_WEIGHT):
+    """按一次采样的奖励对候选源降序排序
+
+    Args:
+        candidates (list): 候选源
+        sample_of (callable): source_name -> (成功率, 耗时)的一次采样
+        price_of (callable): source_name -> 按输入输出比例加权的价格, 未知时为None
+
+    Returns:
+        list: 排序后的候选源
+    """
+    prices = {source_name: price_of(source_name) for source_name in candidates}
+    known = [price for price in prices.values() if price is not None and price > 0]
+    # 价格未知的源按已知最高价格计, 都未知时不考虑价格
+    worst = max(known) if known else None
+
+    def reward(source_name):
+        success, latency = sample_of(source_name)
+        value = success_weight * math.log(max(success, _MIN_SUCCESS)) - latency_weight * math.log(latency)
+        price = prices[source_name] if prices[source_name] is not None and prices[source_name] > 0 else worst
+        if price is not None:
+            value -= price_weight * math.log(price)
+        return value
+
+    rewards = {source_name: reward(source_name) for source_name in candidates}
+    return sorted(candidates, key=lambda source_name: -rewards[source_name])
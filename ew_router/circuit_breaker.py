@@ -0,0 +1,136 @@
+import os
+import time
+import threading
+
+"""按(源, 模型)的熔断器.
+
+由真实请求的结果驱动, 有三种状态:
+- closed: 正常放行, 连续失败BREAKER_FAILURE_THRESHOLD次后转为open
+- open: 路由时跳过该(源, 模型), 请求直接失败以便立即切换到下一个源;
+  经过冷却时间后转为half-open. 冷却时间从BREAKER_OPEN_SECONDS开始, 每次重新熔断翻倍, 不超过BREAKER_MAX_OPEN_SECONDS
+- half-open: 只放行BREAKER_HALF_OPEN_TRIALS个试探请求, 全部成功则恢复为closed, 任意一个失败则重新open
+"""
+
+# 连续失败多少次后熔断
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5))
+# 首次熔断的冷却时间(秒)
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", 30))
+# 冷却时间的上限(秒)
+BREAKER_MAX_OPEN_SECONDS = float(os.environ.get("BREAKER_MAX_OPEN_SECONDS", 300))
+# half-open状态下的试探请求数
+BREAKER_HALF_OPEN_TRIALS = int(os.environ.get("BREAKER_HALF_OPEN_TRIALS", 2))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """熔断器未放行的请求"""
+
+
+class CircuitBreaker:
+    """单个(源, 模型)的熔断器, 调用方负责加锁"""
+
+    __slots__ = ("state", "failures", "open_until", "open_seconds", "trials_in_flight", "trial_successes")
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.open_until = 0.0
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.trials_in_flight = 0
+        self.trial_successes = 0
+
+    def _advance(self, now):
+        """冷却结束后从open转为half-open"""
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+            self.trials_in_flight = 0
+            self.trial_successes = 0
+
+    def _trip(self, now):
+        if self.state == HALF_OPEN:
+            # 试探失败, 冷却时间翻倍
+            self.open_seconds = min(self.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+        self.state = OPEN
+        self.open_until = now + self.open_seconds
+        self.failures = 0
+
+    def is_open(self, now):
+        """路由时是否应跳过"""
+        self._advance(now)
+        if self.state == OPEN:
+            return True
+        return self.state == HALF_OPEN and self.trials_in_flight + self.trial_successes >= BREAKER_HALF_OPEN_TRIALS
+
+    def try_acquire(self, now):
+        """请求前调用, half-open状态下占用一个试探名额"""
+        if self.is_open(now):
+            return False
+        if self.state == HALF_OPEN:
+            self.trials_in_flight += 1
+        return True
+
+    def record(self, success, now):
+        """请求结束后调用, success为None表示请求被取消"""
+        if self.state == HALF_OPEN:
+            self.trials_in_flight = max(self.trials_in_flight - 1, 0)
+            if success is True:
+                self.trial_successes += 1
+                if self.trial_successes >= BREAKER_HALF_OPEN_TRIALS:
+                    self.state = CLOSED
+                    self.failures = 0
+                    self.open_seconds = BREAKER_OPEN_SECONDS
+            elif success is False:
+                self._trip(now)
+            return
+        if success is True:
+            self.failures = 0
+        elif success is False and self.state == CLOSED:
+            self.failures += 1
+            if self.failures >= BREAKER_FAILURE_THRESHOLD:
+                self._trip(now)
+
+
+class CircuitBreakerRegistry:
+    """线程安全的熔断器集合, 按(source_name, source_model_name)区分"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _get(self, source_name, model_name):
+        key = (source_name, model_name)
+        breaker = self._breakers.get(key)
+        if breaker is None:
+            breaker = self._breakers[key] = CircuitBreaker()
+        return breaker
+
+    def is_open(self, source_name, model_name):
+        with self._lock:
+            breaker = self._breakers.get((source_name, model_name))
+            return breaker is not None and breaker.is_open(self.clock())
+
+    def try_acquire(self, source_name, model_name):
+        with self._lock:
+            return self._get(source_name, model_name).try_acquire(self.clock())
+
+    def record(self, source_name, model_name, success):
+        with self._lock:
+            self._get(source_name, model_name).record(success, self.clock())
+
+    def metrics(self):
+        """非closed状态的熔断器"""
+        with self._lock:
+            now = self.clock()
+            result = {}
+            for (source_name, model_name), breaker in self._breakers.items():
+                breaker._advance(now)
+                if breaker.state != CLOSED:
+                    result[f"{source_name}|{model_name}"] = {
+                        "state": breaker.state,
+                        "open_for": round(max(breaker.open_until - now, 0), 1),
+                    }
+            return result
@@ -0,0 +1,238 @@
+import os
+import time
+import asyncio
+import threading
+from collections import Counter
+
+import sys
+from pathlib import Path
+# 更正导入路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ew_router.scheduler import Ticket, capacity
+
+"""按源和(源, 模型)的自适应并发限制(AIMD).
+
+每个源和每个(源, 模型)各有一个并发上限, 根据真实请求的结果调整:
+- 成功且耗时不超过基线的CONCURRENCY_LATENCY_TOLERANCE倍, 且上限确实被用到一半以上时, 上限加性增长(每轮约+1)
+- 失败(超时, 429, 5xx等)时上限乘以CONCURRENCY_BACKOFF
+- 成功但明显变慢时保持不变
+达到上限的请求由调用方转给排名靠后的源, 或排队等待空位.
+排队和争抢空位的顺序由scheduler按优先级类别和截止时间决定, batch请求只能使用上限中未保留给interactive的部分.
+"""
+
+# 初始并发上限
+CONCURRENCY_INITIAL_LIMIT = float(os.environ.get("CONCURRENCY_INITIAL_LIMIT", 16))
+# 并发上限的下限和上限
+CONCURRENCY_MIN_LIMIT = float(os.environ.get("CONCURRENCY_MIN_LIMIT", 1))
+CONCURRENCY_MAX_LIMIT = float(os.environ.get("CONCURRENCY_MAX_LIMIT", 256))
+# 失败时并发上限的缩减系数
+CONCURRENCY_BACKOFF = float(os.environ.get("CONCURRENCY_BACKOFF", 0.7))
+# 耗时超过基线该倍数的成功请求不再增加并发上限
+CONCURRENCY_LATENCY_TOLERANCE = float(os.environ.get("CONCURRENCY_LATENCY_TOLERANCE", 2.0))
+# 所有候选源都达到并发上限时, 排队等待空位的最长时间(秒)
+CONCURRENCY_QUEUE_TIMEOUT = float(os.environ.get("CONCURRENCY_QUEUE_TIMEOUT", 5))
+
+# 耗时基线的EWMA系数
+_BASELINE_ALPHA = 0.05
+# 协程排队时的轮询间隔(秒)
+_POLL_INTERVAL = 0.05
+
+
+class ConcurrencyLimitExceeded(Exception):
+    """排队超时仍未获得并发许可"""
+
+
+class AdaptiveLimit:
+    """单个键的AIMD并发上限, 调用方负责加锁"""
+
+    __slots__ = ("limit", "in_flight", "baseline")
+
+    def __init__(self, limit=CONCURRENCY_INITIAL_LIMIT):
+        self.limit = limit
+        self.in_flight = 0
+        self.baseline = None
+
+    def available(self, priority=None):
+        if priority is None:
+            return self.in_flight < int(self.limit)
+        return self.in_flight < capacity(priority, self.limit)
+
+    def on_success(self, latency, in_flight):
+        """in_flight为请求发出时的并发数"""
+        if self.baseline is None:
+            self.baseline = latency
+        slow = latency > self.baseline * CONCURRENCY_LATENCY_TOLERANCE
+        self.baseline += _BASELINE_ALPHA * (latency - self.baseline)
+        if not slow and in_flight * 2 >= self.limit:
+            self.limit = min(CONCURRENCY_MAX_LIMIT, self.limit + 1 / self.limit)
+
+    def on_error(self):
+        self.limit = max(CONCURRENCY_MIN_LIMIT, self.limit * CONCURRENCY_BACKOFF)
+
+
+class Permit:
+    """一次请求持有的并发许可, 须通过ConcurrencyLimiter.release归还"""
+
+    __slots__ = ("keys", "in_flight", "started_at", "released", "recorded")
+
+    def __init__(self, keys, in_flight):
+        self.keys = keys
+        self.in_flight = in_flight
+        self.started_at = time.monotonic()
+        self.released = False
+        # 结果是否已经用于调整上限
+        self.recorded = False
+
+
+class ConcurrencyLimiter:
+    """线程安全的并发限制器, 同时限制源和(源, 模型)两级"""
+
+    def __init__(self, initial_limit=CONCURRENCY_INITIAL_LIMIT):
+        self.initial_limit = initial_limit
+        self._limits = {}
+        # 正在排队等待许可的Ticket
+        self._waiters = []
+        self._cond = threading.Condition()
+
+    def _keys(self, source_name, model_name):
+        return (source_name,), (source_name, model_name)
+
+    def _limit(self, key):
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = AdaptiveLimit(self.initial_limit)
+        return limit
+
+    def _admissible_locked(self, ticket):
+        return all(self._limit(key).available(ticket.priority) for key in ticket.keys)
+
+    def _try_acquire_locked(self, ticket):
+        """有空位, 且没有更优先的排队请求正可以占用同一个限制时才发放许可"""
+        if not self._admissible_locked(ticket):
+            return None
+        for waiter in self._waiters:
+            if waiter is not ticket and waiter.rank < ticket.rank and waiter.competes_with(ticket) \
+                    and self._admissible_locked(waiter):
+                return None
+        limits = [self._limit(key) for key in ticket.keys]
+        for limit in limits:
+            limit.in_flight += 1
+        return Permit(ticket.keys, max(limit.in_flight for limit in limits))
+
+    def _wait_until(self, ticket, timeout):
+        """排队的最晚时间, 不晚于请求的截止时间"""
+        wait_until = time.monotonic() + timeout
+        return wait_until if ticket.deadline is None else min(wait_until, ticket.deadline)
+
+    def _leave_locked(self, ticket):
+        self._waiters.remove(ticket)
+        # 排在前面的请求离开后, 后面的请求可能可以获得许可
+        self._cond.notify_all()
+
+    def try_acquire(self, source_name, model_name, priority=None, deadline=None):
+        """不等待地获取许可, 任意一级达到该优先级可用的上限时返回None
+
+        Args:
+            priority (str, optional): 优先级类别, 默认取scheduler.priority_scope设置的类别
+            deadline (float, optional): 截止时间(time.monotonic()时间戳), 默认取with_timeout的截止时间
+        """
+        ticket = Ticket(self._keys(source_name, model_name), priority, deadline)
+        with self._cond:
+            return self._try_acquire_locked(ticket)
+
+    def acquire(self, source_name, model_name, timeout=CONCURRENCY_QUEUE_TIMEOUT, priority=None, deadline=None):
+        """按优先级类别和截止时间排队等待许可, 超时或到达截止时间时返回None"""
+        ticket = Ticket(self._keys(source_name, model_name), priority, deadline)
+        wait_until = self._wait_until(ticket, timeout)
+        with self._cond:
+            self._waiters.append(ticket)
+            try:
+                while True:
+                    permit = self._try_acquire_locked(ticket)
+                    if permit is not None:
+                        return permit
+                    remaining = wait_until - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._cond.wait(remaining)
+            finally:
+                self._leave_locked(ticket)
+
+    async def aacquire(self, source_name, model_name, timeout=CONCURRENCY_QUEUE_TIMEOUT, priority=None, deadline=None):
+        """acquire的协程版本, 以轮询代替阻塞等待"""
+        ticket = Ticket(self._keys(source_name, model_name), priority, deadline)
+        wait_until = self._wait_until(ticket, timeout)
+        with self._cond:
+            self._waiters.append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    permit = self._try_acquire_locked(ticket)
+                if permit is not None:
+                    return permit
+                remaining = wait_until - time.monotonic()
+                if remaining <= 0:
+                    return None
+                await asyncio.sleep(min(_POLL_INTERVAL, remaining))
+        finally:
+            with self._cond:
+                self._leave_locked(ticket)
+
+    def _record_locked(self, permit, success):
+        if permit.recorded:
+            return
+        permit.recorded = True
+        latency = time.monotonic() - permit.started_at
+        for key in permit.keys:
+            limit = self._limit(key)
+            if success is True:
+                limit.on_success(latency, permit.in_flight)
+            elif success is False:
+                limit.on_error()
+
+    def record(self, permit, success):
+        """根据结果调整上限但不归还许可
+
+        用于许可要持有到响应用完的请求(如流式响应在首token时已知成功, 流关闭时才归还),
+        之后的release不再调整上限.
+        """
+        with self._cond:
+            if not permit.released:
+                self._record_locked(permit, success)
+
+    def release(self, permit, success=None):
+        """归还许可并根据结果调整上限
+
+        Args:
+            permit (Permit): try_acquire/acquire返回的许可
+            success (bool, optional): 请求是否成功, None表示请求被取消, 不调整上限; 已经record过时忽略
+        """
+        with self._cond:
+            if permit.released:
+                return
+            permit.released = True
+            self._record_locked(permit, success)
+            for key in permit.keys:
+                self._limit(key).in_flight -= 1
+            self._cond.notify_all()
+
+    def in_flight(self, source_name, model_name=None):
+        """源(或源下模型)当前的在途请求数"""
+        key = (source_name,) if model_name is None else (source_name, model_name)
+        with self._cond:
+            limit = self._limits.get(key)
+            return limit.in_flight if limit is not None else 0
+
+    def queued(self):
+        """各优先级类别正在排队的请求数"""
+        with self._cond:
+            return dict(Counter(ticket.priority for ticket in self._waiters))
+
+    def metrics(self):
+        """当前各源和各(源, 模型)的并发上限与在途请求数"""
+        with self._cond:
+            return {
+                "|".join(key): {"limit": round(limit.limit, 2), "in_flight": limit.in_flight}
+                for key, limit in self._limits.items()
+            }
@@ -0,0 +1,51 @@
+import os
+import re
+
+"""按上下文长度过滤候选源.
+
+source_max_ioLength声明了每个源下模型的最大输入输出长度(token). 路由时先粗略估计请求的token数,
+排除放不下"提示 + max_tokens"的源, 避免请求发出后才因上下文超长失败再切换到备用源.
+估计只需要足够保守, 不追求精确:
+- 中日韩字符按每字1个token计
+- 其余字符按每CONTEXT_CHARS_PER_TOKEN个字符1个token计
+- 每张图片按CONTEXT_IMAGE_TOKENS个token计
+"""
+
+# 非中日韩文本平均每个token对应的字符数
+CONTEXT_CHARS_PER_TOKEN = float(os.environ.get("CONTEXT_CHARS_PER_TOKEN", 4))
+# 每张图片估计占用的token数
+CONTEXT_IMAGE_TOKENS = int(os.environ.get("CONTEXT_IMAGE_TOKENS", 1500))
+# 只使用最大输入输出长度的该比例, 为估计误差留出余量
+CONTEXT_SAFETY_RATIO = float(os.environ.get("CONTEXT_SAFETY_RATIO", 0.95))
+
+_CJK = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+
+
+def estimate_tokens(*texts, images=0):
+    """粗略估计若干段文本加images张图片的token数
+
+    Args:
+        texts (str): 提示、工具定义等文本, None会被忽略
+        images (int): 图片数
+    """
+    tokens = images * CONTEXT_IMAGE_TOKENS
+    for text in texts:
+        if not text:
+            continue
+        cjk = len(_CJK.findall(text))
+        tokens += cjk + (len(text) - cjk) / CONTEXT_CHARS_PER_TOKEN
+    return int(tokens) + 1 if tokens else 0
+
+
+def required_length(prompt_tokens, max_tokens=None):
+    """请求需要的上下文长度, 提示长度未知时返回None"""
+    if prompt_tokens is None:
+        return None
+    return prompt_tokens + (max_tokens or 0)
+
+
+def fits(max_io_length, required, ratio=CONTEXT_SAFETY_RATIO):
+    """源的最大输入输出长度是否放得下请求, 任一方未知时视为放得下"""
+    if max_io_length is None or required is None:
+        return True
+    return required <= max_io_length * ratio
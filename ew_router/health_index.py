@@ -0,0 +1,170 @@
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+"""按模型索引的健康检查数据.
+
+健康检查服务返回的数据以(source, model)为键, 查找某个模型的数据需要扫描所有键.
+这里在每份快照上只建一次索引: 所有窗口存放在一个(source x model x window)的稠密
+float数组中(失败为NaN, 窗口右对齐, 最新的记录在最后一列), 各源各模型的近期平均耗时,
+整体平均耗时和成功率在建索引时一次性向量化计算好.
+健康检查服务下发的耗时分位数草图(sketches)按同样的(source, model)位置索引, 各分位数按需计算并缓存.
+"""
+
+# window: 该源该模型的滑动窗口(秒, 失败为NaN)
+# recent_mean: 最近recent_size次中成功请求的平均耗时, 没有成功请求时为NaN
+# mean: 整个窗口中成功请求的平均耗时, 没有成功请求时为NaN
+# success_rate: 整个窗口的成功率, 窗口为空时为NaN
+SourceHealth = namedtuple("SourceHealth", ["window", "recent_mean", "mean", "success_rate"])
+
+
+def _masked_mean(values, mask):
+    """沿最后一维对mask为True的元素求均值, 没有元素时为NaN"""
+    count = mask.sum(axis=-1)
+    total = np.where(mask, values, 0.0).sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+
+class HealthIndex:
+    """单份健康检查数据的模型索引, 建好后只读
+
+    Attributes:
+        source_names (list): 源名称, 按在原始数据中首次出现的顺序
+        model_names (list): 模型名称, 按在原始数据中首次出现的顺序
+        windows (np.ndarray): (source, model, window)的稠密数组, 失败和填充位置为NaN
+        lengths (np.ndarray): (source, model)各窗口的实际长度
+        exists (np.ndarray): (source, model)健康检查数据中是否有该键
+        recent_mean, mean, success_rate (np.ndarray): (source, model)的聚合值
+        sketches (dict): (source位置, model位置) -> QuantileSketch, 只包含健康检查数据中存在的键
+    """
+
+    def __init__(self, healthy, recent_size):
+        data = (healthy or {}).get("data") or {}
+        self.source_names = []
+        self.model_names = []
+        self.source_pos = {}
+        self.model_pos = {}
+        entries = []
+        for key, values in data.items():
+            if len(key) < 2:
+                continue
+            source_name, model_name = key[0], key[1]
+            if source_name not in self.source_pos:
+                self.source_pos[source_name] = len(self.source_names)
+                self.source_names.append(source_name)
+            if model_name not in self.model_pos:
+                self.model_pos[model_name] = len(self.model_names)
+                self.model_names.append(model_name)
+            window = np.array([np.nan if v is None else v for v in (values or [])], dtype=float)
+            entries.append((self.source_pos[source_name], self.model_pos[model_name], window))
+
+        shape = (len(self.source_names), len(self.model_names))
+        width = max((window.size for _, _, window in entries), default=0)
+        self.windows = np.full(shape + (width,), np.nan)
+        self.lengths = np.zeros(shape, dtype=int)
+        self.exists = np.zeros(shape, dtype=bool)
+        for s, m, window in entries:
+            self.exists[s, m] = True
+            self.lengths[s, m] = window.size
+            if window.size:
+                self.windows[s, m, width - window.size:] = window
+
+        # 一次性计算所有源所有模型的聚合值
+        present = np.arange(width) >= (width - self.lengths)[..., None]
+        success = present & ~np.isnan(self.windows)
+        recent = slice(max(width - recent_size, 0), width)
+        self.recent_mean = _masked_mean(self.windows[..., recent], success[..., recent])
+        self.mean = _masked_mean(self.windows, success)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.success_rate = np.where(
+                self.lengths > 0, success.sum(axis=-1) / np.maximum(self.lengths, 1), np.nan
+            )
+
+        self.sketches = {}
+        for key, sketch in ((healthy or {}).get("sketches") or {}).items():
+            if len(key) >= 2 and key[0] in self.source_pos and key[1] in self.model_pos:
+                self.sketches[(self.source_pos[key[0]], self.model_pos[key[1]])] = sketch
+
+        self._quantiles = {}
+        self._sources_cache = {}
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def sources(self, model_name):
+        """返回{source_name: SourceHealth}, 模型不存在时返回空字典"""
+        cached = self._sources_cache.get(model_name)
+        if cached is not None:
+            return cached
+        m = self.model_pos.get(model_name)
+        result = {}
+        if m is not None:
+            for s in np.flatnonzero(self.exists[:, m]):
+                length = self.lengths[s, m]
+                result[self.source_names[s]] = SourceHealth(
+                    self.windows[s, m, self.windows.shape[-1] - length:],
+                    float(self.recent_mean[s, m]),
+                    float(self.mean[s, m]),
+                    float(self.success_rate[s, m]),
+                )
+        self._sources_cache[model_name] = result
+        return result
+
+    def sketch(self, source_name, model_name):
+        """该源该模型的耗时分位数草图, 没有时返回None"""
+        s, m = self.source_pos.get(source_name), self.model_pos.get(model_name)
+        return self.sketches.get((s, m))
+
+    def latency_quantile(self, q):
+        """所有(source, model)耗时的q分位数, 没有草图的位置为NaN"""
+        result = self._quantiles.get(q)
+        if result is None:
+            result = np.full(self.exists.shape, np.nan)
+            for (s, m), sketch in self.sketches.items():
+                value = sketch.quantile(q)
+                if value is not None:
+                    result[s, m] = value
+            self._quantiles[q] = result
+        return result
+
+    def has_data(self, model_name):
+        """模型是否在任意源上有非空的健康检查窗口"""
+        m = self.model_pos.get(model_name)
+        return m is not None and bool((self.lengths[:, m] > 0).any())
+
+    def derived(self, name, factory):
+        """缓存由该索引派生的数据(如评分结果), 随索引一起失效"""
+        value = self._derived.get(name)
+        if value is None:
+            with self._lock:
+                value = self._derived.get(name)
+                if value is None:
+                    value = factory(self)
+                    self._derived[name] = value
+        return value
+
+    def __len__(self):
+        return len(self.model_names)
+
+
+class HealthIndexCache:
+    """缓存共享快照最新版本的索引, 版本变化时重建"""
+
+    def __init__(self, recent_size):
+        self.recent_size = recent_size
+        self._version = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self, version, healthy):
+        """获取健康检查数据的索引, version为None表示数据不属于共享快照, 不缓存; 比缓存的版本旧时同样不缓存"""
+        if version is None:
+            return HealthIndex(healthy, self.recent_size)
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._index = HealthIndex(healthy, self.recent_size)
+                self._version = version
+            elif version < self._version:
+                return HealthIndex(healthy, self.recent_size)
+            return self._index
@@ -0,0 +1,76 @@
+import os
+import threading
+
+"""对冲请求(hedged requests)的预算与触发阈值.
+
+主源在阈值时间内没有返回时, 并行向备用源发出同一请求, 先成功者胜出.
+对冲会放大上游负载, 因此受全局预算限制: 每个请求为预算存入HEDGE_BUDGET_RATIO个令牌,
+每次对冲消耗一个令牌, 令牌数不超过HEDGE_BUDGET_BURST. 长期来看对冲请求数不超过
+总请求数的HEDGE_BUDGET_RATIO.
+"""
+
+# 每个请求为对冲预算存入的令牌数, 即对冲请求占总请求数的上限比例
+HEDGE_BUDGET_RATIO = float(os.environ.get("HEDGE_BUDGET_RATIO", 0.1))
+# 对冲预算的令牌上限, 也是启动时的初始令牌数
+HEDGE_BUDGET_BURST = float(os.environ.get("HEDGE_BUDGET_BURST", 10))
+# 没有被动统计时的对冲阈值(秒)
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", 10))
+# 对冲阈值的下限(秒), 避免在统计偏小时几乎每个请求都对冲
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", 0.5))
+
+
+class HedgeCancelled(Exception):
+    """对冲中落败并被取消的尝试, 记录在错误列表中以便上报使用记录"""
+
+    def __init__(self, attempt):
+        super().__init__(f"Hedged attempt on {attempt.source_name} cancelled")
+        self.attempt = attempt
+
+
+class HedgeBudget:
+    """线程安全的对冲令牌桶"""
+
+    def __init__(self, ratio=HEDGE_BUDGET_RATIO, burst=HEDGE_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = burst
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """每个可对冲的请求调用一次"""
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def try_acquire(self):
+        """尝试消耗一个令牌, 预算不足时返回False"""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+
+def hedge_delay(stat, default=HEDGE_DEFAULT_DELAY, minimum=HEDGE_MIN_DELAY):
+    """对冲阈值: 主源该模型近期耗时的p90, 没有统计时使用默认值
+
+    Args:
+        stat (PassiveStat): 主源的被动统计, 可以为None
+    """
+    if stat is None or stat.tail_latency is None:
+        return max(default, minimum)
+    return max(stat.tail_latency, minimum)
+
+
+def split_lanes(attempts):
+    """把尝试序列按源切分为连续的若干组, 同一组内共用一个源"""
+    lanes = []
+    for attempt in attempts:
+        if lanes and lanes[-1][-1].source_name == attempt.source_name:
+            lanes[-1].append(attempt)
+        else:
+            lanes.append([attempt])
+    return lanes
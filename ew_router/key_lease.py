@@ -0,0 +1,148 @@
+import os
+import time
+import threading
+
+"""客户端API密钥租约缓存.
+
+每次请求都向密钥管理服务要两次密钥(主源和备用源)会在联系供应商之前多出两次往返.
+这里按源从密钥管理服务一次租用若干个健康的密钥, 在KEY_LEASE_TTL秒内于本地轮换使用, 过期后重新租用.
+密钥进入密钥管理服务的失败缓存时吊销序号(revocation epoch)递增, 该序号随每次使用记录的响应下发;
+本地序号落后时拉取吊销的密钥并从租约中移除, 无法同步时放弃所有租约.
+吊销序号只保存在密钥管理服务的内存中, 服务重启后从0开始; 收到比本地小的序号时放弃所有租约并采用新的序号.
+密钥管理服务不支持租约(旧版本)时, 在一个租约有效期内不再尝试租用.
+租用的密钥在本地选取, 密钥管理服务看不到这些请求; 选取次数随下一条使用记录上报, 由其计入该密钥的RPM.
+"""
+
+# 租约有效期(秒), 为0时不使用租约, 每次都向密钥管理服务获取密钥
+KEY_LEASE_TTL = float(os.environ.get("KEY_LEASE_TTL", 60))
+# 每个源每次租用的密钥数
+KEY_LEASE_SIZE = int(os.environ.get("KEY_LEASE_SIZE", 4))
+
+
+class KeyLeaseCache:
+    """线程安全的按源密钥租约缓存"""
+
+    def __init__(self, ttl=KEY_LEASE_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        # source_name -> (密钥元组, 过期时间)
+        self._leases = {}
+        # 已同步到的吊销序号, 还没有租约时为None
+        self.epoch = None
+        # 密钥管理服务不支持租约时, 到该时间之前不再尝试租用
+        self._unsupported_until = None
+        # 尚未上报的本地选取次数, {source_name: {api_key: 次数}}
+        self._picks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        if self.ttl <= 0:
+            return False
+        unsupported_until = self._unsupported_until
+        return unsupported_until is None or self.clock() >= unsupported_until
+
+    def mark_unsupported(self):
+        """密钥管理服务不支持租约, 一个租约有效期内直接向其获取单个密钥"""
+        self._unsupported_until = self.clock() + self.ttl
+
+    def _reset_if_restarted_locked(self, epoch):
+        """服务端的序号比本地小说明密钥管理服务已重启, 放弃所有租约并采用新的序号"""
+        if isinstance(epoch, int) and self.epoch is not None and epoch < self.epoch:
+            self._leases.clear()
+            self.epoch = epoch
+
+    def keys(self, source_name):
+        """该源仍有效的租用密钥, 没有租约或已过期时返回None"""
+        with self._lock:
+            lease = self._leases.get(source_name)
+            if lease is None:
+                return None
+            if self.clock() >= lease[1]:
+                del self._leases[source_name]
+                return None
+            return list(lease[0])
+
+    def store(self, source_name, api_keys, epoch=None):
+        """保存新租到的密钥
+
+        Args:
+            source_name (str): 源名称
+            api_keys (list): 租到的密钥
+            epoch (int, optional): 租用时密钥管理服务的吊销序号
+        """
+        if not api_keys:
+            return
+        with self._lock:
+            self._reset_if_restarted_locked(epoch)
+            self._leases[source_name] = (tuple(api_keys), self.clock() + self.ttl)
+            # 已有的租约可能早于该序号, 只有尚未同步过时才采用租约的序号
+            if self.epoch is None and epoch is not None:
+                self.epoch = epoch
+
+    def is_stale(self, epoch):
+        """密钥管理服务的吊销序号是否比本地新; 本地还没有序号时直接采用, 比本地小时放弃所有租约"""
+        if not isinstance(epoch, int):
+            # 旧版本的密钥管理服务不下发吊销序号
+            return False
+        with self._lock:
+            if self.epoch is None:
+                self.epoch = epoch
+                return False
+            self._reset_if_restarted_locked(epoch)
+            return epoch > self.epoch
+
+    def revoke(self, revoked, epoch):
+        """从租约中移除被吊销的密钥
+
+        Args:
+            revoked (dict): {source_name: [api_key, ...]}
+            epoch (int): 同步到的吊销序号
+        """
+        with self._lock:
+            for source_name, api_keys in (revoked or {}).items():
+                lease = self._leases.get(source_name)
+                if lease is None:
+                    continue
+                remaining = tuple(api_key for api_key in lease[0] if api_key not in set(api_keys))
+                if remaining:
+                    self._leases[source_name] = (remaining, lease[1])
+                else:
+                    del self._leases[source_name]
+            if epoch is not None:
+                self.epoch = epoch if self.epoch is None else max(self.epoch, epoch)
+
+    def clear(self, epoch=None):
+        """放弃所有租约"""
+        with self._lock:
+            self._leases.clear()
+            self.epoch = epoch
+
+    def record_pick(self, source_name, api_key):
+        """记录一次在本地选取租用密钥的请求"""
+        with self._lock:
+            picks = self._picks.setdefault(source_name, {})
+            picks[api_key] = picks.get(api_key, 0) + 1
+
+    def drain_picks(self):
+        """取出尚未上报的选取次数并清零, 没有时返回空字典"""
+        with self._lock:
+            picks, self._picks = self._picks, {}
+            return picks
+
+    def restore_picks(self, picks):
+        """上报失败时放回drain_picks取出的选取次数, 随之后的使用记录重新上报"""
+        with self._lock:
+            for source_name, counts in (picks or {}).items():
+                current = self._picks.setdefault(source_name, {})
+                for api_key, count in counts.items():
+                    current[api_key] = current.get(api_key, 0) + count
+
+    def metrics(self):
+        """各源当前租用的密钥数和剩余有效期"""
+        with self._lock:
+            now = self.clock()
+            return {
+                source_name: {"keys": len(api_keys), "expires_in": round(max(expires_at - now, 0), 1)}
+                for source_name, (api_keys, expires_at) in self._leases.items()
+            }
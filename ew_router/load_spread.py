@@ -0,0 +1,69 @@
+import os
+import random
+
+"""在排名相近的候选源之间按在途请求数分散负载.
+
+路由表在同一份健康检查数据下总是给出相同的主源, fast_first下所有请求都会涌向"最快"的源.
+这里只在排名靠前且耗时相近的候选之间按在途请求数选择主源:
+- p2c: 排名第一的源与随机一个候选比较, 选择在途请求较少的(power of two choices)
+- least_outstanding: 选择在途请求最少的
+- none: 不分散, 总是使用排名第一的源
+在途请求数相同时优先排名靠前的源.
+"""
+
+# 负载分散策略: p2c, least_outstanding或none
+LOAD_SPREAD_POLICY = os.environ.get("LOAD_SPREAD_POLICY", "p2c")
+# 参与负载分散的排名靠前的候选数
+LOAD_SPREAD_TOP_K = int(os.environ.get("LOAD_SPREAD_TOP_K", 3))
+# 近期平均耗时不超过最快候选该倍数的源视为耗时相近
+LOAD_SPREAD_LATENCY_RATIO = float(os.environ.get("LOAD_SPREAD_LATENCY_RATIO", 1.5))
+
+POLICIES = ("p2c", "least_outstanding", "none")
+
+
+def comparable_prefix(route, latency_of, top_k=LOAD_SPREAD_TOP_K, ratio=LOAD_SPREAD_LATENCY_RATIO):
+    """排名前top_k且耗时与第一名相近的候选, 第一名总是包含在内
+
+    Args:
+        route (list): 按优先级排序的候选源
+        latency_of (callable): source_name -> 近期平均耗时, 未知时为None或NaN
+    """
+    if not route:
+        return []
+    best = latency_of(route[0])
+    if best is None or best != best:
+        return [route[0]]
+    result = [route[0]]
+    for source_name in route[1:top_k]:
+        latency = latency_of(source_name)
+        if latency is not None and latency == latency and latency <= best * ratio:
+            result.append(source_name)
+    return result
+
+
+def pick_least_loaded(candidates, in_flight, policy=LOAD_SPREAD_POLICY, rng=random):
+    """按策略从候选中选出主源
+
+    Args:
+        candidates (list): 按优先级排序的候选源
+        in_flight (callable): source_name -> 在途请求数
+        policy (str): p2c, least_outstanding或none
+    """
+    if len(candidates) < 2 or policy not in ("p2c", "least_outstanding"):
+        return candidates[0]
+    if policy == "p2c":
+        # 排名第一的源与随机一个候选比较, 负载相同时不改变原有排名
+        indexes = (0, rng.randrange(1, len(candidates)))
+    else:
+        indexes = range(len(candidates))
+    return candidates[min(indexes, key=lambda i: (in_flight(candidates[i]), i))]
+
+
+def spread_route(route, latency_of, in_flight, policy=LOAD_SPREAD_POLICY, top_k=LOAD_SPREAD_TOP_K,
+                 ratio=LOAD_SPREAD_LATENCY_RATIO, rng=random):
+    """把选出的主源移到最前, 其余候选保持原顺序"""
+    route = list(route)
+    chosen = pick_least_loaded(comparable_prefix(route, latency_of, top_k, ratio), in_flight, policy, rng)
+    if chosen == route[0]:
+        return route
+    return [chosen] + [source_name for source_name in route if source_name != chosen]
@@ -0,0 +1,54 @@
+from bisect import bisect_right
+
+"""三维帕累托前沿(skyline).
+
+所有维度都是越小越好. 先按字典序排序, 能支配某个点的点一定排在它前面;
+再按第二维维护一条"阶梯"(第二维递增, 第三维严格递减), 每个点只需一次二分查找
+即可判断是否被前面的点支配, 比较次数为O(n log n).
+阶梯保存在Python列表中, 插入时的切片赋值最坏要移动O(n)个元素, 因此最坏总复杂度为O(n²);
+移动只是指针的内存拷贝, 候选数(源×模型, 通常几百个)下远小于比较的开销.
+"""
+
+
+def pareto_front(points):
+    """计算三维点集的帕累托前沿
+
+    q支配p当且仅当q在每个维度上都不大于p, 且至少一个维度严格小于p.
+    完全相同的点互不支配, 会同时出现在前沿中.
+
+    Args:
+        points (list): (x, y, z)元组列表, 不能包含NaN
+
+    Returns:
+        list: 前沿中点的下标, 按输入顺序排列
+    """
+    order = sorted(range(len(points)), key=lambda i: points[i])
+    stair_y = []
+    stair_z = []
+    front = []
+    previous = None
+    previous_kept = False
+    for i in order:
+        point = points[i]
+        if point == previous:
+            # 与上一个点完全相同, 结果也相同
+            if previous_kept:
+                front.append(i)
+            continue
+        previous = point
+        _, y, z = point
+        # 第二维不大于y的阶梯点中, 第三维最小的是最后一个
+        pos = bisect_right(stair_y, y)
+        previous_kept = not (pos > 0 and stair_z[pos - 1] <= z)
+        if not previous_kept:
+            continue
+        front.append(i)
+        # 插入阶梯, 并移除被新点覆盖的点(第二维不小于y且第三维不小于z)
+        end = pos
+        while end < len(stair_y) and stair_z[end] >= z:
+            end += 1
+        if pos > 0 and stair_y[pos - 1] == y:
+            pos -= 1
+        stair_y[pos:end] = [y]
+        stair_z[pos:end] = [z]
+    return sorted(front)
@@ -0,0 +1,174 @@
+import os
+import math
+import time
+import threading
+from collections import namedtuple
+
+import sys
+from pathlib import Path
+# 更正导入路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ew_router.quantile_sketch import QuantileSketch, QUANTILE_MODES
+
+"""基于真实请求的被动健康统计.
+
+健康检查服务每个周期才用"Hello!"探测一次, 路由对上游故障的反应要等到下一个周期.
+这里在进程内记录每次真实请求的耗时和成败, 按(source, source_model_name)维护
+随时间衰减的加权统计(EWMA): 距今越久的请求权重越低, 半衰期为PASSIVE_STATS_HALF_LIFE秒.
+长时间没有请求时有效样本数随之衰减, 统计自动失效, 路由退回完全依赖健康检查数据.
+成功请求的耗时同时记入按相同半衰期衰减的分位数草图, 供按分位数路由时与健康检查的草图合并.
+"""
+
+# 统计的半衰期(秒)
+PASSIVE_STATS_HALF_LIFE = float(os.environ.get("PASSIVE_STATS_HALF_LIFE", 60))
+# 有效样本数(衰减后的权重和)低于该值时不使用统计
+PASSIVE_STATS_MIN_SAMPLES = float(os.environ.get("PASSIVE_STATS_MIN_SAMPLES", 3))
+# 错误率超过该值的源会被排到其他候选之后
+PASSIVE_MAX_ERROR_RATE = float(os.environ.get("PASSIVE_MAX_ERROR_RATE", 0.5))
+# fast_first下, 平均耗时超过最快候选该倍数的源会被排到其他候选之后
+PASSIVE_SLOW_FACTOR = float(os.environ.get("PASSIVE_SLOW_FACTOR", 3))
+
+# 正态近似下p90相对均值的标准差倍数
+_P90_Z = 1.2816
+
+# latency: 成功请求的加权平均耗时(秒), 没有成功请求时为None
+# tail_latency: 成功请求耗时的p90估计(均值+1.28倍标准差), 没有成功请求时为None
+# error_rate: 加权错误率
+# samples: 有效样本数
+PassiveStat = namedtuple("PassiveStat", ["latency", "tail_latency", "error_rate", "samples"])
+
+
+class _Ewma:
+    """随时间衰减的加权统计, 调用方负责加锁"""
+
+    __slots__ = ("updated_at", "weight", "errors", "ok_weight", "latency_sum", "latency_sq_sum", "sketch")
+
+    def __init__(self, now):
+        self.updated_at = now
+        self.weight = 0.0
+        self.errors = 0.0
+        self.ok_weight = 0.0
+        self.latency_sum = 0.0
+        self.latency_sq_sum = 0.0
+        self.sketch = QuantileSketch()
+
+    def decay(self, now, half_life):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            factor = 0.5 ** (elapsed / half_life)
+            self.weight *= factor
+            self.errors *= factor
+            self.ok_weight *= factor
+            self.latency_sum *= factor
+            self.latency_sq_sum *= factor
+            self.sketch.decay(factor)
+            self.updated_at = now
+
+    def add(self, latency, success):
+        self.weight += 1.0
+        if success:
+            self.ok_weight += 1.0
+            self.latency_sum += latency
+            self.latency_sq_sum += latency * latency
+            self.sketch.add(latency)
+        else:
+            self.errors += 1.0
+
+    def snapshot(self):
+        latency = tail = None
+        if self.ok_weight > 0:
+            latency = self.latency_sum / self.ok_weight
+            variance = max(self.latency_sq_sum / self.ok_weight - latency * latency, 0.0)
+            tail = latency + _P90_Z * math.sqrt(variance)
+        error_rate = self.errors / self.weight if self.weight > 0 else 0.0
+        return PassiveStat(latency, tail, error_rate, self.weight)
+
+
+class PassiveStats:
+    """线程安全的被动统计, 按(source_name, source_model_name)记录"""
+
+    def __init__(self, half_life=PASSIVE_STATS_HALF_LIFE, min_samples=PASSIVE_STATS_MIN_SAMPLES, clock=time.monotonic):
+        self.half_life = half_life
+        self.min_samples = min_samples
+        self.clock = clock
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, source_name, model_name, latency, success):
+        """记录一次请求
+
+        Args:
+            source_name (str): 源名称
+            model_name (str): 源下的模型名称
+            latency (float): 请求耗时(秒), 失败时不参与耗时统计
+            success (bool): 请求是否成功
+        """
+        now = self.clock()
+        key = (source_name, model_name)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = _Ewma(now)
+            stats.decay(now, self.half_life)
+            stats.add(latency, success)
+
+    def get(self, source_name, model_name):
+        """返回当前统计, 有效样本数不足时返回None"""
+        now = self.clock()
+        with self._lock:
+            stats = self._stats.get((source_name, model_name))
+            if stats is None:
+                return None
+            stats.decay(now, self.half_life)
+            stat = stats.snapshot()
+        return stat if stat.samples >= self.min_samples else None
+
+    def sketch(self, source_name, model_name):
+        """返回成功请求耗时的分位数草图副本, 有效样本数不足时返回None"""
+        now = self.clock()
+        with self._lock:
+            stats = self._stats.get((source_name, model_name))
+            if stats is None:
+                return None
+            stats.decay(now, self.half_life)
+            if stats.sketch.count < self.min_samples:
+                return None
+            return stats.sketch.copy()
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def blend_route(sources, stats_of, mode, max_error_rate=PASSIVE_MAX_ERROR_RATE, slow_factor=PASSIVE_SLOW_FACTOR):
+    """用被动统计调整健康检查给出的候选顺序
+
+    健康检查的排序作为先验, 被动统计只把近期明显异常的源排到后面:
+    错误率超过max_error_rate的源排在最后; fast_first(及分位数模式)下平均耗时超过最快候选slow_factor倍的源次之.
+    没有足够统计的源保持原有位置.
+
+    Args:
+        sources (tuple): 健康检查给出的候选源, 按优先级排序
+        stats_of (callable): source_name -> PassiveStat或None
+        mode (str): "cheap_first"或"fast_first"
+
+    Returns:
+        list: 调整后的候选源
+    """
+    stats = {source_name: stats_of(source_name) for source_name in sources}
+    latencies = [stat.latency for stat in stats.values() if stat is not None and stat.latency is not None]
+    fastest = min(latencies) if latencies else None
+
+    def demotion(source_name):
+        stat = stats[source_name]
+        if stat is None:
+            return 0
+        if stat.error_rate > max_error_rate:
+            return 2
+        if ((mode == "fast_first" or mode in QUANTILE_MODES) and fastest is not None and stat.latency is not None
+                and stat.latency > fastest * slow_factor):
+            return 1
+        return 0
+
+    return sorted(sources, key=demotion)
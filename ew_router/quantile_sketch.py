@@ -0,0 +1,148 @@
+import os
+import math
+
+"""可合并的耗时分位数草图(DDSketch).
+
+均值会被单个离群值拉偏, 而SLO以尾部耗时定义. 这里按相对误差把耗时分到对数间隔的桶中:
+桶i覆盖(gamma^(i-1), gamma^i], gamma = (1 + alpha) / (1 - alpha), 任意分位数的估计值与真实值的
+相对误差不超过alpha. 同一alpha的草图可以直接按桶相加合并, 因此健康检查的探测数据和进程内
+真实请求的数据可以合并后再求分位数.
+桶数超过上限时合并耗时最小的桶, 尾部分位数的精度不受影响. 计数可以是小数, 以支持随时间衰减.
+"""
+
+# 分位数估计的相对误差
+SKETCH_RELATIVE_ACCURACY = float(os.environ.get("SKETCH_RELATIVE_ACCURACY", 0.02))
+# 每个草图最多保留的桶数
+SKETCH_MAX_BINS = int(os.environ.get("SKETCH_MAX_BINS", 256))
+
+# 可以作为路由模式的分位数
+QUANTILE_MODES = {"fast_p50": 0.5, "fast_p95": 0.95, "fast_p99": 0.99}
+
+# 不超过该值的耗时计入零桶
+_MIN_VALUE = 1e-6
+# 衰减后计数低于该值的桶被丢弃
+_MIN_COUNT = 1e-3
+
+
+class QuantileSketch:
+    """DDSketch, 非线程安全, 调用方负责加锁"""
+
+    __slots__ = ("alpha", "max_bins", "_log_gamma", "bins", "zero_count", "count")
+
+    def __init__(self, relative_accuracy=SKETCH_RELATIVE_ACCURACY, max_bins=SKETCH_MAX_BINS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(f"relative_accuracy应在(0, 1)之间: {relative_accuracy}")
+        self.alpha = relative_accuracy
+        self.max_bins = max_bins
+        self._log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        # 桶序号 -> 计数
+        self.bins = {}
+        self.zero_count = 0.0
+        self.count = 0.0
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, index):
+        """桶的代表值, 与桶内任意值的相对误差不超过alpha"""
+        return 2 * math.exp(index * self._log_gamma) / (1 + math.exp(self._log_gamma))
+
+    def add(self, value, weight=1.0):
+        """记录一个耗时(秒), NaN和None被忽略"""
+        if value is None or value != value or weight <= 0:
+            return
+        if value <= _MIN_VALUE:
+            self.zero_count += weight
+        else:
+            index = self._index(value)
+            self.bins[index] = self.bins.get(index, 0.0) + weight
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+        self.count += weight
+
+    def _collapse(self):
+        """把耗时最小的桶合并到一起, 直到桶数不超过上限"""
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        merged = sum(self.bins.pop(index) for index in indexes[:excess])
+        target = indexes[excess]
+        self.bins[target] += merged
+
+    def merge(self, other):
+        """把另一个草图的计数加到当前草图上"""
+        if abs(other.alpha - self.alpha) > 1e-12:
+            raise ValueError(f"无法合并相对误差不同的草图: {self.alpha} != {other.alpha}")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0.0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        return self
+
+    def decay(self, factor):
+        """所有计数乘以factor, 用于让旧数据的权重随时间降低"""
+        self.bins = {index: count * factor for index, count in self.bins.items() if count * factor >= _MIN_COUNT}
+        self.zero_count *= factor
+        self.count = self.zero_count + sum(self.bins.values())
+
+    def quantile(self, q):
+        """估计q分位数, 草图为空时返回None"""
+        if self.count <= 0:
+            return None
+        rank = min(max(q, 0.0), 1.0) * max(self.count - 1, 0.0)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self.bins))
+
+    def copy(self):
+        sketch = QuantileSketch(self.alpha, self.max_bins)
+        sketch.bins = dict(self.bins)
+        sketch.zero_count = self.zero_count
+        sketch.count = self.count
+        return sketch
+
+    def to_dict(self):
+        """紧凑的JSON表示: 从最小桶序号开始的稠密计数数组"""
+        result = {"alpha": self.alpha, "zero": round(self.zero_count, 3), "offset": 0, "counts": []}
+        if self.bins:
+            low, high = min(self.bins), max(self.bins)
+            result["offset"] = low
+            result["counts"] = [round(self.bins.get(index, 0.0), 3) for index in range(low, high + 1)]
+        return result
+
+    @classmethod
+    def from_dict(cls, data, max_bins=SKETCH_MAX_BINS):
+        """从to_dict的结果恢复草图
+
+        Raises:
+            ValueError: 数据格式错误
+        """
+        try:
+            sketch = cls(float(data["alpha"]), max_bins)
+            offset = int(data.get("offset", 0))
+            for i, count in enumerate(data.get("counts") or []):
+                if count:
+                    sketch.bins[offset + i] = float(count)
+            sketch.zero_count = float(data.get("zero", 0.0))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"无效的草图数据: {e}")
+        sketch.count = sketch.zero_count + sum(sketch.bins.values())
+        if len(sketch.bins) > max_bins:
+            sketch._collapse()
+        return sketch
+
+
+def merged_quantile(sketches, q):
+    """合并若干草图(可以包含None)后求q分位数, 全部为空时返回None"""
+    total = None
+    for sketch in sketches:
+        if sketch is None or sketch.count <= 0:
+            continue
+        total = sketch.copy() if total is None else total.merge(sketch)
+    return total.quantile(q) if total is not None else None
@@ -0,0 +1,155 @@
+import time
+import random
+import threading
+
+"""按API密钥和账户的客户端令牌桶限流(RPM/TPM).
+
+限额在密钥池配置中声明:
+- 密钥级: pool_mapping中每个密钥的可选字段"rpm"(每分钟请求数)和"tpm"(每分钟token数)
+- 账户级: account_limit_mapping[source_name][account]中的"rpm"和"tpm", 由该账户下所有密钥共享
+未声明限额的密钥和账户不受限制.
+
+选取密钥时只考虑仍有余量的密钥; 请求数在选取时扣除, token数在请求结束后按实际用量扣除
+(允许透支, 透支期间该密钥不会被选中). 所有密钥都没有余量时, 选择最快恢复的密钥.
+"""
+
+
+class TokenBucket:
+    """每分钟补充per_minute个令牌的令牌桶, 容量为per_minute, 调用方负责加锁"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, per_minute, now):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated_at = now
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, amount, now):
+        """令牌数达到amount还需要等待的时间(秒)"""
+        self._refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, amount, now):
+        """扣除令牌, 允许透支"""
+        self._refill(now)
+        self.tokens -= amount
+
+
+def _bucket_pair(limits, now):
+    """根据{"rpm": ..., "tpm": ...}创建(请求桶, token桶), 未声明的为None"""
+    limits = limits or {}
+    rpm, tpm = limits.get("rpm"), limits.get("tpm")
+    return (TokenBucket(rpm, now) if rpm else None, TokenBucket(tpm, now) if tpm else None)
+
+
+class KeyRateLimiter:
+    """线程安全的密钥选取限流器"""
+
+    def __init__(self, pools, account_limits=None, clock=time.monotonic):
+        """
+        Args:
+            pools (dict): pool_mapping, {source_name: {account: [{"api_key": ..., "rpm": ..., "tpm": ...}]}}
+            account_limits (dict, optional): {source_name: {account: {"rpm": ..., "tpm": ...}}}
+            clock (callable): 单调时钟
+        """
+        self.clock = clock
+        self._lock = threading.Lock()
+        now = clock()
+        # (source_name, api_key) -> [(请求桶, token桶), ...], 依次为密钥级和账户级
+        self._buckets = {}
+        account_limits = account_limits or {}
+        for source_name, pool in (pools or {}).items():
+            for account, keys in (pool or {}).items():
+                account_buckets = _bucket_pair(account_limits.get(source_name, {}).get(account), now)
+                for key_info in keys:
+                    if "api_key" not in key_info:
+                        continue
+                    self._buckets[(source_name, key_info["api_key"])] = [_bucket_pair(key_info, now), account_buckets]
+
+    def _wait_time_locked(self, source_name, api_key, now):
+        wait = 0.0
+        for requests, tokens in self._buckets.get((source_name, api_key), ()):
+            if requests is not None:
+                wait = max(wait, requests.wait_time(1, now))
+            if tokens is not None:
+                # token在请求结束后才扣除, 这里只要求没有透支
+                wait = max(wait, tokens.wait_time(1e-9, now))
+        return wait
+
+    def wait_time(self, source_name, api_key):
+        """该密钥恢复余量还需要等待的时间(秒), 有余量时为0"""
+        with self._lock:
+            return self._wait_time_locked(source_name, api_key, self.clock())
+
+    def has_capacity(self, source_name, api_key):
+        return self.wait_time(source_name, api_key) == 0
+
+    def acquire(self, source_name, api_key, count=1):
+        """记录count次使用该密钥的请求"""
+        with self._lock:
+            now = self.clock()
+            for requests, _ in self._buckets.get((source_name, api_key), ()):
+                if requests is not None:
+                    requests.take(count, now)
+
+    def charge_tokens(self, source_name, api_key, tokens):
+        """请求结束后按实际用量扣除token"""
+        if not tokens:
+            return
+        with self._lock:
+            now = self.clock()
+            for _, bucket in self._buckets.get((source_name, api_key), ()):
+                if bucket is not None:
+                    bucket.take(tokens, now)
+
+    def pick(self, source_name, api_keys, ordered=False):
+        """从候选密钥中随机选择一个有余量的密钥并记录一次请求, 都没有余量时选择最快恢复的
+
+        Args:
+            source_name (str): 源名称
+            api_keys (list): 候选密钥
+            ordered (bool): 为True时按候选顺序选择第一个有余量的密钥, 而不是随机选择
+
+        Returns:
+            str: 选中的密钥, 候选为空时返回None
+        """
+        if not api_keys:
+            return None
+        with self._lock:
+            now = self.clock()
+            waits = [(self._wait_time_locked(source_name, api_key, now), api_key) for api_key in api_keys]
+            ready = [api_key for wait, api_key in waits if wait == 0]
+            if ready:
+                api_key = ready[0] if ordered else random.choice(ready)
+            else:
+                api_key = min(waits, key=lambda x: x[0])[1]
+            for requests, _ in self._buckets.get((source_name, api_key), ()):
+                if requests is not None:
+                    requests.take(1, now)
+        return api_key
+
+    def metrics(self):
+        """各有限额的密钥当前剩余的请求数和token数(取密钥级和账户级中较小者)"""
+        with self._lock:
+            now = self.clock()
+            result = {}
+            for (source_name, api_key), pairs in self._buckets.items():
+                remaining = {}
+                for kind, index in (("rpm", 0), ("tpm", 1)):
+                    buckets = [pair[index] for pair in pairs if pair[index] is not None]
+                    for bucket in buckets:
+                        bucket.wait_time(0, now)
+                    if buckets:
+                        remaining[kind] = round(min(bucket.tokens for bucket in buckets), 2)
+                if remaining:
+                    result[f"{source_name}|{api_key[:8]}"] = remaining
+            return result
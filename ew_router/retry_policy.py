@@ -0,0 +1,187 @@
+import os
+import re
+import random
+
+import sys
+from pathlib import Path
+# 更正导入路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ew_router.hedging import HedgeBudget
+
+"""按错误类型决定的重试策略.
+
+不同的错误重试的价值不同, 按状态码、异常类型和错误消息分为:
+- invalid: 请求本身有问题(400/413/422, 上下文超长等), 同一请求重试注定失败; 换用另一种请求形式或另一个源仍可能成功,
+  但不再进入下一轮重试
+- account: 密钥或账户问题(401/402/403, 余额不足、配额用尽等), 立即换源, 本次调用内不再使用该源
+- throttled: 限流(429), 立即换源, 退避后可以重试
+- provider: 供应商侧故障(5xx, 超时, 连接错误, 熔断, 并发上限), 立即换源, 退避后可以重试
+- unknown: 其余错误(响应格式异常等), 与原来一样退避后重试
+重试间隔为带完全抖动(full jitter)的指数退避, 避免多个进程的重试同步到一起.
+重试受全局预算限制: 每次调用为预算存入RETRY_BUDGET_RATIO个令牌, 每轮重试消耗一个, 令牌数不超过RETRY_BUDGET_BURST,
+上游大面积故障时重试请求数不超过总请求数的RETRY_BUDGET_RATIO, 不会形成重试风暴.
+"""
+
+# 退避的上限(秒)
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 30))
+# 每次调用为重试预算存入的令牌数, 即重试轮数占总调用数的上限比例
+RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", 0.2))
+# 重试预算的令牌上限, 也是启动时的初始令牌数
+RETRY_BUDGET_BURST = float(os.environ.get("RETRY_BUDGET_BURST", 20))
+
+INVALID = "invalid"
+ACCOUNT = "account"
+THROTTLED = "throttled"
+PROVIDER = "provider"
+UNKNOWN = "unknown"
+
+# 商业性错误(余额不足、配额超限等)的关键词, 健康检查服务同样据此区分商业性错误和技术性错误
+COMMERCIAL_ERROR_KEYWORDS = [
+    "negative balance",
+    "insufficient balance",
+    "quota exceeded",
+    "insufficient_user_quota",
+    "rate limit",
+    "billing",
+    "payment",
+    "credit",
+    "funds",
+    "pre-payment",
+    "subscription"
+]
+
+TIMEOUT_ERROR_KEYWORDS = [
+    "timeout",
+    "timed out",
+    "execution timeout",
+    "connection timeout",
+    "read timeout",
+    "request timeout",
+    "执行超时",
+    "连接超时",
+    "请求超时",
+    "响应超时"
+]
+
+# 请求本身无效的关键词, 主要是上下文超长
+INVALID_REQUEST_KEYWORDS = [
+    "context length",
+    "context_length_exceeded",
+    "maximum context",
+    "too many tokens",
+    "prompt is too long",
+    "invalid_request_error"
+]
+
+THROTTLE_KEYWORDS = ["rate limit", "rate_limit", "too many requests"]
+
+# requests("429 Client Error"), openai("Error code: 429"), httpx("Client error '429 Too Many Requests'")的错误消息
+_STATUS_IN_MESSAGE = re.compile(r"\b([1-5]\d\d) (?:Client|Server) Error|Error code: ([1-5]\d\d)|error '([1-5]\d\d) ")
+
+# 供应商侧故障的异常类名片段, 不直接依赖各传输库
+_PROVIDER_ERROR_NAMES = ("Timeout", "Connection", "Connect", "RemoteProtocol", "CircuitOpen", "ConcurrencyLimit")
+
+
+def is_commercial_error(error_message):
+    """是否为商业性错误(如余额不足、配额超限等)"""
+    error_lower = error_message.lower()
+    return any(keyword in error_lower for keyword in COMMERCIAL_ERROR_KEYWORDS)
+
+
+def is_timeout_error(error_message):
+    """是否为超时错误"""
+    error_lower = error_message.lower()
+    return any(keyword in error_lower for keyword in TIMEOUT_ERROR_KEYWORDS)
+
+
+def status_code_of(error):
+    """从异常或其响应中取出HTTP状态码, 没有时返回None"""
+    for obj in (error, getattr(error, "response", None)):
+        code = getattr(obj, "status_code", None)
+        if isinstance(code, int):
+            return code
+    match = _STATUS_IN_MESSAGE.search(str(error))
+    if match:
+        return int(next(group for group in match.groups() if group))
+    return None
+
+
+def classify_error(error):
+    """把一次尝试的异常归入invalid/account/throttled/provider/unknown之一"""
+    status = status_code_of(error)
+    if status == 429:
+        return THROTTLED
+    if status in (401, 402, 403):
+        return ACCOUNT
+    if status is not None and status >= 500:
+        return PROVIDER
+    message = str(error).lower()
+    if any(keyword in message for keyword in THROTTLE_KEYWORDS):
+        return THROTTLED
+    if is_commercial_error(message):
+        return ACCOUNT
+    if status in (400, 404, 413, 422) or any(keyword in message for keyword in INVALID_REQUEST_KEYWORDS):
+        return INVALID
+    if isinstance(error, (TimeoutError, OSError)) or is_timeout_error(message) \
+            or any(name in cls.__name__ for cls in type(error).__mro__ for name in _PROVIDER_ERROR_NAMES):
+        return PROVIDER
+    return UNKNOWN
+
+
+class RetryPolicy:
+    """可替换的重试策略, 子类可以覆盖classify/backoff等方法
+
+    Args:
+        base (float): 第一轮重试的退避上限(秒), 之后每轮翻倍
+        max_delay (float): 退避的上限(秒)
+        budget (HedgeBudget): 重试预算, 与对冲预算使用同样的令牌桶
+    """
+
+    def __init__(self, base=5, max_delay=RETRY_MAX_DELAY, budget=None, rng=None):
+        self.base = base
+        self.max_delay = max_delay
+        self.budget = budget or HedgeBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_BURST)
+        self.rng = rng or random.Random()
+
+    def classify(self, error):
+        return classify_error(error)
+
+    def switch_source(self, error_class):
+        """是否跳过该源在本轮中剩余的尝试, 立即换源"""
+        return error_class in (ACCOUNT, THROTTLED, PROVIDER)
+
+    def drop_source(self, error_class):
+        """是否在本次调用的后续重试中不再使用该源"""
+        return error_class == ACCOUNT
+
+    def retryable(self, error_class):
+        return error_class in (THROTTLED, PROVIDER, UNKNOWN)
+
+    def backoff(self, retry):
+        """第retry轮失败后的等待时间: [0, min(max_delay, base * 2^(retry-1))]内均匀分布"""
+        return self.rng.uniform(0, min(self.max_delay, self.base * 2 ** (retry - 1)))
+
+    def deposit(self):
+        """每次可重试的调用开始时调用一次"""
+        self.budget.deposit()
+
+    def retry_delay(self, errors, retry, remaining=None):
+        """决定是否进行下一轮重试
+
+        Args:
+            errors (list): 本轮各次尝试的异常
+            retry (int): 已完成的轮数
+            remaining (float, optional): 请求级截止时间的剩余秒数, None表示没有截止时间
+
+        Returns:
+            float: 重试前的等待时间, 不重试时返回None
+        """
+        if not any(self.retryable(self.classify(error)) for error in errors):
+            return None
+        delay = self.backoff(retry)
+        if remaining is not None and remaining <= delay:
+            return None
+        if not self.budget.try_acquire():
+            return None
+        return delay
@@ -0,0 +1,75 @@
+import os
+import threading
+
+"""编译后的路由表.
+
+路由结果(按优先级排序的候选源)只取决于健康检查快照, 模型名, 模式和输入输出比例,
+因此按(model, mode, 比例分桶)缓存, 健康检查快照更新到新版本时整体失效.
+仍持有旧快照的调用方的查询不缓存, 也不清空新版本的路由表.
+选路由此变为一次字典查找, 每个键在同一份快照下只计算一次.
+"""
+
+# 输入输出比例的分桶数. 价格只与输入占比有关, 按输入占比均匀分为这么多份
+ROUTING_PROPORTION_BUCKETS = int(os.environ.get("ROUTING_PROPORTION_BUCKETS", 20))
+
+
+class RoutingTable:
+    """按快照版本失效的线程安全路由表"""
+
+    def __init__(self, buckets=ROUTING_PROPORTION_BUCKETS) -> None:
+        self.buckets = max(int(buckets), 1)
+        self._version = None
+        # {(model_name, mode, bucket): tuple(source_name, ...)}
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, input_proportion, output_proportion):
+        """将输入输出比例量化到分桶
+
+        Returns:
+            tuple: (分桶编号, 该桶代表的输入比例, 该桶代表的输出比例)
+        """
+        total = input_proportion + output_proportion
+        # 与_rank_sources一致, 输入输出比例都为0时按各占一半处理
+        share = input_proportion / total if total > 0 else 0.5
+        bucket = int(round(share * self.buckets))
+        return bucket, bucket, self.buckets - bucket
+
+    def _routes_for(self, version):
+        """version对应的路由字典, 比当前版本旧时返回None"""
+        with self._lock:
+            if self._version is None or version > self._version:
+                self._version = version
+                self._routes = {}
+            elif version < self._version:
+                return None
+            return self._routes
+
+    def get(self, version, key, build):
+        """查找路由, 不存在时调用build()计算并缓存
+
+        Args:
+            version (int): 健康检查快照的版本, 比当前版本旧时不缓存
+            key (tuple): (model_name, mode, bucket)
+            build (callable): 计算路由的函数, 抛出的异常不会被缓存
+
+        Returns:
+            tuple: 按优先级排序的候选源
+        """
+        routes = self._routes_for(version)
+        if routes is None:
+            return build()
+        route = routes.get(key)
+        if route is None:
+            # 并发时同一个键可能被计算多次, 但结果相同, 不需要加锁
+            route = build()
+            routes[key] = route
+        return route
+
+    def clear(self):
+        with self._lock:
+            self._version = None
+            self._routes = {}
+
+    def __len__(self):
+        return len(self._routes)
@@ -0,0 +1,96 @@
+import os
+import time
+import itertools
+import contextlib
+import contextvars
+
+import sys
+from pathlib import Path
+# 更正导入路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ew_decorator.with_timeout import get_deadline
+
+"""按优先级类别和截止时间调度排队的请求.
+
+交互请求和批量回填共用同一条LLM_Wrapper调用链, 批量任务会占满供应商的并发和密钥限额, 拖慢交互请求.
+每个请求属于一个优先级类别(interactive或batch), 在并发限制器中争抢空位时:
+- 不同类别之间严格按优先级, 有空位时先满足interactive
+- 同一类别内按截止时间最早优先(EDF); 没有截止时间的请求按进入调度的时间加SCHEDULER_DEFAULT_SLACK计, 不会饿死
+- batch请求不能占用每个并发上限中最后SCHEDULER_INTERACTIVE_RESERVE比例的空位, 留给突发的interactive请求,
+  其余空闲容量都可以被batch用满
+类别通过priority_scope设置, 截止时间默认取with_timeout的截止时间, 二者都随contextvar传递到对冲的线程中.
+"""
+
+# 为interactive请求保留的并发上限比例, batch请求不能使用
+SCHEDULER_INTERACTIVE_RESERVE = float(os.environ.get("SCHEDULER_INTERACTIVE_RESERVE", 0.2))
+# 没有截止时间的请求在EDF中视为的截止时间(距进入调度的秒数)
+SCHEDULER_DEFAULT_SLACK = float(os.environ.get("SCHEDULER_DEFAULT_SLACK", 60))
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+# 优先级类别 -> 排序序号, 越小越优先
+PRIORITIES = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+# 未设置priority_scope时请求所属的类别
+SCHEDULER_DEFAULT_PRIORITY = os.environ.get("SCHEDULER_DEFAULT_PRIORITY", PRIORITY_INTERACTIVE)
+
+_current_priority = contextvars.ContextVar("ew_priority", default=None)
+_seq = itertools.count()
+
+
+def _check_priority(priority):
+    if priority not in PRIORITIES:
+        raise ValueError(f"未知的优先级类别: {priority}, 可选: {', '.join(PRIORITIES)}")
+    return priority
+
+
+def get_priority():
+    """当前调用链上的优先级类别"""
+    priority = _current_priority.get()
+    return priority if priority is not None else SCHEDULER_DEFAULT_PRIORITY
+
+
+@contextlib.contextmanager
+def priority_scope(priority):
+    """在with块内发出的请求都属于priority类别, 例如批量回填:
+
+        with priority_scope("batch"):
+            LLM_Wrapper.generate(...)
+    """
+    token = _current_priority.set(_check_priority(priority))
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def capacity(priority, limit, reserve=SCHEDULER_INTERACTIVE_RESERVE):
+    """该类别的请求可以使用的并发数, batch至少可以使用1个"""
+    if priority == PRIORITY_BATCH:
+        return max(int(limit * (1 - reserve)), 1)
+    return int(limit)
+
+
+class Ticket:
+    """一个请求在调度中的位置, rank越小越优先"""
+
+    __slots__ = ("keys", "priority", "deadline", "rank")
+
+    def __init__(self, keys, priority=None, deadline=None, now=None):
+        """
+        Args:
+            keys (tuple): 请求需要占用的并发限制键
+            priority (str, optional): 优先级类别, 默认取priority_scope设置的类别
+            deadline (float, optional): 截止时间(time.monotonic()时间戳), 默认取with_timeout的截止时间
+        """
+        now = time.monotonic() if now is None else now
+        self.keys = keys
+        self.priority = _check_priority(priority or get_priority())
+        self.deadline = deadline if deadline is not None else get_deadline()
+        effective = self.deadline if self.deadline is not None else now + SCHEDULER_DEFAULT_SLACK
+        self.rank = (PRIORITIES[self.priority], effective, next(_seq))
+
+    def competes_with(self, other):
+        """两个请求是否争抢同一个并发限制"""
+        return any(key in other.keys for key in self.keys)
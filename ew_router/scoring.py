@@ -0,0 +1,132 @@
+import numpy as np
+
+import sys
+from pathlib import Path
+# 更正导入路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ew_router.quantile_sketch import QUANTILE_MODES
+
+"""向量化的源评分.
+
+在一份健康检查索引上一次性为所有模型计算:
+- 预排名: 近期平均耗时升序; 某模型所有源近期均无成功记录时, 改用整体成功率降序
+- fast_first: 预排名中支持该模型的源
+- fast_p50/fast_p95/fast_p99: 按健康检查草图中耗时的对应分位数排名, 没有草图的源退回近期平均耗时
+- cheap_first: 预排名(权重1/3)与按输入输出比例加权的价格排名(权重2/3)融合
+结果按模型缓存在评分对象上, 评分对象随健康检查索引一起失效, 由路由表按键查询.
+"""
+
+# 价格未知或不完整的源的价格, 排在最后
+UNKNOWN_PRICE = 1e8
+# cheap_first中价格排名的权重
+PRICE_WEIGHT = 2 / 3
+
+
+def _rank(mask, *keys):
+    """对(source, model)矩阵的每一列排名, keys按优先级从高到低
+
+    Returns:
+        np.ndarray: 从1开始的名次, mask为False的位置为NaN
+    """
+    filled = [np.where(mask, key, np.inf) for key in keys]
+    # lexsort以最后一个key为主键, 全部相同时按源的顺序(稳定)
+    order = np.lexsort([np.broadcast_to(np.arange(mask.shape[0])[:, None], mask.shape)] + filled[::-1], axis=0)
+    ranks = np.empty(mask.shape)
+    ranks[order, np.arange(mask.shape[1])] = np.arange(1, mask.shape[0] + 1)[:, None]
+    return np.where(mask, ranks, np.nan)
+
+
+def _price_pair(price):
+    """把source_price中的价格配置转换为(输入价格, 输出价格)"""
+    if isinstance(price, tuple) and len(price) >= 2 and None not in price:
+        return float(price[0]), float(price[1])
+    if isinstance(price, float):
+        return price, price
+    return UNKNOWN_PRICE, UNKNOWN_PRICE
+
+
+class ScoringEngine:
+    """单份健康检查索引上所有模型的评分结果, 建好后只读"""
+
+    def __init__(self, index, is_valid, get_price):
+        """
+        Args:
+            index (HealthIndex): 健康检查索引
+            is_valid (callable): (source_name, model_name) -> bool, 模型在源上是否可用
+            get_price (callable): (source_name, model_name) -> source_price中的价格配置, 没有时为None
+        """
+        self.index = index
+        sources, models = index.source_names, index.model_names
+        shape = (len(sources), len(models))
+        self.valid = np.zeros(shape, dtype=bool)
+        self.price_in = np.full(shape, UNKNOWN_PRICE)
+        self.price_out = np.full(shape, UNKNOWN_PRICE)
+        for s, m in zip(*np.nonzero(index.exists)):
+            if is_valid(sources[s], models[m]):
+                self.valid[s, m] = True
+                self.price_in[s, m], self.price_out[s, m] = _price_pair(get_price(sources[s], models[m]))
+
+        has_recent = index.exists & ~np.isnan(index.recent_mean)
+        has_success = index.exists & ~np.isnan(index.success_rate)
+        # 任意源近期有成功记录的模型按近期平均耗时排名, 否则按整体成功率排名
+        by_latency = has_recent.any(axis=0)
+        self.rankable = by_latency | has_success.any(axis=0)
+        self.pre_mask = np.where(by_latency, has_recent, has_success)
+        self.pre_rank = _rank(self.pre_mask, np.where(by_latency, index.recent_mean, -index.success_rate))
+        self.candidate_mask = self.pre_mask & self.valid
+
+        self._by_latency = by_latency
+        self._fast = self._orders(self.pre_rank)
+        self._cheap = {}
+        self._quantile = {}
+
+    def _orders(self, *keys):
+        """按keys对每个模型的候选源排序, 返回{model_name: tuple}"""
+        ranks = _rank(self.candidate_mask, *keys)
+        order = np.argsort(np.where(self.candidate_mask, ranks, np.inf), axis=0, kind="stable")
+        counts = self.candidate_mask.sum(axis=0)
+        sources = self.index.source_names
+        return {
+            model_name: tuple(sources[s] for s in order[:counts[m], m])
+            for m, model_name in enumerate(self.index.model_names)
+        }
+
+    def quantile_scores(self, q):
+        """所有(source, model)按耗时q分位数排名用的得分, 越小越好
+
+        没有草图的源用近期平均耗时代替; 所有源近期都没有成功记录的模型沿用预排名.
+        """
+        latency = self.index.latency_quantile(q)
+        latency = np.where(np.isnan(latency), self.index.recent_mean, latency)
+        return np.where(self._by_latency, latency, self.pre_rank)
+
+    def combined_scores(self, input_proportion, output_proportion):
+        """所有(source, model)在给定输入输出比例下的cheap_first融合得分, 越小越好"""
+        price = (self.price_in * input_proportion + self.price_out * output_proportion) / (input_proportion + output_proportion)
+        price_rank = _rank(self.candidate_mask, price, self.pre_rank)
+        return self.pre_rank * (1 - PRICE_WEIGHT) + price_rank * PRICE_WEIGHT
+
+    def rank(self, model_name, mode, input_proportion, output_proportion):
+        """返回按优先级排序的候选源
+
+        Returns:
+            tuple or None: 健康数据不足以排序(或没有支持该模型的源)时返回None, 由调用方退回预设排名
+        """
+        m = self.index.model_pos.get(model_name)
+        if m is None or not self.rankable[m]:
+            return None
+        if mode == "fast_first":
+            orders = self._fast
+        elif mode in QUANTILE_MODES:
+            q = QUANTILE_MODES[mode]
+            orders = self._quantile.get(q)
+            if orders is None:
+                orders = self._quantile[q] = self._orders(self.quantile_scores(q), self.pre_rank)
+        else:
+            key = (input_proportion, output_proportion)
+            orders = self._cheap.get(key)
+            if orders is None:
+                orders = self._orders(self.combined_scores(input_proportion, output_proportion), self.pre_rank)
+                self._cheap[key] = orders
+        return orders[model_name] or None
@@ -0,0 +1,420 @@
+import os
+import json
+import mmap
+import time
+import struct
+import asyncio
+import hashlib
+import logging
+import threading
+import contextlib
+
+import sys
+from pathlib import Path
+# 更正导入路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ew_router.passive_stats import PassiveStats, _Ewma
+from ew_router.snapshot import HEALTH_SNAPSHOT_TTL, HEALTH_SNAPSHOT_RETRY_TTL
+
+try:
+    import fcntl
+except ImportError:
+    # Windows上没有fcntl, 不支持共享路由状态
+    fcntl = None
+
+"""同一主机上多个路由进程共享的路由状态(可选).
+
+每个导入LLM_Wrapper的工作进程各自拉取健康检查数据、各自记录被动统计, N个进程就有N倍的控制面请求,
+被动统计也被分成N份. 设置ROUTER_SHARED_STATE_PATH后, 各进程映射(mmap)同一个文件, 其中保存:
+- 健康检查服务返回的原始数据: 同一时刻只有一个持有刷新锁的进程请求健康检查服务并写入, 其他进程直接读取后在本地解析
+- 被动统计的衰减计数: 按(source, source_model_name)的哈希开放寻址存放在固定大小的槽位表中, 所有进程的请求记入同一份
+写入方之间通过文件记录锁(fcntl.lockf)互斥. 读取方不加锁: 每个区域带一个序号(seqlock), 写入前后各加1,
+读到奇数序号或读取前后序号不一致说明读取时正好有写入, 重新读取.
+耗时分位数草图仍只在进程内统计. 衰减使用墙上时钟, 保证不同进程记录的时间可以比较.
+所有共享同一文件的进程必须使用相同的SHARED_STATE_*配置. 布局与已有文件不一致时拒绝打开(该进程退回各自维护路由状态),
+不会截断其他进程正在映射的文件; 修改配置时应同时更换ROUTER_SHARED_STATE_PATH.
+"""
+
+# 共享状态文件的路径, 为空时不共享, 每个进程各自维护路由状态
+ROUTER_SHARED_STATE_PATH = os.environ.get("ROUTER_SHARED_STATE_PATH", "")
+# 健康检查数据区的容量(字节), 数据超过容量时不写入共享文件
+SHARED_STATE_HEALTH_BYTES = int(os.environ.get("SHARED_STATE_HEALTH_BYTES", 16 * 1024 * 1024))
+# 被动统计的槽位数, 每个(源, 模型)占用一个槽位
+SHARED_STATE_STATS_SLOTS = int(os.environ.get("SHARED_STATE_STATS_SLOTS", 4096))
+
+_MAGIC = b"EWRS0001"
+# 文件头: 魔数, 健康检查数据区容量, 槽位数
+_HEADER = struct.Struct("<8sQQ")
+_HEADER_SIZE = 64
+_SEQ = struct.Struct("<Q")
+# 健康检查数据区头: 序号, 写入时间(time.time()), 数据长度
+_HEALTH_HEADER = struct.Struct("<QdQ")
+# 被动统计槽位: 序号, 键哈希(0表示空槽位), 更新时间, 权重和, 错误权重, 成功权重, 耗时和, 耗时平方和
+_SLOT = struct.Struct("<QQdddddd")
+_SLOT_KEY = struct.Struct("<Q")
+# lockf锁定的字节: 写入锁和健康检查刷新锁互不影响
+_WRITE_LOCK = 0
+_REFRESH_LOCK = 1
+# 读取遇到写入时的最多重试次数和间隔(秒)
+_READ_RETRIES = 100
+_READ_RETRY_INTERVAL = 0.001
+# 协程等待其他进程刷新健康检查数据时的轮询间隔(秒)
+_POLL_INTERVAL = 0.05
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+
+
+def _key_hash(source_name, model_name):
+    digest = hashlib.md5(f"{source_name}|{model_name}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") or 1
+
+
+class SharedState:
+    """映射到共享文件的路由状态, 同一进程内的各线程共用一个实例"""
+
+    def __init__(self, path, health_bytes=SHARED_STATE_HEALTH_BYTES, slots=SHARED_STATE_STATS_SLOTS):
+        """
+        Args:
+            path (str): 共享文件路径, 不存在时创建
+            health_bytes (int): 健康检查数据区的容量(字节)
+            slots (int): 被动统计的槽位数
+        """
+        if fcntl is None:
+            raise RuntimeError("共享路由状态依赖fcntl, 当前平台不支持")
+        self.path = path
+        self.health_bytes = health_bytes
+        self.slots = slots
+        self._health_offset = _HEADER_SIZE
+        self._slots_offset = _HEADER_SIZE + _HEALTH_HEADER.size + health_bytes
+        self.size = self._slots_offset + slots * _SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._initialize()
+            self._mmap = mmap.mmap(self._fd, self.size)
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._reset_locks()
+
+    def _initialize(self):
+        """新建的文件写入文件头; 已有文件的布局与当前配置不一致时抛出ValueError
+
+        其他进程可能正映射着已有的文件, 截断它会使这些进程在访问时收到SIGBUS, 因此只初始化还没有文件头的文件.
+        """
+        header = _HEADER.pack(_MAGIC, self.health_bytes, self.slots)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, _WRITE_LOCK)
+        try:
+            existing = os.pread(self._fd, _HEADER.size, 0)
+            if existing.strip(b"\0"):
+                if existing != header or os.fstat(self._fd).st_size < self.size:
+                    raise ValueError(f"共享文件 {self.path} 的布局与当前的SHARED_STATE_*配置不一致, "
+                                     f"请为新配置使用新的ROUTER_SHARED_STATE_PATH")
+                return
+            # 新建的文件, 或初始化中途退出而没有写入文件头的文件, 都不会被其他进程映射
+            os.ftruncate(self._fd, self.size)
+            os.pwrite(self._fd, bytes(_HEALTH_HEADER.size), self._health_offset)
+            os.pwrite(self._fd, bytes(self.slots * _SLOT.size), self._slots_offset)
+            os.pwrite(self._fd, header, 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _WRITE_LOCK)
+
+    def _reset_locks(self):
+        self._pid = os.getpid()
+        self._write_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _check_fork(self):
+        """fork出的子进程中重建线程锁, 映射本身在子进程中仍然有效, 记录锁不会被继承"""
+        if self._pid != os.getpid():
+            self._reset_locks()
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """写入锁: 进程内用线程锁互斥, 进程间用文件记录锁互斥"""
+        self._check_fork()
+        with self._write_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, _WRITE_LOCK)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _WRITE_LOCK)
+
+    def acquire_refresh(self, blocking=True):
+        """获取健康检查刷新锁, 同一时刻主机上只有一个线程请求健康检查服务
+
+        Returns:
+            bool: 是否获取到, blocking时总是True
+        """
+        self._check_fork()
+        if not self._refresh_lock.acquire(blocking):
+            return False
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB, 1, _REFRESH_LOCK)
+        except OSError:
+            self._refresh_lock.release()
+            if blocking:
+                raise
+            return False
+        return True
+
+    def release_refresh(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _REFRESH_LOCK)
+        self._refresh_lock.release()
+
+    def write_health(self, payload):
+        """写入健康检查数据
+
+        Args:
+            payload (bytes): 序列化后的数据
+
+        Returns:
+            bool: 数据超过容量时不写入, 返回False
+        """
+        if len(payload) > self.health_bytes:
+            return False
+        offset = self._health_offset
+        start = offset + _HEALTH_HEADER.size
+        with self._writing():
+            seq = _SEQ.unpack_from(self._mmap, offset)[0]
+            _SEQ.pack_into(self._mmap, offset, seq + 1)
+            self._mmap[start:start + len(payload)] = payload
+            _HEALTH_HEADER.pack_into(self._mmap, offset, seq + 1, time.time(), len(payload))
+            _SEQ.pack_into(self._mmap, offset, seq + 2)
+        return True
+
+    def read_health(self):
+        """读取健康检查数据
+
+        Returns:
+            tuple: (数据, 写入时间), 还没有写入过或持续遇到写入时返回None
+        """
+        offset = self._health_offset
+        start = offset + _HEALTH_HEADER.size
+        for _ in range(_READ_RETRIES):
+            seq, written_at, length = _HEALTH_HEADER.unpack_from(self._mmap, offset)
+            if seq % 2 == 0 and length <= self.health_bytes:
+                payload = self._mmap[start:start + length]
+                if _SEQ.unpack_from(self._mmap, offset)[0] == seq:
+                    return (payload, written_at) if seq else None
+            time.sleep(_READ_RETRY_INTERVAL)
+        return None
+
+    def _slot_offset(self, index):
+        return self._slots_offset + index * _SLOT.size
+
+    def _find_slot(self, key_hash, create=False):
+        """线性探测查找键所在的槽位, create时找不到则返回第一个空槽位(需持有写入锁); 槽位表已满时返回None"""
+        start = key_hash % self.slots
+        for i in range(self.slots):
+            index = (start + i) % self.slots
+            stored = _SLOT_KEY.unpack_from(self._mmap, self._slot_offset(index) + _SEQ.size)[0]
+            if stored == key_hash:
+                return index
+            if stored == 0:
+                return index if create else None
+        return None
+
+    def _write_slot(self, offset, key_hash, values):
+        """按seqlock协议写入一个槽位, 调用方需持有写入锁"""
+        seq = _SEQ.unpack_from(self._mmap, offset)[0]
+        _SEQ.pack_into(self._mmap, offset, seq + 1)
+        _SLOT.pack_into(self._mmap, offset, seq + 1, key_hash, *values)
+        _SEQ.pack_into(self._mmap, offset, seq + 2)
+
+    def _read_slot(self, offset):
+        """读取一个槽位的(更新时间, 权重和, ...), 持续遇到写入时返回None"""
+        for _ in range(_READ_RETRIES):
+            seq, _, *values = _SLOT.unpack_from(self._mmap, offset)
+            if seq % 2 == 0 and _SEQ.unpack_from(self._mmap, offset)[0] == seq:
+                return values
+            time.sleep(_READ_RETRY_INTERVAL)
+        return None
+
+    @staticmethod
+    def _load(values):
+        ewma = _Ewma(values[0])
+        ewma.weight, ewma.errors, ewma.ok_weight, ewma.latency_sum, ewma.latency_sq_sum = values[1:]
+        return ewma
+
+    def record_stat(self, source_name, model_name, latency, success, half_life):
+        """把一次请求记入共享的被动统计
+
+        Returns:
+            bool: 槽位表已满时不记录, 返回False
+        """
+        key_hash = _key_hash(source_name, model_name)
+        now = time.time()
+        with self._writing():
+            index = self._find_slot(key_hash, create=True)
+            if index is None:
+                return False
+            offset = self._slot_offset(index)
+            # 持有写入锁时槽位不会被修改, 可以直接读取
+            ewma = self._load(_SLOT.unpack_from(self._mmap, offset)[2:])
+            ewma.decay(now, half_life)
+            ewma.add(latency, success)
+            self._write_slot(offset, key_hash, (ewma.updated_at, ewma.weight, ewma.errors, ewma.ok_weight,
+                                                ewma.latency_sum, ewma.latency_sq_sum))
+        return True
+
+    def read_stat(self, source_name, model_name, half_life):
+        """返回衰减到当前时刻的共享统计(PassiveStat), 没有记录时返回None"""
+        index = self._find_slot(_key_hash(source_name, model_name))
+        if index is None:
+            return None
+        values = self._read_slot(self._slot_offset(index))
+        if values is None:
+            return None
+        ewma = self._load(values)
+        ewma.decay(time.time(), half_life)
+        return ewma.snapshot()
+
+    def clear_stats(self):
+        with self._writing():
+            for index in range(self.slots):
+                offset = self._slot_offset(index)
+                if _SLOT_KEY.unpack_from(self._mmap, offset + _SEQ.size)[0]:
+                    self._write_slot(offset, 0, (0.0,) * 6)
+
+    def metrics(self):
+        """共享文件中健康检查数据的大小和距今秒数, 以及已使用的被动统计槽位数"""
+        health = self.read_health()
+        used = sum(1 for index in range(self.slots)
+                   if _SLOT_KEY.unpack_from(self._mmap, self._slot_offset(index) + _SEQ.size)[0])
+        return {
+            "path": self.path,
+            "health_bytes": len(health[0]) if health else 0,
+            "health_age": round(time.time() - health[1], 1) if health else None,
+            "stat_slots": used,
+        }
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+
+def open_shared_state(path=ROUTER_SHARED_STATE_PATH, **kwargs):
+    """打开共享路由状态, 未配置路径或无法打开时返回None, 各进程退回各自维护路由状态"""
+    if not path:
+        return None
+    try:
+        return SharedState(path, **kwargs)
+    except (OSError, RuntimeError, ValueError) as e:
+        logger.warning(f"无法打开共享路由状态文件 {path}, 各进程将各自维护路由状态: {e}")
+        return None
+
+
+class SharedPassiveStats(PassiveStats):
+    """计数记入共享文件的被动统计, 耗时分位数草图仍只在进程内统计
+
+    共享槽位表已满或读写共享文件出错的(源, 模型)退回使用进程内的统计.
+    """
+
+    def __init__(self, shared, **kwargs):
+        super().__init__(**kwargs)
+        self.shared = shared
+
+    def record(self, source_name, model_name, latency, success):
+        super().record(source_name, model_name, latency, success)
+        try:
+            self.shared.record_stat(source_name, model_name, latency, success, self.half_life)
+        except OSError as e:
+            logger.warning(f"写入共享被动统计时出错: {e}")
+
+    def get(self, source_name, model_name):
+        try:
+            stat = self.shared.read_stat(source_name, model_name, self.half_life)
+        except OSError as e:
+            logger.warning(f"读取共享被动统计时出错: {e}")
+            stat = None
+        if stat is None:
+            return super().get(source_name, model_name)
+        return stat if stat.samples >= self.min_samples else None
+
+    def clear(self):
+        super().clear()
+        self.shared.clear_stats()
+
+
+class SharedHealthSource:
+    """通过共享文件获取健康检查数据, 作为HealthSnapshotStore的fetch/afetch
+
+    共享文件中的数据在有效期内时直接读取, 不请求健康检查服务; 过期时只有获取到刷新锁的线程请求并写入,
+    其他进程等待其写入后读取.
+    """
+
+    def __init__(self, shared, request, arequest=None, parse=None, ttl=HEALTH_SNAPSHOT_TTL,
+                 retry_ttl=HEALTH_SNAPSHOT_RETRY_TTL):
+        """
+        Args:
+            shared (SharedState): 共享状态
+            request (callable): 请求健康检查服务, 返回可JSON序列化的原始数据, 失败时返回None
+            arequest (callable, optional): request的协程版本
+            parse (callable, optional): 原始数据(请求失败时为None) -> 健康检查数据, 默认原样返回
+            ttl (float): 共享数据的有效期(秒)
+            retry_ttl (float): 健康检查服务不可用时共享数据的有效期(秒)
+        """
+        self.shared = shared
+        self.request = request
+        self.arequest = arequest
+        self.parse = parse or (lambda raw: raw)
+        self.ttl = ttl
+        self.retry_ttl = retry_ttl
+
+    def _read_fresh(self):
+        """共享文件中仍在有效期内的健康检查数据, 没有时返回None"""
+        entry = self.shared.read_health()
+        if entry is None:
+            return None
+        payload, written_at = entry
+        try:
+            raw = json.loads(payload)
+        except ValueError:
+            return None
+        ttl = self.ttl if raw and raw.get("data") else min(self.ttl, self.retry_ttl)
+        if time.time() - written_at > ttl:
+            return None
+        return self.parse(raw)
+
+    def _publish(self, raw):
+        payload = json.dumps(raw).encode("utf-8")
+        try:
+            if not self.shared.write_health(payload):
+                logger.warning(f"健康检查数据({len(payload)}字节)超过SHARED_STATE_HEALTH_BYTES, 未写入共享文件")
+        except OSError as e:
+            logger.warning(f"写入共享健康检查数据时出错: {e}")
+        return self.parse(raw)
+
+    def fetch(self):
+        healthy = self._read_fresh()
+        if healthy is not None:
+            return healthy
+        self.shared.acquire_refresh()
+        try:
+            # 等待刷新锁期间其他进程可能已经完成了刷新
+            healthy = self._read_fresh()
+            if healthy is not None:
+                return healthy
+            return self._publish(self.request())
+        finally:
+            self.shared.release_refresh()
+
+    async def afetch(self):
+        """fetch的协程版本, 其他进程正在刷新时轮询等待其结果, 不阻塞事件循环"""
+        while True:
+            healthy = self._read_fresh()
+            if healthy is not None:
+                return healthy
+            if self.shared.acquire_refresh(blocking=False):
+                break
+            await asyncio.sleep(_POLL_INTERVAL)
+        try:
+            healthy = self._read_fresh()
+            if healthy is not None:
+                return healthy
+            raw = await self.arequest() if self.arequest is not None else self.request()
+            return self._publish(raw)
+        finally:
+            self.shared.release_refresh()
@@ -0,0 +1,233 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import namedtuple
+
+import sys
+from pathlib import Path
+# 更正导入路径
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ew_decorator.with_timeout import detached_scope
+
+"""进程级共享的健康检查快照.
+
+健康检查服务每CHECK_TIMER_SPAN分钟才更新一次数据, 因此没有必要在每次LLM请求时
+都同步请求一次/check_healthy并解析整份数据. 这里维护一份进程内共享的只读快照:
+- 后台守护线程每HEALTH_SNAPSHOT_TTL秒刷新一次
+- 快照过期但未超过HEALTH_SNAPSHOT_MAX_STALE时, 直接返回旧快照并在后台触发刷新(stale-while-revalidate)
+- 健康检查服务不可用时保留已有的快照, 并较早重试
+- 刷新的结果由所有调用方共享, 因此刷新不受触发它的调用方的截止时间约束
+- 只有在没有快照或快照严重过期时, 调用方才会同步等待刷新
+"""
+
+# 快照的有效期(秒), 也是后台线程的刷新间隔
+HEALTH_SNAPSHOT_TTL = float(os.environ.get("HEALTH_SNAPSHOT_TTL", 60))
+# 快照过期超过该时间(秒)后不再返回旧数据, 调用方同步等待刷新
+HEALTH_SNAPSHOT_MAX_STALE = float(os.environ.get("HEALTH_SNAPSHOT_MAX_STALE", 1800))
+# 健康检查服务不可用(返回空数据)时距下一次刷新的时间(秒), 以便服务恢复后尽快拿到数据
+HEALTH_SNAPSHOT_RETRY_TTL = float(os.environ.get("HEALTH_SNAPSHOT_RETRY_TTL", 10))
+
+# version在快照数据变化时递增, 依赖快照的缓存可以据此判断是否需要重建; fetched_at是首次取到该数据的时间
+HealthSnapshot = namedtuple("HealthSnapshot", ["healthy", "version", "fetched_at"])
+
+
+def _has_data(healthy):
+    return bool(healthy) and bool(healthy.get("data"))
+
+
+def _content(healthy):
+    """快照中决定路由的内容: 健康检查数据和分位数草图
+
+    不含每次响应都不同的timestamp; NaN换成None, 草图换成to_dict()的形式, 以便直接比较.
+    """
+    data = {key: [None if v != v else v for v in values] for key, values in (healthy.get("data") or {}).items()}
+    sketches = {key: sketch.to_dict() for key, sketch in (healthy.get("sketches") or {}).items()}
+    return data, sketches
+
+
+class HealthSnapshotStore:
+    """线程安全的健康检查快照缓存.
+
+    快照中的healthy字典被所有线程共享, 调用方只能读取不能修改.
+    刷新取到的数据除timestamp外与当前快照相同时沿用当前的version; 健康检查服务不可用(返回空数据)时保留已有的快照,
+    并在HEALTH_SNAPSHOT_RETRY_TTL秒后重试.
+    """
+
+    def __init__(self,
+        fetch,
+        afetch=None,
+        ttl=HEALTH_SNAPSHOT_TTL,
+        max_stale=HEALTH_SNAPSHOT_MAX_STALE,
+        retry_ttl=HEALTH_SNAPSHOT_RETRY_TTL,
+        background=True
+    ) -> None:
+        """
+        Args:
+            fetch (callable): 同步获取健康检查数据的函数
+            afetch (callable, optional): 异步获取健康检查数据的协程函数, 用于协程中的首次加载
+            ttl (float): 快照有效期(秒)
+            max_stale (float): 快照过期后仍可返回旧数据的最长时间(秒)
+            retry_ttl (float): 健康数据为空时距下一次刷新的时间(秒)
+            background (bool): 是否启动后台线程定时刷新
+        """
+        self.fetch = fetch
+        self.afetch = afetch
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.retry_ttl = retry_ttl
+        self.background = background
+        self._snapshot = None
+        # 当前快照的_content(), 用于判断刷新取到的数据是否变化
+        self._content = None
+        # 当前快照的过期时间(time.monotonic()时间戳), 每次刷新后更新
+        self._expires_at = 0.0
+        self._version = 0
+        # 已完成的刷新次数, 等待刷新的线程据此判断等待期间是否已有其他线程刷新
+        self._generation = 0
+        # 保证同一时刻只有一个同步刷新在进行, 持有期间会请求健康检查服务, 不能在事件循环中获取
+        self._refresh_lock = threading.Lock()
+        # 只保护快照的替换, 持有时间极短, 事件循环中也可以获取
+        self._swap_lock = threading.Lock()
+        # 协程中正在进行的刷新, (事件循环, 任务), 同一事件循环中并发的aget共用
+        self._arefreshing = None
+        self._thread = None
+        self._thread_pid = None
+        self._thread_lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.logger.propagate = False
+
+    def _swap(self, healthy):
+        """用刷新取到的数据更新快照, 返回更新后的快照
+
+        数据为空时保留已有的快照; 除timestamp外与当前快照相同时沿用当前的version. 两种情况下version都不变.
+        """
+        now = time.monotonic()
+        with self._swap_lock:
+            self._generation += 1
+            current = self._snapshot
+            if not _has_data(healthy):
+                self._expires_at = now + min(self.ttl, self.retry_ttl)
+                if current is None:
+                    self._version += 1
+                    self._snapshot = HealthSnapshot(healthy, self._version, now)
+                return self._snapshot
+            self._expires_at = now + self.ttl
+            content = _content(healthy)
+            if current is None or content != self._content:
+                self._version += 1
+                self._snapshot = HealthSnapshot(healthy, self._version, now)
+            else:
+                # 内容未变, 沿用版本以保留依赖版本的缓存, 只换用带新timestamp的数据
+                self._snapshot = HealthSnapshot(healthy, current.version, current.fetched_at)
+            self._content = content
+            return self._snapshot
+
+    def refresh(self):
+        """同步刷新快照, 已有刷新在进行时等待其完成并返回其结果"""
+        generation = self._generation
+        with self._refresh_lock:
+            # 等待锁期间其他线程已经完成了刷新
+            if self._snapshot is not None and self._generation != generation:
+                return self._snapshot
+            with detached_scope():
+                healthy = self.fetch()
+            return self._swap(healthy)
+
+    def _refresh_in_background(self):
+        """在后台线程中刷新快照, 已有刷新在进行时直接返回"""
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        def worker():
+            try:
+                self._swap(self.fetch())
+            except Exception as e:
+                self.logger.error(f"后台刷新健康检查快照时出错: {str(e)}")
+            finally:
+                self._refresh_lock.release()
+        threading.Thread(target=worker, name="health-snapshot-revalidate", daemon=True).start()
+
+    def _ensure_background_thread(self):
+        """启动定时刷新线程, fork出的子进程中会重新启动"""
+        if not self.background:
+            return
+        pid = os.getpid()
+        if self._thread is not None and self._thread_pid == pid:
+            return
+        with self._thread_lock:
+            if self._thread is not None and self._thread_pid == pid:
+                return
+            self._thread = threading.Thread(target=self._run, name="health-snapshot-refresher", daemon=True)
+            self._thread_pid = pid
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            delay = self._expires_at - time.monotonic() if self._snapshot is not None else 0
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.error(f"定时刷新健康检查快照时出错: {str(e)}")
+                time.sleep(self.retry_ttl)
+
+    def _get_cached(self):
+        """返回可直接使用的快照, 需要同步刷新时返回None"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        overdue = time.monotonic() - self._expires_at
+        if overdue <= 0:
+            return snapshot
+        if overdue <= self.max_stale:
+            # 先返回旧快照, 同时在后台重新验证
+            self._refresh_in_background()
+            return snapshot
+        return None
+
+    def get(self):
+        """获取当前快照, 只有在没有可用快照时才同步刷新
+
+        Returns:
+            HealthSnapshot: (healthy, version, fetched_at)
+        """
+        self._ensure_background_thread()
+        snapshot = self._get_cached()
+        if snapshot is None:
+            snapshot = self.refresh()
+        return snapshot
+
+    async def aget(self):
+        """get的协程版本, 首次加载或快照严重过期时通过afetch获取, 不阻塞事件循环
+
+        同一事件循环中并发的调用共用一次afetch.
+        """
+        self._ensure_background_thread()
+        snapshot = self._get_cached()
+        if snapshot is not None:
+            return snapshot
+        if self.afetch is None:
+            return self.refresh()
+        loop = asyncio.get_event_loop()
+        refreshing = self._arefreshing
+        if refreshing is None or refreshing[0] is not loop or refreshing[1].done():
+            refreshing = (loop, loop.create_task(self._arefresh()))
+            self._arefreshing = refreshing
+        # 某个调用方被取消时不取消共用的刷新
+        return await asyncio.shield(refreshing[1])
+
+    async def _arefresh(self):
+        # 任务复制了创建它的调用方的上下文, 清除其截止时间
+        with detached_scope():
+            healthy = await self.afetch()
+        return self._swap(healthy)
+
+    def invalidate(self):
+        """丢弃当前快照, 下一次get时同步刷新"""
+        with self._swap_lock:
+            self._snapshot = None
+            self._expires_at = 0.0
@@ -0,0 +1,52 @@
+import unittest
+import sys
+from pathlib import Path
+
+# 导入亲和路由
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.affinity import prefix_key, ring_order
+
+
+NODES = ["openai", "deerapi", "openrouter", "google", "anthropic"]
+
+
+class TestAffinity(unittest.TestCase):
+
+    def test_prefix_key(self):
+        """只看前缀, 短于前缀长度的提示不计算亲和键"""
+        system = "x" * 100
+        self.assertEqual(prefix_key(system + "问题一", length=100), prefix_key(system + "问题二", length=100))
+        self.assertNotEqual(prefix_key(system, length=100), prefix_key("y" * 100, length=100))
+        self.assertIsNone(prefix_key("short", length=100))
+        self.assertEqual(prefix_key("x" * 50, None, "x" * 50, length=100), prefix_key(system, length=100))
+
+    def test_ring_order_is_stable(self):
+        order = ring_order(NODES, "key")
+        self.assertEqual(sorted(order), sorted(NODES))
+        # 与候选顺序无关
+        self.assertEqual(ring_order(list(reversed(NODES)), "key"), order)
+        self.assertEqual(ring_order(NODES, None), NODES)
+
+    def test_removing_node_only_moves_its_keys(self):
+        """一致性哈希: 去掉一个节点时只有原本落在它上面的键改变, 且顺延到环上的下一个节点"""
+        keys = [f"prefix-{i}" for i in range(500)]
+        before = {key: ring_order(NODES, key) for key in keys}
+        removed = "google"
+        remaining = [node for node in NODES if node != removed]
+        for key in keys:
+            after = ring_order(remaining, key)
+            if before[key][0] != removed:
+                self.assertEqual(after[0], before[key][0])
+            else:
+                self.assertEqual(after[0], before[key][1])
+
+    def test_keys_spread_across_nodes(self):
+        counts = {node: 0 for node in NODES}
+        for i in range(2000):
+            counts[ring_order(NODES, f"prefix-{i}")[0]] += 1
+        for node, count in counts.items():
+            self.assertGreater(count, 200, node)
+
+
+if __name__ == "__main__":
+    unittest.main()
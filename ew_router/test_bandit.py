@@ -0,0 +1,61 @@
+import unittest
+import sys
+import random
+from collections import Counter
+from pathlib import Path
+
+# 导入自适应路由
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.bandit import BanditArms, ArmPrior, thompson_order
+from ew_router.testing import FakeClock
+
+
+class TestBandit(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.arms = BanditArms(half_life=100, prior_weight=2, clock=self.clock, rng=random.Random(0))
+
+    def winners(self, candidates, prices=None, rounds=200, priors=None):
+        prices = prices or {}
+        priors = priors or {}
+        sample_of = lambda s: self.arms.sample(s, "m", priors.get(s, ArmPrior(None, None)))
+        return Counter(thompson_order(candidates, sample_of, prices.get)[0] for _ in range(rounds))
+
+    def test_posterior_narrows_with_data(self):
+        _, _, _, wide = self.arms.posterior("a", "m")
+        for _ in range(50):
+            self.arms.record("a", "m", 2.0, True)
+        alpha, beta, mu, narrow = self.arms.posterior("a", "m")
+        self.assertLess(narrow, wide)
+        self.assertGreater(alpha, 50)
+        self.assertEqual(beta, 1.0)
+
+    def test_exploits_better_arm(self):
+        for _ in range(30):
+            self.arms.record("fast", "m", 1.0, True)
+            self.arms.record("slow", "m", 8.0, True)
+            self.arms.record("broken", "m", 1.0, False)
+        winners = self.winners(["slow", "broken", "fast"])
+        self.assertGreater(winners["fast"], 190)
+
+    def test_price_breaks_latency_tie(self):
+        for _ in range(30):
+            self.arms.record("a", "m", 2.0, True)
+            self.arms.record("b", "m", 2.0, True)
+        winners = self.winners(["a", "b"], prices={"a": 10.0, "b": 1.0})
+        self.assertGreater(winners["b"], 150)
+
+    def test_recovered_source_is_rediscovered(self):
+        """失败记录随时间衰减后, 先验健康的源会重新被探索到"""
+        for _ in range(20):
+            self.arms.record("a", "m", 1.0, False)
+            self.arms.record("b", "m", 3.0, True)
+        priors = {"a": ArmPrior(1.0, 1.0), "b": ArmPrior(1.0, 3.0)}
+        self.assertLess(self.winners(["a", "b"], priors=priors)["a"], 10)
+        self.clock.now = 1000
+        self.assertGreater(self.winners(["a", "b"], priors=priors)["a"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
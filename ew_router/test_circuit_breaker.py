@@ -0,0 +1,67 @@
+import unittest
+import sys
+from pathlib import Path
+
+# 导入熔断器
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.circuit_breaker import (
+    CircuitBreakerRegistry, BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_SECONDS, BREAKER_HALF_OPEN_TRIALS
+)
+from ew_router.testing import FakeClock
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breakers = CircuitBreakerRegistry(clock=self.clock)
+
+    def trip(self):
+        for _ in range(BREAKER_FAILURE_THRESHOLD):
+            self.assertTrue(self.breakers.try_acquire("a", "m"))
+            self.breakers.record("a", "m", False)
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(BREAKER_FAILURE_THRESHOLD - 1):
+            self.breakers.record("a", "m", False)
+        self.breakers.record("a", "m", True)
+        self.assertFalse(self.breakers.is_open("a", "m"))
+        self.trip()
+        self.assertTrue(self.breakers.is_open("a", "m"))
+        self.assertFalse(self.breakers.try_acquire("a", "m"))
+        self.assertFalse(self.breakers.is_open("a", "other"))
+        self.assertEqual(self.breakers.metrics()["a|m"]["state"], "open")
+
+    def test_half_open_recovers(self):
+        self.trip()
+        self.clock.now = BREAKER_OPEN_SECONDS
+        for _ in range(BREAKER_HALF_OPEN_TRIALS):
+            self.assertTrue(self.breakers.try_acquire("a", "m"))
+        # 试探名额已用完
+        self.assertFalse(self.breakers.try_acquire("a", "m"))
+        for _ in range(BREAKER_HALF_OPEN_TRIALS):
+            self.breakers.record("a", "m", True)
+        self.assertFalse(self.breakers.is_open("a", "m"))
+        self.assertEqual(self.breakers.metrics(), {})
+
+    def test_half_open_failure_doubles_cooldown(self):
+        self.trip()
+        self.clock.now = BREAKER_OPEN_SECONDS
+        self.assertTrue(self.breakers.try_acquire("a", "m"))
+        self.breakers.record("a", "m", False)
+        self.clock.now += BREAKER_OPEN_SECONDS
+        self.assertTrue(self.breakers.is_open("a", "m"))
+        self.clock.now += BREAKER_OPEN_SECONDS
+        self.assertFalse(self.breakers.is_open("a", "m"))
+
+    def test_cancelled_trial_frees_slot(self):
+        self.trip()
+        self.clock.now = BREAKER_OPEN_SECONDS
+        for _ in range(BREAKER_HALF_OPEN_TRIALS):
+            self.breakers.try_acquire("a", "m")
+        self.breakers.record("a", "m", None)
+        self.assertTrue(self.breakers.try_acquire("a", "m"))
+
+
+if __name__ == "__main__":
+    unittest.main()
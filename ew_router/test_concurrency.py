@@ -0,0 +1,64 @@
+import unittest
+import sys
+import threading
+import time
+from pathlib import Path
+
+# 导入并发限制器
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.concurrency import ConcurrencyLimiter, AdaptiveLimit
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def test_aimd(self):
+        limit = AdaptiveLimit(4)
+        limit.on_success(1.0, in_flight=4)
+        self.assertAlmostEqual(limit.limit, 4.25)
+        # 并发远未用满时不增长
+        limit.on_success(1.0, in_flight=1)
+        self.assertAlmostEqual(limit.limit, 4.25)
+        # 明显变慢时不增长
+        limit.on_success(10.0, in_flight=4)
+        self.assertAlmostEqual(limit.limit, 4.25)
+        limit.on_error()
+        self.assertAlmostEqual(limit.limit, 4.25 * 0.7)
+
+
+class TestConcurrencyLimiter(unittest.TestCase):
+
+    def test_limits_source_and_model(self):
+        limiter = ConcurrencyLimiter(initial_limit=2)
+        first = limiter.try_acquire("a", "m1")
+        second = limiter.try_acquire("a", "m2")
+        # 源级别的上限已满
+        self.assertIsNone(limiter.try_acquire("a", "m3"))
+        self.assertIsNotNone(limiter.try_acquire("b", "m1"))
+        limiter.release(first)
+        limiter.release(first)  # 重复归还无效
+        self.assertIsNotNone(limiter.try_acquire("a", "m3"))
+        self.assertEqual(limiter.metrics()["a"], {"limit": 2, "in_flight": 2})
+        limiter.release(second, success=False)
+        self.assertEqual(limiter.metrics()["a|m2"]["limit"], 1.4)
+
+    def test_record_keeps_permit(self):
+        """record只调整上限, 许可在release时才归还且不再重复调整"""
+        limiter = ConcurrencyLimiter(initial_limit=2)
+        permit = limiter.try_acquire("a", "m")
+        limiter.record(permit, False)
+        self.assertEqual(limiter.metrics()["a"], {"limit": 1.4, "in_flight": 1})
+        limiter.release(permit, success=False)
+        self.assertEqual(limiter.metrics()["a"], {"limit": 1.4, "in_flight": 0})
+
+    def test_acquire_waits_for_release(self):
+        limiter = ConcurrencyLimiter(initial_limit=1)
+        permit = limiter.try_acquire("a", "m")
+        self.assertIsNone(limiter.acquire("a", "m", timeout=0.05))
+        threading.Timer(0.05, limiter.release, args=(permit,)).start()
+        start = time.monotonic()
+        self.assertIsNotNone(limiter.acquire("a", "m", timeout=2))
+        self.assertLess(time.monotonic() - start, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,34 @@
+import unittest
+import sys
+from pathlib import Path
+
+# 导入上下文长度过滤
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.context_length import estimate_tokens, required_length, fits, CONTEXT_IMAGE_TOKENS
+
+
+class TestContextLength(unittest.TestCase):
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens(None, images=0), 0)
+        self.assertEqual(estimate_tokens("a" * 400), 101)
+        # 中文按每字一个token
+        self.assertEqual(estimate_tokens("你好" * 100), 201)
+        self.assertEqual(estimate_tokens("a" * 400, images=1), 101 + CONTEXT_IMAGE_TOKENS)
+
+    def test_required_length(self):
+        self.assertIsNone(required_length(None, 100))
+        self.assertEqual(required_length(1000), 1000)
+        self.assertEqual(required_length(1000, 500), 1500)
+
+    def test_fits(self):
+        self.assertTrue(fits(None, 10 ** 9))
+        self.assertTrue(fits(32000, None))
+        self.assertTrue(fits(32000, 30000))
+        self.assertFalse(fits(32000, 31000))
+        self.assertFalse(fits(32000, 40000, ratio=1))
+
+
+if __name__ == "__main__":
+    unittest.main()
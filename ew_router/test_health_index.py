@@ -0,0 +1,75 @@
+import unittest
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# 导入健康检查索引
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.health_index import HealthIndex, HealthIndexCache
+
+
+class TestHealthIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.healthy = {"data": {
+            ("a", "m1"): [1.0, None, 3.0, 5.0],
+            ("b", "m1"): [],
+            ("a", "m2"): [np.nan, np.nan],
+        }}
+        self.index = HealthIndex(self.healthy, recent_size=2)
+
+    def test_sources_by_model(self):
+        """按模型查找各源的数据, 保持原始顺序"""
+        self.assertEqual(list(self.index.sources("m1")), ["a", "b"])
+        self.assertEqual(self.index.sources("unknown"), {})
+
+    def test_aggregates(self):
+        """预先计算近期均值, 整体均值和成功率, 失败记为NaN"""
+        stats = self.index.sources("m1")["a"]
+        self.assertAlmostEqual(stats.recent_mean, 4.0)
+        self.assertAlmostEqual(stats.mean, 3.0)
+        self.assertAlmostEqual(stats.success_rate, 0.75)
+
+        failed = self.index.sources("m2")["a"]
+        self.assertTrue(np.isnan(failed.recent_mean))
+        self.assertEqual(failed.success_rate, 0.0)
+
+        empty = self.index.sources("m1")["b"]
+        self.assertTrue(np.isnan(empty.success_rate))
+
+    def test_dense_windows(self):
+        """窗口右对齐存放在稠密数组中, 较短窗口左侧填充NaN"""
+        self.assertEqual(self.index.windows.shape, (2, 2, 4))
+        self.assertEqual(self.index.lengths.tolist(), [[4, 2], [0, 0]])
+        self.assertEqual(self.index.exists.tolist(), [[True, True], [True, False]])
+        np.testing.assert_array_equal(self.index.sources("m2")["a"].window, [np.nan, np.nan])
+
+    def test_has_data(self):
+        self.assertTrue(self.index.has_data("m1"))
+        self.assertTrue(self.index.has_data("m2"))
+        self.assertFalse(self.index.has_data("unknown"))
+        self.assertFalse(HealthIndex({"data": {("b", "m3"): []}}, 2).has_data("m3"))
+
+    def test_derived(self):
+        """派生数据只计算一次"""
+        calls = []
+        factory = lambda index: calls.append(index) or len(calls)
+        self.assertEqual(self.index.derived("x", factory), 1)
+        self.assertEqual(self.index.derived("x", factory), 1)
+        self.assertEqual(len(calls), 1)
+
+    def test_cache_by_version(self):
+        """同一快照版本复用索引, 显式传入的数据不缓存"""
+        cache = HealthIndexCache(recent_size=2)
+        self.assertIs(cache.get(1, self.healthy), cache.get(1, self.healthy))
+        self.assertIsNot(cache.get(1, self.healthy), cache.get(2, self.healthy))
+        self.assertIsNot(cache.get(None, self.healthy), cache.get(None, self.healthy))
+        # 旧版本的索引不替换缓存中的新版本
+        latest = cache.get(2, self.healthy)
+        self.assertIsNot(cache.get(1, self.healthy), latest)
+        self.assertIs(cache.get(2, self.healthy), latest)
+
+
+if __name__ == "__main__":
+    unittest.main()
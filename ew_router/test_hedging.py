@@ -0,0 +1,41 @@
+import unittest
+import sys
+from collections import namedtuple
+from pathlib import Path
+
+# 导入对冲工具
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.hedging import HedgeBudget, hedge_delay, split_lanes
+from ew_router.passive_stats import PassiveStat
+
+Attempt = namedtuple("Attempt", ["label", "source_name"])
+
+
+class TestHedging(unittest.TestCase):
+
+    def test_budget(self):
+        """令牌耗尽后不再对冲, 每个请求补充ratio个令牌"""
+        budget = HedgeBudget(ratio=0.5, burst=1)
+        self.assertTrue(budget.try_acquire())
+        self.assertFalse(budget.try_acquire())
+        budget.deposit()
+        self.assertFalse(budget.try_acquire())
+        budget.deposit()
+        self.assertTrue(budget.try_acquire())
+        for _ in range(10):
+            budget.deposit()
+        self.assertEqual(budget.tokens, 1)
+
+    def test_delay(self):
+        self.assertEqual(hedge_delay(None, default=10, minimum=0.5), 10)
+        self.assertEqual(hedge_delay(PassiveStat(1.0, 2.5, 0.0, 5), default=10, minimum=0.5), 2.5)
+        self.assertEqual(hedge_delay(PassiveStat(0.1, 0.2, 0.0, 5), default=10, minimum=0.5), 0.5)
+
+    def test_split_lanes(self):
+        attempts = [Attempt("Primary", "a"), Attempt("Fallback", "a"), Attempt("Primary", "b")]
+        self.assertEqual(split_lanes(attempts), [attempts[:2], attempts[2:]])
+        self.assertEqual(len(split_lanes(attempts[:2])), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
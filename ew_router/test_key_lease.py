@@ -0,0 +1,84 @@
+import unittest
+import sys
+from pathlib import Path
+
+# 导入密钥租约缓存
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.key_lease import KeyLeaseCache
+from ew_router.testing import FakeClock
+
+
+class TestKeyLeaseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.leases = KeyLeaseCache(ttl=60, clock=self.clock)
+
+    def test_lease_expires(self):
+        self.assertIsNone(self.leases.keys("a"))
+        self.leases.store("a", ["k1", "k2"], epoch=3)
+        self.assertEqual(self.leases.keys("a"), ["k1", "k2"])
+        self.clock.now = 60
+        self.assertIsNone(self.leases.keys("a"))
+        self.leases.store("a", [])
+        self.assertIsNone(self.leases.keys("a"))
+        self.assertFalse(KeyLeaseCache(ttl=0).enabled)
+
+    def test_epoch(self):
+        """本地序号只在首次租用时采用租约的序号, 之后只由吊销同步推进"""
+        self.assertFalse(self.leases.is_stale(None))
+        self.leases.store("a", ["k1"], epoch=3)
+        self.leases.store("b", ["k2"], epoch=5)
+        self.assertEqual(self.leases.epoch, 3)
+        self.assertFalse(self.leases.is_stale(3))
+        self.assertTrue(self.leases.is_stale(4))
+        # 还没有租约时直接采用服务端的序号
+        fresh = KeyLeaseCache(clock=self.clock)
+        self.assertFalse(fresh.is_stale(7))
+        self.assertEqual(fresh.epoch, 7)
+
+    def test_server_restart_resets_epoch(self):
+        """密钥管理服务重启后序号变小, 放弃重启前的租约并采用新的序号"""
+        self.leases.store("a", ["k1"], epoch=5)
+        self.assertFalse(self.leases.is_stale(0))
+        self.assertIsNone(self.leases.keys("a"))
+        self.assertEqual(self.leases.epoch, 0)
+        self.assertTrue(self.leases.is_stale(1))
+        # 租约中的序号比本地小时同样放弃其他租约
+        self.leases.revoke({}, epoch=5)
+        self.leases.store("a", ["k1"], epoch=5)
+        self.leases.store("b", ["k2"], epoch=2)
+        self.assertIsNone(self.leases.keys("a"))
+        self.assertEqual(self.leases.epoch, 2)
+
+    def test_unsupported(self):
+        self.leases.mark_unsupported()
+        self.assertFalse(self.leases.enabled)
+        self.clock.now = 60
+        self.assertTrue(self.leases.enabled)
+
+    def test_revoke(self):
+        self.leases.store("a", ["k1", "k2"], epoch=0)
+        self.leases.store("b", ["k3"], epoch=0)
+        self.leases.revoke({"a": ["k1"], "b": ["k3"], "c": ["k4"]}, epoch=2)
+        self.assertEqual(self.leases.keys("a"), ["k2"])
+        self.assertIsNone(self.leases.keys("b"))
+        self.assertEqual(self.leases.epoch, 2)
+        self.leases.clear(epoch=5)
+        self.assertIsNone(self.leases.keys("a"))
+        self.assertEqual(self.leases.epoch, 5)
+
+    def test_picks(self):
+        """选取次数取出后清零, 上报失败时放回并与之后的选取合并"""
+        self.leases.record_pick("a", "k1")
+        self.leases.record_pick("a", "k1")
+        picks = self.leases.drain_picks()
+        self.assertEqual(picks, {"a": {"k1": 2}})
+        self.assertEqual(self.leases.drain_picks(), {})
+        self.leases.record_pick("a", "k2")
+        self.leases.restore_picks(picks)
+        self.assertEqual(self.leases.drain_picks(), {"a": {"k1": 2, "k2": 1}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+import sys
+import random
+from pathlib import Path
+
+# 导入负载分散
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.load_spread import comparable_prefix, pick_least_loaded, spread_route
+
+
+LATENCY = {"a": 1.0, "b": 1.2, "c": 5.0, "d": 1.1}
+
+
+class TestLoadSpread(unittest.TestCase):
+
+    def test_comparable_prefix(self):
+        """只保留前top_k中耗时与第一名相近的候选"""
+        self.assertEqual(comparable_prefix(["a", "b", "c", "d"], LATENCY.get, top_k=3), ["a", "b"])
+        self.assertEqual(comparable_prefix(["a", "b", "c", "d"], LATENCY.get, top_k=4), ["a", "b", "d"])
+        self.assertEqual(comparable_prefix(["x", "a"], LATENCY.get), ["x"])
+
+    def test_least_outstanding(self):
+        in_flight = {"a": 3, "b": 1, "d": 1}.get
+        self.assertEqual(pick_least_loaded(["a", "b", "d"], in_flight, "least_outstanding"), "b")
+        self.assertEqual(pick_least_loaded(["a", "b", "d"], in_flight, "none"), "a")
+
+    def test_p2c_prefers_less_loaded(self):
+        rng = random.Random(0)
+        in_flight = {"a": 5, "b": 0}.get
+        for _ in range(20):
+            self.assertEqual(pick_least_loaded(["a", "b"], in_flight, "p2c", rng), "b")
+        # 负载相同时保持原有排名
+        for _ in range(20):
+            self.assertEqual(pick_least_loaded(["a", "b", "d"], lambda s: 0, "p2c", rng), "a")
+
+    def test_spread_route(self):
+        in_flight = {"a": 2, "b": 0, "c": 0}.get
+        route = spread_route(("a", "b", "c"), LATENCY.get, in_flight, "least_outstanding")
+        self.assertEqual(route, ["b", "a", "c"])
+        idle = spread_route(("a", "b", "c"), LATENCY.get, lambda s: 0, "least_outstanding")
+        self.assertEqual(idle, ["a", "b", "c"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import sys
+import random
+from pathlib import Path
+
+# 导入帕累托前沿
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.pareto import pareto_front
+
+
+def brute_force(points):
+    return [i for i, p in enumerate(points)
+            if not any(q != p and all(a <= b for a, b in zip(q, p)) for q in points)]
+
+
+class TestParetoFront(unittest.TestCase):
+
+    def test_three_objectives(self):
+        """只在两个维度上被支配的点仍在三维前沿中"""
+        points = [
+            (1.0, 10.0, -0.9),  # 最快
+            (2.0, 1.0, -0.9),   # 最便宜
+            (3.0, 5.0, -1.0),   # 最稳定
+            (3.0, 10.0, -0.9),  # 被第一个支配
+        ]
+        self.assertEqual(pareto_front(points), [0, 1, 2])
+
+    def test_duplicates(self):
+        """完全相同的点互不支配"""
+        self.assertEqual(pareto_front([(1, 1, 1), (1, 1, 1), (2, 2, 2)]), [0, 1])
+        self.assertEqual(pareto_front([]), [])
+
+    def test_matches_brute_force(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            points = [tuple(rng.randint(0, 4) for _ in range(3)) for _ in range(rng.randint(0, 25))]
+            self.assertEqual(pareto_front(points), brute_force(points))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import sys
+from pathlib import Path
+
+# 导入被动统计
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.passive_stats import PassiveStats, PassiveStat, blend_route
+from ew_router.testing import FakeClock
+
+
+class TestPassiveStats(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.stats = PassiveStats(half_life=10, min_samples=2, clock=self.clock)
+
+    def test_latency_and_error_rate(self):
+        self.stats.record("a", "m", 1.0, True)
+        self.assertIsNone(self.stats.get("a", "m"))  # 样本不足
+        self.stats.record("a", "m", 3.0, True)
+        self.stats.record("a", "m", 30.0, False)
+        self.stats.record("a", "m", 30.0, False)
+        stat = self.stats.get("a", "m")
+        self.assertAlmostEqual(stat.latency, 2.0)
+        self.assertAlmostEqual(stat.tail_latency, 2.0 + 1.2816)
+        self.assertAlmostEqual(stat.error_rate, 0.5)
+        self.assertIsNone(self.stats.get("b", "m"))
+
+    def test_sketch(self):
+        """成功请求的耗时记入草图, 样本不足时返回None, 返回的是副本"""
+        self.stats.record("a", "m", 1.0, True)
+        self.assertIsNone(self.stats.sketch("a", "m"))
+        self.stats.record("a", "m", 2.0, False)
+        self.assertIsNone(self.stats.sketch("a", "m"))
+        self.stats.record("a", "m", 3.0, True)
+        sketch = self.stats.sketch("a", "m")
+        self.assertEqual(sketch.count, 2)
+        sketch.add(5.0)
+        self.assertEqual(self.stats.sketch("a", "m").count, 2)
+
+    def test_decay(self):
+        """旧样本的权重按半衰期衰减, 长时间无请求后统计失效"""
+        for _ in range(4):
+            self.stats.record("a", "m", 1.0, False)
+        self.clock.now = 10
+        for _ in range(4):
+            self.stats.record("a", "m", 1.0, True)
+        stat = self.stats.get("a", "m")
+        self.assertAlmostEqual(stat.error_rate, 2 / 6)
+        self.clock.now = 100
+        self.assertIsNone(self.stats.get("a", "m"))
+
+
+class TestBlendRoute(unittest.TestCase):
+
+    def test_demotes_failing_and_slow_sources(self):
+        stats = {
+            "a": PassiveStat(10.0, 12.0, 0.0, 5),
+            "b": PassiveStat(1.0, 2.0, 0.9, 5),
+            "c": PassiveStat(2.0, 3.0, 0.0, 5),
+        }
+        route = ("a", "b", "c", "d")
+        self.assertEqual(blend_route(route, stats.get, "fast_first"), ["c", "d", "a", "b"])
+        self.assertEqual(blend_route(route, stats.get, "cheap_first"), ["a", "c", "d", "b"])
+        self.assertEqual(blend_route(route, lambda s: None, "fast_first"), list(route))
+
+
+if __name__ == "__main__":
+    unittest.main()
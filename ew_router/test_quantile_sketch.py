@@ -0,0 +1,73 @@
+import unittest
+import sys
+import random
+from pathlib import Path
+
+# 导入分位数草图
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.quantile_sketch import QuantileSketch, merged_quantile
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def assertRelativelyClose(self, estimate, expected, accuracy):
+        self.assertLessEqual(abs(estimate - expected), expected * accuracy + 1e-9)
+
+    def test_relative_accuracy(self):
+        rng = random.Random(0)
+        values = sorted(rng.lognormvariate(0, 1) for _ in range(5000))
+        sketch = QuantileSketch(relative_accuracy=0.02)
+        for value in values:
+            sketch.add(value)
+        for q in (0.5, 0.95, 0.99):
+            self.assertRelativelyClose(sketch.quantile(q), values[int(q * (len(values) - 1))], 0.02)
+
+    def test_empty_and_invalid_values(self):
+        sketch = QuantileSketch()
+        self.assertIsNone(sketch.quantile(0.5))
+        sketch.add(None)
+        sketch.add(float("nan"))
+        self.assertEqual(sketch.count, 0)
+
+    def test_outlier_does_not_move_median(self):
+        sketch = QuantileSketch()
+        for _ in range(9):
+            sketch.add(1.0)
+        sketch.add(100.0)
+        self.assertRelativelyClose(sketch.quantile(0.5), 1.0, 0.02)
+        self.assertRelativelyClose(sketch.quantile(1.0), 100.0, 0.02)
+
+    def test_merge_and_round_trip(self):
+        a, b = QuantileSketch(), QuantileSketch()
+        for i in range(1, 101):
+            (a if i % 2 else b).add(i / 10)
+        restored = QuantileSketch.from_dict(a.to_dict())
+        self.assertEqual(restored.quantile(0.9), a.quantile(0.9))
+        self.assertRelativelyClose(merged_quantile([a, None, b], 0.5), 5.0, 0.05)
+        self.assertIsNone(merged_quantile([None, QuantileSketch()], 0.5))
+        with self.assertRaises(ValueError):
+            a.merge(QuantileSketch(relative_accuracy=0.05))
+        with self.assertRaises(ValueError):
+            QuantileSketch.from_dict({"counts": [1]})
+
+    def test_bins_are_bounded(self):
+        """桶数超过上限时合并最小的桶, 尾部分位数不受影响"""
+        sketch = QuantileSketch(max_bins=16)
+        for i in range(1, 1001):
+            sketch.add(i / 100)
+        self.assertLessEqual(len(sketch.bins), 16)
+        self.assertRelativelyClose(sketch.quantile(0.99), 9.9, 0.02)
+
+    def test_decay(self):
+        sketch = QuantileSketch()
+        for _ in range(10):
+            sketch.add(1.0)
+        sketch.decay(0.5)
+        self.assertAlmostEqual(sketch.count, 5.0)
+        for _ in range(10):
+            sketch.add(3.0)
+        self.assertRelativelyClose(sketch.quantile(0.5), 3.0, 0.02)
+
+
+if __name__ == "__main__":
+    unittest.main()
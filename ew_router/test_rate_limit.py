@@ -0,0 +1,63 @@
+import unittest
+import sys
+from pathlib import Path
+
+# 导入限流器
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.rate_limit import KeyRateLimiter, TokenBucket
+from ew_router.testing import FakeClock
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_refill(self):
+        bucket = TokenBucket(60, now=0)
+        bucket.take(60, now=0)
+        self.assertAlmostEqual(bucket.wait_time(1, now=0), 1.0)
+        self.assertEqual(bucket.wait_time(1, now=1), 0)
+        # 不超过容量
+        self.assertAlmostEqual(bucket.wait_time(61, now=1000), 1.0)
+
+
+class TestKeyRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        pools = {"src": {
+            "acc1": [{"api_key": "k1", "rpm": 2}, {"api_key": "k2", "tpm": 100}],
+            "acc2": [{"api_key": "k3"}],
+        }}
+        self.limiter = KeyRateLimiter(pools, {"src": {"acc2": {"rpm": 1}}}, clock=self.clock)
+
+    def test_rpm_per_key(self):
+        self.assertEqual(self.limiter.pick("src", ["k1"]), "k1")
+        self.assertEqual(self.limiter.pick("src", ["k1"]), "k1")
+        self.assertFalse(self.limiter.has_capacity("src", "k1"))
+        self.assertAlmostEqual(self.limiter.wait_time("src", "k1"), 30)
+        self.clock.now = 30
+        self.assertTrue(self.limiter.has_capacity("src", "k1"))
+
+    def test_tpm_charged_after_request(self):
+        self.limiter.acquire("src", "k2")
+        self.assertTrue(self.limiter.has_capacity("src", "k2"))
+        self.limiter.charge_tokens("src", "k2", 150)
+        self.assertFalse(self.limiter.has_capacity("src", "k2"))
+        self.assertEqual(self.limiter.pick("src", ["k2", "k1"]), "k1")
+
+    def test_account_limit_and_unknown_keys(self):
+        self.limiter.acquire("src", "k3")
+        self.assertFalse(self.limiter.has_capacity("src", "k3"))
+        self.assertTrue(self.limiter.has_capacity("src", "unknown"))
+        # 都没有余量时选择最快恢复的
+        self.limiter.pick("src", ["k1"])
+        self.limiter.pick("src", ["k1"])
+        self.assertEqual(self.limiter.pick("src", ["k3", "k1"]), "k1")
+        self.assertIsNone(self.limiter.pick("src", []))
+
+    def test_metrics(self):
+        self.limiter.acquire("src", "k1")
+        self.assertEqual(self.limiter.metrics()["src|k1"], {"rpm": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import sys
+import random
+from pathlib import Path
+
+# 导入重试策略
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.retry_policy import RetryPolicy, classify_error, status_code_of, INVALID, ACCOUNT, THROTTLED, PROVIDER, UNKNOWN
+from ew_router.hedging import HedgeBudget
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.response = _Response(status_code)
+
+
+class ReadTimeout(Exception):
+    pass
+
+
+class TestClassify(unittest.TestCase):
+
+    def test_status_code(self):
+        self.assertEqual(status_code_of(HTTPError(503)), 503)
+        self.assertEqual(status_code_of(Exception("400 Client Error: Bad Request for url: x")), 400)
+        self.assertEqual(status_code_of(Exception("Error code: 429 - {'error': ...}")), 429)
+        self.assertIsNone(status_code_of(Exception("boom")))
+
+    def test_classes(self):
+        self.assertEqual(classify_error(HTTPError(400)), INVALID)
+        self.assertEqual(classify_error(Exception("This model's maximum context length is 8192 tokens")), INVALID)
+        self.assertEqual(classify_error(HTTPError(401)), ACCOUNT)
+        self.assertEqual(classify_error(Exception("insufficient balance")), ACCOUNT)
+        self.assertEqual(classify_error(HTTPError(429)), THROTTLED)
+        self.assertEqual(classify_error(Exception("Rate limit reached")), THROTTLED)
+        self.assertEqual(classify_error(HTTPError(502)), PROVIDER)
+        self.assertEqual(classify_error(ReadTimeout("read")), PROVIDER)
+        self.assertEqual(classify_error(TimeoutError()), PROVIDER)
+        self.assertEqual(classify_error(Exception("API响应格式异常")), UNKNOWN)
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(base=1, max_delay=3, budget=HedgeBudget(ratio=0.5, burst=2), rng=random.Random(0))
+
+    def test_backoff_is_jittered_and_capped(self):
+        delays = [self.policy.backoff(3) for _ in range(200)]
+        self.assertTrue(all(0 <= delay <= 3 for delay in delays))
+        self.assertGreater(len(set(delays)), 100)
+        self.assertTrue(all(self.policy.backoff(1) <= 1 for _ in range(50)))
+
+    def test_hopeless_errors_are_not_retried(self):
+        self.assertIsNone(self.policy.retry_delay([HTTPError(400), HTTPError(403)], 1))
+        self.assertIsNotNone(self.policy.retry_delay([HTTPError(400), HTTPError(503)], 1))
+
+    def test_deadline_and_budget(self):
+        self.assertIsNone(self.policy.retry_delay([HTTPError(503)], 1, remaining=0))
+        # 预算初始为2个令牌, 每轮重试消耗一个
+        self.assertIsNotNone(self.policy.retry_delay([HTTPError(503)], 1))
+        self.assertIsNotNone(self.policy.retry_delay([HTTPError(503)], 1))
+        self.assertIsNone(self.policy.retry_delay([HTTPError(503)], 1))
+        self.policy.deposit()
+        self.policy.deposit()
+        self.assertIsNotNone(self.policy.retry_delay([HTTPError(503)], 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import sys
+from pathlib import Path
+
+# 导入路由表
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.routing_table import RoutingTable
+
+
+class TestRoutingTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RoutingTable(buckets=20)
+
+    def test_bucket(self):
+        """比例按输入占比分桶, 同比例的不同写法落在同一个桶"""
+        self.assertEqual(self.table.bucket(60, 40), (12, 12, 8))
+        self.assertEqual(self.table.bucket(3, 2), (12, 12, 8))
+        self.assertEqual(self.table.bucket(100, 0), (20, 20, 0))
+        self.assertEqual(self.table.bucket(0, 0), (10, 10, 10))
+
+    def test_route_is_built_once_per_version(self):
+        """同一快照版本下每个键只计算一次, 版本变化后重新计算"""
+        calls = []
+
+        def build():
+            calls.append(1)
+            return ("a", "b")
+
+        key = ("model", "fast_first", 12)
+        self.assertEqual(self.table.get(1, key, build), ("a", "b"))
+        self.assertEqual(self.table.get(1, key, build), ("a", "b"))
+        self.assertEqual(len(calls), 1)
+        self.table.get(2, key, build)
+        self.assertEqual(len(calls), 2)
+
+    def test_older_version_does_not_clear_table(self):
+        """持有旧快照的调用方照常计算路由, 但不缓存, 也不清空新版本的路由表"""
+        calls = []
+
+        def build():
+            calls.append(1)
+            return ("a", "b")
+
+        key = ("model", "fast_first", 12)
+        self.table.get(2, key, build)
+        self.assertEqual(self.table.get(1, key, lambda: ("c",)), ("c",))
+        self.assertEqual(self.table.get(1, key, lambda: ("c",)), ("c",))
+        self.assertEqual(self.table.get(2, key, build), ("a", "b"))
+        self.assertEqual(len(calls), 1)
+
+    def test_errors_are_not_cached(self):
+        """计算失败时不缓存, 下次重新计算"""
+        def build():
+            raise ValueError("no source")
+
+        with self.assertRaises(ValueError):
+            self.table.get(1, ("model", "fast_first", 12), build)
+        self.assertEqual(len(self.table), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
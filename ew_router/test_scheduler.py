@@ -0,0 +1,72 @@
+import unittest
+import sys
+import threading
+import time
+from pathlib import Path
+
+# 导入调度
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.scheduler import Ticket, capacity, priority_scope, get_priority
+from ew_router.concurrency import ConcurrencyLimiter
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_priority_scope(self):
+        self.assertEqual(get_priority(), "interactive")
+        with priority_scope("batch"):
+            self.assertEqual(get_priority(), "batch")
+            self.assertEqual(Ticket(("a",)).priority, "batch")
+        self.assertEqual(get_priority(), "interactive")
+        with self.assertRaises(ValueError):
+            with priority_scope("urgent"):
+                pass
+
+    def test_rank(self):
+        """类别优先, 类别内截止时间早的优先"""
+        batch = Ticket(("a",), "batch", deadline=1.0, now=0)
+        late = Ticket(("a",), "interactive", deadline=10.0, now=0)
+        early = Ticket(("a",), "interactive", deadline=5.0, now=0)
+        self.assertEqual(sorted([batch, late, early], key=lambda t: t.rank), [early, late, batch])
+
+    def test_batch_capacity(self):
+        self.assertEqual(capacity("interactive", 10), 10)
+        self.assertEqual(capacity("batch", 10, reserve=0.2), 8)
+        self.assertEqual(capacity("batch", 1, reserve=0.2), 1)
+
+
+class TestPriorityLimiter(unittest.TestCase):
+
+    def test_batch_leaves_reserve_for_interactive(self):
+        limiter = ConcurrencyLimiter(initial_limit=5)
+        batch = [limiter.try_acquire("a", "m", priority="batch") for _ in range(5)]
+        self.assertEqual(sum(permit is not None for permit in batch), 4)
+        self.assertIsNotNone(limiter.try_acquire("a", "m", priority="interactive"))
+
+    def test_waiters_served_by_priority_then_deadline(self):
+        limiter = ConcurrencyLimiter(initial_limit=1)
+        held = limiter.try_acquire("a", "m")
+        order = []
+
+        def wait(priority, deadline):
+            permit = limiter.acquire("a", "m", timeout=5, priority=priority, deadline=deadline)
+            order.append((priority, deadline))
+            time.sleep(0.02)
+            limiter.release(permit)
+
+        now = time.monotonic()
+        requests = [("batch", now + 1), ("interactive", now + 4), ("interactive", now + 2)]
+        threads = [threading.Thread(target=wait, args=request) for request in requests]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.02)
+        self.assertEqual(limiter.queued(), {"batch": 1, "interactive": 2})
+        limiter.release(held)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [requests[2], requests[1], requests[0]])
+        self.assertEqual(limiter.queued(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
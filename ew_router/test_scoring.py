@@ -0,0 +1,88 @@
+import unittest
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# 导入评分模块
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.health_index import HealthIndex
+from ew_router.scoring import ScoringEngine
+from ew_router.quantile_sketch import QuantileSketch
+
+
+PRICES = {
+    ("fast", "m"): (10.0, 10.0),
+    ("cheap", "m"): (1.0, 1.0),
+    ("mid", "m"): (2.0, 20.0),
+}
+
+
+class TestScoringEngine(unittest.TestCase):
+
+    def build(self, data, valid=lambda s, m: True):
+        index = HealthIndex({"data": data}, recent_size=2)
+        return ScoringEngine(index, valid, lambda s, m: PRICES.get((s, m)))
+
+    def test_fast_first_by_recent_latency(self):
+        """按近期平均耗时排序, 近期没有成功记录的源不参与排序"""
+        engine = self.build({
+            ("mid", "m"): [2.0, 2.0],
+            ("fast", "m"): [1.0, 1.0],
+            ("cheap", "m"): [1.0, np.nan, np.nan],
+        })
+        self.assertEqual(engine.rank("m", "fast_first", 50, 50), ("fast", "mid"))
+
+    def test_success_rate_fallback(self):
+        """所有源近期都失败时按整体成功率排序, 连成功率都没有时返回None"""
+        engine = self.build({
+            ("mid", "m"): [np.nan, np.nan],
+            ("fast", "m"): [1.0, np.nan, np.nan],
+            ("cheap", "m"): [],
+            ("fast", "n"): [],
+        })
+        self.assertEqual(engine.rank("m", "fast_first", 50, 50), ("fast", "mid"))
+        self.assertIsNone(engine.rank("n", "fast_first", 50, 50))
+        self.assertIsNone(engine.rank("unknown", "fast_first", 50, 50))
+
+    def test_cheap_first_weights_price_by_proportion(self):
+        """价格按输入输出比例加权后与预排名融合"""
+        engine = self.build({
+            ("fast", "m"): [1.0],
+            ("mid", "m"): [2.0],
+            ("cheap", "m"): [3.0],
+        })
+        self.assertEqual(engine.rank("m", "cheap_first", 100, 0), ("cheap", "mid", "fast"))
+        self.assertEqual(engine.rank("m", "cheap_first", 0, 100), ("fast", "cheap", "mid"))
+
+    def test_quantile_mode_ranks_by_sketch(self):
+        """分位数模式按草图的分位数排序, 没有草图的源退回近期平均耗时"""
+        steady, spiky = QuantileSketch(), QuantileSketch()
+        for _ in range(95):
+            steady.add(2.0)
+            spiky.add(1.0)
+        for _ in range(5):
+            steady.add(2.0)
+            spiky.add(30.0)
+        index = HealthIndex({
+            "data": {("fast", "m"): [1.0, 1.0], ("mid", "m"): [2.0, 2.0], ("cheap", "m"): [2.5, 2.5]},
+            "sketches": {("fast", "m"): spiky, ("mid", "m"): steady},
+        }, recent_size=2)
+        engine = ScoringEngine(index, lambda s, m: True, lambda s, m: PRICES.get((s, m)))
+        self.assertEqual(engine.rank("m", "fast_p50", 50, 50), ("fast", "mid", "cheap"))
+        self.assertEqual(engine.rank("m", "fast_p99", 50, 50), ("mid", "cheap", "fast"))
+
+    def test_invalid_sources_are_skipped(self):
+        """不支持该模型的源不出现在结果中, 全部不支持时返回None"""
+        engine = self.build({
+            ("fast", "m"): [1.0],
+            ("mid", "m"): [2.0],
+        }, valid=lambda s, m: s != "fast")
+        self.assertEqual(engine.rank("m", "fast_first", 50, 50), ("mid",))
+        self.assertEqual(engine.rank("m", "cheap_first", 50, 50), ("mid",))
+        engine = self.build({("fast", "m"): [1.0]}, valid=lambda s, m: False)
+        self.assertIsNone(engine.rank("m", "cheap_first", 50, 50))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+# 导入共享路由状态
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.shared_state import SharedState, SharedPassiveStats, SharedHealthSource, open_shared_state, fcntl
+
+
+def _record_many(path, count):
+    shared = SharedState(path, health_bytes=1024, slots=16)
+    for i in range(count):
+        shared.record_stat("a", "m", 1.0, i % 2 == 0, half_life=3600)
+
+
+class CountingRequest:
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        return {"data": {"a|m": [1.0]}, "calls": self.calls}
+
+
+@unittest.skipIf(fcntl is None, "当前平台没有fcntl")
+class TestSharedState(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "router.state")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def open(self):
+        return SharedState(self.path, health_bytes=1024, slots=16)
+
+    def test_disabled_without_path(self):
+        self.assertIsNone(open_shared_state(""))
+
+    def test_health_visible_to_other_mapping(self):
+        writer, reader = self.open(), self.open()
+        self.assertIsNone(reader.read_health())
+        self.assertTrue(writer.write_health(b'{"data": {}}'))
+        payload, written_at = reader.read_health()
+        self.assertEqual(payload, b'{"data": {}}')
+        self.assertLessEqual(written_at, time.time())
+        self.assertFalse(writer.write_health(b"x" * 2048))  # 超过容量
+
+    def test_layout_mismatch_refused(self):
+        """布局不一致时拒绝打开, 不截断其他进程正在映射的文件"""
+        shared = self.open()
+        shared.write_health(b"{}")
+        with self.assertRaises(ValueError):
+            SharedState(self.path, health_bytes=2048, slots=16)
+        self.assertIsNone(open_shared_state(self.path, health_bytes=16, slots=16))
+        self.assertEqual(os.path.getsize(self.path), shared.size)
+        self.assertEqual(shared.read_health()[0], b"{}")
+
+    def test_passive_stats_shared(self):
+        """一个进程记录的统计对另一个进程可见, 草图仍在进程内"""
+        a = SharedPassiveStats(self.open(), min_samples=2)
+        b = SharedPassiveStats(self.open(), min_samples=2)
+        a.record("a", "m", 1.0, True)
+        a.record("a", "m", 3.0, True)
+        b.record("a", "m", 30.0, False)
+        stat = b.get("a", "m")
+        self.assertAlmostEqual(stat.latency, 2.0, places=3)
+        self.assertAlmostEqual(stat.error_rate, 1 / 3, places=3)
+        self.assertIsNone(b.sketch("a", "m"))
+        self.assertIsNone(b.get("b", "m"))
+        b.clear()
+        self.assertIsNone(a.get("a", "m"))
+
+    def test_full_table_falls_back_to_local(self):
+        stats = SharedPassiveStats(SharedState(self.path, health_bytes=1024, slots=1), min_samples=0.5)
+        stats.record("a", "m", 1.0, True)
+        stats.record("b", "m", 2.0, True)
+        self.assertAlmostEqual(stats.get("b", "m").latency, 2.0)
+        self.assertEqual(stats.shared.metrics()["stat_slots"], 1)
+
+    def test_concurrent_processes(self):
+        """多个进程同时写入同一槽位不丢失计数"""
+        ctx = multiprocessing.get_context("fork")
+        procs = [ctx.Process(target=_record_many, args=(self.path, 200)) for _ in range(4)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        stat = self.open().read_stat("a", "m", half_life=3600)
+        self.assertAlmostEqual(stat.samples, 800, delta=0.5)
+        self.assertAlmostEqual(stat.error_rate, 0.5, places=2)
+
+    def test_single_refresh_across_mappings(self):
+        """有效期内其他进程直接读取共享数据, 不请求健康检查服务"""
+        request = CountingRequest()
+        first = SharedHealthSource(self.open(), request, ttl=60)
+        second = SharedHealthSource(self.open(), request, ttl=60)
+        self.assertEqual(first.fetch()["calls"], 1)
+        self.assertEqual(second.fetch()["calls"], 1)
+        self.assertEqual(asyncio.run(second.afetch())["calls"], 1)
+        self.assertEqual(request.calls, 1)
+
+    def test_failed_request_uses_retry_ttl(self):
+        shared = self.open()
+        source = SharedHealthSource(shared, lambda: None, parse=lambda raw: raw or {"data": {}}, ttl=60, retry_ttl=0.01)
+        source.fetch()
+        time.sleep(0.05)
+        self.assertIsNone(source._read_fresh())
+
+    def test_concurrent_threads_refresh_once(self):
+        request = CountingRequest(delay=0.1)
+        source = SharedHealthSource(self.open(), request, ttl=60)
+        threads = [threading.Thread(target=source.fetch) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(request.calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+import asyncio
+import unittest
+import sys
+import threading
+import time
+from pathlib import Path
+
+# 导入健康检查快照
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from ew_router.quantile_sketch import QuantileSketch
+from ew_router.snapshot import HealthSnapshotStore
+from ew_decorator.with_timeout import deadline_scope, remaining_time
+
+
+class CountingFetch:
+    """记录调用次数的健康检查数据源, 未指定data时每次返回的数据都不同"""
+
+    def __init__(self, delay=0.0, data=None):
+        self.calls = 0
+        self.delay = delay
+        self.data = data
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        time.sleep(self.delay)
+        data = {("source", "model"): [float(calls)]} if self.data is None else self.data
+        return {"timestamp": "2025-01-01T00:00:00", "check_timer_span": 15, "data": data}
+
+
+class TestHealthSnapshotStore(unittest.TestCase):
+
+    def test_snapshot_is_cached(self):
+        """有效期内多次获取只请求一次健康检查服务"""
+        fetch = CountingFetch()
+        store = HealthSnapshotStore(fetch, ttl=60, background=False)
+        s1 = store.get()
+        s2 = store.get()
+        self.assertIs(s1, s2)
+        self.assertEqual(fetch.calls, 1)
+
+    def test_stale_while_revalidate(self):
+        """快照过期后先返回旧快照, 后台刷新完成后返回新快照"""
+        fetch = CountingFetch(delay=0.1)
+        store = HealthSnapshotStore(fetch, ttl=0.05, max_stale=60, background=False)
+        first = store.get()
+        time.sleep(0.1)
+        start = time.monotonic()
+        stale = store.get()
+        self.assertIs(stale, first)
+        self.assertLess(time.monotonic() - start, 0.05)
+        time.sleep(0.3)
+        fresh = store.get()
+        self.assertGreater(fresh.version, first.version)
+
+    def test_too_stale_refreshes_synchronously(self):
+        """超过最长过期时间后同步刷新"""
+        fetch = CountingFetch()
+        store = HealthSnapshotStore(fetch, ttl=0.01, max_stale=0.01, background=False)
+        first = store.get()
+        time.sleep(0.05)
+        self.assertGreater(store.get().version, first.version)
+
+    def test_concurrent_first_load(self):
+        """多线程同时首次加载时只请求一次"""
+        fetch = CountingFetch(delay=0.1)
+        store = HealthSnapshotStore(fetch, ttl=60, background=False)
+        threads = [threading.Thread(target=store.get) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(fetch.calls, 1)
+
+    def test_empty_data_uses_retry_ttl(self):
+        """健康检查服务不可用时较早重试"""
+        fetch = CountingFetch(data={})
+        store = HealthSnapshotStore(fetch, ttl=60, max_stale=0, retry_ttl=0.01, background=False)
+        store.get()
+        time.sleep(0.05)
+        store.get()
+        self.assertEqual(fetch.calls, 2)
+
+    def test_empty_data_keeps_snapshot(self):
+        """健康检查服务不可用时保留已有的快照, 服务恢复后换用新数据"""
+        fetch = CountingFetch()
+        store = HealthSnapshotStore(fetch, ttl=0.01, max_stale=0, retry_ttl=0.01, background=False)
+        first = store.get()
+        fetch.data = {}
+        time.sleep(0.05)
+        self.assertIs(store.get(), first)
+        time.sleep(0.05)
+        store.get()
+        self.assertEqual(fetch.calls, 3)
+        fetch.data = {("source", "model"): [2.0]}
+        time.sleep(0.05)
+        self.assertGreater(store.get().version, first.version)
+
+    def test_unchanged_data_keeps_version(self):
+        """刷新取到相同的数据时version不变, 依赖version的缓存不会被丢弃"""
+        fetch = CountingFetch(data={("source", "model"): [1.0]})
+        store = HealthSnapshotStore(fetch, ttl=0.01, max_stale=0, background=False)
+        first = store.get()
+        time.sleep(0.05)
+        self.assertEqual(store.get().version, first.version)
+        fetch.data = {("source", "model"): [2.0]}
+        time.sleep(0.05)
+        self.assertGreater(store.get().version, first.version)
+
+    def test_timestamp_only_change_keeps_version(self):
+        """每次响应的timestamp都不同, 草图每次解析为新对象, 这些都不算数据变化"""
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            sketch = QuantileSketch()
+            sketch.add(1.5)
+            return {"timestamp": f"2025-01-01T00:{len(calls):02d}:00", "check_timer_span": 15,
+                    "data": {("source", "model"): [1.0, float("nan")]}, "sketches": {("source", "model"): sketch}}
+
+        store = HealthSnapshotStore(fetch, ttl=0.01, max_stale=0, background=False)
+        first = store.get()
+        time.sleep(0.05)
+        second = store.get()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(second.version, first.version)
+        self.assertEqual(second.healthy["timestamp"], "2025-01-01T00:02:00")
+
+    def test_async_first_load(self):
+        """协程中首次加载使用异步数据源"""
+        fetch = CountingFetch()
+
+        async def afetch():
+            return {"data": {}, "async": True}
+
+        store = HealthSnapshotStore(fetch, afetch=afetch, ttl=60, background=False)
+        snapshot = asyncio.run(store.aget())
+        self.assertTrue(snapshot.healthy["async"])
+        self.assertEqual(fetch.calls, 0)
+
+    def test_async_single_flight(self):
+        """协程中并发的首次加载只请求一次"""
+        calls = []
+
+        async def afetch():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return {"data": {("source", "model"): [1.0]}}
+
+        async def main():
+            return await asyncio.gather(*(store.aget() for _ in range(8)))
+
+        store = HealthSnapshotStore(CountingFetch(), afetch=afetch, ttl=60, background=False)
+        snapshots = asyncio.run(main())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len({id(snapshot) for snapshot in snapshots}), 1)
+
+    def test_async_load_not_blocked_by_sync_refresh(self):
+        """其他线程同步刷新期间, 协程中的加载不等待其完成"""
+        fetch = CountingFetch(delay=0.5)
+
+        async def afetch():
+            return {"data": {("source", "model"): [1.0]}}
+
+        store = HealthSnapshotStore(fetch, afetch=afetch, ttl=60, background=False)
+        thread = threading.Thread(target=store.get)
+        thread.start()
+        time.sleep(0.05)
+        start = time.monotonic()
+        asyncio.run(store.aget())
+        self.assertLess(time.monotonic() - start, 0.25)
+        thread.join()
+
+    def test_refresh_ignores_caller_deadline(self):
+        """刷新结果由所有调用方共享, 不受触发刷新的调用方的截止时间约束"""
+        seen = []
+
+        def fetch():
+            seen.append(remaining_time())
+            return {"data": {("source", "model"): [1.0]}}
+
+        async def afetch():
+            return fetch()
+
+        async def aget(store):
+            with deadline_scope(0.01):
+                return await store.aget()
+
+        with deadline_scope(0.01):
+            HealthSnapshotStore(fetch, ttl=60, background=False).get()
+        asyncio.run(aget(HealthSnapshotStore(fetch, afetch=afetch, ttl=60, background=False)))
+        self.assertEqual(seen, [None, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
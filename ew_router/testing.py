@@ -0,0 +1,11 @@
+"""ew_router单元测试共用的辅助工具."""
+
+
+class FakeClock:
+    """可手动推进的时钟, 代替time.monotonic传给带clock参数的组件"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
@@ -18,6 +18,7 @@ setup(
         "python-multipart>=0.0.6",
         "requests>=2.28.0",
         "openai>=1.0.0",
+        "httpx>=0.24.0",
         "sqlalchemy>=2.0.0",
         "pymysql>=1.0.0",
         "cryptography>=39.0.0",
@@ -0,0 +1,464 @@
+import asyncio
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import LLMwrapper
+import LoadBalancing
+from LLMwrapper import LLM_Wrapper, Attempt
+from ew_router.bandit import BanditArms
+from ew_router.circuit_breaker import CircuitBreakerRegistry
+from ew_router.concurrency import ConcurrencyLimiter
+from ew_router.hedging import HedgeBudget, HedgeCancelled
+from ew_router.key_lease import KeyLeaseCache
+from ew_router.passive_stats import PassiveStats
+from ew_router.rate_limit import KeyRateLimiter
+from ew_router.retry_policy import RetryPolicy
+from ew_decorator.with_timeout import call_at_deadline, deadline_scope
+
+
+class FakeInfra:
+    """按顺序返回预设结果的传输层, 结果为异常时抛出; usage为服务商返回的token用量"""
+
+    def __init__(self, *outcomes, delay=0.0, usage=None):
+        self.outcomes = list(outcomes)
+        self.delay = delay
+        self.usage = usage or {}
+        self.calls = 0
+        self.threads = []
+
+    def _next(self):
+        self.calls += 1
+        self.threads.append(threading.current_thread())
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return {"content": outcome, **self.usage}
+
+    def get_response(self, messages, tools, model, timeout=None, additional_params=None):
+        time.sleep(self.delay)
+        return self._next()
+
+    async def aget_response(self, messages, tools, model, timeout=None, additional_params=None):
+        await asyncio.sleep(self.delay)
+        return self._next()
+
+
+class StreamInfra:
+    """逐个产出预设token的流式传输层"""
+
+    def __init__(self, *tokens):
+        self.tokens = tokens
+
+    def stream_response(self, messages, tools, model, timeout=None, additional_params=None):
+        yield from self.tokens
+
+    async def astream_response(self, messages, tools, model, timeout=None, additional_params=None):
+        for token in self.tokens:
+            yield token
+
+
+class BlockingInfra:
+    """阻塞到连接被断开的传输层, 像OpenaiInfra一样通过call_at_deadline登记断开回调"""
+
+    def __init__(self):
+        self.aborted = threading.Event()
+        self.returned = threading.Event()
+
+    def get_response(self, messages, tools, model, timeout=None, additional_params=None):
+        try:
+            with call_at_deadline(self.aborted.set):
+                self.aborted.wait(5)
+            raise ConnectionError("Connection aborted")
+        finally:
+            self.returned.set()
+
+
+def returning(value):
+    """返回value的协程函数"""
+    async def coroutine(*args, **kwargs):
+        return value
+    return coroutine
+
+
+def attempts_for(main, backup):
+    return [
+        Attempt("Main", main, [], "srcA", "m", "key-a"),
+        Attempt("Backup", backup, [], "srcB", "m", "key-b"),
+    ]
+
+
+class WrapperTestCase(unittest.TestCase):
+    """每个用例使用全新的熔断器、并发限制、被动统计和重试策略"""
+
+    def setUp(self):
+        self.fresh()
+
+    def fresh(self):
+        """换用全新的路由组件, 同一用例内分别测试同步和异步版本时调用"""
+        self.breakers = CircuitBreakerRegistry()
+        self.limiter = ConcurrencyLimiter()
+        self.stats = PassiveStats()
+        self.arms = BanditArms()
+        self.policy = RetryPolicy(base=0.01, budget=HedgeBudget(1, 100))
+        patches = [
+            mock.patch.object(LLMwrapper, "circuit_breakers", self.breakers),
+            mock.patch.object(LLMwrapper, "concurrency_limiter", self.limiter),
+            mock.patch.object(LLMwrapper, "passive_stats", self.stats),
+            mock.patch.object(LLMwrapper, "bandit_arms", self.arms),
+            mock.patch.object(LLM_Wrapper, "retry_policy", self.policy),
+            mock.patch.object(LLMwrapper, "hedge_budget", HedgeBudget(1, 10)),
+            mock.patch("builtins.print"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_failover(self, attempts, is_async=False, **kwargs):
+        if is_async:
+            return asyncio.run(LLM_Wrapper._arun_with_failover(attempts, [], 5, {}, **kwargs))
+        return LLM_Wrapper._run_with_failover(attempts, [], 5, {}, **kwargs)
+
+    def modes(self):
+        """依次产出False(同步)和True(异步), 每次都使用全新的路由组件"""
+        for is_async in (False, True):
+            with self.subTest(is_async=is_async):
+                self.fresh()
+                yield is_async
+
+
+class TestHealthSignals(WrapperTestCase):
+
+    def test_invalid_request_does_not_hurt_source(self):
+        """请求本身无效的失败不计入熔断、并发上限、被动统计和adaptive后验"""
+        infra = FakeInfra(Exception("Error code: 400 - context_length_exceeded"))
+        for _ in range(5):
+            self.run_failover(attempts_for(infra, infra), max_retry=1)
+        self.assertEqual(self.breakers.metrics(), {})
+        self.assertEqual(self.limiter.metrics()["srcA"]["limit"], self.limiter.initial_limit)
+        self.assertIsNone(self.stats.get("srcA", "m"))
+        self.assertIsNone(self.arms._arms.get(("srcA", "m")))
+
+    def test_provider_failure_opens_circuit(self):
+        infra = FakeInfra(Exception("503 Server Error"))
+        for _ in range(5):
+            self.run_failover(attempts_for(infra, infra), max_retry=1)
+        self.assertEqual(self.breakers.metrics()["srcA|m"]["state"], "open")
+        self.assertLess(self.limiter.metrics()["srcA"]["limit"], self.limiter.initial_limit)
+        self.assertEqual(self.stats.get("srcA", "m").error_rate, 1.0)
+
+
+class TestFailover(WrapperTestCase):
+    """同步和异步两个版本的故障转移按同样的规则重试和换源"""
+
+    def test_retries_provider_errors(self):
+        for is_async in self.modes():
+            main = FakeInfra(Exception("503 Server Error"), Exception("503 Server Error"), "ok")
+            backup = FakeInfra(Exception("Read timed out"))
+            response, attempt, errors = self.run_failover(attempts_for(main, backup), is_async, max_retry=3)
+            self.assertEqual(response["content"], "ok")
+            self.assertEqual(attempt.label, "Main")
+            self.assertEqual(len(errors), 4)
+            self.assertEqual((main.calls, backup.calls), (3, 2))
+
+    def test_invalid_request_not_retried(self):
+        for is_async in self.modes():
+            infra = FakeInfra(Exception("400 Client Error: Bad Request"))
+            response, _, errors = self.run_failover(attempts_for(infra, infra), is_async, max_retry=3)
+            self.assertIsNone(response)
+            self.assertEqual(infra.calls, 2)
+            self.assertEqual(len(errors), 2)
+
+    def test_provider_error_skips_rest_of_source_in_round(self):
+        for is_async in self.modes():
+            main, backup = FakeInfra(Exception("502 Server Error")), FakeInfra("ok")
+            attempts = [Attempt("Main-url", main, [], "srcA", "m", "k"), Attempt("Main-b64", main, [], "srcA", "m", "k"),
+                        Attempt("Backup", backup, [], "srcB", "m", "k")]
+            _, attempt, _ = self.run_failover(attempts, is_async, max_retry=2)
+            self.assertEqual(attempt.label, "Backup")
+            self.assertEqual(main.calls, 1)
+
+    def test_account_error_drops_source(self):
+        for is_async in self.modes():
+            main = FakeInfra(Exception("401 Client Error: Unauthorized"))
+            backup = FakeInfra(Exception("503 Server Error"))
+            response, _, _ = self.run_failover(attempts_for(main, backup), is_async, max_retry=3)
+            self.assertIsNone(response)
+            self.assertEqual((main.calls, backup.calls), (1, 3))
+
+    def test_all_sources_dropped_stops_retrying(self):
+        for is_async in self.modes():
+            infra = FakeInfra(Exception("insufficient balance"))
+            self.run_failover(attempts_for(infra, infra), is_async, max_retry=3)
+            self.assertEqual(infra.calls, 2)
+
+    def test_retry_budget_exhausted(self):
+        for is_async in self.modes():
+            self.policy.budget = HedgeBudget(0, 1)
+            first, second = FakeInfra(Exception("503 Server Error")), FakeInfra(Exception("503 Server Error"))
+            self.run_failover(attempts_for(first, first), is_async, max_retry=3)
+            self.run_failover(attempts_for(second, second), is_async, max_retry=3)
+            # 第一次调用消耗唯一的令牌重试一轮, 第二次调用不再重试
+            self.assertEqual((first.calls, second.calls), (4, 2))
+
+
+class TestHedging(WrapperTestCase):
+
+    def test_backoff_does_not_replace_hedge_threshold(self):
+        """重试轮中仍按对冲阈值发出对冲请求, 而不是按退避时间"""
+        for is_async in self.modes():
+            main = FakeInfra(Exception("503 Server Error"), "main", delay=0.2)
+            backup = FakeInfra(Exception("503 Server Error"), "backup")
+            with mock.patch.object(LLM_Wrapper, "_hedge_delay", return_value=5):
+                response, attempt, errors = self.run_failover(attempts_for(main, backup), is_async, max_retry=2,
+                                                              hedge=True)
+            self.assertEqual(attempt.label, "Main")
+            self.assertEqual(backup.calls, 1)
+            self.assertFalse(any(isinstance(e, HedgeCancelled) for _, e in errors))
+
+    def test_loser_aborted(self):
+        """同步对冲中落败的请求被取消: 连接立即断开, 不计入源的健康信号"""
+        main, backup = BlockingInfra(), FakeInfra("backup")
+        with mock.patch.object(LLM_Wrapper, "_hedge_delay", return_value=0.05):
+            response, attempt, errors = self.run_failover(attempts_for(main, backup), max_retry=1, hedge=True)
+        self.assertEqual(attempt.label, "Backup")
+        self.assertTrue(main.returned.wait(1))
+        self.assertTrue(main.aborted.is_set())
+        self.assertIsInstance(errors[-1][1], HedgeCancelled)
+        time.sleep(0.05)
+        self.assertEqual(self.breakers.metrics(), {})
+        self.assertIsNone(self.stats.get("srcA", "m"))
+        self.assertEqual(self.limiter.metrics()["srcA"]["in_flight"], 0)
+
+    def test_budget_deposited_once_per_call(self):
+        for is_async in self.modes():
+            budget = HedgeBudget(1, 10)
+            budget._tokens = 0
+            infra = FakeInfra(Exception("503 Server Error"))
+            with mock.patch.object(LLMwrapper, "hedge_budget", budget):
+                self.run_failover(attempts_for(infra, infra), is_async, max_retry=3, hedge=True)
+            self.assertEqual(budget.tokens, 1)
+
+    def test_retry_budget_deposited_only_with_retries(self):
+        """和_run_with_failover一样, 只有允许重试时才为重试预算存入令牌"""
+        for is_async in self.modes():
+            infra = FakeInfra("ok")
+            with mock.patch.object(self.policy, "deposit") as deposit:
+                self.run_failover(attempts_for(infra, infra), is_async, max_retry=1, hedge=True)
+                deposit.assert_not_called()
+                self.run_failover(attempts_for(infra, infra), is_async, max_retry=2, hedge=True)
+                deposit.assert_called_once()
+
+    def test_main_lane_runs_in_caller_thread(self):
+        main, backup = FakeInfra("main", delay=0.2), FakeInfra("backup", delay=0.5)
+        with mock.patch.object(LLM_Wrapper, "_hedge_delay", return_value=0.05):
+            response, attempt, errors = self.run_failover(attempts_for(main, backup), max_retry=1, hedge=True)
+        self.assertEqual(attempt.label, "Main")
+        self.assertEqual(main.threads, [threading.current_thread()])
+        self.assertIsInstance(errors[-1][1], HedgeCancelled)
+
+    def test_saturated_pool_skips_hedge(self):
+        """线程池已满时不对冲, 主源照常执行, 不消耗对冲预算"""
+        main, backup = FakeInfra("main", delay=0.2), FakeInfra("backup")
+        budget = HedgeBudget(1, 10)
+        budget._tokens = 0
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+        with mock.patch.object(LLM_Wrapper, "_hedge_delay", return_value=0.05), \
+                mock.patch.object(LLMwrapper, "hedge_slots", slots), mock.patch.object(LLMwrapper, "hedge_budget", budget):
+            start = time.monotonic()
+            response, attempt, errors = self.run_failover(attempts_for(main, backup), max_retry=1, hedge=True)
+        self.assertEqual((attempt.label, backup.calls, errors), ("Main", 0, []))
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(budget.tokens, 1)
+
+
+class TestStreaming(WrapperTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name in ("_send_api_key_usage", "_asend_api_key_usage"):
+            patch = mock.patch.object(LLM_Wrapper, name)
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def in_flight(self):
+        return self.limiter.metrics()["srcA"]["in_flight"]
+
+    def test_permit_held_until_stream_closes(self):
+        stream = LLM_Wrapper._stream_with_failover(attempts_for(StreamInfra("a", "b", "c"), FakeInfra("x")), 5, {}, 0, "")
+        self.assertEqual(next(stream), "a")
+        self.assertEqual(self.in_flight(), 1)
+        stream.close()
+        self.assertEqual(self.in_flight(), 0)
+        self.assertEqual(self.breakers.metrics(), {})
+
+    def test_async_permit_held_until_stream_closes(self):
+        async def consume():
+            stream = LLM_Wrapper._astream_with_failover(
+                attempts_for(StreamInfra("a", "b", "c"), FakeInfra("x")), 5, {}, 0, ""
+            )
+            first = await stream.__anext__()
+            held = self.in_flight()
+            rest = [token async for token in stream]
+            return first, held, rest
+
+        self.assertEqual(asyncio.run(consume()), ("a", 1, ["b", "c"]))
+        self.assertEqual(self.in_flight(), 0)
+
+
+class TestUsageRecords(WrapperTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.response = mock.Mock(status_code=201, json=mock.Mock(return_value={"revocation_epoch": None}))
+        self.client = mock.Mock(post=mock.Mock(return_value=self.response))
+        aclient = mock.Mock(post=mock.Mock(side_effect=returning(self.response)))
+        patches = [
+            mock.patch.object(LLMwrapper, "get_session", return_value=self.client),
+            mock.patch.object(LLMwrapper, "get_async_client", return_value=aclient),
+            mock.patch.object(LLMwrapper, "key_rate_limiter"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.aclient = aclient
+
+    def test_positional_signature(self):
+        """_send_api_key_usage保持原有的位置参数签名"""
+        now = datetime.now()
+        args = ("key-a", "m", "srcA", 10, 5, now, now, 0.5, True, "req-1", "remark")
+        self.assertTrue(LLM_Wrapper._send_api_key_usage(*args))
+        self.assertTrue(asyncio.run(LLM_Wrapper._asend_api_key_usage(*args)))
+        payload = self.client.post.call_args[1]["json"]
+        self.assertEqual(payload, self.aclient.post.call_args[1]["json"])
+        self.assertEqual((payload["source_name"], payload["request_id"], payload["remark"]), ("srcA", "req-1", "remark"))
+        self.assertNotIn("time_to_first_token", payload)
+
+    def test_lease_picks_reported(self):
+        """两个进程租到同一个密钥并在本地选取, 选取次数都随使用记录上报, 由密钥管理服务计入该密钥的RPM"""
+        server = KeyRateLimiter({"srcA": {"account": [{"api_key": "key-a", "rpm": 2}, {"api_key": "key-b"}]}})
+        now = datetime.now()
+        for holder in (KeyLeaseCache(ttl=60), KeyLeaseCache(ttl=60)):
+            holder.store("srcA", ["key-a"])
+            with mock.patch.object(LoadBalancing, "key_leases", holder), \
+                    mock.patch.object(LLMwrapper, "key_leases", holder):
+                self.assertEqual(LoadBalancing.Harness_localAPI._pick_leased_key("srcA"), "key-a")
+                self.assertTrue(LLM_Wrapper._send_api_key_usage("key-a", "m", "srcA", 10, 5, now, now, 0.5, True, "r"))
+            # 密钥管理服务的notice_api_key按上报的次数计入RPM
+            for source_name, picks in self.client.post.call_args[1]["json"]["lease_picks"].items():
+                for api_key, count in picks.items():
+                    server.acquire(source_name, api_key, count)
+            self.assertEqual(holder.drain_picks(), {})
+        self.assertFalse(server.has_capacity("srcA", "key-a"))
+
+    def test_lease_picks_restored_on_failure(self):
+        holder = KeyLeaseCache(ttl=60)
+        holder.record_pick("srcA", "key-a")
+        self.response.status_code = 500
+        now = datetime.now()
+        with mock.patch.object(LLMwrapper, "key_leases", holder):
+            self.assertFalse(LLM_Wrapper._send_api_key_usage("key-a", "m", "srcA", 10, 5, now, now, 0.5, True, "r"))
+        self.assertEqual(holder.drain_picks(), {"srcA": {"key-a": 1}})
+
+
+class TestTokenCharging(WrapperTestCase):
+    """请求结束后按token数而不是字符数扣除密钥的TPM限额"""
+
+    IMAGE = "A" * 400000
+
+    def setUp(self):
+        super().setUp()
+        self.infra = FakeInfra("ok")
+        config = ("srcA", "m", "key-a", "srcB", "m", "key-b")
+        balancer = mock.Mock(get_config=mock.Mock(return_value=config))
+        response = mock.Mock(status_code=201, json=mock.Mock(return_value={"revocation_epoch": None}))
+        self.limiter = KeyRateLimiter({"srcA": {"account": [{"api_key": "key-a", "tpm": 10000}]}})
+        patches = [
+            mock.patch.object(LLMwrapper, "LoadBalancing", mock.Mock(return_value=balancer)),
+            mock.patch.object(LLM_Wrapper, "_validate_model_for_generate_mm"),
+            mock.patch.object(LLM_Wrapper, "_build_mm_attempts",
+                              side_effect=lambda *args: attempts_for(self.infra, self.infra)),
+            mock.patch.object(LLMwrapper, "get_session", return_value=mock.Mock(post=mock.Mock(return_value=response))),
+            mock.patch.object(LLMwrapper, "key_rate_limiter", self.limiter),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def remaining_tokens(self):
+        return self.limiter.metrics()["srcA|key-a"]["tpm"]
+
+    def test_image_does_not_exhaust_tpm(self):
+        """没有返回用量时按估计值扣除, 不按图片base64的长度扣除"""
+        self.assertEqual(LLM_Wrapper.generate_mm("m", "describe", self.IMAGE, timeout=5), "ok")
+        self.assertTrue(self.limiter.has_capacity("srcA", "key-a"))
+        self.assertGreater(self.remaining_tokens(), 5000)
+
+    def test_provider_usage_charged(self):
+        self.infra.usage = {"prompt_tokens": 1200, "completion_tokens": 30}
+        LLM_Wrapper.generate_mm("m", "describe", self.IMAGE, timeout=5)
+        self.assertAlmostEqual(self.remaining_tokens(), 10000 - 1230, delta=1)
+
+
+class TestImageDownload(unittest.TestCase):
+
+    def test_download_bounded_by_deadline(self):
+        """预先下载图片的超时不超过整次调用的剩余时间"""
+        response = mock.Mock(content=b"img")
+        aclient = mock.Mock(get=mock.Mock(side_effect=returning(response)))
+
+        async def adownload():
+            with deadline_scope(0.5):
+                return await LLM_Wrapper._adownload_image_to_base64("http://img", 30)
+
+        with mock.patch.object(LLMwrapper.requests, "get", return_value=response) as get, \
+                mock.patch.object(LLMwrapper, "get_async_client", return_value=aclient):
+            with deadline_scope(0.5):
+                self.assertEqual(LLM_Wrapper._download_image_to_base64("http://img", 30), "aW1n")
+            self.assertEqual(asyncio.run(adownload()), "aW1n")
+        self.assertLessEqual(get.call_args[1]["timeout"], 0.5)
+        self.assertLessEqual(aclient.get.call_args[1]["timeout"], 0.5)
+
+
+class TestGenerateFailover(WrapperTestCase):
+    """generate和agenerate在主源失败时转到备用源, 并按备用源发送使用记录"""
+
+    def setUp(self):
+        super().setUp()
+        self.main, self.backup = FakeInfra(Exception("503 Server Error")), FakeInfra("ok")
+        config = ("srcA", "m", "key-a", "srcB", "m", "key-b")
+        balancer = mock.Mock(get_config=mock.Mock(return_value=config), aget_config=returning(config))
+        balancer_class = mock.Mock(return_value=balancer, acreate=returning(balancer))
+        patches = [
+            mock.patch.object(LLMwrapper, "LoadBalancing", balancer_class),
+            mock.patch.object(LLM_Wrapper, "_validate_model_for_generate"),
+            mock.patch.object(LLM_Wrapper, "_build_text_attempts",
+                              side_effect=lambda config, messages: attempts_for(self.main, self.backup)),
+            mock.patch.object(LLM_Wrapper, "_send_api_key_usage", autospec=True),
+            mock.patch.object(LLM_Wrapper, "_asend_api_key_usage", autospec=True),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def check_usage(self, sender):
+        sender.assert_called_once()
+        usage = sender.call_args[1]
+        self.assertEqual((usage["source_name"], usage["api_key"], usage["status"]), ("srcB", "key-b", True))
+
+    def test_generate(self):
+        self.assertEqual(LLM_Wrapper.generate("m", "hi", timeout=5), "ok")
+        self.assertEqual((self.main.calls, self.backup.calls), (1, 1))
+        self.check_usage(LLM_Wrapper._send_api_key_usage)
+
+    def test_agenerate(self):
+        self.assertEqual(asyncio.run(LLM_Wrapper.agenerate("m", "hi", timeout=5)), "ok")
+        self.assertEqual((self.main.calls, self.backup.calls), (1, 1))
+        self.check_usage(LLM_Wrapper._asend_api_key_usage)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import LoadBalancing
+from LoadBalancing import LoadBalancing as Balancer, Harness_localAPI
+from ew_router.key_lease import KeyLeaseCache
+from ew_router.rate_limit import KeyRateLimiter
+
+
+class FakeResponse:
+    """只实现用到的接口的HTTP响应"""
+
+    def __init__(self, payload, status_code=200):
+        self.payload = payload
+        self.status_code = status_code
+
+    def json(self):
+        return self.payload
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"{self.status_code} Client Error")
+
+
+class FakeKeyManager:
+    """记录请求的密钥管理服务, 同时提供同步和异步接口"""
+
+    def __init__(self, api_keys=("key-1", "key-2", "key-3"), lease=True):
+        self.api_keys = list(api_keys)
+        self.lease = lease
+        self.requests = []
+
+    def post(self, url, json=None, timeout=None):
+        self.requests.append((url, json))
+        if url.endswith(LoadBalancing.API_KEY_MANAGER_LEASE_ENDPOINT):
+            if not self.lease:
+                return FakeResponse({"detail": "Not Found"}, 404)
+            return FakeResponse({"api_keys": self.api_keys, "revocation_epoch": 0})
+        return FakeResponse({"api_key": self.api_keys[0]})
+
+    async def apost(self, url, json=None, timeout=None):
+        return self.post(url, json, timeout)
+
+
+class LoadBalancingTestCase(unittest.TestCase):
+    """每个用例使用全新的租约缓存和限流器, 密钥管理服务由FakeKeyManager代替"""
+
+    def setUp(self):
+        self.manager = FakeKeyManager()
+        client = mock.Mock(post=self.manager.apost)
+        patches = [
+            mock.patch.object(LoadBalancing, "key_leases", KeyLeaseCache(ttl=60)),
+            mock.patch.object(LoadBalancing, "key_rate_limiter", KeyRateLimiter({})),
+            mock.patch.object(LoadBalancing.requests, "post", self.manager.post),
+            mock.patch.object(LoadBalancing, "get_async_client", return_value=client),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def get_api_key(self, source_name, affinity_key=None, is_async=False):
+        if is_async:
+            return asyncio.run(Harness_localAPI.aget_api_key(source_name, affinity_key))
+        return Harness_localAPI.get_api_key(source_name, affinity_key)
+
+
+class TestKeyAffinity(LoadBalancingTestCase):
+
+    def test_affinity_bypasses_lease(self):
+        """亲和请求由密钥管理服务在所有健康的密钥上固定, 不在本进程租到的密钥上选择"""
+        for is_async in (False, True):
+            with self.subTest(is_async=is_async):
+                self.manager.requests.clear()
+                self.get_api_key("srcA", is_async=is_async)
+                self.get_api_key("srcA", "prefix", is_async=is_async)
+                self.get_api_key("srcA", "prefix", is_async=is_async)
+                affinity_requests = [body for url, body in self.manager.requests
+                                     if url.endswith(LoadBalancing.API_KEY_MANAGER_GET_ENDPOINT)]
+                self.assertEqual(affinity_requests, [{"source_name": "srcA", "affinity_key": "prefix"}] * 2)
+
+    def test_lease_reused_without_affinity(self):
+        for _ in range(3):
+            self.get_api_key("srcA")
+        self.assertEqual(len(self.manager.requests), 1)
+
+
+class TestKeyLease(LoadBalancingTestCase):
+
+    def test_unsupported_lease_remembered(self):
+        """旧版本的密钥管理服务不支持租约时只尝试一次, 之后直接获取单个密钥"""
+        self.manager.lease = False
+        for is_async in (False, True):
+            for _ in range(3):
+                self.assertEqual(self.get_api_key("srcA", is_async=is_async), "key-1")
+        endpoints = [url for url, _ in self.manager.requests]
+        self.assertEqual(len(endpoints), 7)
+        self.assertEqual(sum(url.endswith(LoadBalancing.API_KEY_MANAGER_LEASE_ENDPOINT) for url in endpoints), 1)
+
+
+
+class TestFrontSelection(unittest.TestCase):
+    RANKED = [("m1", "srcA", "a-m1"), ("m2", "srcA", "a-m2"), ("m1", "srcB", "b-m1"), ("m1", "srcC", "c-m1"),
+              ("m2", "srcD", "d-m2")]
+
+    def setUp(self):
+        self.fetched = []
+        self.balancer = Balancer(healthy={})
+        patch = mock.patch.object(Balancer, "_rank_best_from_batch", return_value=self.RANKED)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def get_api_key(self, source_name):
+        self.fetched.append(source_name)
+        if source_name == "srcB":
+            raise Exception("no key")
+        return f"key-{source_name}"
+
+    async def aget_api_key(self, source_name):
+        return self.get_api_key(source_name)
+
+    def test_keys_fetched_once_per_source(self):
+        with mock.patch.object(Harness_localAPI, "get_api_key", self.get_api_key):
+            front = self.balancer.select_the_front_fromAbatch(["m1", "m2"], size=4)
+        self.assertEqual([(source, key) for _, source, _, key in front],
+                         [("srcA", "key-srcA"), ("srcA", "key-srcA"), ("srcC", "key-srcC"), ("srcD", "key-srcD")])
+        self.assertEqual(self.fetched, ["srcA", "srcB", "srcC", "srcD"])
+
+    def test_async_front_matches_sync(self):
+        with mock.patch.object(Harness_localAPI, "get_api_key", self.get_api_key):
+            expected = self.balancer.select_the_front_fromAbatch(["m1", "m2"], size=3)
+        self.fetched.clear()
+        with mock.patch.object(Harness_localAPI, "aget_api_key", self.aget_api_key):
+            front = asyncio.run(self.balancer.aselect_the_front_fromAbatch(["m1", "m2"], size=3))
+        self.assertEqual(front, expected)
+        self.assertEqual(sorted(self.fetched), ["srcA", "srcB", "srcC"])
+
+
+if __name__ == "__main__":
+    unittest.main()